@@ -0,0 +1,114 @@
+"""Benchmark of the parallel scanner against os.walk.
+
+The trees of the benchmark scenarios are generated, or an existing directory is given, then walked with os.walk and
+os.lstat, as a single threaded scan would, and with the scanner using an increasing number of threads. A tree generated
+in /dev/shm is in memory: give a directory on a disk or a network mount, with a cold cache, to measure the latency the
+threads hide.
+
+Run it from the backup_to_harddrive directory:
+python benchmarks/benchmark_scanner.py [--scale 0.1] [--source /home/foo] [--threads 1 --threads 8]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from run_benchmarks import SCENARIOS, SOURCE_DIRECTORY, get_default_work_directory
+
+sys.path.insert(0, str(SOURCE_DIRECTORY))
+# pylint: disable=(wrong-import-position, wrong-import-order)
+from backup_to_harddrive.scanner import SCANNER_THREADS, scan_files  # noqa: E402
+
+
+def walk_with_os_walk(source_path: Path) -> int:
+    """Walk a tree with os.walk and get the metadata of each file.
+
+    Args:
+        source_path [Path]: The tree.
+    Returns:
+        int: The number of files.
+    """
+    number_of_files = 0
+    for directory, _, file_names in os.walk(source_path):
+        for name in file_names:
+            os.lstat(os.path.join(directory, name))
+            number_of_files += 1
+    return number_of_files
+
+
+def measure(walk: Callable[[], int]) -> float:
+    """Measure the wall time of a walk, the best of three.
+
+    Args:
+        walk [Callable[[], int]]: The walk.
+    Returns:
+        float: The wall time in seconds.
+    """
+    wall_times = []
+    for _ in range(3):
+        start = time.perf_counter()
+        walk()
+        wall_times.append(time.perf_counter() - start)
+    return min(wall_times)
+
+
+def print_benchmark_of(source_path: Path, threads_list: List[int]) -> None:
+    """Print the wall time and files/s of os.walk and of the scanner on a tree.
+
+    Args:
+        source_path [Path]: The tree.
+        threads_list [List[int]]: The numbers of threads of the scanner to measure.
+    """
+    number_of_files = walk_with_os_walk(source_path)
+    print(f"{str(source_path)}: {number_of_files} files")
+    print(f"{'walk':<20} {'wall (s)':>10} {'files/s':>12} {'speedup':>8}")
+    reference = measure(lambda: walk_with_os_walk(source_path))
+    print(f"{'os.walk':<20} {reference:>10.3f} {number_of_files / reference:>12.0f} {1:>8.2f}")
+    for threads in threads_list:
+        wall_seconds = measure(lambda threads=threads: sum(1 for _ in scan_files(source_path, [], threads)))
+        print(
+            f"{f'scanner {threads} threads':<20} {wall_seconds:>10.3f} {number_of_files / wall_seconds:>12.0f} "
+            f"{reference / wall_seconds:>8.2f}"
+        )
+
+
+def main(arguments: Optional[List[str]] = None) -> int:
+    """Run the benchmark of the scanner.
+
+    Args:
+        arguments [Optional[List[str]]]: The arguments, None for the ones of the command line.
+    Returns:
+        int: 0.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the parallel scanner against os.walk")
+    parser.add_argument("--source", help="Existing directory to walk instead of the scenarios", type=Path)
+    parser.add_argument("--scale", help="Scale of the generated trees", type=float, default=1.0)
+    parser.add_argument("--seed", help="Seed of the generated trees", type=int, default=0)
+    parser.add_argument("--threads", help="Number of threads of the scanner", type=int, action="append")
+    parser.add_argument("--work-dir", help="Where to generate the trees, a tmpfs or loopback mount", default=None)
+    options = parser.parse_args(arguments)
+    threads_list = options.threads or sorted({1, 4, SCANNER_THREADS})
+    if options.source is not None:
+        print_benchmark_of(options.source, threads_list)
+        return 0
+    work_path = Path(
+        tempfile.mkdtemp(prefix="scanner_benchmark_", dir=options.work_dir or get_default_work_directory())
+    )
+    try:
+        for name, generate in SCENARIOS.items():
+            if name != "large_files":
+                generate(work_path / name, random.Random(f"{name}-{options.seed}"), options.scale)
+                print_benchmark_of(work_path / name, threads_list)
+    finally:
+        shutil.rmtree(work_path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,381 @@
+"""Benchmarks of the backup pipeline on reproducible synthetic sources.
+
+Each scenario generates a source tree from a seeded random generator, backs it up end to end with
+run_backup_from_config_file to a local target directory, applies a reproducible churn (modified, deleted and new
+files) and backs it up again. Each backup runs in a child process with its own configuration directory, so that its
+wall time, throughput and peak RSS (the one of the child or of the largest rsync it waited for) are measured alone.
+
+The results are compared with a stored baseline, a run slower than the baseline by more than the tolerance fails.
+
+Run it from the backup_to_harddrive directory:
+python benchmarks/run_benchmarks.py [--scale 0.1] [--backend native] [--save-baseline]
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import yaml
+
+BENCHMARKS_DIRECTORY = Path(__file__).absolute().parent
+DEFAULT_BASELINE_PATH = BENCHMARKS_DIRECTORY / "baseline.json"
+SOURCE_DIRECTORY = BENCHMARKS_DIRECTORY.parent / "src"
+BLOCK_SIZE = 1024 * 1024
+GENERATED_MTIME = 1_600_000_000
+CHURNED_MTIME = 1_700_000_000
+CHURN_FRACTIONS = {"modified": 0.05, "deleted": 0.02, "added": 0.05}
+
+
+@dataclass
+class Measurement:
+    """Measurement of a single backup run."""
+
+    wall_seconds: float
+    bytes_transferred: int
+    files_transferred: int
+    peak_rss_kib: int
+    complete: bool
+
+    @property
+    def bytes_per_second(self) -> float:
+        """Get the throughput in bytes."""
+        return self.bytes_transferred / self.wall_seconds if self.wall_seconds else 0.0
+
+    @property
+    def files_per_second(self) -> float:
+        """Get the throughput in files."""
+        return self.files_transferred / self.wall_seconds if self.wall_seconds else 0.0
+
+
+def write_file(file_path: Path, size: int, rng: random.Random, mtime: int) -> None:
+    """Write a file of random content with a fixed modification time.
+
+    Args:
+        file_path [Path]: The file to write.
+        size [int]: Size of the file in bytes.
+        rng [Random]: The seeded random generator.
+        mtime [int]: Modification time of the file, in seconds.
+    """
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(file_path, "wb") as file:
+        for offset in range(0, size, BLOCK_SIZE):
+            file.write(rng.randbytes(min(BLOCK_SIZE, size - offset)))
+    os.utime(file_path, (mtime, mtime))
+
+
+def generate_small_files(source_path: Path, rng: random.Random, scale: float) -> None:
+    """Generate many small files, 100 per directory.
+
+    Args:
+        source_path [Path]: The source directory.
+        rng [Random]: The seeded random generator.
+        scale [float]: Scale of the scenario, 1.0 for 20000 files.
+    """
+    for index in range(max(1, int(20000 * scale))):
+        write_file(
+            source_path / f"dir{index // 100:04d}" / f"file{index:06d}.dat", rng.randint(1, 16384), rng, GENERATED_MTIME
+        )
+
+
+def generate_large_files(source_path: Path, rng: random.Random, scale: float) -> None:
+    """Generate a few huge files.
+
+    Args:
+        source_path [Path]: The source directory.
+        rng [Random]: The seeded random generator.
+        scale [float]: Scale of the scenario, 1.0 for 4 files of 256 MiB.
+    """
+    for index in range(4):
+        write_file(source_path / f"large{index}.bin", max(1, int(256 * BLOCK_SIZE * scale)), rng, GENERATED_MTIME)
+
+
+def generate_deep_tree(source_path: Path, rng: random.Random, scale: float) -> None:
+    """Generate deep chains of directories, with a file at each level.
+
+    Args:
+        source_path [Path]: The source directory.
+        rng [Random]: The seeded random generator.
+        scale [float]: Scale of the scenario, 1.0 for 40 chains of 50 levels.
+    """
+    for chain in range(max(1, int(40 * scale))):
+        directory = source_path / f"chain{chain:03d}"
+        for level in range(50):
+            directory = directory / f"level{level:02d}"
+            write_file(directory / "file.dat", rng.randint(1, 4096), rng, GENERATED_MTIME)
+
+
+def generate_mixed_tree(source_path: Path, rng: random.Random, scale: float) -> None:
+    """Generate a home directory like mix of small files, deep trees and large files.
+
+    Args:
+        source_path [Path]: The source directory.
+        rng [Random]: The seeded random generator.
+        scale [float]: Scale of the scenario.
+    """
+    generate_small_files(source_path / "documents", rng, scale / 4)
+    generate_deep_tree(source_path / "projects", rng, scale / 4)
+    generate_large_files(source_path / "videos", rng, scale / 4)
+
+
+SCENARIOS: Dict[str, Callable[[Path, random.Random, float], None]] = {
+    "small_files": generate_small_files,
+    "large_files": generate_large_files,
+    "deep_tree": generate_deep_tree,
+    "mixed": generate_mixed_tree,
+}
+
+
+def apply_churn_to(source_path: Path, rng: random.Random) -> None:
+    """Modify, delete and add files of a source, the same ones for a given seed.
+
+    Args:
+        source_path [Path]: The source directory.
+        rng [Random]: The seeded random generator.
+    """
+    files = sorted(path for path in source_path.rglob("*") if path.is_file())
+    modified = rng.sample(files, int(len(files) * CHURN_FRACTIONS["modified"]))
+    deleted = rng.sample(sorted(set(files) - set(modified)), int(len(files) * CHURN_FRACTIONS["deleted"]))
+    for file_path in modified:
+        write_file(file_path, min(file_path.stat().st_size, 16 * BLOCK_SIZE), rng, CHURNED_MTIME)
+    for file_path in deleted:
+        file_path.unlink()
+    for index, file_path in enumerate(rng.sample(files, int(len(files) * CHURN_FRACTIONS["added"]))):
+        write_file(file_path.parent / f"added{index:06d}.dat", rng.randint(1, 65536), rng, CHURNED_MTIME)
+
+
+def write_config_file(config_home: Path, source_path: Path, target_path: Path, settings: Dict[str, object]) -> None:
+    """Write the configuration file of a benchmark run.
+
+    Args:
+        config_home [Path]: The directory used as XDG_CONFIG_HOME by the child process.
+        source_path [Path]: The source directory.
+        target_path [Path]: The directory standing for the harddrive.
+        settings [Dict[str, object]]: The optional settings of the backup configuration.
+    """
+    config = {
+        "backup_configurations": {
+            "benchmark": {"source": str(source_path), "list_of_harddrive": [str(target_path)], **settings}
+        }
+    }
+    config_path = config_home / "backup_to_harddrive" / "config.yaml"
+    config_path.parent.mkdir(parents=True, exist_ok=True)
+    config_path.write_text(yaml.safe_dump(config), encoding="utf-8")
+
+
+def run_child() -> int:
+    """Run a backup from the configuration file and print its measurement as JSON.
+
+    Returns:
+        int: 0, the completeness of the backup is part of the measurement.
+    """
+    # pylint: disable=import-outside-toplevel
+    from backup_to_harddrive.backup_from_config import (
+        path_to_backup_within_harddrive,
+        run_backup_from_config_file,
+    )
+    from backup_to_harddrive.config import extract_valid_configuration_from_config_file
+    from backup_to_harddrive.run_report import (
+        get_path_to_run_reports,
+        read_last_run_reports,
+    )
+
+    start = time.perf_counter()
+    complete = run_backup_from_config_file()
+    wall_seconds = time.perf_counter() - start
+    sources = [
+        source
+        for backup_config in extract_valid_configuration_from_config_file().backup_configs
+        for harddrive in backup_config.list_of_harddrive
+        for report in read_last_run_reports(get_path_to_run_reports(path_to_backup_within_harddrive(harddrive)), 1)
+        for source in report.get("sources", [])
+    ]
+    measurement = Measurement(
+        wall_seconds=round(wall_seconds, 3),
+        bytes_transferred=sum(source.get("bytes_transferred", 0) for source in sources),
+        files_transferred=sum(source.get("files_transferred", 0) for source in sources),
+        peak_rss_kib=max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        ),
+        complete=complete,
+    )
+    print(json.dumps(asdict(measurement)))
+    return 0
+
+
+def measure_backup(work_path: Path) -> Measurement:
+    """Run a backup in a child process using the configuration of a work directory.
+
+    Args:
+        work_path [Path]: The work directory, holding the configuration and cache directories of the child.
+    Returns:
+        Measurement: The measurement of the backup.
+    """
+    environment = dict(os.environ)
+    environment["XDG_CONFIG_HOME"] = str(work_path / "config")
+    environment["XDG_CACHE_HOME"] = str(work_path / "cache")
+    environment["PYTHONPATH"] = os.pathsep.join(filter(None, [str(SOURCE_DIRECTORY), os.environ.get("PYTHONPATH")]))
+    result = subprocess.run(
+        [sys.executable, str(Path(__file__).absolute()), "--child"],
+        env=environment,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return Measurement(**json.loads(result.stdout.decode("utf-8").splitlines()[-1]))
+
+
+def run_scenario(name: str, work_path: Path, options: argparse.Namespace) -> Dict[str, Measurement]:
+    """Generate the source of a scenario, back it up, apply the churn and back it up again.
+
+    Args:
+        name [str]: The name of the scenario.
+        work_path [Path]: The work directory of the scenario.
+        options [Namespace]: The parsed command line options.
+    Returns:
+        Dict[str, Measurement]: The measurements of the full and of the churn runs, indexed by <scenario>/<run>.
+    """
+    rng = random.Random(f"{name}-{options.seed}")
+    source_path = work_path / "source" / name
+    target_path = work_path / "target"
+    target_path.mkdir(parents=True)
+    SCENARIOS[name](source_path, rng, options.scale)
+    write_config_file(work_path / "config", source_path, target_path, get_settings_of(options))
+    measurements = {f"{name}/full": measure_backup(work_path)}
+    apply_churn_to(source_path, rng)
+    measurements[f"{name}/churn"] = measure_backup(work_path)
+    return measurements
+
+
+def get_settings_of(options: argparse.Namespace) -> Dict[str, object]:
+    """Get the optional settings of the backup configuration from the command line options.
+
+    Args:
+        options [Namespace]: The parsed command line options.
+    Returns:
+        Dict[str, object]: The settings, as written in the configuration file.
+    """
+    return {
+        "backend": options.backend,
+        "target_format": options.target_format,
+        "shards": options.shards,
+        "incremental_manifest": options.incremental_manifest,
+    }
+
+
+def get_default_work_directory() -> str:
+    """Get the directory holding the generated trees: /dev/shm (tmpfs) if available, the temporary directory otherwise.
+
+    Returns:
+        str: The directory.
+    """
+    if os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def compare_with_baseline(
+    measurements: Dict[str, Measurement], baseline: Optional[dict], tolerance: float
+) -> List[str]:
+    """Print the measurements next to the baseline and list the regressions.
+
+    Args:
+        measurements [Dict[str, Measurement]]: The measurements, indexed by <scenario>/<run>.
+        baseline [Optional[dict]]: The baseline file content, None if there is none.
+        tolerance [float]: Accepted relative increase of the wall time.
+    Returns:
+        List[str]: The names of the runs slower than the baseline by more than the tolerance, or incomplete.
+    """
+    baseline_measurements = (baseline or {}).get("measurements", {})
+    regressions = []
+    print(f"{'run':<20} {'wall (s)':>10} {'MB/s':>10} {'files/s':>10} {'peak RSS (MiB)':>15} {'vs baseline':>12}")
+    for name, measurement in measurements.items():
+        reference = baseline_measurements.get(name)
+        change = ""
+        if reference is not None and reference["wall_seconds"] > 0:
+            ratio = measurement.wall_seconds / reference["wall_seconds"] - 1
+            change = f"{ratio:+.1%}"
+            if ratio > tolerance:
+                regressions.append(name)
+        if not measurement.complete:
+            regressions.append(name)
+            change += " INCOMPLETE"
+        print(
+            f"{name:<20} {measurement.wall_seconds:>10.3f} {measurement.bytes_per_second / 1e6:>10.1f} "
+            f"{measurement.files_per_second:>10.0f} {measurement.peak_rss_kib / 1024:>15.1f} {change:>12}"
+        )
+    return regressions
+
+
+def parse_arguments(arguments: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse the command line.
+
+    Args:
+        arguments [Optional[List[str]]]: The arguments, None for the ones of the command line.
+    Returns:
+        Namespace: The options.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the backup pipeline on synthetic sources")
+    parser.add_argument("--scenario", help="Scenario to run, all by default", action="append", choices=SCENARIOS)
+    parser.add_argument("--scale", help="Scale of the generated sources", type=float, default=1.0)
+    parser.add_argument("--seed", help="Seed of the generated sources and churn", type=int, default=0)
+    parser.add_argument("--backend", choices=["rsync", "native"], default="rsync")
+    parser.add_argument("--target-format", choices=["directory", "dedup"], default="directory")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--incremental-manifest", action="store_true")
+    parser.add_argument("--work-dir", help="Where to generate the trees, a tmpfs or loopback mount", default=None)
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE_PATH)
+    parser.add_argument("--save-baseline", help="Store the measurements as the new baseline", action="store_true")
+    parser.add_argument("--tolerance", help="Accepted increase of the wall time", type=float, default=0.10)
+    parser.add_argument("--child", help=argparse.SUPPRESS, action="store_true")
+    return parser.parse_args(arguments)
+
+
+def main(arguments: Optional[List[str]] = None) -> int:
+    """Run the benchmarks and compare them with the baseline.
+
+    Args:
+        arguments [Optional[List[str]]]: The arguments, None for the ones of the command line.
+    Returns:
+        int: 0 if no run regressed, 1 otherwise.
+    """
+    options = parse_arguments(arguments)
+    if options.child:
+        return run_child()
+    settings = {"scale": options.scale, "seed": options.seed, **get_settings_of(options)}
+    work_path = Path(tempfile.mkdtemp(prefix="backup_benchmark_", dir=options.work_dir or get_default_work_directory()))
+    measurements: Dict[str, Measurement] = {}
+    try:
+        for name in options.scenario or list(SCENARIOS):
+            measurements.update(run_scenario(name, work_path / name, options))
+    finally:
+        shutil.rmtree(work_path)
+    try:
+        baseline = json.loads(options.baseline.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        baseline = None
+    if baseline is not None and baseline.get("settings") != settings:
+        print(f"Baseline settings {baseline.get('settings')} differ from {settings}, not compared.")
+        baseline = None
+    regressions = compare_with_baseline(measurements, baseline, options.tolerance)
+    if options.save_baseline:
+        content = {"settings": settings, "measurements": {name: asdict(value) for name, value in measurements.items()}}
+        options.baseline.write_text(json.dumps(content, indent=2) + "\n", encoding="utf-8")
+        print(f"Baseline saved to {options.baseline}")
+        return 0
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,28 +1,108 @@
 """Module that backups file based on backup configurations."""
 
+# pylint: disable=(too-many-lines)
+
 import datetime
+import hashlib
 import logging
 import os
+import shlex
 import socket
-import subprocess
+import sys
 from pathlib import Path
-from typing import List
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+from platformdirs import user_cache_dir
 
 # from backup_to_harddrive.backup import RSYNC_OPTIONS
+from backup_to_harddrive.block_sync import (
+    get_max_size_options_of,
+    get_path_to_block_maps,
+)
+from backup_to_harddrive.catalog import add_run_to_catalog_of
+from backup_to_harddrive.change_journal import get_live_manifest_of
 from backup_to_harddrive.config import (
     BackupConfig,
     RunConfig,
     extract_valid_configuration_from_config_file,
 )
+from backup_to_harddrive.dedup_store import (
+    STORE_DIRECTORY_NAME,
+    get_latest_run_manifest_of,
+    get_path_to_run_manifest,
+    get_path_to_store,
+    read_store_manifest,
+)
+from backup_to_harddrive.filters import (
+    Exclusions,
+    as_exclusion_filter,
+    escape_glob,
+    get_exclusion_filter_of,
+    get_filter_options_of,
+)
+from backup_to_harddrive.manifest import (
+    Manifest,
+    add_digests_to,
+    get_changed_and_deleted_paths,
+    get_path_to_manifest,
+    read_manifest,
+    write_manifest,
+)
+from backup_to_harddrive.preflight import (
+    DriveCheck,
+    TransferPlan,
+    check_harddrive,
+    get_device_of,
+    get_jobs_in_plan_order,
+    get_transfer_plan,
+    skip_failed_harddrives_of,
+)
+from backup_to_harddrive.run_journal import (
+    add_journal_recording_to,
+    get_path_to_run_journal,
+    get_unfinished_jobs,
+    read_run_journal,
+    remove_run_journal,
+    start_run_journal,
+)
+from backup_to_harddrive.run_report import (
+    append_run_report,
+    get_path_to_run_reports,
+    get_run_history,
+    get_run_reports_of,
+)
+from backup_to_harddrive.scan_cache import (
+    get_cached_scan_of_backup,
+    get_cached_scan_of_source,
+    remove_cached_scans_of,
+)
+from backup_to_harddrive.scheduler import (
+    BackupJob,
+    JobLimits,
+    run_jobs_with_device_limits,
+)
+from backup_to_harddrive.sharding import get_weights_of, split_into_shards
+from backup_to_harddrive.snapshot import (
+    get_latest_complete_snapshot_of,
+    get_latest_snapshot_link_of,
+    get_snapshot_name,
+    mark_snapshot_as_complete,
+    prune_snapshots_of,
+)
+from backup_to_harddrive.telemetry import get_telemetry_sink_for
+from backup_to_harddrive.throttle import get_prioritized_command
 
+PARTIAL_DIR = ".rsync-partial"
 RSYNC_OPTIONS = [
     "-av",
     "--mkpath",
     "--delete",
     "--delete-before",
     "--update",
-    "--progress",
+    "--info=progress2",
+    "--stats",
     "-h",
+    f"--partial-dir={PARTIAL_DIR}",
 ]
 
 
@@ -45,76 +125,920 @@ def path_to_backup_within_harddrive(harddrive_path: Path) -> Path:
     return harddrive_path.absolute() / "Backup" / socket.gethostname()
 
 
-def get_rsync_command_for(source_path: Path, harddrive_path: Path, excluded_path_list: List[Path]) -> List[str]:
+def get_snapshot_options_and_destination_for(
+    source_path: Path, harddrive_path: Path, snapshot_name: Optional[str]
+) -> Tuple[List[str], str]:
+    """Get the rsync options and the destination directory to backup a source to a harddrive.
+
+    In snapshot mode, the destination is a new snapshot directory and unchanged files are hard linked to the latest
+    complete snapshot of the source.
+
+    Args:
+        source_path [Path]: The source directory to backup.
+        harddrive_path [Path]: The destination directory to backup to.
+        snapshot_name [Optional[str]]: Name of the snapshot directory, None when not in snapshot mode.
+    """
+    backup_path = path_to_backup_within_harddrive(harddrive_path)
+    if snapshot_name is None:
+        return [], str(backup_path)
+    previous_snapshot = get_latest_complete_snapshot_of(backup_path, source_path.absolute().name)
+    options = [] if previous_snapshot is None else [f"--link-dest={str(previous_snapshot)}"]
+    return options, str(backup_path / snapshot_name)
+
+
+def get_rsync_transfer_command(options: List[str], source: str, destination: str) -> List[str]:
+    """Get the command that copies a directory into another one with rsync.
+
+    Args:
+        options [List[str]]: The --filter and --link-dest options.
+        source [str]: The directory to copy.
+        destination [str]: The directory to copy into.
+    """
+    return ["rsync"] + RSYNC_OPTIONS + options + [source, destination]
+
+
+def get_native_transfer_command(options: List[str], source: str, destination: str) -> List[str]:
+    """Get the command that copies a directory into another one with the native copy engine.
+
+    Args:
+        options [List[str]]: The --exclude-from and --link-dest options.
+        source [str]: The directory to copy.
+        destination [str]: The directory to copy into.
+    """
+    return (
+        [sys.executable, "-m", "backup_to_harddrive.native_copy", "--delete", "--update"]
+        + options
+        + [source, destination]
+    )
+
+
+TRANSFER_BACKENDS: Dict[str, Callable[[List[str], str, str], List[str]]] = {
+    "rsync": get_rsync_transfer_command,
+    "native": get_native_transfer_command,
+}
+
+
+def get_rsync_command_for(  # pylint: disable=(too-many-positional-arguments)
+    source_path: Path,
+    harddrive_path: Path,
+    excluded_path_list: Exclusions,
+    snapshot_name: Optional[str] = None,
+    backend: str = "rsync",
+    large_file_size: int = 0,
+) -> List[str]:
     """Get the rsync command to run.
 
     Args:
         source_path [Path]: The source directory to backup.
         harddrive_path [Path]: The destination directory to backup to.
-        excluded_path_list [List]: List of excluded paths.
+        excluded_path_list [Exclusions]: The exclusion rules, or the absolute paths of the excluded folders.
+        snapshot_name [Optional[str]]: Name of the snapshot directory, None when not in snapshot mode.
+        backend [str]: The transfer backend, a key of TRANSFER_BACKENDS.
+        large_file_size [int]: Size, in bytes, from which the files are left to the block-level transfer, 0 for none.
+    """
+    snapshot_options, destination = get_snapshot_options_and_destination_for(source_path, harddrive_path, snapshot_name)
+    return TRANSFER_BACKENDS[backend](
+        snapshot_options
+        + get_max_size_options_of(large_file_size)
+        + get_filter_options_of(
+            as_exclusion_filter(source_path, excluded_path_list), backend, anchor=source_path.absolute().name
+        ),
+        str(source_path.absolute()),
+        destination,
+    )
+
+
+def get_rsync_seed_command_for(
+    source_path: Path,
+    seed_harddrive_path: Path,
+    harddrive_path: Path,
+    snapshot_name: Optional[str] = None,
+    backend: str = "rsync",
+) -> List[str]:
+    """Get the rsync command that copies the backup of a source from one harddrive to another one.
+
+    Args:
+        source_path [Path]: The source directory that was backed up.
+        seed_harddrive_path [Path]: The harddrive that already holds an up to date backup of the source.
+        harddrive_path [Path]: The destination harddrive.
+        snapshot_name [Optional[str]]: Name of the snapshot directory, None when not in snapshot mode.
+        backend [str]: The transfer backend, a key of TRANSFER_BACKENDS.
+    """
+    seed_path = path_to_backup_within_harddrive(seed_harddrive_path)
+    if snapshot_name is not None:
+        seed_path = seed_path / snapshot_name
+    snapshot_options, destination = get_snapshot_options_and_destination_for(source_path, harddrive_path, snapshot_name)
+    return TRANSFER_BACKENDS[backend](snapshot_options, str(seed_path / source_path.absolute().name), destination)
+
+
+def get_rsync_shard_command_for(
+    source_path: Path, harddrive_path: Path, excluded_path_list: Exclusions, directory_names: List[str]
+) -> List[str]:
+    """Get the rsync command that only transfers some top-level directories of a source.
+
+    The other top-level entries are excluded, which also protects them from --delete.
+
+    Args:
+        source_path [Path]: The source directory to backup.
+        harddrive_path [Path]: The destination directory to backup to.
+        excluded_path_list [Exclusions]: The exclusion rules, or the absolute paths of the excluded folders.
+        directory_names [List[str]]: Names of the top-level directories of the shard.
     """
+    source_name = source_path.absolute().name
     return (
         ["rsync"]
         + RSYNC_OPTIONS
-        + [f"--exclude={str(excluded_path.absolute())}" for excluded_path in excluded_path_list]
-        + [str(source_path.absolute()), str(path_to_backup_within_harddrive(harddrive_path))]
+        + get_filter_options_of(as_exclusion_filter(source_path, excluded_path_list), "rsync", anchor=source_name)
+        + [
+            f"--include={escape_glob(f'/{source_name}/{name}', is_within_wildcards=True)}/***"
+            for name in directory_names
+        ]
+        + [
+            f"--exclude={escape_glob(f'/{source_name}', is_within_wildcards=True)}/*",
+            str(source_path.absolute()),
+            str(path_to_backup_within_harddrive(harddrive_path)),
+        ]
+    )
+
+
+def get_rsync_top_level_command_for(
+    source_path: Path, harddrive_path: Path, excluded_path_list: Exclusions
+) -> List[str]:
+    """Get the rsync command that transfers the top level of a source without recursing into its directories.
+
+    It copies the top-level files and deletes the top-level entries that no longer exist in the source, which the
+    shards cannot do as each of them excludes the entries of the other ones.
+
+    Args:
+        source_path [Path]: The source directory to backup.
+        harddrive_path [Path]: The destination directory to backup to.
+        excluded_path_list [Exclusions]: The exclusion rules, or the absolute paths of the excluded folders.
+    """
+    return (
+        ["rsync", "-dlptgoDv"]
+        + [option for option in RSYNC_OPTIONS if option != "-av"]
+        + get_filter_options_of(as_exclusion_filter(source_path, excluded_path_list), "rsync")
+        + [
+            str(source_path.absolute()) + os.sep,
+            str(path_to_backup_within_harddrive(harddrive_path) / source_path.absolute().name),
+        ]
+    )
+
+
+def get_sharded_backup_jobs_for(
+    backup_config: BackupConfig, harddrive: Path, shards: List[List[str]]
+) -> List[BackupJob]:
+    """Get the parallel jobs that backup a source split into shards to a harddrive.
+
+    Args:
+        backup_config [BackupConfig]: The backup configuration.
+        harddrive [Path]: The destination harddrive.
+        shards [List[List[str]]]: Names of the top-level directories of each shard.
+    """
+    stream_group = f"{str(backup_config.source.absolute())}:{str(harddrive.absolute())}"
+    exclusion_filter = get_exclusion_filter_of(backup_config)
+    commands = [get_rsync_top_level_command_for(backup_config.source, harddrive, exclusion_filter)] + [
+        get_rsync_shard_command_for(backup_config.source, harddrive, exclusion_filter, shard) for shard in shards
+    ]
+    return [
+        BackupJob(command=command, source=backup_config.source, harddrive=harddrive, stream_group=stream_group)
+        for command in commands
+    ]
+
+
+def get_dedup_store_command_for(backup_config: BackupConfig, harddrive: Path, run_name: str) -> List[str]:
+    """Get the command that backups a source to the deduplicating store of a harddrive.
+
+    Args:
+        backup_config [BackupConfig]: The backup configuration.
+        harddrive [Path]: The destination harddrive.
+        run_name [str]: Name of the run, used to name its manifest.
+    """
+    backup_path = path_to_backup_within_harddrive(harddrive)
+    source_name = backup_config.source.absolute().name
+    previous_manifest = get_latest_run_manifest_of(backup_path, source_name)
+    return (
+        [sys.executable, "-m", "backup_to_harddrive.dedup_store", "backup"]
+        + get_filter_options_of(get_exclusion_filter_of(backup_config), "dedup")
+        + ([] if previous_manifest is None else [f"--previous={str(previous_manifest)}"])
+        + ([] if backup_config.compression == "none" else [f"--compression={backup_config.compression}"])
+        + (["--pack"] if backup_config.pack_small_files else [])
+        + [
+            str(backup_config.source.absolute()),
+            str(get_path_to_store(harddrive)),
+            str(get_path_to_run_manifest(backup_path, run_name, source_name)),
+        ]
+    )
+
+
+def get_dedup_store_compaction_job_for(harddrive: Path, backup_job_index: int) -> BackupJob:
+    """Get the job that merges the small segments of the store of a harddrive, once a backup to it succeeded.
+
+    Args:
+        harddrive [Path]: The harddrive.
+        backup_job_index [int]: Index, in the list of all jobs of the run, of the backup to the store.
+    """
+    store_path = get_path_to_store(harddrive)
+    return BackupJob(
+        command=[sys.executable, "-m", "backup_to_harddrive.dedup_store", "compact", str(store_path)],
+        source=store_path,
+        harddrive=harddrive,
+        depends_on=backup_job_index,
+    )
+
+
+def get_block_sync_jobs_for(
+    backup_config: BackupConfig, jobs: List[BackupJob], first_job_index: int
+) -> List[BackupJob]:
+    """Get the jobs that write the changed blocks of the large files of a source, once the rest of it is transferred.
+
+    A harddrive without transfer job, as nothing changed in the manifest, still gets its job so that a large file
+    whose previous transfer failed is caught up.
+
+    Args:
+        backup_config [BackupConfig]: The backup configuration.
+        jobs [List[BackupJob]]: The transfer jobs of the source.
+        first_job_index [int]: Index, in the list of all jobs of the run, of the first transfer job.
+    """
+    if not backup_config.large_file_size:
+        return []
+    job_indexes = {job.harddrive: first_job_index + index for index, job in enumerate(jobs)}
+    source_name = backup_config.source.absolute().name
+    return [
+        BackupJob(
+            command=[sys.executable, "-m", "backup_to_harddrive.block_sync"]
+            + [f"--min-size={backup_config.large_file_size}"]
+            + get_filter_options_of(get_exclusion_filter_of(backup_config), "native")
+            + [
+                str(backup_config.source.absolute()),
+                str(path_to_backup_within_harddrive(harddrive) / source_name),
+                str(get_path_to_block_maps(path_to_backup_within_harddrive(harddrive), backup_config.source)),
+            ],
+            source=backup_config.source,
+            harddrive=harddrive,
+            depends_on=job_indexes.get(harddrive),
+        )
+        for harddrive in backup_config.list_of_harddrive
+    ]
+
+
+def get_snapshot_finalizer_for(backup_config: BackupConfig, harddrive: Path, snapshot_name: str) -> Callable[[], None]:
+    """Get the function that completes a snapshot once its rsync succeeded.
+
+    It marks the snapshot as complete and deletes the snapshots that are not kept by the retention policy.
+
+    Args:
+        backup_config [BackupConfig]: The backup configuration.
+        harddrive [Path]: The destination harddrive.
+        snapshot_name [str]: Name of the snapshot directory.
+    """
+    backup_path = path_to_backup_within_harddrive(harddrive)
+    source_name = backup_config.source.absolute().name
+
+    def finalize_snapshot() -> None:
+        mark_snapshot_as_complete(backup_path, snapshot_name, source_name)
+        prune_snapshots_of(
+            backup_path, source_name, backup_config.keep_daily, backup_config.keep_weekly, backup_config.keep_monthly
+        )
+
+    return finalize_snapshot
+
+
+def get_rsync_files_from_command_for(
+    source_path: Path, harddrive_path: Path, files_from_path: Path, large_file_size: int = 0
+) -> List[str]:
+    """Get the rsync command that only transfers the files listed in a file.
+
+    Listed files missing from the source are deleted from the harddrive.
+
+    Args:
+        source_path [Path]: The source directory to backup.
+        harddrive_path [Path]: The destination directory to backup to.
+        files_from_path [Path]: NUL separated list of paths, relative to the parent of the source directory.
+        large_file_size [int]: Size, in bytes, from which the files are left to the block-level transfer, 0 for none.
+    """
+    return (
+        ["rsync"]
+        + [option for option in RSYNC_OPTIONS if not option.startswith("--delete")]
+        + get_max_size_options_of(large_file_size)
+        + [f"--files-from={str(files_from_path)}", "--from0", "--delete-missing-args"]
+        + [str(source_path.absolute().parent), str(path_to_backup_within_harddrive(harddrive_path))]
+    )
+
+
+def get_path_to_files_from_list(source_path: Path, harddrive_path: Path) -> Path:
+    """Get the path of the list of files to transfer from a source to a harddrive.
+
+    Args:
+        source_path [Path]: The source directory to backup.
+        harddrive_path [Path]: The destination directory to backup to.
+    """
+    key = hashlib.blake2b(f"{source_path.absolute()}:{harddrive_path.absolute()}".encode("utf-8"), digest_size=8)
+    return Path(user_cache_dir("backup_to_harddrive")) / "files_from" / f"{key.hexdigest()}.lst"
+
+
+def write_files_from_list(files_from_path: Path, source_path: Path, relative_paths: List[str]) -> None:
+    """Write the list of files to transfer, in the format expected by rsync --files-from --from0.
+
+    Args:
+        files_from_path [Path]: The path of the list.
+        source_path [Path]: The source directory to backup.
+        relative_paths [List[str]]: Paths relative to the source directory.
+    """
+    files_from_path.parent.mkdir(parents=True, exist_ok=True)
+    source_name = source_path.absolute().name
+    with open(files_from_path, "w", encoding="utf-8") as file:
+        file.write("".join(f"{source_name}{os.sep}{path}\0" for path in relative_paths))
+
+
+def get_incremental_backup_job_for(
+    backup_config: BackupConfig, harddrive: Path, live_manifest: Manifest
+) -> Optional[BackupJob]:
+    """Get the backup job of a source to a harddrive, transferring only what changed since the manifest was written.
+
+    Without manifest on the harddrive, a full rsync is done. The manifest is written once the job succeeded.
+
+    Args:
+        backup_config [BackupConfig]: The backup configuration.
+        harddrive [Path]: The destination harddrive.
+        live_manifest [Manifest]: Current metadata of the source.
+    Returns:
+        Optional[BackupJob]: The job, or None if nothing changed.
+    """
+    manifest_path = get_path_to_manifest(path_to_backup_within_harddrive(harddrive), backup_config.source)
+    stored_manifest = read_manifest(manifest_path)
+
+    def update_manifest() -> None:
+        if backup_config.manifest_with_digest:
+            add_digests_to(live_manifest, stored_manifest or {}, backup_config.source)
+        write_manifest(manifest_path, live_manifest)
+
+    if stored_manifest is None:
+        command = get_rsync_command_for(
+            backup_config.source,
+            harddrive,
+            get_exclusion_filter_of(backup_config),
+            backend=backup_config.backend,
+            large_file_size=backup_config.large_file_size,
+        )
+    else:
+        changed, deleted = get_changed_and_deleted_paths(live_manifest, stored_manifest)
+        if not changed and not deleted:
+            logging.info("Nothing changed in %s since last backup on %s", str(backup_config.source), str(harddrive))
+            return None
+        files_from_path = get_path_to_files_from_list(backup_config.source, harddrive)
+        write_files_from_list(files_from_path, backup_config.source, changed + deleted)
+        command = get_rsync_files_from_command_for(
+            backup_config.source, harddrive, files_from_path, backup_config.large_file_size
+        )
+    return BackupJob(command=command, source=backup_config.source, harddrive=harddrive, on_success=update_manifest)
+
+
+def get_planned_incremental_command_for(backup_config: BackupConfig, harddrive: Path) -> List[str]:
+    """Get the command of the incremental backup of a source to a harddrive, without scanning the source.
+
+    The list of the files to transfer is neither computed nor written: the command only names its path.
+
+    Args:
+        backup_config [BackupConfig]: The backup configuration.
+        harddrive [Path]: The destination harddrive.
+    """
+    if not get_path_to_manifest(path_to_backup_within_harddrive(harddrive), backup_config.source).is_file():
+        return get_rsync_command_for(
+            backup_config.source,
+            harddrive,
+            get_exclusion_filter_of(backup_config),
+            backend=backup_config.backend,
+            large_file_size=backup_config.large_file_size,
+        )
+    return get_rsync_files_from_command_for(
+        backup_config.source,
+        harddrive,
+        get_path_to_files_from_list(backup_config.source, harddrive),
+        backup_config.large_file_size,
     )
 
 
+def get_backup_job_from_source_for(
+    backup_config: BackupConfig, harddrive: Path, live_manifest: Optional[Manifest], snapshot_name: str
+) -> Optional[BackupJob]:
+    """Get the job that backups a source to a harddrive.
+
+    Args:
+        backup_config [BackupConfig]: The backup configuration.
+        harddrive [Path]: The destination harddrive.
+        live_manifest [Optional[Manifest]]: Current metadata of the source, None if no manifest is used or in a dry
+            run.
+        snapshot_name [str]: Name of the snapshot directory of this run, used in snapshot mode only.
+    Returns:
+        Optional[BackupJob]: The job, or None if there is nothing to transfer.
+    """
+    if backup_config.incremental_manifest:
+        if live_manifest is None:
+            return BackupJob(
+                command=get_planned_incremental_command_for(backup_config, harddrive),
+                source=backup_config.source,
+                harddrive=harddrive,
+            )
+        return get_incremental_backup_job_for(backup_config, harddrive, live_manifest)
+    if backup_config.snapshot:
+        return BackupJob(
+            command=get_rsync_command_for(
+                backup_config.source,
+                harddrive,
+                get_exclusion_filter_of(backup_config),
+                snapshot_name,
+                backup_config.backend,
+            ),
+            source=backup_config.source,
+            harddrive=harddrive,
+            on_success=get_snapshot_finalizer_for(backup_config, harddrive, snapshot_name),
+        )
+    return BackupJob(
+        command=get_rsync_command_for(
+            backup_config.source,
+            harddrive,
+            get_exclusion_filter_of(backup_config),
+            backend=backup_config.backend,
+            large_file_size=backup_config.large_file_size,
+        ),
+        source=backup_config.source,
+        harddrive=harddrive,
+    )
+
+
+def get_list_of_backup_jobs_for(
+    backup_config: BackupConfig,
+    first_job_index: int,
+    snapshot_name: str = "",
+    live_manifests: Optional[Dict[Path, Manifest]] = None,
+    dry_run: bool = False,
+) -> List[BackupJob]:
+    """Get the list of backup jobs of a single backup configuration.
+
+    Without fan out, each harddrive gets its own rsync from the source, split into parallel shards if configured.
+    With fan out, only the first harddrive reads from the source, the other ones are seeded from the first harddrive
+    once it is up to date. With the dedup target format, each harddrive gets a backup to its deduplicating store,
+    followed by the compaction of the store when small files are packed.
+    A dry run neither scans the source nor writes any state: the incremental jobs transfer the list of files the run
+    would write, and the shards are split from the cached weights.
+
+    Args:
+        backup_config [BackupConfig]: The backup configuration.
+        first_job_index [int]: Index, in the list of all jobs of the run, of the first job returned.
+        snapshot_name [str]: Name of the snapshot directory of this run, used in snapshot and dedup modes only.
+        live_manifests [Optional[Dict[Path, Manifest]]]: Receives the live manifest of the source, by source, if it
+            is backed up incrementally.
+        dry_run [bool]: If True, the jobs are only planned, to be printed.
+    """
+    if backup_config.target_format == "dedup":
+        return [
+            BackupJob(
+                command=get_dedup_store_command_for(backup_config, harddrive, snapshot_name),
+                source=backup_config.source,
+                harddrive=harddrive,
+            )
+            for harddrive in backup_config.list_of_harddrive
+        ] + [
+            get_dedup_store_compaction_job_for(harddrive, first_job_index + index)
+            for index, harddrive in enumerate(backup_config.list_of_harddrive)
+            if backup_config.pack_small_files
+        ]
+    live_manifest = None
+    if backup_config.incremental_manifest and not dry_run:
+        live_manifest = get_live_manifest_of(backup_config.source, get_exclusion_filter_of(backup_config))
+        if live_manifests is not None:
+            live_manifests[backup_config.source] = live_manifest
+    if backup_config.shards > 1:
+        shards = split_into_shards(
+            get_weights_of(backup_config.source, get_exclusion_filter_of(backup_config), dry_run),
+            backup_config.shards,
+        )
+        return [
+            job
+            for harddrive in backup_config.list_of_harddrive
+            for job in get_sharded_backup_jobs_for(backup_config, harddrive, shards)
+        ]
+    if not backup_config.fan_out:
+        jobs = [
+            job
+            for job in (
+                get_backup_job_from_source_for(backup_config, harddrive, live_manifest, snapshot_name)
+                for harddrive in backup_config.list_of_harddrive
+            )
+            if job is not None
+        ]
+        return jobs + get_block_sync_jobs_for(backup_config, jobs, first_job_index)
+    seed_harddrive = backup_config.list_of_harddrive[0]
+    seed_job = get_backup_job_from_source_for(backup_config, seed_harddrive, live_manifest, snapshot_name)
+    jobs = [] if seed_job is None else [seed_job]
+    for harddrive in backup_config.list_of_harddrive[1:]:
+        jobs.append(
+            BackupJob(
+                command=get_rsync_seed_command_for(
+                    backup_config.source,
+                    seed_harddrive,
+                    harddrive,
+                    snapshot_name if backup_config.snapshot else None,
+                    backup_config.backend,
+                ),
+                source=seed_harddrive,
+                harddrive=harddrive,
+                depends_on=None if seed_job is None else first_job_index,
+                on_success=(
+                    get_snapshot_finalizer_for(backup_config, harddrive, snapshot_name)
+                    if backup_config.snapshot
+                    else None
+                ),
+            )
+        )
+    return jobs
+
+
+def get_list_of_backup_jobs_for_this_run_configuration(
+    run_config: RunConfig,
+    snapshot_name: Optional[str] = None,
+    live_manifests: Optional[Dict[Path, Manifest]] = None,
+    dry_run: bool = False,
+) -> List[BackupJob]:
+    """Get the list of backup jobs to run for this run configuration.
+
+    Args:
+        run_config [RunConfig]: The run configuration to use.
+        snapshot_name [Optional[str]]: Name of the snapshot directory of the run, None to name it after the current
+            time.
+        live_manifests [Optional[Dict[Path, Manifest]]]: Receives the live manifests of the sources backed up
+            incrementally.
+        dry_run [bool]: If True, the jobs are only planned, without scanning the sources nor writing any state.
+    """
+    snapshot_name = snapshot_name or get_snapshot_name(datetime.datetime.now())
+    all_jobs: List[BackupJob] = []
+    for backup_config in run_config.backup_configs:
+        jobs = get_list_of_backup_jobs_for(backup_config, len(all_jobs), snapshot_name, live_manifests, dry_run)
+        for job in jobs:
+            job.command = get_prioritized_command(job.command, backup_config, job.source, job.harddrive)
+            job.adaptive_throttle = backup_config.adaptive_throttle
+        all_jobs += jobs
+    return all_jobs
+
+
+def is_rsync_required_by(run_config: RunConfig) -> bool:
+    """Check if a run configuration needs the rsync binary.
+
+    The native backend only replaces the full copies: incremental transfers and shards always use rsync. The
+    dedup target format never uses it.
+
+    Args:
+        run_config [RunConfig]: The run configuration to check.
+    """
+    return any(
+        backup_config.target_format != "dedup"
+        and (backup_config.backend == "rsync" or backup_config.incremental_manifest or backup_config.shards > 1)
+        for backup_config in run_config.backup_configs
+    )
+
+
+def is_rsync_required_by_config_file() -> bool:
+    """Check if the configuration file needs the rsync binary."""
+    return is_rsync_required_by(extract_valid_configuration_from_config_file())
+
+
 def get_list_of_rsync_command_for_this_run_configuration(run_config: RunConfig) -> List[List[str]]:
     """Get the list of rsync commands to run for this run configuration.
 
     Args:
         run_config [RunConfig]: The run configuration to use.
     """
-    all_commands = []
+    return [job.command for job in get_list_of_backup_jobs_for_this_run_configuration(run_config)]
+
+
+def get_files_backed_up_by_run(
+    run_config: RunConfig, harddrives: List[Path], live_manifests: Mapping[Path, Manifest]
+) -> Dict[Tuple[Path, Path], Mapping[str, Any]]:
+    """Get the files a run backed up from each source to the harddrives it completed on, without walking the sources.
+
+    They are read from the run manifest of the deduplicating store, or taken from the live manifest of an incremental
+    backup. The other sources are left out.
+
+    Args:
+        run_config [RunConfig]: The run configuration.
+        harddrives [List[Path]]: The harddrives the run completed on.
+        live_manifests [Mapping[Path, Manifest]]: The live manifests of the sources backed up incrementally.
+    Returns:
+        Dict[Tuple[Path, Path], Mapping[str, Any]]: The metadata (size and mtime_ns) of each file, indexed by its
+            path, by source and harddrive.
+    """
+    backed_up_files: Dict[Tuple[Path, Path], Mapping[str, Any]] = {}
+    for backup_config in run_config.backup_configs:
+        for harddrive in backup_config.list_of_harddrive:
+            if harddrive not in harddrives:
+                continue
+            if backup_config.target_format == "dedup":
+                backed_up_files[(backup_config.source, harddrive)] = {
+                    path: entry
+                    for path, entry in get_backed_up_manifest_of(backup_config, harddrive).items()
+                    if entry.kind != "d"
+                }
+            elif backup_config.source in live_manifests:
+                backed_up_files[(backup_config.source, harddrive)] = live_manifests[backup_config.source]
+            else:
+                logging.info("%s has no manifest, its backup to %s is not cataloged", backup_config.source, harddrive)
+    return backed_up_files
+
+
+def record_run_on_harddrives(  # pylint: disable=(too-many-positional-arguments)
+    run_config: RunConfig,
+    jobs: List[BackupJob],
+    return_codes: List[Optional[int]],
+    started_at: datetime.datetime,
+    live_manifests: Mapping[Path, Manifest],
+) -> bool:
+    """Append the report of the run to each harddrive, and advance the timestamp of the ones it completed on.
+
+    The files backed up to the harddrives the run completed on are added to the catalog.
+
+    Args:
+        run_config [RunConfig]: The run configuration.
+        jobs [List[BackupJob]]: The jobs of the run.
+        return_codes [List[Optional[int]]]: The return code of each job, None if it was skipped.
+        started_at [datetime]: The moment the run started.
+        live_manifests [Mapping[Path, Manifest]]: The live manifests of the sources backed up incrementally.
+    Returns:
+        bool: True if the run is complete on every harddrive.
+    """
+    reports = get_run_reports_of(jobs, return_codes, started_at)
+    complete_harddrives = []
+    is_complete = True
+    for backup_config in run_config.backup_configs:
+        for harddrive in backup_config.list_of_harddrive:
+            report = reports.pop(harddrive, None)
+            if report is not None:
+                append_run_report(get_path_to_run_reports(path_to_backup_within_harddrive(harddrive)), report)
+            if report is None or report.complete:
+                write_timetsamp_on_harddrive(harddrive)
+                complete_harddrives.append(harddrive)
+            else:
+                logging.error("Backup to %s is incomplete, its timestamp is left unchanged", str(harddrive))
+                is_complete = False
+    add_run_to_catalog_of(get_files_backed_up_by_run(run_config, complete_harddrives, live_manifests), started_at)
+    return is_complete
+
+
+def print_run_history(number_of_runs: int) -> None:
+    """Print the last run reports of each harddrive of the configuration.
+
+    Args:
+        number_of_runs [int]: Maximum number of runs to print per harddrive.
+    """
+    run_config = extract_valid_configuration_from_config_file()
+    harddrives = dict.fromkeys(
+        harddrive for backup_config in run_config.backup_configs for harddrive in backup_config.list_of_harddrive
+    )
+    for harddrive in harddrives:
+        print(f"{str(harddrive)}:")
+        reports_path = get_path_to_run_reports(path_to_backup_within_harddrive(harddrive))
+        for line in get_run_history(reports_path, number_of_runs):
+            print(f"  {line}")
+
+
+def get_backed_up_manifest_of(backup_config: BackupConfig, harddrive: Path) -> Mapping[str, Any]:
+    """Get the metadata of the files of the latest backup of a source on a harddrive.
+
+    It is read from the manifest of the backup when there is one, otherwise from the cached scan of the backup
+    directory.
+
+    Args:
+        backup_config [BackupConfig]: The backup configuration.
+        harddrive [Path]: The harddrive.
+    Returns:
+        Mapping[str, Any]: The metadata (size and mtime_ns) of each file, indexed by its path. Empty if there is no
+            backup yet.
+    """
+    backup_path = path_to_backup_within_harddrive(harddrive)
+    source_name = backup_config.source.absolute().name
+    if backup_config.target_format == "dedup":
+        return read_store_manifest(get_latest_run_manifest_of(backup_path, source_name))
+    manifest = read_manifest(get_path_to_manifest(backup_path, backup_config.source))
+    if manifest is not None:
+        return manifest
+    backup_directory = backup_path / source_name
+    if backup_config.snapshot:
+        snapshot_path = get_latest_complete_snapshot_of(backup_path, source_name)
+        if snapshot_path is None:
+            return {}
+        backup_directory = snapshot_path / source_name
+    return get_cached_scan_of_backup(harddrive, backup_directory) if backup_directory.is_dir() else {}
+
+
+def get_transfer_plans_of(run_config: RunConfig) -> Dict[Tuple[Path, Path], TransferPlan]:
+    """Plan the transfer of each source to each of its harddrives, from the cached scans of the sources and backups.
+
+    Args:
+        run_config [RunConfig]: The run configuration.
+    Returns:
+        Dict[Tuple[Path, Path], TransferPlan]: The plan of each source and harddrive.
+    """
+    transfer_plans = {}
     for backup_config in run_config.backup_configs:
+        live_manifest = get_cached_scan_of_source(backup_config.source, get_exclusion_filter_of(backup_config))
         for harddrive in backup_config.list_of_harddrive:
-            all_commands.append(
-                get_rsync_command_for(backup_config.source, harddrive, backup_config.list_of_excluded_folders)
+            transfer_plans[(backup_config.source, harddrive)] = get_transfer_plan(
+                live_manifest, get_backed_up_manifest_of(backup_config, harddrive)
             )
-    return all_commands
+    return transfer_plans
 
 
-def run_backup_from_config_file(dry_run=False) -> None:
+def print_transfer_plans(transfer_plans: Dict[Tuple[Path, Path], TransferPlan]) -> None:
+    """Print the planned transfer of each source to each of its harddrives.
+
+    Args:
+        transfer_plans [Dict[Tuple[Path, Path], TransferPlan]]: The plan of each source and harddrive.
+    """
+    for (source, harddrive), transfer_plan in transfer_plans.items():
+        print(
+            f"{str(source)} -> {str(harddrive)}: {transfer_plan.files_to_add} to add, "
+            f"{transfer_plan.files_to_update} to update, {transfer_plan.files_to_delete} to delete, "
+            f"{transfer_plan.bytes_to_write} bytes"
+        )
+
+
+def check_harddrives_of(run_config: RunConfig, dry_run: bool = False) -> Dict[Path, DriveCheck]:
+    """Check each harddrive of a run configuration before the run.
+
+    The bytes needed on a harddrive are summed over the sources backed up to it.
+
+    Args:
+        run_config [RunConfig]: The run configuration.
+        dry_run [bool]: If True, nothing is written on the harddrives, their throughput is not measured.
+    Returns:
+        Dict[Path, DriveCheck]: The check of each harddrive.
+    """
+    needed_bytes: Dict[Path, int] = {}
+    for (_, harddrive), transfer_plan in get_transfer_plans_of(run_config).items():
+        needed_bytes[harddrive] = needed_bytes.get(harddrive, 0) + transfer_plan.bytes_to_write
+    other_devices = {get_device_of(Path("/"))} | {
+        get_device_of(backup_config.source) for backup_config in run_config.backup_configs
+    }
+    return {
+        harddrive: check_harddrive(
+            harddrive, needed, {device for device in other_devices if device is not None}, dry_run
+        )
+        for harddrive, needed in needed_bytes.items()
+    }
+
+
+def print_dry_run_of(run_config: RunConfig, jobs: List[BackupJob]) -> None:
+    """Print the planned transfers and the commands of a run, without running them.
+
+    Args:
+        run_config [RunConfig]: The run configuration.
+        jobs [List[BackupJob]]: The jobs of the run.
+    """
+    print_transfer_plans(get_transfer_plans_of(run_config))
+    logging.info("Dry run mode enabled. The following commands would be executed")
+    for job in jobs:
+        print(" ".join(job.command))
+
+
+def get_jobs_of_run(  # pylint: disable=(too-many-positional-arguments)
+    run_config: RunConfig,
+    snapshot_name: str,
+    journal_path: Path,
+    resume: bool,
+    live_manifests: Optional[Dict[Path, Manifest]] = None,
+    dry_run: bool = False,
+) -> Optional[List[BackupJob]]:
+    """Get the jobs of a new run, or the unfinished jobs of the run recorded in the journal.
+
+    Args:
+        run_config [RunConfig]: The run configuration.
+        snapshot_name [str]: Name of the snapshot directory of a new run.
+        journal_path [Path]: The path to the run journal.
+        resume [bool]: If True, resume the run of the journal.
+        live_manifests [Optional[Dict[Path, Manifest]]]: Receives the live manifests of the sources backed up
+            incrementally.
+        dry_run [bool]: If True, the jobs are only planned, without scanning the sources nor writing any state.
+    Returns:
+        Optional[List[BackupJob]]: The jobs to run, None if there is no run to resume.
+    """
+    if not resume:
+        return get_list_of_backup_jobs_for_this_run_configuration(run_config, snapshot_name, live_manifests, dry_run)
+    run_journal = read_run_journal(journal_path)
+    if run_journal is None:
+        return None
+    jobs = get_unfinished_jobs(
+        get_list_of_backup_jobs_for_this_run_configuration(
+            run_config, run_journal.snapshot_name, live_manifests, dry_run
+        ),
+        run_journal.finished,
+    )
+    logging.info("Resuming the run started at %s: %s job(s) left", run_journal.started_at, len(jobs))
+    return jobs
+
+
+def run_backup_from_config_file(
+    dry_run=False,
+    max_parallel_jobs: Optional[int] = None,
+    telemetry_file: Optional[Path] = None,
+    resume=False,
+    preflight=False,
+) -> bool:
     """Run the backup based on the configuration.
 
+    The jobs that succeed are recorded in the run journal, which is removed once the run is complete. Resuming runs
+    the jobs of the last run that did not succeed, with the same snapshot name, rsync resuming the large files from
+    their partial copy.
+    With the pre-flight check, the harddrives that are not mounted, too full or not writable are skipped, and the jobs
+    of the slowest harddrives are started first. In a dry run, no write sample is taken, and the jobs of the harddrives
+    that need the most bytes are started first.
+    The dry run plans the transfers from the cached scans of the sources and backups, which a run then reuses for its
+    pre-flight check. The scans of the backups on the harddrives of a run are discarded when its jobs start. The dry
+    run leaves the change journals of the sources, the lists of files to transfer and the shard weights as they are.
+
     Args:
-        dry_run [bool]: If True, the backup will not be executed. Rsync commands will only be printed.
+        dry_run [bool]: If True, the backup will not be executed. The planned transfer of each source to each
+            harddrive, and the rsync commands, will only be printed.
+        max_parallel_jobs [Optional[int]]: Global limit of parallel jobs, overrides the one of the config file.
+        telemetry_file [Optional[Path]]: JSON lines file receiving the metrics, "-" for the standard output.
+            Overrides the one of the config file. Without any, telemetry is disabled.
+        resume [bool]: If True, only run the jobs of the last run that did not succeed.
+        preflight [bool]: If True, check the harddrives before the run, whatever the config file says.
+    Returns:
+        bool: False if a backup job failed or was skipped.
     """
+    started_at = datetime.datetime.now()
     run_config = extract_valid_configuration_from_config_file()
-    rsync_commands = get_list_of_rsync_command_for_this_run_configuration(run_config)
+    if max_parallel_jobs is not None:
+        run_config.max_parallel_jobs = max_parallel_jobs
+    if telemetry_file is not None:
+        run_config.telemetry_file = telemetry_file
+    drive_checks = check_harddrives_of(run_config, dry_run) if preflight or run_config.preflight else {}
+    are_all_harddrives_usable = skip_failed_harddrives_of(run_config, drive_checks)
+    journal_path = get_path_to_run_journal()
+    live_manifests: Dict[Path, Manifest] = {}
+    jobs = get_jobs_of_run(run_config, get_snapshot_name(started_at), journal_path, resume, live_manifests, dry_run)
+    if jobs is None:
+        logging.info("No interrupted run to resume")
+        return are_all_harddrives_usable
+    jobs = get_jobs_in_plan_order(jobs, drive_checks)
 
-    # pylint: disable=(consider-using-with)
     if not dry_run:
-        processes = [subprocess.Popen(cmd) for cmd in rsync_commands]
-        for proc in processes:
-            proc.wait()
+        if not resume:
+            start_run_journal(journal_path, get_snapshot_name(started_at), started_at.isoformat())
+        add_journal_recording_to(jobs, journal_path)
+        remove_cached_scans_of({job.harddrive for job in jobs})
+        return_codes = run_jobs_with_device_limits(
+            jobs,
+            run_config.max_parallel_jobs,
+            get_telemetry_sink_for(run_config.telemetry_file),
+            JobLimits(
+                run_config.job_timeout, run_config.stall_timeout, run_config.max_load, run_config.max_disk_latency_ms
+            ),
+        )
+        is_complete = record_run_on_harddrives(run_config, jobs, return_codes, started_at, live_manifests)
+        if is_complete:
+            remove_run_journal(journal_path)
         for backup_config in run_config.backup_configs:
-            for harddrive in backup_config.list_of_harddrive:
-                write_timetsamp_on_harddrive(harddrive)
             create_restore_scripts_from_config(backup_config)
-    else:
-        logging.info("Dry run mode enabled. The following commands would be executed")
-        for cmd in rsync_commands:
-            print(" ".join(cmd))
+        return is_complete and are_all_harddrives_usable
+    print_dry_run_of(run_config, jobs)
+    return are_all_harddrives_usable
 
 
-def create_restore_script_for(quick_restore_path: Path, hard_drive_path: Path, source_path: Path) -> None:
+def create_restore_script_for(
+    quick_restore_path: Path,
+    hard_drive_path: Path,
+    source_path: Path,
+    snapshot: bool = False,
+    target_format: str = "directory",
+) -> None:
     """Create a restore script for a quick restore path.
 
     Args:
         quick_restore_path [Path]: The quick restore path.
         hard_drive_path [Path]: The hard drive path.
         source_path [Path]: The source path.
+        snapshot [bool]: If True, restore from the latest snapshot of the source.
+        target_format [str]: If dedup, restore from the latest run manifest of the source in the store, with the
+            Python interpreter this tool is installed for.
     """
     relative_part = quick_restore_path.relative_to(source_path)
+    backed_up_source = source_path.name
+    if snapshot:
+        backed_up_source = get_latest_snapshot_link_of(Path(), source_path.name).name
+    restore_command = f"rsync -av --delete {backed_up_source+os.sep+str(relative_part)} {str(source_path)}"
+    if target_format == "dedup":
+        latest_manifest = f"$(ls -d {get_path_to_run_manifest(Path(), '*', source_path.name)} | tail -n 1)"
+        restore_command = (
+            f"{shlex.quote(sys.executable)} -m backup_to_harddrive.dedup_store restore --path={str(relative_part)} "
+            f"{latest_manifest} {os.pardir + os.sep + STORE_DIRECTORY_NAME} {str(source_path)}"
+        )
     restore_script_path = path_to_backup_within_harddrive(hard_drive_path) / f"restore_{relative_part}.sh"
     with open(restore_script_path, "w", encoding="utf-8") as file:
         file.write(
             f"""#!/bin/bash
 set -euxo pipefail
-rsync -av --delete {str(source_path.name)+os.sep+str(relative_part)} {str(source_path)}
+{restore_command}
 """
         )
     restore_script_path.chmod(restore_script_path.stat().st_mode | 0o755)
@@ -129,4 +1053,6 @@ def create_restore_scripts_from_config(backup_config: BackupConfig) -> None:
     logging.warning("Creating restore scripts")
     for hard_drive in backup_config.list_of_harddrive:
         for restore_path in backup_config.quick_restore_path:
-            create_restore_script_for(restore_path, hard_drive, backup_config.source)
+            create_restore_script_for(
+                restore_path, hard_drive, backup_config.source, backup_config.snapshot, backup_config.target_format
+            )
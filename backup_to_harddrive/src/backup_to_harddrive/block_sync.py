@@ -0,0 +1,418 @@
+"""Block-level transfer of the large files of a source, writing in place only the blocks that changed.
+
+Virtual machine disk images and databases change by a few blocks a day: copying them whole makes the writes of each run
+grow with their size instead of with the change. For each file of at least --min-size bytes, a block map kept in the
+backup directory of the harddrive records the size and the modification time of the file as last backed up, and a
+BLAKE2b hash of each of its blocks. A run leaves the files whose size and modification time did not change untouched,
+hashes the blocks of the other ones with a pool of threads and writes the blocks whose hash differs from the map in
+place, in the backup file.
+
+The map is removed before the backup file is written and written again once the file is synced, so that a backup without
+a valid map (the first run, or an interrupted one) is hashed to rebuild it: only the blocks that differ are written then
+too. A new backup file is sparse, the blocks of zeros of the source are not written.
+
+The transfer of the rest of the source skips the large files (rsync --max-size) and runs before this one. Run it with
+python -m backup_to_harddrive.block_sync.
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from backup_to_harddrive.filters import (
+    Exclusions,
+    as_exclusion_filter,
+    compile_exclusion_filter,
+    read_rules_file,
+)
+from backup_to_harddrive.scanner import scan_files
+
+BLOCK_SIZE = 1024 * 1024
+SEGMENT_BLOCKS = 16
+DIGEST_SIZE = 16
+BLOCK_SYNC_THREADS = min(8, os.cpu_count() or 1)
+MAP_MAGIC = b"BTHBMAP1"
+MAP_HEADER = struct.Struct("<8sQQQ")
+ZERO_BLOCK_DIGEST = hashlib.blake2b(bytes(BLOCK_SIZE), digest_size=DIGEST_SIZE).digest()
+RETURN_CODE_PARTIAL_TRANSFER = 23
+
+
+@dataclass
+class BlockMap:
+    """Size, modification time and block hashes of a large file, as last backed up."""
+
+    size: int
+    mtime_ns: int
+    digests: List[bytes]
+
+
+@dataclass
+class BlockSyncStats:
+    """Statistics of a block-level transfer."""
+
+    files_transferred: int = 0
+    bytes_transferred: int = 0
+    bytes_written: int = 0
+    errors: int = 0
+
+
+def get_path_to_block_maps(backup_path: Path, source_path: Path) -> Path:
+    """Get the directory holding the block maps of the large files of a source, within the backup directory.
+
+    Args:
+        backup_path [Path]: The backup directory within the harddrive (Backup/<hostname>).
+        source_path [Path]: The source directory.
+    Returns:
+        Path: The block maps directory.
+    """
+    return backup_path / f".block_maps_{source_path.absolute().name}"
+
+
+def get_path_to_block_map(block_maps_path: Path, relative_path: str) -> Path:
+    """Get the path of the block map of a file, named after the hash of its path.
+
+    Args:
+        block_maps_path [Path]: The block maps directory.
+        relative_path [str]: The path of the file, relative to the source.
+    Returns:
+        Path: The path to the block map.
+    """
+    key = hashlib.blake2b(os.fsencode(relative_path), digest_size=16).hexdigest()
+    return block_maps_path / f"{key}.map"
+
+
+def get_max_size_options_of(large_file_size: int) -> List[str]:
+    """Get the options that leave the large files out of a transfer, for the block-level transfer.
+
+    Args:
+        large_file_size [int]: Size, in bytes, from which a file is transferred by blocks, 0 if none is.
+    Returns:
+        List[str]: The --max-size option, none if no file is transferred by blocks.
+    """
+    return [f"--max-size={large_file_size - 1}"] if large_file_size else []
+
+
+def read_block_map(map_path: Path) -> Optional[BlockMap]:
+    """Read a block map.
+
+    Args:
+        map_path [Path]: The path to the block map.
+    Returns:
+        Optional[BlockMap]: The block map, None if it is missing, corrupt or of another block size.
+    """
+    try:
+        content = map_path.read_bytes()
+    except FileNotFoundError:
+        return None
+    if len(content) >= MAP_HEADER.size:
+        magic, size, mtime_ns, block_size = MAP_HEADER.unpack_from(content)
+        digests = content[MAP_HEADER.size :]
+        if magic == MAP_MAGIC and block_size == BLOCK_SIZE and len(digests) == -(-size // BLOCK_SIZE) * DIGEST_SIZE:
+            return BlockMap(
+                size=size,
+                mtime_ns=mtime_ns,
+                digests=[digests[offset : offset + DIGEST_SIZE] for offset in range(0, len(digests), DIGEST_SIZE)],
+            )
+    logging.warning("Corrupt block map ignored: %s", str(map_path))
+    return None
+
+
+def write_block_map(map_path: Path, block_map: BlockMap) -> None:
+    """Write a block map atomically.
+
+    Args:
+        map_path [Path]: The path to the block map.
+        block_map [BlockMap]: The block map.
+    """
+    map_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = map_path.with_name(map_path.name + ".tmp")
+    temporary_path.write_bytes(
+        MAP_HEADER.pack(MAP_MAGIC, block_map.size, block_map.mtime_ns, BLOCK_SIZE) + b"".join(block_map.digests)
+    )
+    os.replace(temporary_path, map_path)
+
+
+def write_at(fd: int, data: bytes, offset: int) -> None:
+    """Write all the bytes of a block at an offset of a file.
+
+    Args:
+        fd [int]: Descriptor of the file.
+        data [bytes]: The block.
+        offset [int]: Offset of the block in the file.
+    """
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def sync_segment(
+    source_fd: int, destination_fd: Optional[int], first_block: int, old_digests: List[bytes]
+) -> Tuple[List[bytes], int]:
+    """Hash the blocks of a segment of a file, writing the ones whose hash changed to the destination.
+
+    Args:
+        source_fd [int]: Descriptor of the file to hash.
+        destination_fd [Optional[int]]: Descriptor of the file to write the changed blocks to, None to only hash.
+        first_block [int]: Index of the first block of the segment.
+        old_digests [List[bytes]]: Hashes of the blocks of the destination, by index.
+    Returns:
+        Tuple[List[bytes], int]: The hashes of the blocks of the segment, and the number of bytes written.
+    """
+    digests = []
+    written = 0
+    for index in range(first_block, first_block + SEGMENT_BLOCKS):
+        block = os.pread(source_fd, BLOCK_SIZE, index * BLOCK_SIZE)
+        if not block:
+            break
+        digest = hashlib.blake2b(block, digest_size=DIGEST_SIZE).digest()
+        digests.append(digest)
+        if destination_fd is not None and (index >= len(old_digests) or old_digests[index] != digest):
+            write_at(destination_fd, block, index * BLOCK_SIZE)
+            written += len(block)
+    return digests, written
+
+
+def sync_blocks(
+    pool: ThreadPoolExecutor, source_fd: int, destination_fd: Optional[int], size: int, old_digests: List[bytes]
+) -> Tuple[List[bytes], int]:
+    """Hash the blocks of a file by segments in parallel, writing the ones whose hash changed to the destination.
+
+    Args:
+        pool [ThreadPoolExecutor]: The pool hashing the segments.
+        source_fd [int]: Descriptor of the file to hash.
+        destination_fd [Optional[int]]: Descriptor of the file to write the changed blocks to, None to only hash.
+        size [int]: Size of the file to hash.
+        old_digests [List[bytes]]: Hashes of the blocks of the destination, by index.
+    Returns:
+        Tuple[List[bytes], int]: The hashes of the blocks of the file, and the number of bytes written.
+    """
+    digests: List[bytes] = []
+    written = 0
+    for segment_digests, segment_written in pool.map(
+        lambda first_block: sync_segment(source_fd, destination_fd, first_block, old_digests),
+        range(0, -(-size // BLOCK_SIZE), SEGMENT_BLOCKS),
+    ):
+        digests.extend(segment_digests)
+        written += segment_written
+    return digests, written
+
+
+def open_destination(destination_path: Path) -> Tuple[int, Optional[os.stat_result]]:
+    """Open a backup file for writing in place, replacing a directory or a link standing at its path.
+
+    Args:
+        destination_path [Path]: The backup file.
+    Returns:
+        Tuple[int, Optional[stat_result]]: The descriptor of the file, and its metadata if it already existed.
+    """
+    try:
+        destination_stat: Optional[os.stat_result] = os.lstat(destination_path)
+    except FileNotFoundError:
+        destination_stat = None
+    if destination_stat is not None and stat.S_ISDIR(destination_stat.st_mode):
+        shutil.rmtree(destination_path)
+        destination_stat = None
+    elif destination_stat is not None and not stat.S_ISREG(destination_stat.st_mode):
+        destination_path.unlink()
+        destination_stat = None
+    destination_path.parent.mkdir(parents=True, exist_ok=True)
+    return os.open(destination_path, os.O_RDWR | os.O_CREAT, 0o600), destination_stat
+
+
+def get_destination_digests_of(
+    pool: ThreadPoolExecutor,
+    destination_fd: int,
+    destination_stat: Optional[os.stat_result],
+    block_map: Optional[BlockMap],
+) -> List[bytes]:
+    """Get the hashes of the blocks of a backup file, from its map if it is valid, hashing the file otherwise.
+
+    Args:
+        pool [ThreadPoolExecutor]: The pool hashing the segments.
+        destination_fd [int]: Descriptor of the backup file.
+        destination_stat [Optional[stat_result]]: Metadata of the backup file, None if it was just created.
+        block_map [Optional[BlockMap]]: The block map of the file, None if there is none.
+    Returns:
+        List[bytes]: The hashes of the blocks of the backup file.
+    """
+    if destination_stat is None:
+        return []
+    if block_map is not None and (block_map.size, block_map.mtime_ns) == (
+        destination_stat.st_size,
+        destination_stat.st_mtime_ns,
+    ):
+        return block_map.digests
+    return sync_blocks(pool, destination_fd, None, destination_stat.st_size, [])[0]
+
+
+def is_up_to_date(source_stat: os.stat_result, destination_path: Path, block_map: Optional[BlockMap]) -> bool:
+    """Check if a backup file and its map have the size and modification time of the source file.
+
+    Args:
+        source_stat [stat_result]: Metadata of the source file.
+        destination_path [Path]: The backup file.
+        block_map [Optional[BlockMap]]: The block map of the file, None if there is none.
+    Returns:
+        bool: True if the backup file can be left as is.
+    """
+    if block_map is None or (block_map.size, block_map.mtime_ns) != (source_stat.st_size, source_stat.st_mtime_ns):
+        return False
+    try:
+        destination_stat = os.lstat(destination_path)
+    except FileNotFoundError:
+        return False
+    return stat.S_ISREG(destination_stat.st_mode) and (destination_stat.st_size, destination_stat.st_mtime_ns) == (
+        block_map.size,
+        block_map.mtime_ns,
+    )
+
+
+def write_changed_blocks(
+    source_path: Path,
+    destination_path: Path,
+    source_stat: os.stat_result,
+    block_map: Optional[BlockMap],
+    pool: ThreadPoolExecutor,
+) -> Tuple[List[bytes], int]:
+    """Write the blocks of a source file that differ from its backup file, keeping the new blocks of zeros sparse.
+
+    Args:
+        source_path [Path]: The source file.
+        destination_path [Path]: The backup file.
+        source_stat [stat_result]: Metadata of the source file.
+        block_map [Optional[BlockMap]]: The block map of the backup file, None if there is none.
+        pool [ThreadPoolExecutor]: The pool hashing the segments.
+    Returns:
+        Tuple[List[bytes], int]: The hashes of the blocks of the file, and the number of bytes written.
+    """
+    destination_fd, destination_stat = open_destination(destination_path)
+    try:
+        old_digests = get_destination_digests_of(pool, destination_fd, destination_stat, block_map)
+        number_of_blocks = -(-source_stat.st_size // BLOCK_SIZE)
+        os.ftruncate(destination_fd, source_stat.st_size)
+        old_digests = old_digests[:number_of_blocks] + [ZERO_BLOCK_DIGEST] * (number_of_blocks - len(old_digests))
+        with open(source_path, "rb") as source_file:
+            digests, written = sync_blocks(pool, source_file.fileno(), destination_fd, source_stat.st_size, old_digests)
+        os.fsync(destination_fd)
+    finally:
+        os.close(destination_fd)
+    os.chmod(destination_path, stat.S_IMODE(source_stat.st_mode))
+    os.utime(destination_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+    return digests, written
+
+
+def sync_large_file(
+    source_path: Path, destination_path: Path, map_path: Path, pool: ThreadPoolExecutor, stats: BlockSyncStats
+) -> None:
+    """Bring a backup file up to date with its source by writing the blocks that changed, then update its map.
+
+    The map is removed first, so that a transfer that is interrupted compares the whole file on the next run.
+
+    Args:
+        source_path [Path]: The source file.
+        destination_path [Path]: The backup file.
+        map_path [Path]: The block map of the backup file.
+        pool [ThreadPoolExecutor]: The pool hashing the segments.
+        stats [BlockSyncStats]: The statistics to update.
+    """
+    try:
+        source_stat = os.stat(source_path)
+        block_map = read_block_map(map_path)
+        if is_up_to_date(source_stat, destination_path, block_map):
+            return
+        map_path.unlink(missing_ok=True)
+        digests, written = write_changed_blocks(source_path, destination_path, source_stat, block_map, pool)
+        current_stat = os.stat(source_path)
+        if (current_stat.st_size, current_stat.st_mtime_ns) != (source_stat.st_size, source_stat.st_mtime_ns):
+            logging.error("File changed during the transfer, its blocks will be compared again: %s", str(source_path))
+            stats.errors += 1
+            return
+        write_block_map(map_path, BlockMap(size=source_stat.st_size, mtime_ns=source_stat.st_mtime_ns, digests=digests))
+        if written:
+            stats.files_transferred += 1
+            stats.bytes_transferred += source_stat.st_size
+            stats.bytes_written += written
+    except OSError as error:
+        logging.error("Cannot transfer the blocks of file: %s %s", str(source_path), error)
+        stats.errors += 1
+
+
+def sync_large_files(
+    source_path: Path, destination_path: Path, block_maps_path: Path, min_size: int, excluded_path_list: Exclusions
+) -> BlockSyncStats:
+    """Transfer the changed blocks of the large files of a source to its backup, and remove the maps of the other files.
+
+    Args:
+        source_path [Path]: The source directory.
+        destination_path [Path]: The backup of the source directory.
+        block_maps_path [Path]: The block maps directory.
+        min_size [int]: Size, in bytes, from which a file is transferred by blocks.
+        excluded_path_list [Exclusions]: The exclusion rules, or the absolute paths of the excluded folders.
+    Returns:
+        BlockSyncStats: The statistics of the transfer.
+    """
+    stats = BlockSyncStats()
+    map_names = set()
+    with ThreadPoolExecutor(max_workers=BLOCK_SYNC_THREADS) as pool:
+        for scanned_file in sorted(scan_files(source_path, as_exclusion_filter(source_path, excluded_path_list))):
+            if not stat.S_ISREG(scanned_file.mode) or scanned_file.size < min_size:
+                continue
+            map_path = get_path_to_block_map(block_maps_path, scanned_file.path)
+            map_names.add(map_path.name)
+            sync_large_file(
+                source_path / scanned_file.path, destination_path / scanned_file.path, map_path, pool, stats
+            )
+    if block_maps_path.is_dir():
+        for map_path in block_maps_path.iterdir():
+            if map_path.name not in map_names:
+                map_path.unlink()
+    return stats
+
+
+def main(arguments: Optional[List[str]] = None) -> int:
+    """Transfer the changed blocks of the large files of a source and print the statistics as rsync --stats does.
+
+    Args:
+        arguments [Optional[List[str]]]: The arguments, None for the ones of the command line.
+    Returns:
+        int: 0 on success, 23 (partial transfer, as rsync) if a file could not be transferred.
+    """
+    parser = argparse.ArgumentParser(description="Transfer the changed blocks of the large files of a source")
+    parser.add_argument("--min-size", help="Size, in bytes, from which a file is transferred", type=int, default=1)
+    parser.add_argument("--exclude", help="Absolute path to exclude", action="append", default=[])
+    parser.add_argument("--exclude-from", help="File of exclusion rules, one per line", type=Path, default=None)
+    parser.add_argument("source", type=Path)
+    parser.add_argument("destination", type=Path, help="The backup of the source directory")
+    parser.add_argument("block_maps", type=Path, help="The directory of the block maps")
+    options = parser.parse_args(arguments)
+    stats = sync_large_files(
+        options.source,
+        options.destination,
+        options.block_maps,
+        options.min_size,
+        compile_exclusion_filter(
+            options.source, options.exclude, read_rules_file(options.exclude_from) if options.exclude_from else []
+        ),
+    )
+    print(f"Number of regular files transferred: {stats.files_transferred}")
+    print(f"Total transferred file size: {stats.bytes_transferred} bytes")
+    print(f"Literal data: {stats.bytes_written} bytes")
+    print(f"Matched data: {stats.bytes_transferred - stats.bytes_written} bytes")
+    print(f"Total bytes sent: {stats.bytes_written}")
+    sys.stdout.flush()
+    return RETURN_CODE_PARTIAL_TRANSFER if stats.errors else 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""Catalog of the files backed up to each harddrive, to find them without mounting the harddrives.
+
+The catalog is an SQLite database in the user config directory. It holds a row per version (size and modification
+time) of each file backed up to a harddrive, with the first and the last run that backed it up: a complete run on a
+harddrive adds the new versions of the files of its sources and advances the last run of the unchanged ones. The files
+are the ones the run knows it backed up, from the run manifest of the deduplicating store or the live manifest of an
+incremental backup, so that the sources are not walked again. The rows are indexed by file name, by reversed file name
+for the searches by suffix, and by path.
+
+A version whose last run is older than the last run on its harddrive was replaced or deleted since, it is still on the
+harddrive in a snapshot or in the deduplicating store only.
+"""
+
+import datetime
+import logging
+import os
+import sqlite3
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, List, Mapping, Tuple
+
+from platformdirs import user_config_dir
+
+CATALOG_FILE_NAME = "catalog.sqlite"
+
+
+@dataclass
+class CatalogEntry:  # pylint: disable=(too-many-instance-attributes)
+    """A version of a file backed up to a harddrive. The runs are the moments they started, in ISO format."""
+
+    harddrive: str
+    source: str
+    path: str
+    size: int
+    mtime_ns: int
+    first_backed_up: str
+    last_backed_up: str
+    last_run_on_harddrive: str
+
+
+def get_path_to_catalog() -> Path:
+    """Get the path of the catalog.
+
+    Returns:
+        Path: The path to the SQLite database.
+    """
+    return Path(user_config_dir("backup_to_harddrive")) / CATALOG_FILE_NAME
+
+
+def open_catalog(catalog_path: Path) -> sqlite3.Connection:
+    """Open the catalog, creating it if needed.
+
+    Args:
+        catalog_path [Path]: The path to the SQLite database.
+    Returns:
+        Connection: The connection to the database.
+    """
+    catalog_path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(catalog_path)
+    with connection:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS backups (id INTEGER PRIMARY KEY, harddrive TEXT, source TEXT, "
+            "last_run TEXT, UNIQUE (harddrive, source))"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (backup_id INTEGER, path TEXT, name TEXT, size INTEGER, "
+            "mtime_ns INTEGER, first_run TEXT, last_run TEXT, reversed_name TEXT, "
+            "PRIMARY KEY (backup_id, path, size, mtime_ns))"
+        )
+        if "reversed_name" not in {column[1] for column in connection.execute("PRAGMA table_info(files)")}:
+            connection.create_function("reverse", 1, lambda text: text[::-1])
+            connection.execute("ALTER TABLE files ADD COLUMN reversed_name TEXT")
+            connection.execute("UPDATE files SET reversed_name = reverse(name)")
+        connection.execute("CREATE INDEX IF NOT EXISTS files_by_name ON files (name)")
+        connection.execute("CREATE INDEX IF NOT EXISTS files_by_reversed_name ON files (reversed_name)")
+        connection.execute("CREATE INDEX IF NOT EXISTS files_by_path ON files (path)")
+    return connection
+
+
+def add_run_to_catalog(
+    connection: sqlite3.Connection, harddrive: Path, source: Path, manifest: Mapping[str, Any], started_at: str
+) -> None:
+    """Add the files of a source backed up by a run to a harddrive to the catalog.
+
+    Args:
+        connection [Connection]: The catalog.
+        harddrive [Path]: The harddrive.
+        source [Path]: The source.
+        manifest [Mapping[str, Any]]: The metadata (size and mtime_ns) of the files of the source that were backed up.
+        started_at [str]: The moment the run started, in ISO format.
+    """
+    with connection:
+        connection.execute(
+            "INSERT INTO backups (harddrive, source, last_run) VALUES (?, ?, ?) "
+            "ON CONFLICT (harddrive, source) DO UPDATE SET last_run = excluded.last_run",
+            (str(harddrive.absolute()), str(source.absolute()), started_at),
+        )
+        (backup_id,) = connection.execute(
+            "SELECT id FROM backups WHERE harddrive = ? AND source = ?",
+            (str(harddrive.absolute()), str(source.absolute())),
+        ).fetchone()
+        connection.executemany(
+            "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (backup_id, path, size, mtime_ns) DO UPDATE SET last_run = excluded.last_run",
+            (
+                (
+                    backup_id,
+                    path,
+                    os.path.basename(path),
+                    entry.size,
+                    entry.mtime_ns,
+                    started_at,
+                    started_at,
+                    os.path.basename(path)[::-1],
+                )
+                for path, entry in manifest.items()
+            ),
+        )
+
+
+def find_in_catalog(connection: sqlite3.Connection, pattern: str) -> List[CatalogEntry]:
+    """Find the versions of the files matching a pattern in the catalog.
+
+    A name pattern with a leading wildcard is matched against the reversed names, so that a search by suffix uses an
+    index too.
+
+    Args:
+        connection [Connection]: The catalog.
+        pattern [str]: A case sensitive shell pattern, matched against the file names, or against the paths relative
+            to the sources if it contains a separator.
+    Returns:
+        List[CatalogEntry]: The versions, by path then by run.
+    """
+    column = "path" if os.sep in pattern else "name"
+    if column == "name" and pattern[:1] in "*?" and pattern[-1:] not in "*?]" and "[" not in pattern:
+        column, pattern = "reversed_name", pattern[::-1]
+    rows = connection.execute(
+        "SELECT backups.harddrive, backups.source, files.path, files.size, files.mtime_ns, files.first_run, "
+        "files.last_run, backups.last_run FROM files JOIN backups ON backups.id = files.backup_id "
+        f"WHERE files.{column} GLOB ? ORDER BY backups.source, files.path, files.last_run, backups.harddrive",
+        (pattern,),
+    ).fetchall()
+    return [CatalogEntry(*row) for row in rows]
+
+
+def add_run_to_catalog_of(
+    backed_up_files: Mapping[Tuple[Path, Path], Mapping[str, Any]], started_at: datetime.datetime
+) -> None:
+    """Add the files backed up by a run to the catalog.
+
+    A catalog that cannot be written is logged, it does not fail the run.
+
+    Args:
+        backed_up_files [Mapping[Tuple[Path, Path], Mapping[str, Any]]]: The metadata (size and mtime_ns) of the
+            files backed up, indexed by their path, by source and harddrive.
+        started_at [datetime]: The moment the run started.
+    """
+    try:
+        connection = open_catalog(get_path_to_catalog())
+        try:
+            for (source, harddrive), manifest in backed_up_files.items():
+                add_run_to_catalog(connection, harddrive, source, manifest, started_at.isoformat())
+        finally:
+            connection.close()
+    except sqlite3.Error as error:
+        logging.error("Cannot update the catalog: %s", error)
+
+
+def print_files_found_in_catalog(pattern: str) -> int:
+    """Print the versions of the files matching a pattern in the catalog, and the harddrives they were backed up to.
+
+    Args:
+        pattern [str]: A case sensitive shell pattern, matched against the file names, or against the paths relative
+            to the sources if it contains a separator.
+    Returns:
+        int: 0 if a file was found, 1 otherwise.
+    """
+    connection = open_catalog(get_path_to_catalog())
+    try:
+        catalog_entries = find_in_catalog(connection, pattern)
+    finally:
+        connection.close()
+    for catalog_entry in catalog_entries:
+        modified_at = datetime.datetime.fromtimestamp(catalog_entry.mtime_ns / 1e9).isoformat(timespec="seconds")
+        replaced = "" if catalog_entry.last_backed_up == catalog_entry.last_run_on_harddrive else ", replaced since"
+        path = os.path.join(catalog_entry.source, catalog_entry.path)
+        print(f"{path}  {catalog_entry.size} bytes, modified {modified_at}")
+        print(
+            f"  on {catalog_entry.harddrive}, backed up from {catalog_entry.first_backed_up[:19]}"
+            f" to {catalog_entry.last_backed_up[:19]}{replaced}"
+        )
+    if not catalog_entries:
+        logging.error("No file matching %s in the catalog", pattern)
+        return 1
+    return 0
@@ -0,0 +1,519 @@
+"""Journal of the changes below the sources, recorded by a background watcher so that runs need not walk the sources.
+
+The watcher puts an inotify watch on every directory of each source with an incremental manifest, excluded folders
+apart, and appends the relative path of each changed entry to the journal of the source. A session identifies an
+uninterrupted period of watching: a new one starts with the watcher, when the event queue of the kernel overflows and
+when the journal grows over MAX_JOURNAL_SIZE. A run updates the live manifest of the previous run with the journaled
+paths only if the watcher is alive and its session is the one the previous run consumed. Otherwise the source is
+walked in full.
+
+Run the watcher with backup_to_harddrive --watch or python -m backup_to_harddrive.change_journal.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import functools
+import hashlib
+import json
+import logging
+import os
+import select
+import stat
+import struct
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from platformdirs import user_config_dir
+
+from backup_to_harddrive.config import (
+    BackupConfig,
+    extract_valid_configuration_from_config_file,
+)
+from backup_to_harddrive.filters import (
+    ExclusionFilter,
+    Exclusions,
+    as_exclusion_filter,
+    compile_exclusion_filter,
+    get_exclusion_filter_of,
+)
+from backup_to_harddrive.manifest import (
+    Manifest,
+    ManifestEntry,
+    read_manifest,
+    scan_source,
+    write_manifest,
+)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+    | IN_EXCL_UNLINK
+)
+DIRECTORY_CHANGE_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+MAX_JOURNAL_SIZE = 64 * 1024 * 1024
+POLL_INTERVAL_IN_SECONDS = 1.0
+
+
+@dataclass
+class JournalPaths:
+    """Files of the journal of a source, in the journal directory."""
+
+    state: Path
+    journal: Path
+    consuming: Path
+    consumed: Path
+    live_manifest: Path
+
+
+@dataclass
+class WatchedSource:
+    """A source watched by the watcher, with the changed paths not written to its journal yet.
+
+    The source is complete while all its directories are watched.
+    """
+
+    source_path: Path
+    excluded: ExclusionFilter
+    journal_paths: JournalPaths
+    pending: Set[str] = field(default_factory=set)
+    complete: bool = True
+
+
+@dataclass
+class Watcher:
+    """An inotify instance and the directory of each of its watches."""
+
+    fd: int
+    directories: Dict[int, Tuple[WatchedSource, str]] = field(default_factory=dict)
+
+
+def get_path_to_journal_directory() -> Path:
+    """Get the directory holding the journals of the sources.
+
+    Returns:
+        Path: The journal directory, in the user config directory.
+    """
+    return Path(user_config_dir("backup_to_harddrive")) / "journal"
+
+
+def get_journal_paths_of(source_path: Path) -> JournalPaths:
+    """Get the files of the journal of a source.
+
+    Args:
+        source_path [Path]: The source directory.
+    Returns:
+        JournalPaths: The files of the journal.
+    """
+    key = hashlib.blake2b(str(source_path.absolute()).encode("utf-8"), digest_size=8).hexdigest()
+    directory = get_path_to_journal_directory()
+    return JournalPaths(
+        state=directory / f"{key}.state.json",
+        journal=directory / f"{key}.journal",
+        consuming=directory / f"{key}.journal.consuming",
+        consumed=directory / f"{key}.consumed",
+        live_manifest=directory / f"{key}.live.json.gz",
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_libc() -> ctypes.CDLL:
+    """Load the C library, which provides the inotify functions.
+
+    Returns:
+        CDLL: The C library.
+    """
+    return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+def inotify_init() -> int:
+    """Create a non blocking inotify instance.
+
+    Returns:
+        int: The descriptor of the instance.
+    """
+    fd = get_libc().inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return fd
+
+
+def inotify_add_watch(fd: int, directory: str) -> int:
+    """Watch a directory for changes of its entries.
+
+    Args:
+        fd [int]: The descriptor of the inotify instance.
+        directory [str]: The directory to watch.
+    Returns:
+        int: The watch descriptor, the same one if the directory is already watched.
+    """
+    wd = get_libc().inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK)
+    if wd < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), directory)
+    return wd
+
+
+def parse_events(buffer: bytes) -> List[Tuple[int, int, str]]:
+    """Parse the events read from an inotify instance.
+
+    Args:
+        buffer [bytes]: The bytes read.
+    Returns:
+        List[Tuple[int, int, str]]: The watch descriptor, mask and entry name of each event.
+    """
+    events = []
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(buffer):
+        wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+        offset += EVENT_HEADER.size
+        events.append((wd, mask, os.fsdecode(buffer[offset : offset + length].rstrip(b"\0"))))
+        offset += length
+    return events
+
+
+def start_session_of(watched_source: WatchedSource) -> None:
+    """Start a new session of the journal of a source, so that the next run walks the source in full.
+
+    The journal of an incomplete source is never used.
+
+    Args:
+        watched_source [WatchedSource]: The source.
+    """
+    paths = watched_source.journal_paths
+    paths.state.parent.mkdir(parents=True, exist_ok=True)
+    state = {
+        "source": str(watched_source.source_path.absolute()),
+        "session": f"{os.getpid()}-{time.time_ns()}",
+        "pid": os.getpid(),
+        "complete": watched_source.complete,
+    }
+    temporary_path = paths.state.with_name(paths.state.name + ".tmp")
+    temporary_path.write_text(json.dumps(state), encoding="utf-8")
+    os.replace(temporary_path, paths.state)
+    paths.journal.unlink(missing_ok=True)
+
+
+def add_watches_below(watcher: Watcher, watched_source: WatchedSource, directory: str) -> bool:
+    """Watch a directory and all the directories below it, excluded folders and symbolic links apart.
+
+    Args:
+        watcher [Watcher]: The watcher.
+        watched_source [WatchedSource]: The source the directory belongs to.
+        directory [str]: The absolute path of the directory.
+    Returns:
+        bool: False if the limit of watches was reached, the source is then marked incomplete.
+    """
+    for directory_path, directory_names, _ in os.walk(directory):
+        directory_names[:] = [
+            name
+            for name in directory_names
+            if not watched_source.excluded.is_excluded(os.path.join(directory_path, name), True)
+        ]
+        try:
+            wd = inotify_add_watch(watcher.fd, directory_path)
+        except OSError as error:
+            if error.errno in (errno.ENOSPC, errno.ENOMEM):
+                logging.error("Cannot watch %s, raise fs.inotify.max_user_watches. %s", directory_path, error)
+                watched_source.complete = False
+                return False
+            logging.warning("Cannot watch directory: %s %s", directory_path, error)
+            continue
+        watcher.directories[wd] = (watched_source, directory_path)
+    return True
+
+
+def handle_event(watcher: Watcher, wd: int, mask: int, name: str) -> None:
+    """Record the path changed by an inotify event, watching the directories created or moved in.
+
+    Changes of the attributes of directories are not recorded: the manifest only holds files.
+
+    Args:
+        watcher [Watcher]: The watcher.
+        wd [int]: The watch descriptor of the event.
+        mask [int]: The mask of the event.
+        name [str]: The name of the entry, empty for an event on the watched directory itself.
+    """
+    if mask & IN_Q_OVERFLOW:
+        logging.warning("Event queue overflowed, the next runs will walk the sources in full")
+        for watched_source in {id(source): source for source, _ in watcher.directories.values()}.values():
+            watched_source.pending.clear()
+            start_session_of(watched_source)
+        return
+    if mask & IN_IGNORED:
+        watcher.directories.pop(wd, None)
+        return
+    if wd not in watcher.directories or not name:
+        return
+    watched_source, directory = watcher.directories[wd]
+    path = os.path.join(directory, name)
+    if watched_source.excluded.is_excluded(path, bool(mask & IN_ISDIR)):
+        return
+    if mask & IN_ISDIR:
+        if not mask & DIRECTORY_CHANGE_MASK:
+            return
+        if mask & (IN_CREATE | IN_MOVED_TO) and not add_watches_below(watcher, watched_source, path):
+            start_session_of(watched_source)
+    watched_source.pending.add(os.path.relpath(path, watched_source.source_path.absolute()))
+
+
+def write_pending_paths_of(watched_source: WatchedSource) -> None:
+    """Append the pending changed paths of a source to its journal, starting a new session if it grew too large.
+
+    Args:
+        watched_source [WatchedSource]: The source.
+    """
+    if not watched_source.pending:
+        return
+    journal_path = watched_source.journal_paths.journal
+    with open(journal_path, "ab") as file:
+        file.write(b"".join(os.fsencode(path) + b"\0" for path in sorted(watched_source.pending)))
+        size = file.tell()
+    watched_source.pending.clear()
+    if size > MAX_JOURNAL_SIZE:
+        logging.warning("Journal %s overflowed, the next run will walk the source in full", str(journal_path))
+        start_session_of(watched_source)
+
+
+def get_watched_sources_of(backup_configs: List[BackupConfig]) -> List[WatchedSource]:
+    """Get the sources to watch: the ones with an incremental manifest.
+
+    A source shared by several backup configurations only excludes what the rules common to all of them exclude.
+
+    Args:
+        backup_configs [List[BackupConfig]]: The backup configurations.
+    Returns:
+        List[WatchedSource]: The sources to watch.
+    """
+    watched_sources: Dict[Path, WatchedSource] = {}
+    for backup_config in backup_configs:
+        if not backup_config.incremental_manifest:
+            continue
+        source_path = backup_config.source.absolute()
+        excluded = get_exclusion_filter_of(backup_config)
+        if source_path in watched_sources:
+            watched_source = watched_sources[source_path]
+            watched_source.excluded = compile_exclusion_filter(
+                source_path, [], [rule for rule in watched_source.excluded.rules if rule in excluded.rules]
+            )
+            continue
+        watched_sources[source_path] = WatchedSource(source_path, excluded, get_journal_paths_of(source_path))
+    return list(watched_sources.values())
+
+
+def watch_sources(
+    backup_configs: List[BackupConfig],
+    should_stop: Callable[[], bool] = lambda: False,
+    poll_interval: float = POLL_INTERVAL_IN_SECONDS,
+) -> int:
+    """Record the changes below the sources with an incremental manifest until stopped.
+
+    Args:
+        backup_configs [List[BackupConfig]]: The backup configurations.
+        should_stop [Callable[[], bool]]: Checked after each batch of events, the watcher stops when it returns True.
+        poll_interval [float]: Maximum time to wait for events, in seconds.
+    Returns:
+        int: 0 once stopped, 1 if there is no source to watch.
+    """
+    watched_sources = get_watched_sources_of(backup_configs)
+    if not watched_sources:
+        logging.error("No backup configuration uses incremental_manifest, there is nothing to watch.")
+        return 1
+    watcher = Watcher(inotify_init())
+    try:
+        for watched_source in watched_sources:
+            add_watches_below(watcher, watched_source, str(watched_source.source_path))
+            start_session_of(watched_source)
+            logging.info("Watching %s", str(watched_source.source_path))
+        while not should_stop():
+            readable, _, _ = select.select([watcher.fd], [], [], poll_interval)
+            if readable:
+                for wd, mask, name in parse_events(os.read(watcher.fd, READ_SIZE)):
+                    handle_event(watcher, wd, mask, name)
+            for watched_source in watched_sources:
+                write_pending_paths_of(watched_source)
+    except KeyboardInterrupt:
+        logging.info("Watcher stopped.")
+    finally:
+        os.close(watcher.fd)
+    return 0
+
+
+def watch_sources_of_config_file() -> int:
+    """Record the changes below the sources of the configuration file until interrupted.
+
+    Returns:
+        int: 0 once stopped, 1 if there is no source to watch.
+    """
+    return watch_sources(extract_valid_configuration_from_config_file().backup_configs)
+
+
+def read_journal_state(state_path: Path) -> Optional[dict]:
+    """Read the state written by the watcher for a source.
+
+    Args:
+        state_path [Path]: The state file.
+    Returns:
+        Optional[dict]: The state, None if the source was never watched, or if the state cannot be read or has no
+            valid pid.
+    """
+    try:
+        state = json.loads(state_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or not isinstance(state.get("pid"), int) or isinstance(state.get("pid"), bool):
+        return None
+    return state
+
+
+def is_watcher_alive(pid: int) -> bool:
+    """Check if the watcher process is still running.
+
+    Args:
+        pid [int]: The process id of the watcher.
+    Returns:
+        bool: True if a process with this id exists.
+    """
+    try:
+        os.kill(pid, 0)
+    except PermissionError:
+        return True
+    except (OSError, OverflowError):
+        return False
+    return True
+
+
+def read_journal(journal_path: Path) -> List[str]:
+    """Read the changed paths of a journal.
+
+    Args:
+        journal_path [Path]: The journal file.
+    Returns:
+        List[str]: The changed paths, relative to the source, each one once.
+    """
+    try:
+        content = journal_path.read_bytes()
+    except FileNotFoundError:
+        return []
+    return sorted({os.fsdecode(path) for path in content.split(b"\0") if path})
+
+
+def apply_journal_to(
+    manifest: Manifest, source_path: Path, excluded_path_list: Exclusions, relative_paths: List[str]
+) -> Manifest:
+    """Update a manifest of a source with the current state of the changed paths.
+
+    Changed files are stat'ed again. Changed directories are rescanned and deleted ones are removed with their content.
+
+    Args:
+        manifest [Manifest]: The manifest of the source before the changes, updated in place.
+        source_path [Path]: The source directory.
+        excluded_path_list [Exclusions]: The exclusion rules, or the absolute paths of the excluded folders.
+        relative_paths [List[str]]: The changed paths, relative to the source.
+    Returns:
+        Manifest: The updated manifest.
+    """
+    root = str(source_path.absolute())
+    exclusion_filter = as_exclusion_filter(source_path, excluded_path_list)
+    rescanned_directories = []
+    removed_prefixes = []
+    for relative_path in relative_paths:
+        path = os.path.join(root, relative_path)
+        try:
+            path_stat = os.lstat(path)
+        except OSError:
+            if not exclusion_filter.is_below_excluded(path, False):
+                manifest.pop(relative_path, None)
+                removed_prefixes.append(relative_path + os.sep)
+            continue
+        is_directory = stat.S_ISDIR(path_stat.st_mode)
+        if exclusion_filter.is_below_excluded(path, is_directory):
+            continue
+        manifest.pop(relative_path, None)
+        if is_directory:
+            rescanned_directories.append(relative_path)
+            removed_prefixes.append(relative_path + os.sep)
+            continue
+        manifest[relative_path] = ManifestEntry(
+            size=path_stat.st_size, mtime_ns=path_stat.st_mtime_ns, inode=path_stat.st_ino
+        )
+    if removed_prefixes:
+        for stale_path in [path for path in manifest if path.startswith(tuple(removed_prefixes))]:
+            del manifest[stale_path]
+    for relative_path in rescanned_directories:
+        for path, entry in scan_source(Path(root) / relative_path, exclusion_filter).items():
+            manifest[os.path.join(relative_path, path)] = entry
+    return manifest
+
+
+def get_live_manifest_of(source_path: Path, excluded_path_list: Exclusions) -> Manifest:
+    """Get the current metadata of a source, from the journal of the watcher when it can be trusted.
+
+    The journal is trusted if the watcher is alive, watches the whole source, and its session is the one consumed by
+    the previous run, whose live manifest is kept in the journal directory. Otherwise the source is walked in full.
+
+    Args:
+        source_path [Path]: The source directory.
+        excluded_path_list [Exclusions]: The exclusion rules, or the absolute paths of the excluded folders.
+    Returns:
+        Manifest: The metadata of each file, indexed by its path relative to the source.
+    """
+    paths = get_journal_paths_of(source_path)
+    state = read_journal_state(paths.state)
+    if state is None:
+        return scan_source(source_path, excluded_path_list)
+    is_previous_consumption_interrupted = paths.consuming.exists()
+    try:
+        os.replace(paths.journal, paths.consuming)
+    except FileNotFoundError:
+        pass
+    try:
+        consumed_session = paths.consumed.read_text(encoding="utf-8")
+    except OSError:
+        consumed_session = None
+    previous_manifest = read_manifest(paths.live_manifest)
+    if (
+        state.get("complete") is True
+        and state.get("session") == consumed_session
+        and is_watcher_alive(state["pid"])
+        and previous_manifest is not None
+        and not is_previous_consumption_interrupted
+    ):
+        live_manifest = apply_journal_to(
+            previous_manifest, source_path, excluded_path_list, read_journal(paths.consuming)
+        )
+    else:
+        logging.info("Journal of %s cannot be used, walking the source in full", str(source_path))
+        live_manifest = scan_source(source_path, excluded_path_list)
+    write_manifest(paths.live_manifest, live_manifest)
+    paths.consumed.write_text(str(state.get("session")), encoding="utf-8")
+    paths.consuming.unlink(missing_ok=True)
+    return live_manifest
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(watch_sources_of_config_file())
@@ -1,30 +1,68 @@
-"""Functions to handle reading from config files."""
+"""Functions to handle reading from config files.
+
+The parsed configuration file is cached in a binary form in the user cache directory, keyed by the modification time
+and the size of the file, so that a run does not import the YAML parser and parse the file again. The cached content is
+validated at each run: whether the sources and the harddrives exist changes without the file changing.
+"""
 
 import logging
-from dataclasses import dataclass
+import marshal
+import os
+import re
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List
+from typing import Any, List, Optional, Tuple
+
+from platformdirs import user_cache_dir, user_config_dir
 
-import yaml
-import yaml.scanner
-from platformdirs import user_config_dir
+BACKENDS = ["rsync", "native"]
+TARGET_FORMATS = ["directory", "dedup"]
+IO_PRIORITIES = ["normal", "best-effort", "idle"]
+COMPRESSIONS = ["none", "zlib", "zstd"]
+REGEX_RULE_PREFIX = "re:"
 
 
 @dataclass
-class BackupConfig:
+class BackupConfig:  # pylint: disable=(too-many-instance-attributes)
     """Configuration of a single backup use case."""
 
     source: Path
     list_of_harddrive: List[Path]
     list_of_excluded_folders: List[Path]
     quick_restore_path: List[Path]
+    fan_out: bool = False
+    incremental_manifest: bool = False
+    manifest_with_digest: bool = False
+    snapshot: bool = False
+    keep_daily: int = 7
+    keep_weekly: int = 4
+    keep_monthly: int = 6
+    shards: int = 1
+    backend: str = "rsync"
+    target_format: str = "directory"
+    io_priority: str = "normal"
+    nice: int = 0
+    bwlimit: int = 0
+    io_max: int = 0
+    adaptive_throttle: bool = False
+    compression: str = "none"
+    pack_small_files: bool = False
+    exclude: List[str] = field(default_factory=list)
+    large_file_size: int = 0
 
 
 @dataclass
-class RunConfig:
+class RunConfig:  # pylint: disable=(too-many-instance-attributes)
     """Dataclass to hold configuration values for the whole run."""
 
     backup_configs: List[BackupConfig]
+    max_parallel_jobs: int = 0
+    telemetry_file: Optional[Path] = None
+    job_timeout: float = 0
+    stall_timeout: float = 0
+    max_load: float = 0
+    max_disk_latency_ms: float = 0
+    preflight: bool = False
 
 
 def get_path_to_config_file_and_initialize_if_none() -> Path:
@@ -164,6 +202,303 @@ def populate_config_with_valid_quick_restore_path(config_dict: dict, backup: str
         pass
 
 
+def populate_run_config_with_valid_max_parallel_jobs(config_dict: dict, run_config: RunConfig) -> None:
+    """Populate the run configuration with the global limit of parallel jobs.
+
+    Args:
+        config_dict (dict): Dictionary containing the configuration data (read from a YAML file for example).
+        run_config (RunConfig): Run configuration to populate.
+    """
+    max_parallel_jobs = config_dict.get("max_parallel_jobs", 0)
+    if isinstance(max_parallel_jobs, bool) or not isinstance(max_parallel_jobs, int) or max_parallel_jobs < 0:
+        logging.warning("'max_parallel_jobs' must be a positive integer, got: %s. No limit applied.", max_parallel_jobs)
+        return
+    run_config.max_parallel_jobs = max_parallel_jobs
+
+
+def populate_run_config_with_valid_limits(config_dict: dict, run_config: RunConfig) -> None:
+    """Populate the run configuration with the time limits of the jobs and the thresholds of the adaptive throttling.
+
+    Args:
+        config_dict (dict): Dictionary containing the configuration data (read from a YAML file for example).
+        run_config (RunConfig): Run configuration to populate.
+    """
+    for key in ["job_timeout", "stall_timeout", "max_load", "max_disk_latency_ms"]:
+        value = config_dict.get(key, 0)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            logging.warning("'%s' must be a positive number, got: %s. Default applied.", key, value)
+            continue
+        setattr(run_config, key, value)
+
+
+def populate_run_config_with_telemetry_file(config_dict: dict, run_config: RunConfig) -> None:
+    """Populate the run configuration with the file receiving the telemetry of the run.
+
+    Args:
+        config_dict (dict): Dictionary containing the configuration data (read from a YAML file for example).
+        run_config (RunConfig): Run configuration to populate.
+    """
+    telemetry_file = config_dict.get("telemetry_file")
+    if telemetry_file is None:
+        return
+    if not isinstance(telemetry_file, str):
+        logging.warning("'telemetry_file' must be a path, got: %s. Telemetry disabled.", telemetry_file)
+        return
+    run_config.telemetry_file = Path(telemetry_file).expanduser()
+
+
+def populate_run_config_with_preflight(config_dict: dict, run_config: RunConfig) -> None:
+    """Populate the run configuration with the activation of the pre-flight check of the harddrives.
+
+    Args:
+        config_dict (dict): Dictionary containing the configuration data (read from a YAML file for example).
+        run_config (RunConfig): Run configuration to populate.
+    """
+    preflight = config_dict.get("preflight", False)
+    if not isinstance(preflight, bool):
+        logging.warning("'preflight' must be true or false, got: %s. No pre-flight check done.", preflight)
+        return
+    run_config.preflight = preflight
+
+
+def get_optional_setting(config_dict: dict, backup: str, key: str, default: Any, expected_type: type) -> Any:
+    """Get an optional setting of a backup configuration, falling back to a default value.
+
+    Args:
+        config_dict (dict): Dictionary containing the configuration data (read from a YAML file for example).
+        backup (str): Key to look for in the dictionary.
+        key (str): Name of the setting.
+        default (Any): Value used when the setting is absent, empty or invalid.
+        expected_type (type): Type the setting must have.
+    Returns:
+        Any: The value of the setting.
+    """
+    value = config_dict["backup_configurations"][backup].get(key)
+    if value is None:
+        return default
+    if not isinstance(value, expected_type) or (expected_type is int and isinstance(value, bool)):
+        logging.warning(
+            "'%s' must be of type %s for configuration: %s. Default value %s used.",
+            key,
+            expected_type.__name__,
+            backup,
+            default,
+        )
+        return default
+    return value
+
+
+def populate_config_with_optional_settings(config_dict: dict, backup: str, backup_config: BackupConfig) -> None:
+    """Populate the backup configuration with the optional settings that tune how the backup is performed.
+
+    Args:
+        config_dict (dict): Dictionary containing the configuration data (read from a YAML file for example).
+        backup (str): Key to look for in the dictionary.
+        backup_config (BackupConfig): Backup configuration to populate.
+    """
+    backup_config.fan_out = get_optional_setting(config_dict, backup, "fan_out", False, bool)
+    backup_config.incremental_manifest = get_optional_setting(config_dict, backup, "incremental_manifest", False, bool)
+    backup_config.manifest_with_digest = get_optional_setting(config_dict, backup, "manifest_with_digest", False, bool)
+    backup_config.snapshot = get_optional_setting(config_dict, backup, "snapshot", False, bool)
+    backup_config.keep_daily = get_optional_setting(config_dict, backup, "keep_daily", 7, int)
+    backup_config.keep_weekly = get_optional_setting(config_dict, backup, "keep_weekly", 4, int)
+    backup_config.keep_monthly = get_optional_setting(config_dict, backup, "keep_monthly", 6, int)
+    backup_config.shards = get_optional_setting(config_dict, backup, "shards", 1, int)
+    backup_config.backend = get_optional_setting(config_dict, backup, "backend", "rsync", str)
+    if backup_config.backend not in BACKENDS:
+        logging.warning("'backend' must be one of %s for configuration: %s. rsync used.", ", ".join(BACKENDS), backup)
+        backup_config.backend = "rsync"
+    if backup_config.snapshot and backup_config.incremental_manifest:
+        logging.warning("'incremental_manifest' is ignored for configuration: %s as 'snapshot' is enabled.", backup)
+        backup_config.incremental_manifest = False
+    backup_config.large_file_size = get_optional_setting(config_dict, backup, "large_file_size", 0, int)
+    backup_config.target_format = get_optional_setting(config_dict, backup, "target_format", "directory", str)
+    populate_config_with_valid_target_format(backup, backup_config)
+    backup_config.compression = get_optional_setting(config_dict, backup, "compression", "none", str)
+    backup_config.pack_small_files = get_optional_setting(config_dict, backup, "pack_small_files", False, bool)
+    populate_config_with_valid_store_settings(backup, backup_config)
+    populate_config_with_valid_shards(backup, backup_config)
+    populate_config_with_valid_large_file_size(backup, backup_config)
+    populate_config_with_valid_priority(config_dict, backup, backup_config)
+    populate_config_with_valid_exclude_rules(config_dict, backup, backup_config)
+
+
+def populate_config_with_valid_exclude_rules(config_dict: dict, backup: str, backup_config: BackupConfig) -> None:
+    """Populate the backup configuration with the valid glob and regular expression exclusion rules.
+
+    Regular expressions are only kept for the backups that are not transferred by rsync: the dedup store, or the
+    native backend without shards.
+
+    Args:
+        config_dict (dict): Dictionary containing the configuration data (read from a YAML file for example).
+        backup (str): Key to look for in the dictionary.
+        backup_config (BackupConfig): Backup configuration to populate.
+    """
+    is_transferred_by_rsync = backup_config.target_format != "dedup" and (
+        backup_config.backend == "rsync" or backup_config.shards > 1
+    )
+    for rule in get_optional_setting(config_dict, backup, "exclude", [], list):
+        if not isinstance(rule, str) or not rule.strip("/") or "\n" in rule:
+            logging.warning("Exclusion rule: %s is not a pattern for configuration: %s. Rule skipped.", rule, backup)
+            continue
+        if rule.startswith(REGEX_RULE_PREFIX):
+            if is_transferred_by_rsync:
+                logging.warning(
+                    "Exclusion rule: %s is a regular expression, which rsync does not support, for configuration: %s."
+                    " Rule skipped.",
+                    rule,
+                    backup,
+                )
+                continue
+            try:
+                re.compile(f"(?:{rule[len(REGEX_RULE_PREFIX) :]})")
+            except re.error as error:
+                logging.warning(
+                    "Exclusion rule: %s is not a valid regular expression for configuration: %s. Rule skipped. %s",
+                    rule,
+                    backup,
+                    error,
+                )
+                continue
+        backup_config.exclude.append(rule)
+
+
+def populate_config_with_valid_priority(config_dict: dict, backup: str, backup_config: BackupConfig) -> None:
+    """Populate the backup configuration with the priority and the bandwidth limits of its jobs.
+
+    Args:
+        config_dict (dict): Dictionary containing the configuration data (read from a YAML file for example).
+        backup (str): Key to look for in the dictionary.
+        backup_config (BackupConfig): Backup configuration to populate.
+    """
+    backup_config.io_priority = get_optional_setting(config_dict, backup, "io_priority", "normal", str)
+    if backup_config.io_priority not in IO_PRIORITIES:
+        logging.warning(
+            "'io_priority' must be one of %s for configuration: %s. normal used.", ", ".join(IO_PRIORITIES), backup
+        )
+        backup_config.io_priority = "normal"
+    backup_config.nice = get_optional_setting(config_dict, backup, "nice", 0, int)
+    if not 0 <= backup_config.nice <= 19:
+        logging.warning("'nice' must be between 0 and 19 for configuration: %s. 0 used.", backup)
+        backup_config.nice = 0
+    for key in ["bwlimit", "io_max"]:
+        setattr(backup_config, key, get_optional_setting(config_dict, backup, key, 0, int))
+        if getattr(backup_config, key) < 0:
+            logging.warning("'%s' must be positive for configuration: %s. No limit applied.", key, backup)
+            setattr(backup_config, key, 0)
+    backup_config.adaptive_throttle = get_optional_setting(config_dict, backup, "adaptive_throttle", False, bool)
+
+
+def populate_config_with_valid_target_format(backup: str, backup_config: BackupConfig) -> None:
+    """Check the target format, and disable the modes that only apply to plain directories for the dedup store.
+
+    Args:
+        backup (str): Name of the backup configuration.
+        backup_config (BackupConfig): Backup configuration to check.
+    """
+    if backup_config.target_format not in TARGET_FORMATS:
+        logging.warning(
+            "'target_format' must be one of %s for configuration: %s. directory used.",
+            ", ".join(TARGET_FORMATS),
+            backup,
+        )
+        backup_config.target_format = "directory"
+    if backup_config.target_format != "dedup":
+        return
+    for mode, default in [
+        ("fan_out", False),
+        ("incremental_manifest", False),
+        ("snapshot", False),
+        ("shards", 1),
+        ("backend", "rsync"),
+        ("large_file_size", 0),
+    ]:
+        if getattr(backup_config, mode) != default:
+            logging.warning("'%s' is ignored for configuration: %s as 'target_format' is dedup.", mode, backup)
+            setattr(backup_config, mode, default)
+
+
+def populate_config_with_valid_store_settings(backup: str, backup_config: BackupConfig) -> None:
+    """Check the compression and the packing, which only apply to the chunks of the dedup store.
+
+    Args:
+        backup (str): Name of the backup configuration.
+        backup_config (BackupConfig): Backup configuration to check.
+    """
+    if backup_config.compression not in COMPRESSIONS:
+        logging.warning(
+            "'compression' must be one of %s for configuration: %s. No compression applied.",
+            ", ".join(COMPRESSIONS),
+            backup,
+        )
+        backup_config.compression = "none"
+    if backup_config.target_format == "dedup":
+        return
+    for setting, default in [("compression", "none"), ("pack_small_files", False)]:
+        if getattr(backup_config, setting) != default:
+            logging.warning("'%s' is ignored for configuration: %s as 'target_format' is not dedup.", setting, backup)
+            setattr(backup_config, setting, default)
+
+
+def populate_config_with_valid_shards(backup: str, backup_config: BackupConfig) -> None:
+    """Fall back to a single rsync job per harddrive when the number of shards cannot be applied.
+
+    Sharding only applies to plain backups: incremental, snapshot and fan out modes need a single job per harddrive.
+
+    Args:
+        backup (str): Name of the backup configuration.
+        backup_config (BackupConfig): Backup configuration to check.
+    """
+    if backup_config.shards < 1:
+        logging.warning("'shards' must be at least 1 for configuration: %s. No sharding applied.", backup)
+        backup_config.shards = 1
+    incompatible_modes = [
+        mode
+        for mode, is_enabled in [
+            ("fan_out", backup_config.fan_out),
+            ("incremental_manifest", backup_config.incremental_manifest),
+            ("snapshot", backup_config.snapshot),
+        ]
+        if is_enabled
+    ]
+    if backup_config.shards > 1 and incompatible_modes:
+        logging.warning(
+            "'shards' is ignored for configuration: %s as '%s' is enabled.", backup, "', '".join(incompatible_modes)
+        )
+        backup_config.shards = 1
+
+
+def populate_config_with_valid_large_file_size(backup: str, backup_config: BackupConfig) -> None:
+    """Disable the block-level transfer of the large files when it cannot be applied.
+
+    The blocks are written in place, while the files of snapshots are hard links to the previous ones. Fan out seeds
+    and shards do not run the block-level transfer.
+
+    Args:
+        backup (str): Name of the backup configuration.
+        backup_config (BackupConfig): Backup configuration to check.
+    """
+    if backup_config.large_file_size < 0:
+        logging.warning("'large_file_size' must be positive for configuration: %s. Files copied whole.", backup)
+        backup_config.large_file_size = 0
+    incompatible_modes = [
+        mode
+        for mode, is_enabled in [
+            ("fan_out", backup_config.fan_out),
+            ("snapshot", backup_config.snapshot),
+            ("shards", backup_config.shards > 1),
+        ]
+        if is_enabled
+    ]
+    if backup_config.large_file_size and incompatible_modes:
+        logging.warning(
+            "'large_file_size' is ignored for configuration: %s as '%s' is enabled.",
+            backup,
+            "', '".join(incompatible_modes),
+        )
+        backup_config.large_file_size = 0
+
+
 def extract_valid_configuration_from_configuration_dict(config_dict: dict) -> BackupConfig:
     """Extract valid configuration from a dictionary.
 
@@ -173,6 +508,10 @@ def extract_valid_configuration_from_configuration_dict(config_dict: dict) -> Ba
         RunConfig: Dataclass containing the configuration.
     """
     run_config = RunConfig(backup_configs=[])
+    populate_run_config_with_valid_max_parallel_jobs(config_dict, run_config)
+    populate_run_config_with_valid_limits(config_dict, run_config)
+    populate_run_config_with_telemetry_file(config_dict, run_config)
+    populate_run_config_with_preflight(config_dict, run_config)
     if config_dict["backup_configurations"] is None:
         logging.error("No backup configurations found in the configuration file.")
         return run_config
@@ -189,31 +528,111 @@ def extract_valid_configuration_from_configuration_dict(config_dict: dict) -> Ba
             continue
         populate_config_with_valid_excluded_folders(config_dict, backup, backup_config)
         populate_config_with_valid_quick_restore_path(config_dict, backup, backup_config)
+        populate_config_with_optional_settings(config_dict, backup, backup_config)
         run_config.backup_configs.append(backup_config)
     return run_config
 
 
-def extract_valid_configuration_from_config_file() -> RunConfig:
-    """Read configuration from a YAML file and populate the RunConfig dataclass.
+def get_path_to_config_cache() -> Path:
+    """Get the path of the cached configuration file.
+
+    Returns:
+        Path: The path to the cache, in the user cache directory.
+    """
+    return Path(user_cache_dir("backup_to_harddrive")) / "config_cache.marshal"
 
-    This will read from the default config file in the user's configuration directory
-    Not valid configurations (missing entry, or invalid path) will be logged and skipped.
 
+def get_config_cache_key_of(config_file_path: Path) -> Optional[Tuple[str, int, int]]:
+    """Get what identifies a version of the configuration file in the cache.
+
+    Args:
+        config_file_path (Path): The path to the configuration file.
     Returns:
-        RunConfig: Dataclass containing the valid configurations only.
+        Optional[Tuple[str, int, int]]: The path, modification time and size of the file, None if it cannot be accessed.
     """
     try:
-        config_file_path = get_path_to_config_file_and_initialize_if_none()
+        stat = config_file_path.stat()
+    except OSError:
+        return None
+    return str(config_file_path.absolute()), stat.st_mtime_ns, stat.st_size
+
+
+def read_config_cache(key: Tuple[str, int, int]) -> Optional[dict]:
+    """Read the cached configuration file.
+
+    Args:
+        key (Tuple[str, int, int]): The key of the current version of the configuration file.
+    Returns:
+        Optional[dict]: The configuration data, None if the cache is missing, unreadable or of another version.
+    """
+    try:
+        cached_key, config_dict = marshal.loads(get_path_to_config_cache().read_bytes())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return config_dict if cached_key == key else None
+
+
+def write_config_cache(key: Tuple[str, int, int], config_dict: dict) -> None:
+    """Cache the configuration file, unless it holds values that cannot be cached, such as dates.
+
+    Args:
+        key (Tuple[str, int, int]): The key of the version of the configuration file that was read.
+        config_dict (dict): The configuration data.
+    """
+    try:
+        data = marshal.dumps((key, config_dict))
+    except ValueError:
+        return
+    cache_path = get_path_to_config_cache()
+    temporary_path = cache_path.with_suffix(".tmp")
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path.write_bytes(data)
+        os.replace(temporary_path, cache_path)
+    except OSError as error:
+        logging.warning("Cannot cache the configuration file: %s", error)
+
+
+def read_config_file(config_file_path: Path) -> Optional[dict]:
+    """Read the configuration file, from the cache if it did not change since it was cached.
+
+    The YAML parser is only imported when the file is parsed.
+
+    Args:
+        config_file_path (Path): The path to the configuration file.
+    Returns:
+        Optional[dict]: The configuration data, None if the file is empty or not valid YAML.
+    """
+    key = get_config_cache_key_of(config_file_path)
+    config_dict = None if key is None else read_config_cache(key)
+    if config_dict is not None:
+        return config_dict
+    import yaml.scanner  # pylint: disable=(import-outside-toplevel)
+
+    try:
         with open(config_file_path, "r", encoding="utf-8") as file:
             config_dict = yaml.safe_load(file)
-            if config_dict is None:
-                logging.error("No configuration found in the configuration file: %s.", config_file_path)
-                return RunConfig(backup_configs=[])
-            return extract_valid_configuration_from_configuration_dict(config_dict)
     except yaml.scanner.ScannerError:
-        logging.error(
-            "Yaml structure of the configuration file not valid: %s",
-            str(get_path_to_config_file_and_initialize_if_none().absolute()),
-        )
+        logging.error("Yaml structure of the configuration file not valid: %s", str(config_file_path.absolute()))
+        return None
+    if config_dict is None:
+        logging.error("No configuration found in the configuration file: %s.", config_file_path)
+        return None
+    if key is not None:
+        write_config_cache(key, config_dict)
+    return config_dict
+
+
+def extract_valid_configuration_from_config_file() -> RunConfig:
+    """Read configuration from a YAML file and populate the RunConfig dataclass.
+
+    This will read from the default config file in the user's configuration directory
+    Not valid configurations (missing entry, or invalid path) will be logged and skipped.
 
+    Returns:
+        RunConfig: Dataclass containing the valid configurations only.
+    """
+    config_dict = read_config_file(get_path_to_config_file_and_initialize_if_none())
+    if config_dict is None:
         return RunConfig(backup_configs=[])
+    return extract_valid_configuration_from_configuration_dict(config_dict)
@@ -0,0 +1,893 @@
+"""Content addressed store that deduplicates the backups written to a harddrive.
+
+Files are split into chunks at content defined boundaries and each chunk is stored once per harddrive, under its
+BLAKE2b hash, in Backup/.store/chunks. Every run of a source writes a manifest listing the chunks of each file in
+Backup/<hostname>/runs/<run name>/<source name>.json.gz. Data shared by several sources, hosts or runs is then written
+only once.
+
+Every byte value is mapped to a bit by CUT_CANDIDATE_TABLE, and a cut point candidate is a position where the bits of
+the bytes before it spell CUT_CANDIDATE_PATTERN, so that any content, text included, has candidates. A candidate is a
+chunk boundary when the BLAKE2b hash of the HASH_WINDOW_SIZE bytes before it has its CUT_BITS top bits cleared, so that
+boundaries move with the content when bytes are inserted or removed. Every position is tested with bytes.translate and
+bytes.find, keeping the chunking fast without a compiled extension.
+
+Chunks can be stored compressed, with zstd (multithreaded, if the zstandard package is installed) or zlib. A
+compressed chunk gets the suffix of its compression, and is stored plain when compression does not save enough. The
+hash is the one of the plain content, so chunks are still shared between compressed and plain backups, and restoring
+reads any of them.
+
+With packing, the chunks smaller than PACKED_CHUNK_MAX_SIZE (small files and the tails of large ones) are appended
+to segment files in Backup/.store/packs instead of being written to a file each, which avoids the cost of creating
+millions of files on a slow harddrive. Each segment has an index file, a JSON line per chunk with its offset. A run
+appends to its own segments, so incremental runs leave small segments behind: compaction merges them once there are
+SMALL_SEGMENTS_BEFORE_COMPACTION, dropping the chunks no run manifest of the store refers to anymore.
+
+Run it with python -m backup_to_harddrive.dedup_store backup|restore|compact.
+"""
+
+import argparse
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import os
+import stat
+import sys
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import (
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    TextIO,
+    Tuple,
+)
+
+from backup_to_harddrive.filters import (
+    Exclusions,
+    as_exclusion_filter,
+    compile_exclusion_filter,
+    read_rules_file,
+)
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+READ_SIZE = 8 * 1024 * 1024
+CUT_CANDIDATE_TABLE = bytes(hashlib.blake2b(bytes([value]), digest_size=1).digest()[0] & 1 for value in range(256))
+CUT_CANDIDATE_PATTERN = b"\x01\x00\x00\x01\x00\x01\x01\x00"
+CUT_BITS = 12
+HASH_WINDOW_SIZE = 32
+RETURN_CODE_PARTIAL_TRANSFER = 23
+STORE_DIRECTORY_NAME = ".store"
+COMPRESSED_CHUNK_SUFFIXES = {"zstd": ".zst", "zlib": ".zz"}
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 6
+MAX_COMPRESSED_SIZE_RATIO = 0.95
+PACKS_DIRECTORY_NAME = "packs"
+PACKED_CHUNK_MAX_SIZE = 128 * 1024
+SEGMENT_MAX_SIZE = 64 * 1024 * 1024
+SMALL_SEGMENT_SIZE = SEGMENT_MAX_SIZE // 4
+SMALL_SEGMENTS_BEFORE_COMPACTION = 8
+RESTORE_THREADS = 8
+
+Compressor = Tuple[str, Optional[Callable[[bytes], bytes]]]
+
+
+@dataclass
+class StoreEntry:
+    """An entry of a run manifest: a directory, a symbolic link or a file with its chunks."""
+
+    kind: str
+    size: int = 0
+    mtime_ns: int = 0
+    mode: int = 0
+    chunks: List[str] = field(default_factory=list)
+    target: str = ""
+
+
+StoreManifest = Dict[str, StoreEntry]
+
+
+@dataclass
+class PackedChunk:
+    """Location of a chunk in a segment of the packs, with the suffix of its compression."""
+
+    segment: str
+    offset: int
+    length: int
+    suffix: str = ""
+
+
+@dataclass
+class StoreWriter:  # pylint: disable=(too-many-instance-attributes)
+    """What a backup needs to add chunks to the store.
+
+    With pack, the small chunks are appended to the current segment, opened on the first one. The directories of the
+    loose chunks written are synced with the segments.
+    """
+
+    store_path: Path
+    compressor: Compressor = ("", None)
+    pack: bool = False
+    known_chunks: Set[str] = field(default_factory=set)
+    packed_chunks: Dict[str, PackedChunk] = field(default_factory=dict)
+    segment_file: Optional[BinaryIO] = None
+    index_file: Optional[TextIO] = None
+    chunk_directories: Set[Path] = field(default_factory=set)
+
+
+@dataclass
+class StoreStats:
+    """Statistics of a backup to the store."""
+
+    files_transferred: int = 0
+    bytes_transferred: int = 0
+    bytes_written: int = 0
+    errors: int = 0
+
+
+def get_path_to_store(harddrive_path: Path) -> Path:
+    """Get the path of the chunk store of a harddrive, shared by all the hosts.
+
+    Args:
+        harddrive_path [Path]: The path to the harddrive.
+    Returns:
+        Path: The store directory.
+    """
+    return harddrive_path.absolute() / "Backup" / STORE_DIRECTORY_NAME
+
+
+def get_path_to_run_manifest(backup_path: Path, run_name: str, source_name: str) -> Path:
+    """Get the path of the manifest of a source for a run.
+
+    Args:
+        backup_path [Path]: The backup directory within the harddrive (Backup/<hostname>).
+        run_name [str]: The name of the run.
+        source_name [str]: The name of the source directory.
+    Returns:
+        Path: The path to the manifest.
+    """
+    return backup_path / "runs" / run_name / f"{source_name}.json.gz"
+
+
+def get_latest_run_manifest_of(backup_path: Path, source_name: str) -> Optional[Path]:
+    """Get the manifest of the latest complete run of a source.
+
+    Args:
+        backup_path [Path]: The backup directory within the harddrive (Backup/<hostname>).
+        source_name [str]: The name of the source directory.
+    Returns:
+        Optional[Path]: The path to the manifest, None if the source was never backed up to the store.
+    """
+    try:
+        run_names = sorted((entry.name for entry in os.scandir(backup_path / "runs") if entry.is_dir()), reverse=True)
+    except OSError:
+        return None
+    for run_name in run_names:
+        manifest_path = get_path_to_run_manifest(backup_path, run_name, source_name)
+        if manifest_path.exists():
+            return manifest_path
+    return None
+
+
+def find_cut_point(data: bytes, start: int, end: int) -> int:
+    """Find the end of the chunk starting at a position.
+
+    Args:
+        data [bytes]: The buffer.
+        start [int]: Start of the chunk in the buffer.
+        end [int]: End of the data available in the buffer.
+    Returns:
+        int: The end of the chunk, between start + MIN_CHUNK_SIZE and start + MAX_CHUNK_SIZE unless end comes first.
+    """
+    limit = min(end, start + MAX_CHUNK_SIZE)
+    first = start + MIN_CHUNK_SIZE - len(CUT_CANDIDATE_PATTERN)
+    if limit <= start + MIN_CHUNK_SIZE:
+        return limit
+    bits = data[first:limit].translate(CUT_CANDIDATE_TABLE)
+    candidate = bits.find(CUT_CANDIDATE_PATTERN)
+    while candidate >= 0:
+        position = first + candidate + len(CUT_CANDIDATE_PATTERN)
+        window_hash = hashlib.blake2b(data[position - HASH_WINDOW_SIZE : position], digest_size=8).digest()
+        if int.from_bytes(window_hash, "big") < 1 << (64 - CUT_BITS):
+            return position
+        candidate = bits.find(CUT_CANDIDATE_PATTERN, candidate + 1)
+    return limit
+
+
+def iter_chunks_of(file: BinaryIO) -> Iterator[bytes]:
+    """Split the content of a file into content defined chunks.
+
+    Args:
+        file [BinaryIO]: The file, opened for binary reading.
+    Yields:
+        bytes: The successive chunks.
+    """
+    buffer = b""
+    position = 0
+    is_end_of_file = False
+    while not is_end_of_file:
+        data = file.read(READ_SIZE)
+        is_end_of_file = not data
+        buffer = buffer[position:] + data
+        position = 0
+        while len(buffer) - position >= MAX_CHUNK_SIZE or (is_end_of_file and position < len(buffer)):
+            cut_point = find_cut_point(buffer, position, len(buffer))
+            yield buffer[position:cut_point]
+            position = cut_point
+
+
+def get_path_to_chunk(store_path: Path, chunk_hash: str) -> Path:
+    """Get the path of a chunk in the store.
+
+    Args:
+        store_path [Path]: The store directory.
+        chunk_hash [str]: The hexadecimal hash of the chunk.
+    Returns:
+        Path: The path to the chunk.
+    """
+    return store_path / "chunks" / chunk_hash[:2] / chunk_hash
+
+
+def find_chunk(store_path: Path, chunk_hash: str) -> Optional[Path]:
+    """Find a chunk in the store, plain or compressed.
+
+    Args:
+        store_path [Path]: The store directory.
+        chunk_hash [str]: The hexadecimal hash of the chunk.
+    Returns:
+        Optional[Path]: The path to the chunk, None if the store does not hold it.
+    """
+    chunk_path = get_path_to_chunk(store_path, chunk_hash)
+    for suffix in [""] + list(COMPRESSED_CHUNK_SUFFIXES.values()):
+        if chunk_path.with_name(chunk_hash + suffix).exists():
+            return chunk_path.with_name(chunk_hash + suffix)
+    return None
+
+
+def get_compressor_for(compression: str) -> Compressor:
+    """Get the compressor of the chunks, falling back to zlib when zstandard is not installed.
+
+    Args:
+        compression [str]: none, zlib or zstd.
+    Returns:
+        Compressor: The suffix of the compressed chunks and the function compressing them, None for no compression.
+    """
+    if compression == "zstd" and zstandard is None:
+        logging.warning("zstandard is not installed, chunks are compressed with zlib")
+        compression = "zlib"
+    if compression == "zstd":
+        return COMPRESSED_CHUNK_SUFFIXES["zstd"], zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1).compress
+    if compression == "zlib":
+        return COMPRESSED_CHUNK_SUFFIXES["zlib"], functools.partial(zlib.compress, level=ZLIB_LEVEL)
+    return "", None
+
+
+def get_path_to_packs(store_path: Path) -> Path:
+    """Get the directory of the segments of a store.
+
+    Args:
+        store_path [Path]: The store directory.
+    Returns:
+        Path: The directory of the segments and of their index.
+    """
+    return store_path / PACKS_DIRECTORY_NAME
+
+
+def read_pack_index(store_path: Path) -> Dict[str, PackedChunk]:
+    """Read the index of all the segments of a store.
+
+    Torn lines, and chunks beyond the end of their segment, left by an interrupted backup are ignored.
+
+    Args:
+        store_path [Path]: The store directory.
+    Returns:
+        Dict[str, PackedChunk]: The location of each packed chunk, indexed by its hash.
+    """
+    packed_chunks = {}
+    for index_path in sorted(get_path_to_packs(store_path).glob("*.idx")):
+        try:
+            segment_size = index_path.with_suffix(".pack").stat().st_size
+            lines = index_path.read_text(encoding="utf-8").splitlines()
+        except OSError as error:
+            logging.warning("Pack index: %s cannot be read. %s", str(index_path), error)
+            continue
+        for line in lines:
+            try:
+                chunk_hash, offset, length, suffix = json.loads(line)
+            except (ValueError, TypeError):
+                continue
+            if offset + length <= segment_size:
+                packed_chunks[chunk_hash] = PackedChunk(index_path.stem, offset, length, suffix)
+    return packed_chunks
+
+
+def open_segment(store_path: Path) -> Tuple[BinaryIO, TextIO]:
+    """Open a new segment, and its index, to append chunks to.
+
+    Args:
+        store_path [Path]: The store directory.
+    Returns:
+        Tuple[BinaryIO, TextIO]: The segment and its index, opened for appending.
+    """
+    packs_path = get_path_to_packs(store_path)
+    packs_path.mkdir(parents=True, exist_ok=True)
+    segment_name = f"{time.time_ns()}_{os.getpid()}"
+    segment_file = open(packs_path / f"{segment_name}.pack", "ab")  # pylint: disable=(consider-using-with)
+    index_path = packs_path / f"{segment_name}.idx"
+    index_file = open(index_path, "a", encoding="utf-8")  # pylint: disable=(consider-using-with)
+    return segment_file, index_file
+
+
+def close_segment(store_writer: StoreWriter) -> None:
+    """Sync and close the current segment, then its index, if there is one.
+
+    Args:
+        store_writer [StoreWriter]: The writer, updated in place.
+    """
+    for file in [store_writer.segment_file, store_writer.index_file]:
+        if file is not None:
+            file.flush()
+            os.fsync(file.fileno())
+            file.close()
+    store_writer.segment_file = None
+    store_writer.index_file = None
+
+
+def sync_chunk_directories(store_writer: StoreWriter) -> None:
+    """Sync the directories the loose chunks were moved to, so that a manifest never references a lost chunk.
+
+    Args:
+        store_writer [StoreWriter]: The writer, updated in place.
+    """
+    for directory in sorted(store_writer.chunk_directories):
+        directory_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+    store_writer.chunk_directories.clear()
+
+
+def append_to_segment(store_writer: StoreWriter, chunk_hash: str, data: bytes, suffix: str) -> None:
+    """Append a chunk to the current segment, starting a new one when it is full.
+
+    Args:
+        store_writer [StoreWriter]: The writer, updated in place.
+        chunk_hash [str]: The hash of the plain content of the chunk.
+        data [bytes]: The chunk, as stored.
+        suffix [str]: The suffix of its compression, empty if it is plain.
+    """
+    if store_writer.segment_file is not None and store_writer.segment_file.tell() + len(data) > SEGMENT_MAX_SIZE:
+        close_segment(store_writer)
+    if store_writer.segment_file is None or store_writer.index_file is None:
+        store_writer.segment_file, store_writer.index_file = open_segment(store_writer.store_path)
+    offset = store_writer.segment_file.tell()
+    store_writer.segment_file.write(data)
+    store_writer.index_file.write(json.dumps([chunk_hash, offset, len(data), suffix]) + "\n")
+    store_writer.packed_chunks[chunk_hash] = PackedChunk(
+        Path(store_writer.segment_file.name).stem, offset, len(data), suffix
+    )
+
+
+def compress_chunk(chunk: bytes, compressor: Compressor) -> Tuple[bytes, str]:
+    """Compress a chunk, unless compression saves too little.
+
+    Args:
+        chunk [bytes]: The chunk.
+        compressor [Compressor]: The compressor.
+    Returns:
+        Tuple[bytes, str]: The chunk as it is stored and the suffix of its compression, empty if it is plain.
+    """
+    suffix, compress = compressor
+    if compress is None:
+        return chunk, ""
+    compressed_chunk = compress(chunk)
+    if len(compressed_chunk) < len(chunk) * MAX_COMPRESSED_SIZE_RATIO:
+        return compressed_chunk, suffix
+    return chunk, ""
+
+
+def store_chunk(store_writer: StoreWriter, chunk: bytes) -> Tuple[str, int]:
+    """Store a chunk unless the store already holds it.
+
+    A small chunk that is packed is only looked up in the packs, so that no file is accessed for it.
+
+    Args:
+        store_writer [StoreWriter]: The writer.
+        chunk [bytes]: The chunk.
+    Returns:
+        Tuple[str, int]: The hash of the chunk and the number of bytes written.
+    """
+    chunk_hash = hashlib.blake2b(chunk, digest_size=32).hexdigest()
+    if chunk_hash in store_writer.known_chunks:
+        return chunk_hash, 0
+    store_writer.known_chunks.add(chunk_hash)
+    is_packed = store_writer.pack and len(chunk) < PACKED_CHUNK_MAX_SIZE
+    if chunk_hash in store_writer.packed_chunks or (
+        not is_packed and find_chunk(store_writer.store_path, chunk_hash) is not None
+    ):
+        return chunk_hash, 0
+    data, suffix = compress_chunk(chunk, store_writer.compressor)
+    if is_packed:
+        append_to_segment(store_writer, chunk_hash, data, suffix)
+        return chunk_hash, len(data)
+    chunk_path = get_path_to_chunk(store_writer.store_path, chunk_hash).with_name(chunk_hash + suffix)
+    chunk_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = chunk_path.with_name(f".{chunk_hash}.{os.getpid()}.tmp")
+    with open(temporary_path, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, chunk_path)
+    store_writer.chunk_directories.add(chunk_path.parent)
+    return chunk_hash, len(data)
+
+
+def read_packed_chunk(store_path: Path, packed_chunk: PackedChunk) -> bytes:
+    """Read a chunk from its segment, as it is stored.
+
+    Args:
+        store_path [Path]: The store directory.
+        packed_chunk [PackedChunk]: The location of the chunk.
+    Returns:
+        bytes: The chunk, compressed if it was.
+    Raises:
+        OSError: If the segment cannot be read or is truncated.
+    """
+    segment_path = get_path_to_packs(store_path) / f"{packed_chunk.segment}.pack"
+    with open(segment_path, "rb") as file:
+        file.seek(packed_chunk.offset)
+        data = file.read(packed_chunk.length)
+    if len(data) != packed_chunk.length:
+        raise OSError(f"Truncated segment: {str(segment_path)}")
+    return data
+
+
+def decompress_chunk(data: bytes, suffix: str, chunk_path: Path) -> bytes:
+    """Get the plain content of a chunk.
+
+    Args:
+        data [bytes]: The chunk, as stored.
+        suffix [str]: The suffix of its compression, empty if it is plain.
+        chunk_path [Path]: The file holding the chunk, for the error messages.
+    Returns:
+        bytes: The content of the chunk.
+    Raises:
+        OSError: If the chunk is corrupt, or compressed with zstd while zstandard is not installed.
+    """
+    try:
+        if suffix == COMPRESSED_CHUNK_SUFFIXES["zlib"]:
+            return zlib.decompress(data)
+        if suffix == COMPRESSED_CHUNK_SUFFIXES["zstd"]:
+            if zstandard is None:
+                raise OSError(f"zstandard is not installed, cannot read chunk: {str(chunk_path)}")
+            return zstandard.ZstdDecompressor().decompress(data)
+    except zlib.error as error:
+        raise OSError(f"Corrupt chunk: {str(chunk_path)} {error}") from error
+    return data
+
+
+def read_chunk(store_path: Path, chunk_hash: str, packed_chunks: Optional[Dict[str, PackedChunk]] = None) -> bytes:
+    """Read the plain content of a chunk of the store.
+
+    Args:
+        store_path [Path]: The store directory.
+        chunk_hash [str]: The hexadecimal hash of the chunk.
+        packed_chunks [Optional[Dict[str, PackedChunk]]]: The index of the packs, None if it is not used.
+    Returns:
+        bytes: The content of the chunk.
+    Raises:
+        OSError: If the chunk is missing, corrupt, or compressed with zstd while zstandard is not installed.
+    """
+    packed_chunk = (packed_chunks or {}).get(chunk_hash)
+    if packed_chunk is not None:
+        return decompress_chunk(
+            read_packed_chunk(store_path, packed_chunk),
+            packed_chunk.suffix,
+            get_path_to_packs(store_path) / f"{packed_chunk.segment}.pack",
+        )
+    chunk_path = find_chunk(store_path, chunk_hash) or get_path_to_chunk(store_path, chunk_hash)
+    return decompress_chunk(chunk_path.read_bytes(), chunk_path.suffix, chunk_path)
+
+
+def load_store_manifest(manifest_path: Path) -> StoreManifest:
+    """Load a run manifest.
+
+    Args:
+        manifest_path [Path]: The path to the manifest.
+    Returns:
+        StoreManifest: The entries, indexed by their path relative to the source.
+    Raises:
+        OSError, EOFError, ValueError, TypeError: If it cannot be read.
+    """
+    with gzip.open(manifest_path, "rt", encoding="utf-8") as file:
+        return {line[0]: StoreEntry(*line[1:]) for line in (json.loads(text) for text in file)}
+
+
+def read_store_manifest(manifest_path: Optional[Path]) -> StoreManifest:
+    """Read a run manifest.
+
+    Args:
+        manifest_path [Optional[Path]]: The path to the manifest, None for no manifest.
+    Returns:
+        StoreManifest: The entries, indexed by their path relative to the source. Empty if it cannot be read.
+    """
+    if manifest_path is None:
+        return {}
+    try:
+        return load_store_manifest(manifest_path)
+    except (OSError, EOFError, ValueError, TypeError) as error:
+        logging.warning("Run manifest: %s cannot be read. %s", str(manifest_path), error)
+        return {}
+
+
+def write_store_manifest(manifest_path: Path, manifest: StoreManifest) -> None:
+    """Write a run manifest atomically, which marks the run of the source as complete.
+
+    Args:
+        manifest_path [Path]: The path to the manifest.
+        manifest [StoreManifest]: The entries, indexed by their path relative to the source.
+    """
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    with gzip.open(temporary_path, "wt", encoding="utf-8") as file:
+        for path, entry in manifest.items():
+            line = [path, entry.kind, entry.size, entry.mtime_ns, entry.mode, entry.chunks, entry.target]
+            file.write(json.dumps(line) + "\n")
+    os.replace(temporary_path, manifest_path)
+
+
+def walk_source(source_path: Path, excluded_path_list: Exclusions) -> Iterator[Path]:
+    """Walk a source, without following symbolic links nor descending into excluded folders.
+
+    Args:
+        source_path [Path]: The source directory.
+        excluded_path_list [Exclusions]: The exclusion rules, or the absolute paths of the excluded folders.
+    Yields:
+        Path: The path of each directory, file and link below the source.
+    """
+    exclusion_filter = as_exclusion_filter(source_path, excluded_path_list)
+    for directory, directory_names, file_names in os.walk(source_path.absolute(), onerror=logging.warning):
+        directory_names[:] = sorted(
+            name for name in directory_names if not exclusion_filter.is_excluded(os.path.join(directory, name), True)
+        )
+        yield from (Path(directory) / name for name in directory_names)
+        for name in sorted(file_names):
+            if not exclusion_filter.is_excluded(os.path.join(directory, name), False):
+                yield Path(directory) / name
+
+
+def get_entry_of(
+    path: Path, previous_entry: Optional[StoreEntry], store_writer: StoreWriter, stats: StoreStats
+) -> Optional[StoreEntry]:
+    """Get the manifest entry of a path of the source, storing the chunks of new or changed files.
+
+    Args:
+        path [Path]: The path in the source.
+        previous_entry [Optional[StoreEntry]]: The entry of the path in the previous run, None if it is new.
+        store_writer [StoreWriter]: The writer of the new chunks.
+        stats [StoreStats]: The statistics to update.
+    Returns:
+        Optional[StoreEntry]: The entry, None for special files.
+    """
+    path_stat = os.lstat(path)
+    mode = stat.S_IMODE(path_stat.st_mode)
+    if stat.S_ISDIR(path_stat.st_mode):
+        return StoreEntry(kind="d", mtime_ns=path_stat.st_mtime_ns, mode=mode)
+    if stat.S_ISLNK(path_stat.st_mode):
+        return StoreEntry(kind="l", mtime_ns=path_stat.st_mtime_ns, target=os.readlink(path))
+    if not stat.S_ISREG(path_stat.st_mode):
+        return None
+    entry = StoreEntry(kind="f", size=path_stat.st_size, mtime_ns=path_stat.st_mtime_ns, mode=mode)
+    if previous_entry is not None and (previous_entry.kind, previous_entry.size, previous_entry.mtime_ns) == (
+        "f",
+        entry.size,
+        entry.mtime_ns,
+    ):
+        entry.chunks = previous_entry.chunks
+        return entry
+    with open(path, "rb") as file:
+        for chunk in iter_chunks_of(file):
+            chunk_hash, written = store_chunk(store_writer, chunk)
+            entry.chunks.append(chunk_hash)
+            stats.bytes_written += written
+    stats.files_transferred += 1
+    stats.bytes_transferred += entry.size
+    return entry
+
+
+def backup_to_store(  # pylint: disable=(too-many-positional-arguments)
+    source_path: Path,
+    store_path: Path,
+    manifest_path: Path,
+    previous_manifest_path: Optional[Path],
+    excluded_path_list: Exclusions,
+    compression: str = "none",
+    pack: bool = False,
+) -> StoreStats:
+    """Backup a source to the store and write the manifest of the run.
+
+    Files whose size and modification time did not change since the previous run reuse their chunks without being
+    read. The chunks and the segments are synced before the manifest is written.
+
+    Args:
+        source_path [Path]: The source directory.
+        store_path [Path]: The store directory.
+        manifest_path [Path]: The manifest of this run.
+        previous_manifest_path [Optional[Path]]: The manifest of the previous run, None if there is none.
+        excluded_path_list [Exclusions]: The exclusion rules, or the absolute paths of the excluded folders.
+        compression [str]: Compression of the new chunks: none, zlib or zstd.
+        pack [bool]: If True, append the small chunks to segments.
+    Returns:
+        StoreStats: The statistics of the backup.
+    """
+    store_writer = StoreWriter(
+        store_path=store_path,
+        compressor=get_compressor_for(compression),
+        pack=pack,
+        packed_chunks=read_pack_index(store_path),
+    )
+    previous_manifest = read_store_manifest(previous_manifest_path)
+    manifest: StoreManifest = {}
+    stats = StoreStats()
+    try:
+        for path in walk_source(source_path, excluded_path_list):
+            relative_path = os.path.relpath(path, source_path.absolute())
+            try:
+                entry = get_entry_of(path, previous_manifest.get(relative_path), store_writer, stats)
+            except OSError as error:
+                logging.error("Cannot backup: %s %s", str(path), error)
+                stats.errors += 1
+                continue
+            if entry is not None:
+                manifest[relative_path] = entry
+    finally:
+        close_segment(store_writer)
+    sync_chunk_directories(store_writer)
+    write_store_manifest(manifest_path, manifest)
+    return stats
+
+
+def restore_entry(
+    entry: StoreEntry, store_path: Path, destination_path: Path, packed_chunks: Dict[str, PackedChunk]
+) -> None:
+    """Restore an entry of a run manifest. The permissions of directories are left to the caller.
+
+    Args:
+        entry [StoreEntry]: The entry.
+        store_path [Path]: The store directory.
+        destination_path [Path]: Where to restore it.
+        packed_chunks [Dict[str, PackedChunk]]: The index of the packs.
+    """
+    destination_path.parent.mkdir(parents=True, exist_ok=True)
+    if entry.kind == "d":
+        destination_path.mkdir(exist_ok=True)
+        return
+    temporary_path = destination_path.with_name(f".{destination_path.name}.tmp")
+    temporary_path.unlink(missing_ok=True)
+    if entry.kind == "l":
+        temporary_path.symlink_to(entry.target)
+    else:
+        with open(temporary_path, "wb") as file:
+            for chunk_hash in entry.chunks:
+                file.write(read_chunk(store_path, chunk_hash, packed_chunks))
+        os.chmod(temporary_path, entry.mode)
+        os.utime(temporary_path, ns=(entry.mtime_ns, entry.mtime_ns))
+    os.replace(temporary_path, destination_path)
+
+
+def is_restored(entry: StoreEntry, destination_path: Path) -> bool:
+    """Check if a file or link of a run manifest is at its destination already, or was changed there since.
+
+    Args:
+        entry [StoreEntry]: The entry of a file or a link.
+        destination_path [Path]: Where to restore it.
+    Returns:
+        bool: True if the destination has the size and modification time of the file, is newer, or is the same link.
+    """
+    try:
+        destination_stat = os.lstat(destination_path)
+        if entry.kind == "l":
+            return stat.S_ISLNK(destination_stat.st_mode) and os.readlink(destination_path) == entry.target
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+    return stat.S_ISREG(destination_stat.st_mode) and (
+        destination_stat.st_mtime_ns > entry.mtime_ns
+        or (destination_stat.st_size, destination_stat.st_mtime_ns) == (entry.size, entry.mtime_ns)
+    )
+
+
+def restore_entry_or_log_error(
+    entry: StoreEntry, store_path: Path, destination_path: Path, packed_chunks: Dict[str, PackedChunk]
+) -> bool:
+    """Restore an entry of a run manifest, logging the error if it cannot be restored.
+
+    Args:
+        entry [StoreEntry]: The entry.
+        store_path [Path]: The store directory.
+        destination_path [Path]: Where to restore it.
+        packed_chunks [Dict[str, PackedChunk]]: The index of the packs.
+    Returns:
+        bool: True if the entry was restored.
+    """
+    try:
+        restore_entry(entry, store_path, destination_path, packed_chunks)
+    except OSError as error:
+        logging.error("Cannot restore: %s %s", str(destination_path), error)
+        return False
+    return True
+
+
+def restore_from_store(
+    manifest_path: Path, store_path: Path, destination_path: Path, relative_path: str = "", update: bool = False
+) -> int:
+    """Restore a source, or a part of it, from a run manifest.
+
+    Directories are created in the order of the manifest, files and links are restored by RESTORE_THREADS threads.
+
+    Args:
+        manifest_path [Path]: The manifest of the run to restore.
+        store_path [Path]: The store directory.
+        destination_path [Path]: The directory to restore the source into.
+        relative_path [str]: Only restore this path of the source, and what is below it. Empty for the whole source.
+        update [bool]: If True, the files restored already, or newer at the destination, are left as is.
+    Returns:
+        int: Number of entries that could not be restored.
+    """
+    prefix = os.path.normpath(relative_path) if relative_path else ""
+    packed_chunks = read_pack_index(store_path)
+    restored_directories = []
+    results: List[bool] = []
+    restored_files: List[Future] = []
+    with ThreadPoolExecutor(max_workers=RESTORE_THREADS) as pool:
+        for path, entry in read_store_manifest(manifest_path).items():
+            if prefix and path != prefix and not path.startswith(prefix + os.sep):
+                continue
+            if entry.kind != "d":
+                if not (update and is_restored(entry, destination_path / path)):
+                    restored_files.append(
+                        pool.submit(
+                            restore_entry_or_log_error, entry, store_path, destination_path / path, packed_chunks
+                        )
+                    )
+                continue
+            results.append(restore_entry_or_log_error(entry, store_path, destination_path / path, packed_chunks))
+            if results[-1]:
+                restored_directories.append((destination_path / path, entry.mode))
+        results.extend(future.result() for future in restored_files)
+    for directory, mode in reversed(restored_directories):
+        os.chmod(directory, mode)
+    return results.count(False)
+
+
+def get_referenced_chunks_of(store_path: Path) -> Optional[Set[str]]:
+    """Get the chunks the run manifests of all the hosts using a store refer to.
+
+    Args:
+        store_path [Path]: The store directory (Backup/.store).
+    Returns:
+        Optional[Set[str]]: The hashes of the chunks, None if a manifest cannot be read.
+    """
+    referenced_chunks: Set[str] = set()
+    for manifest_path in store_path.parent.glob("*/runs/*/*.json.gz"):
+        try:
+            manifest = load_store_manifest(manifest_path)
+        except (OSError, EOFError, ValueError, TypeError) as error:
+            logging.error("Run manifest: %s cannot be read, the store is not compacted. %s", str(manifest_path), error)
+            return None
+        for entry in manifest.values():
+            referenced_chunks.update(entry.chunks)
+    return referenced_chunks
+
+
+def compact_store(store_path: Path) -> int:
+    """Merge the small segments of a store into new ones, without the chunks no run manifest refers to anymore.
+
+    Nothing is done until there are SMALL_SEGMENTS_BEFORE_COMPACTION small segments. The new segments are synced
+    before the small ones are removed, index first. No backup must write to the store meanwhile.
+
+    Args:
+        store_path [Path]: The store directory.
+    Returns:
+        int: The number of segments merged.
+    """
+    packs_path = get_path_to_packs(store_path)
+    small_segments = {
+        segment_path.stem
+        for segment_path in packs_path.glob("*.pack")
+        if segment_path.stat().st_size < SMALL_SEGMENT_SIZE
+    }
+    if len(small_segments) < SMALL_SEGMENTS_BEFORE_COMPACTION:
+        return 0
+    referenced_chunks = get_referenced_chunks_of(store_path)
+    if referenced_chunks is None:
+        return 0
+    store_writer = StoreWriter(store_path=store_path, pack=True)
+    try:
+        for chunk_hash, packed_chunk in read_pack_index(store_path).items():
+            if packed_chunk.segment in small_segments and chunk_hash in referenced_chunks:
+                append_to_segment(
+                    store_writer, chunk_hash, read_packed_chunk(store_path, packed_chunk), packed_chunk.suffix
+                )
+    finally:
+        close_segment(store_writer)
+    for segment in small_segments:
+        (packs_path / f"{segment}.idx").unlink(missing_ok=True)
+        (packs_path / f"{segment}.pack").unlink()
+    return len(small_segments)
+
+
+def main(arguments: Optional[List[str]] = None) -> int:
+    """Backup a source to the store, restore it or compact the store, from the command line.
+
+    Args:
+        arguments [Optional[List[str]]]: The arguments, None for the ones of the command line.
+    Returns:
+        int: 0 on success, 23 (partial transfer, as rsync) if an entry could not be backed up or restored or if the
+            store could not be compacted.
+    """
+    parser = argparse.ArgumentParser(description="Deduplicating store of backups")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    backup_parser = subparsers.add_parser("backup", help="Backup a source to the store")
+    backup_parser.add_argument("--exclude", help="Absolute path to exclude", action="append", default=[])
+    backup_parser.add_argument("--exclude-from", help="File of exclusion rules, one per line", type=Path, default=None)
+    backup_parser.add_argument("--previous", help="Manifest of the previous run", type=Path, default=None)
+    backup_parser.add_argument(
+        "--compression", help="Compression of the new chunks", choices=["none", "zlib", "zstd"], default="none"
+    )
+    backup_parser.add_argument("--pack", help="Append the small chunks to segments", action="store_true")
+    backup_parser.add_argument("source", type=Path)
+    backup_parser.add_argument("store", type=Path)
+    backup_parser.add_argument("manifest", type=Path)
+    restore_parser = subparsers.add_parser("restore", help="Restore a source from the store")
+    restore_parser.add_argument("--path", help="Only restore this path of the source", default="")
+    restore_parser.add_argument("manifest", type=Path)
+    restore_parser.add_argument("store", type=Path)
+    restore_parser.add_argument("destination", type=Path)
+    compact_parser = subparsers.add_parser("compact", help="Merge the small segments of the store")
+    compact_parser.add_argument("store", type=Path)
+    options = parser.parse_args(arguments)
+    if options.command == "compact":
+        try:
+            print(f"Segments compacted: {compact_store(options.store)}")
+        except OSError as error:
+            logging.error("Cannot compact the store: %s %s", str(options.store), error)
+            return RETURN_CODE_PARTIAL_TRANSFER
+        return 0
+    if options.command == "restore":
+        errors = restore_from_store(options.manifest, options.store, options.destination, options.path)
+        return RETURN_CODE_PARTIAL_TRANSFER if errors else 0
+    stats = backup_to_store(
+        options.source,
+        options.store,
+        options.manifest,
+        options.previous,
+        compile_exclusion_filter(
+            options.source, options.exclude, read_rules_file(options.exclude_from) if options.exclude_from else []
+        ),
+        options.compression,
+        options.pack,
+    )
+    print(f"Number of regular files transferred: {stats.files_transferred}")
+    print(f"Total transferred file size: {stats.bytes_transferred} bytes")
+    print(f"Total bytes sent: {stats.bytes_written}")
+    sys.stdout.flush()
+    return RETURN_CODE_PARTIAL_TRANSFER if stats.errors else 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
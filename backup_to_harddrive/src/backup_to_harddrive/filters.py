@@ -0,0 +1,329 @@
+"""Exclusion rules of the sources, compiled once and shared by rsync, the other transfers and the scans.
+
+A backup configuration excludes the folders of list_of_excluded_folders and the rules of exclude:
+
+* a glob pattern, in the syntax of rsync: `*` and `?` match within a name, `**` across directories, `[...]` matches a
+  character of a set. A pattern starting with / is anchored to the source, otherwise it matches the end of the path, the
+  name if it holds no other /. A pattern ending with / only matches directories.
+* `re:` followed by a regular expression, matched against the whole path relative to the source, with a trailing / for
+  directories. rsync has no regular expressions: they only apply to the backups transferred by the native backend or
+  to the dedup store.
+
+Literal paths and names are looked up in sets, the other rules are compiled into a single regular expression, so that
+matching an entry does not depend on the number of rules. rsync reads the rules from a merge file, the native backend
+and the dedup store from a rules file, written in the user cache directory instead of one argument per rule.
+"""
+
+import hashlib
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import FrozenSet, Iterable, List, Optional, Pattern, Set, Tuple, Union
+
+from platformdirs import user_cache_dir
+
+from backup_to_harddrive.config import REGEX_RULE_PREFIX, BackupConfig
+
+WILDCARDS = "*?["
+
+
+@dataclass(frozen=True)
+class ExclusionFilter:
+    """Compiled exclusion rules of a source.
+
+    The rules are relative to root, the absolute path of the source. The paths matched are absolute, below root.
+    """
+
+    root: str
+    rules: Tuple[str, ...]
+    excluded_paths: FrozenSet[str]
+    names: FrozenSet[str]
+    directory_names: FrozenSet[str]
+    pattern: Optional[Pattern[str]]
+
+    def is_excluded(self, path: str, is_directory: bool) -> bool:
+        """Check if an entry is excluded by a rule, whatever the directories holding it.
+
+        Args:
+            path [str]: The absolute path of the entry.
+            is_directory [bool]: Whether the entry is a directory.
+        Returns:
+            bool: True if the entry is excluded.
+        """
+        if path in self.excluded_paths:
+            return True
+        name = path[path.rfind(os.sep) + 1 :]
+        if name in self.names or (is_directory and name in self.directory_names):
+            return True
+        if self.pattern is None:
+            return False
+        relative_path = path[len(self.root) + 1 :]
+        return self.pattern.fullmatch(relative_path + "/" if is_directory else relative_path) is not None
+
+    def is_below_excluded(self, path: str, is_directory: bool) -> bool:
+        """Check if an entry, or one of the directories holding it below the root, is excluded.
+
+        Args:
+            path [str]: The absolute path of the entry.
+            is_directory [bool]: Whether the entry is a directory.
+        Returns:
+            bool: True if the entry is excluded.
+        """
+        position = path.find(os.sep, len(self.root) + 1)
+        while position != -1:
+            if self.is_excluded(path[:position], True):
+                return True
+            position = path.find(os.sep, position + 1)
+        return self.is_excluded(path, is_directory)
+
+
+Exclusions = Union[ExclusionFilter, Iterable[Union[str, Path]]]
+
+
+def has_wildcards(text: str) -> bool:
+    """Check if a glob pattern holds wildcards. Without any, rsync matches it literally, backslashes included.
+
+    Args:
+        text [str]: The pattern.
+    Returns:
+        bool: True if the pattern holds *, ? or [.
+    """
+    return any(character in text for character in WILDCARDS)
+
+
+def escape_glob(text: str, is_within_wildcards: bool = False) -> str:
+    """Escape a literal path so that rsync matches it literally.
+
+    Args:
+        text [str]: The path.
+        is_within_wildcards [bool]: Whether the path is part of a pattern holding wildcards, in which rsync reads the
+            backslashes as escapes even if the path holds no wildcard.
+    Returns:
+        str: The glob pattern matching the path.
+    """
+    return re.sub(r"([\\*?\[])", r"\\\1", text) if is_within_wildcards or has_wildcards(text) else text
+
+
+def translate_wildcards(body: str) -> str:
+    """Translate a glob pattern holding wildcards into a regular expression.
+
+    Args:
+        body [str]: The pattern, without its leading and trailing /.
+    Returns:
+        str: The regular expression.
+    """
+    parts = []
+    index = 0
+    while index < len(body):
+        character = body[index]
+        index += 1
+        if character == "*" and body.startswith("*", index):
+            index = len(body) - len(body[index:].lstrip("*"))
+            parts.append(".*")
+        elif character in "*?":
+            parts.append("[^/]*" if character == "*" else "[^/]")
+        elif character == "[" and body.find("]", index + 1) != -1:
+            end = body.find("]", index + 1)
+            content = body[index:end]
+            parts.append("[" + ("^" + content[1:] if content.startswith("!") else content) + "]")
+            index = end + 1
+        elif character == "\\" and index < len(body):
+            parts.append(re.escape(body[index]))
+            index += 1
+        else:
+            parts.append(re.escape(character))
+    return "".join(parts)
+
+
+def translate_glob(rule: str) -> str:
+    """Translate a glob rule into a regular expression matching the relative paths it excludes.
+
+    Args:
+        rule [str]: The rule.
+    Returns:
+        str: The regular expression, matching directories with a trailing /.
+    """
+    body = rule.strip("/")
+    expression = translate_wildcards(body) if has_wildcards(body) else re.escape(body)
+    prefix = "" if rule.startswith("/") else "(?:.*/)?"
+    return prefix + expression + ("/" if rule.endswith("/") else "/?")
+
+
+def compile_exclusion_filter(
+    root: Path, excluded_path_list: Iterable[Union[str, Path]], rules: Iterable[str] = ()
+) -> ExclusionFilter:
+    """Compile the exclusion rules of a source.
+
+    Args:
+        root [Path]: The source directory.
+        excluded_path_list [Iterable[Union[str, Path]]]: Absolute paths of the excluded folders.
+        rules [Iterable[str]]: The glob and regular expression rules.
+    Returns:
+        ExclusionFilter: The compiled rules, the excluded folders below the source first as anchored rules.
+    """
+    root_path = str(root.absolute())
+    excluded_paths = {os.path.abspath(excluded_path) for excluded_path in excluded_path_list}
+    rules = [
+        "/" + escape_glob(os.path.relpath(path, root_path))
+        for path in sorted(excluded_paths)
+        if path.startswith(root_path + os.sep)
+    ] + list(rules)
+    names: Set[str] = set()
+    directory_names: Set[str] = set()
+    expressions: List[str] = []
+    for rule in rules:
+        body = rule.strip("/")
+        is_anchored = rule.startswith("/")
+        is_directory_only = rule.endswith("/")
+        if rule.startswith(REGEX_RULE_PREFIX):
+            expressions.append(rule[len(REGEX_RULE_PREFIX) :])
+        elif has_wildcards(body) or (is_directory_only and is_anchored) or (not is_anchored and "/" in body):
+            expressions.append(translate_glob(rule))
+        elif is_anchored:
+            excluded_paths.add(os.path.join(root_path, body))
+        else:
+            (directory_names if is_directory_only else names).add(body)
+    return ExclusionFilter(
+        root=root_path,
+        rules=tuple(rules),
+        excluded_paths=frozenset(excluded_paths),
+        names=frozenset(names),
+        directory_names=frozenset(directory_names),
+        pattern=re.compile("|".join(f"(?:{expression})" for expression in expressions)) if expressions else None,
+    )
+
+
+def get_exclusion_filter_of(backup_config: BackupConfig) -> ExclusionFilter:
+    """Compile the exclusion rules of a backup configuration.
+
+    Args:
+        backup_config [BackupConfig]: The backup configuration.
+    Returns:
+        ExclusionFilter: The compiled rules.
+    """
+    return compile_exclusion_filter(backup_config.source, backup_config.list_of_excluded_folders, backup_config.exclude)
+
+
+def as_exclusion_filter(root: Path, exclusions: Exclusions) -> ExclusionFilter:
+    """Get the exclusion filter of a scan, compiling it if a list of excluded folders is given.
+
+    Args:
+        root [Path]: The scanned directory.
+        exclusions [Exclusions]: The compiled rules, or the absolute paths of the excluded folders.
+    Returns:
+        ExclusionFilter: The compiled rules.
+    """
+    if isinstance(exclusions, ExclusionFilter):
+        return exclusions
+    return compile_exclusion_filter(root, exclusions)
+
+
+def as_wildcard_pattern(rule: str) -> str:
+    """Get a glob rule as a pattern holding wildcards, escaping it if it is a literal.
+
+    Args:
+        rule [str]: The rule.
+    Returns:
+        str: The pattern, matching the same paths once joined to a pattern holding wildcards.
+    """
+    return rule if has_wildcards(rule) else escape_glob(rule, is_within_wildcards=True)
+
+
+def prefix_rule(prefix: str, rule: str) -> str:
+    """Prefix a glob rule with a literal path, escaping the path, and the rule if the result holds wildcards.
+
+    Args:
+        prefix [str]: The literal path.
+        rule [str]: The rule.
+    Returns:
+        str: The rule matching below the path.
+    """
+    if not has_wildcards(prefix + rule):
+        return prefix + rule
+    return escape_glob(prefix, is_within_wildcards=True) + as_wildcard_pattern(rule)
+
+
+def get_rsync_filter_rules_of(exclusion_filter: ExclusionFilter, anchor: str) -> List[str]:
+    """Translate the glob rules into rsync filter rules, anchored to the root of the transfer.
+
+    An unanchored rule becomes two anchored ones, so that it never matches the source directory itself.
+
+    Args:
+        exclusion_filter [ExclusionFilter]: The compiled rules.
+        anchor [str]: Path of the source relative to the root of the transfer, empty if it is the root.
+    Returns:
+        List[str]: The rsync filter rules.
+    """
+    prefix = f"/{anchor}" if anchor else ""
+    rsync_rules = []
+    for rule in exclusion_filter.rules:
+        if rule.startswith(REGEX_RULE_PREFIX):
+            continue
+        if rule.startswith("/"):
+            rsync_rules.append(f"- {prefix_rule(prefix, rule)}")
+        else:
+            rsync_rules.extend(
+                [
+                    f"- {prefix_rule(prefix, '/' + rule)}",
+                    f"- {escape_glob(prefix, is_within_wildcards=True)}/**/{as_wildcard_pattern(rule)}",
+                ]
+            )
+    return rsync_rules
+
+
+def get_path_to_filter_files() -> Path:
+    """Get the directory holding the filter files.
+
+    Returns:
+        Path: The filter files directory, in the user cache directory.
+    """
+    return Path(user_cache_dir("backup_to_harddrive")) / "filters"
+
+
+def write_filter_file(lines: List[str], suffix: str) -> Path:
+    """Write a filter file, named after its content so that it is written once and never changes.
+
+    Args:
+        lines [List[str]]: The rules.
+        suffix [str]: The suffix of the file name, after its format.
+    Returns:
+        Path: The path of the file.
+    """
+    content = "".join(f"{line}\n" for line in lines)
+    key = hashlib.blake2b(content.encode("utf-8"), digest_size=8).hexdigest()
+    filter_path = get_path_to_filter_files() / f"{key}.{suffix}"
+    if not filter_path.exists():
+        filter_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = filter_path.with_name(f"{filter_path.name}.{os.getpid()}.tmp")
+        temporary_path.write_text(content, encoding="utf-8")
+        os.replace(temporary_path, filter_path)
+    return filter_path
+
+
+def read_rules_file(rules_path: Path) -> List[str]:
+    """Read a rules file written for the native backend or the dedup store.
+
+    Args:
+        rules_path [Path]: The path of the file.
+    Returns:
+        List[str]: The rules.
+    """
+    return [line for line in rules_path.read_text(encoding="utf-8").split("\n") if line]
+
+
+def get_filter_options_of(exclusion_filter: ExclusionFilter, backend: str, anchor: str = "") -> List[str]:
+    """Get the options passing the exclusion rules to a transfer command.
+
+    Args:
+        exclusion_filter [ExclusionFilter]: The compiled rules.
+        backend [str]: rsync for a merge file, native or dedup for a rules file.
+        anchor [str]: Path of the source relative to the root of the rsync transfer, empty if it is the root.
+    Returns:
+        List[str]: The options, none if nothing is excluded.
+    """
+    if not exclusion_filter.rules:
+        return []
+    if backend == "rsync":
+        return [f"--filter=merge {write_filter_file(get_rsync_filter_rules_of(exclusion_filter, anchor), 'rsync')}"]
+    return [f"--exclude-from={write_filter_file(list(exclusion_filter.rules), 'rules')}"]
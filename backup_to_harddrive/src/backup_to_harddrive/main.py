@@ -1,13 +1,17 @@
-"""Main function."""
+"""Main function.
+
+The status and switch commands are run from login and shutdown hooks: the other subsystems are only imported by the
+commands that need them, so that these start in a few milliseconds.
+"""
+
+# pylint: disable=(import-outside-toplevel)
 
 import argparse
 import logging
+from pathlib import Path
+from typing import Callable, Optional
 
-from backup_to_harddrive.backup_from_config import run_backup_from_config_file
 from backup_to_harddrive.backup_status import is_backup_switched_on, set_backup_status
-from backup_to_harddrive.rsync_installation_check import (
-    check_if_rsync_is_installed_and_log_if_not,
-)
 
 
 def return_backup_status() -> int:
@@ -38,6 +42,90 @@ def apply_activation_status(switch_on: int, switch_off: int):
         logging.info("Backup is switched off.")
 
 
+def get_integer_type_at_least(minimum: int) -> Callable[[str], int]:
+    """Get the type of an integer option of the command line that rejects the values below a minimum.
+
+    Args:
+        minimum (int): The smallest value accepted.
+    Returns:
+        Callable[[str], int]: The type, raising argparse.ArgumentTypeError for an invalid value.
+    """
+
+    def integer_at_least(value: str) -> int:
+        try:
+            integer = int(value)
+        except ValueError as error:
+            raise argparse.ArgumentTypeError(f"invalid integer: {value}") from error
+        if integer < minimum:
+            raise argparse.ArgumentTypeError(f"must be at least {minimum}, got: {value}")
+        return integer
+
+    return integer_at_least
+
+
+def run_command_other_than_backup(args: argparse.Namespace) -> Optional[int]:
+    """Run the command of the command line that does not backup the sources, if any.
+
+    Args:
+        args (argparse.Namespace): The parsed command line.
+    Returns:
+        Optional[int]: The return value of the command, None if the command line does not ask for one.
+    """
+    if "history" in args and args.history is not None:
+        from backup_to_harddrive.backup_from_config import print_run_history
+
+        print_run_history(args.history)
+        return 0
+    if "watch" in args and args.watch == 1:
+        from backup_to_harddrive.change_journal import watch_sources_of_config_file
+
+        return watch_sources_of_config_file()
+    if "verify" in args and args.verify == 1:
+        from backup_to_harddrive.verify import verify_backups_from_config_file
+
+        return verify_backups_from_config_file()
+    if "restore" in args and args.restore == 1:
+        from backup_to_harddrive.restore import restore_from_config_file
+
+        return restore_from_config_file(harddrive=args.restore_from, destination=args.restore_to)
+    if "find" in args and args.find is not None:
+        from backup_to_harddrive.catalog import print_files_found_in_catalog
+
+        return print_files_found_in_catalog(args.find)
+    return None
+
+
+def run_backup(args: argparse.Namespace) -> int:
+    """Run the backup of the sources, if rsync is installed or not needed by the configuration file.
+
+    Args:
+        args (argparse.Namespace): The parsed command line.
+    Returns:
+        int: 0 if the backup is complete, 1 otherwise.
+    """
+    from backup_to_harddrive.backup_from_config import (
+        is_rsync_required_by_config_file,
+        run_backup_from_config_file,
+    )
+    from backup_to_harddrive.rsync_installation_check import (
+        check_if_rsync_is_installed_and_log_if_not,
+    )
+
+    dry_run = "dry_run" in args and args.dry_run == 1
+    rsync_is_installed = check_if_rsync_is_installed_and_log_if_not(dry_run_enabled=dry_run)
+    if rsync_is_installed is not True and is_rsync_required_by_config_file():
+        logging.error("Rsync is not installed. Backup cannot be performed.")
+        return 1
+    is_complete = run_backup_from_config_file(
+        dry_run=dry_run,
+        max_parallel_jobs=args.max_parallel_jobs if "max_parallel_jobs" in args else None,
+        telemetry_file=args.telemetry_file if "telemetry_file" in args else None,
+        resume="resume" in args and args.resume == 1,
+        preflight="preflight" in args and args.preflight == 1,
+    )
+    return 0 if is_complete else 1
+
+
 def main() -> int:
     """Implement main function.
 
@@ -47,35 +135,98 @@ def main() -> int:
     parser = argparse.ArgumentParser(description="Script that performs backup of home directory")
     parser.add_argument(
         "--dry-run",
-        help="Perform dry run (Displays rsync commands without execution)",
+        help="Perform dry run (Displays the planned transfers and the rsync commands without execution)",
         action="count",
         required=False,
         default=0,
     )
+    parser.add_argument(
+        "--max-parallel-jobs",
+        help="Maximum number of rsync jobs running at the same time (overrides max_parallel_jobs of config.yaml)",
+        type=get_integer_type_at_least(0),
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--telemetry-file",
+        help="Enable telemetry: JSON lines file receiving the progress of each rsync job, '-' for the standard output",
+        type=Path,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--resume",
+        help="Only run the jobs of the last run that did not succeed, after an interruption or a failure",
+        action="count",
+    )
+    parser.add_argument(
+        "--preflight",
+        help="Check that the harddrives are mounted, have room for the run and can be written before the run",
+        action="count",
+    )
+    parser.add_argument(
+        "--history",
+        help="Print the reports of the last runs on each harddrive (10 by default)",
+        type=get_integer_type_at_least(1),
+        nargs="?",
+        const=10,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--watch",
+        help="Record the changes below the sources with an incremental manifest until interrupted",
+        action="count",
+    )
+    parser.add_argument(
+        "--verify",
+        help="Hash the sources and their backups and print the files that do not match",
+        action="count",
+    )
+    parser.add_argument(
+        "--restore",
+        help="Restore the sources from their backup, the quick restore paths first",
+        action="count",
+    )
+    parser.add_argument(
+        "--restore-from",
+        help="Harddrive to restore from (by default, the first harddrive of each source holding a backup)",
+        type=Path,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--restore-to",
+        help="Directory to restore the sources into (by default, they are restored in place)",
+        type=Path,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--find",
+        help="Print the backed up versions of the files whose name (or path, if it contains a /) matches a shell "
+        "pattern, and the harddrives holding them, from the catalog of the runs",
+        type=str,
+        required=False,
+        default=None,
+    )
     parser.add_argument("--switch-on", help="Switch the backup functionality on", action="count")
     parser.add_argument("--switch-off", help="Switch the backup functionality off", action="count")
     parser.add_argument("--status", help="Get the status of the backup", action="count")
     args = parser.parse_args()
 
-    dry_run = "dry_run" in args and args.dry_run == 1
-
-    rsync_is_installed = check_if_rsync_is_installed_and_log_if_not(dry_run_enabled=dry_run)
-
     if "status" in args and args.status == 1:
         return return_backup_status()
 
+    command_return_value = run_command_other_than_backup(args)
+    if command_return_value is not None:
+        return command_return_value
+
     if args.switch_on == 1 or args.switch_off == 1:
         apply_activation_status(args.switch_on, args.switch_off)
         return 0
 
-    return_value = 0
     if is_backup_switched_on() is False:
         logging.info("Backup is switched off. Exiting.")
-    else:
-        if rsync_is_installed is True:
-            run_backup_from_config_file(dry_run=dry_run)
-        else:
-            logging.error("Rsync is not installed. Backup cannot be performed.")
-            return_value = 1
-
-    return return_value
+        return 0
+    return run_backup(args)
@@ -0,0 +1,159 @@
+"""Persistent manifest of the backed up files, used to detect changes without walking the harddrive."""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from backup_to_harddrive.filters import Exclusions
+from backup_to_harddrive.scanner import scan_files
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass
+class ManifestEntry:
+    """Metadata of a single backed up file."""
+
+    size: int
+    mtime_ns: int
+    inode: int
+    digest: str = ""
+
+
+Manifest = Dict[str, ManifestEntry]
+
+
+def get_path_to_manifest(backup_path: Path, source_path: Path) -> Path:
+    """Get the path of the manifest of a source within the backup directory of a harddrive.
+
+    Args:
+        backup_path [Path]: The backup directory within the harddrive (Backup/<hostname>).
+        source_path [Path]: The source directory.
+    Returns:
+        Path: The path to the manifest.
+    """
+    return backup_path / f".manifest_{source_path.absolute().name}.json.gz"
+
+
+def compute_digest_of(file_path: Path) -> str:
+    """Compute the hash of the content of a file.
+
+    Args:
+        file_path [Path]: The file to hash.
+    Returns:
+        str: The hexadecimal BLAKE2b digest of the file.
+    """
+    digest = hashlib.blake2b()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan_source(source_path: Path, excluded_path_list: Exclusions) -> Manifest:
+    """Collect the metadata of all files below a source directory, walking it with the parallel scanner.
+
+    Excluded directories are not descended into. Directories are not part of the manifest.
+
+    Args:
+        source_path [Path]: The source directory.
+        excluded_path_list [Exclusions]: The exclusion rules, or the absolute paths of the excluded folders.
+    Returns:
+        Manifest: The metadata of each file, indexed by its path relative to the source.
+    """
+    return {
+        scanned_file.path: ManifestEntry(
+            size=scanned_file.size, mtime_ns=scanned_file.mtime_ns, inode=scanned_file.inode
+        )
+        for scanned_file in scan_files(source_path, excluded_path_list)
+    }
+
+
+def is_entry_changed(live: ManifestEntry, stored: Optional[ManifestEntry]) -> bool:
+    """Check if a file changed since it was recorded in the manifest.
+
+    Args:
+        live [ManifestEntry]: Current metadata of the file.
+        stored [Optional[ManifestEntry]]: Recorded metadata of the file, None if it was not recorded.
+    Returns:
+        bool: True if the file is new or changed.
+    """
+    if stored is None:
+        return True
+    return (live.size, live.mtime_ns, live.inode) != (stored.size, stored.mtime_ns, stored.inode)
+
+
+def get_changed_and_deleted_paths(live: Manifest, stored: Manifest) -> Tuple[List[str], List[str]]:
+    """Compare the live state of a source with its manifest.
+
+    Args:
+        live [Manifest]: Current metadata of the source.
+        stored [Manifest]: Manifest recorded at the last successful backup.
+    Returns:
+        Tuple[List[str], List[str]]: Relative paths of the new or changed files, and of the deleted files.
+    """
+    changed = sorted(path for path, entry in live.items() if is_entry_changed(entry, stored.get(path)))
+    deleted = sorted(path for path in stored if path not in live)
+    return changed, deleted
+
+
+def add_digests_to(live: Manifest, stored: Manifest, source_path: Path) -> None:
+    """Fill the digest of each file, reusing the recorded digest of unchanged files and the ones already computed.
+
+    Args:
+        live [Manifest]: Current metadata of the source, updated in place.
+        stored [Manifest]: Manifest recorded at the last successful backup.
+        source_path [Path]: The source directory.
+    """
+    for path, entry in live.items():
+        if entry.digest:
+            continue
+        stored_entry = stored.get(path)
+        if stored_entry is not None and stored_entry.digest and not is_entry_changed(entry, stored_entry):
+            entry.digest = stored_entry.digest
+            continue
+        try:
+            entry.digest = compute_digest_of(source_path / path)
+        except OSError as error:
+            logging.warning("Cannot hash file: %s %s", str(source_path / path), error)
+
+
+def read_manifest(manifest_path: Path) -> Optional[Manifest]:
+    """Read a manifest from the harddrive.
+
+    Args:
+        manifest_path [Path]: The path to the manifest.
+    Returns:
+        Optional[Manifest]: The manifest, or None if it does not exist or cannot be read.
+    """
+    try:
+        with gzip.open(manifest_path, "rt", encoding="utf-8") as file:
+            return {
+                path: ManifestEntry(size=size, mtime_ns=mtime_ns, inode=inode, digest=digest)
+                for path, size, mtime_ns, inode, digest in (json.loads(line) for line in file)
+            }
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError) as error:
+        logging.warning("Manifest: %s cannot be read, a full scan will be done. %s", str(manifest_path), error)
+        return None
+
+
+def write_manifest(manifest_path: Path, manifest: Manifest) -> None:
+    """Write a manifest on the harddrive, replacing the previous one atomically.
+
+    Args:
+        manifest_path [Path]: The path to the manifest.
+        manifest [Manifest]: The manifest to write.
+    """
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    with gzip.open(temporary_path, "wt", encoding="utf-8") as file:
+        for path, entry in manifest.items():
+            file.write(json.dumps([path, entry.size, entry.mtime_ns, entry.inode, entry.digest]) + "\n")
+    os.replace(temporary_path, manifest_path)
@@ -0,0 +1,356 @@
+"""Native copy engine, an alternative to rsync for local disk to local disk backups.
+
+It mirrors the options of rsync used by the backups: archive mode (owner and group when run as root), --delete (before
+the transfer of each directory), --update, --max-size, --exclude of absolute paths, --exclude-from of a rules file (see
+filters) and --link-dest. File contents are copied in the kernel with copy_file_range or sendfile. Files are compared
+and copied by a thread pool while the source tree is walked with os.scandir.
+
+The statistics are printed in the format of rsync --stats so that the telemetry parses them the same way. Run it with
+python -m backup_to_harddrive.native_copy.
+"""
+
+import argparse
+import errno
+import logging
+import os
+import shutil
+import stat
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, List, Optional, Set, Tuple
+
+from backup_to_harddrive.filters import compile_exclusion_filter, read_rules_file
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+RETURN_CODE_PARTIAL_TRANSFER = 23
+
+
+@dataclass
+class CopyStats:
+    """Statistics of a copy, updated by the workers."""
+
+    files_transferred: int = 0
+    bytes_transferred: int = 0
+    errors: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, compare=False, repr=False)
+
+    def add_file(self, size: int) -> None:
+        """Count a transferred file.
+
+        Args:
+            size [int]: Number of bytes transferred.
+        """
+        with self.lock:
+            self.files_transferred += 1
+            self.bytes_transferred += size
+
+    def add_error(self) -> None:
+        """Count an entry that could not be transferred."""
+        with self.lock:
+            self.errors += 1
+
+
+def copy_with_copy_file_range(source_fd: int, destination_fd: int, offset: int) -> int:
+    """Copy a chunk of a file within the kernel, sharing extents on filesystems that support it.
+
+    Args:
+        source_fd [int]: Descriptor of the source file.
+        destination_fd [int]: Descriptor of the destination file.
+        offset [int]: Offset of the chunk, in both files.
+    Returns:
+        int: Number of bytes copied, 0 at the end of the source file.
+    """
+    return os.copy_file_range(source_fd, destination_fd, COPY_CHUNK_SIZE, offset, offset)
+
+
+def copy_with_sendfile(source_fd: int, destination_fd: int, offset: int) -> int:
+    """Copy a chunk of a file within the kernel.
+
+    Args:
+        source_fd [int]: Descriptor of the source file.
+        destination_fd [int]: Descriptor of the destination file.
+        offset [int]: Offset of the chunk, in both files.
+    Returns:
+        int: Number of bytes copied, 0 at the end of the source file.
+    """
+    os.lseek(destination_fd, offset, os.SEEK_SET)
+    return os.sendfile(destination_fd, source_fd, offset, COPY_CHUNK_SIZE)
+
+
+def copy_with_read_and_write(source_fd: int, destination_fd: int, offset: int) -> int:
+    """Copy a chunk of a file through a user space buffer.
+
+    Args:
+        source_fd [int]: Descriptor of the source file.
+        destination_fd [int]: Descriptor of the destination file.
+        offset [int]: Offset of the chunk, in both files.
+    Returns:
+        int: Number of bytes copied, 0 at the end of the source file.
+    """
+    return os.pwrite(destination_fd, os.pread(source_fd, COPY_CHUNK_SIZE, offset), offset)
+
+
+COPY_METHODS: List[Callable[[int, int, int], int]] = [
+    copy_with_copy_file_range,
+    copy_with_sendfile,
+    copy_with_read_and_write,
+]
+
+
+def copy_file_content(source_fd: int, destination_fd: int) -> int:
+    """Copy the content of a file, falling back to the next method when the filesystems do not support one.
+
+    Args:
+        source_fd [int]: Descriptor of the source file.
+        destination_fd [int]: Descriptor of the destination file.
+    Returns:
+        int: Number of bytes copied.
+    """
+    copied = 0
+    methods = iter(COPY_METHODS)
+    copy = next(methods)
+    while True:
+        try:
+            count = copy(source_fd, destination_fd, copied)
+        except OSError as error:
+            fallback = next(methods, None)
+            if error.errno not in FALLBACK_ERRNOS or fallback is None:
+                raise
+            copy = fallback
+            continue
+        if count == 0:
+            return copied
+        copied += count
+
+
+def is_up_to_date(source_stat: os.stat_result, destination_path: Path, update: bool) -> bool:
+    """Check if a destination file can be left as is, with the quick check of rsync.
+
+    Args:
+        source_stat [stat_result]: Metadata of the source file.
+        destination_path [Path]: The destination file.
+        update [bool]: If True, a destination file newer than the source is left as is.
+    Returns:
+        bool: True if the destination file has the size and modification time of the source, or is newer.
+    """
+    try:
+        destination_stat = os.stat(destination_path, follow_symlinks=False)
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISREG(destination_stat.st_mode):
+        return False
+    if update and destination_stat.st_mtime_ns > source_stat.st_mtime_ns:
+        return True
+    return (destination_stat.st_size, destination_stat.st_mtime_ns) == (source_stat.st_size, source_stat.st_mtime_ns)
+
+
+def replace_with(temporary_path: Path, destination_path: Path) -> None:
+    """Move a file into place, replacing a directory or a link standing at the destination.
+
+    Args:
+        temporary_path [Path]: The file to move.
+        destination_path [Path]: Where to move it.
+    """
+    if destination_path.is_dir() and not destination_path.is_symlink():
+        shutil.rmtree(destination_path)
+    os.replace(temporary_path, destination_path)
+
+
+def copy_ownership(path: Path, source_stat: os.stat_result) -> None:
+    """Give a destination entry the owner and group of its source when run as root, as rsync -a does.
+
+    Otherwise the entries belong to the user running the copy, as with rsync.
+
+    Args:
+        path [Path]: The destination entry, not followed if it is a link.
+        source_stat [stat_result]: Metadata of the source entry.
+    """
+    if os.geteuid() == 0:
+        os.chown(path, source_stat.st_uid, source_stat.st_gid, follow_symlinks=False)
+
+
+def sync_file(source_path: Path, destination_path: Path, options: argparse.Namespace, stats: CopyStats) -> None:
+    """Bring a destination file up to date with its source.
+
+    Unchanged files are hard linked to the --link-dest directory when it holds them. Otherwise the file is copied to a
+    temporary file that replaces the destination once complete, with the ownership, permissions and times of the
+    source. Files larger than --max-size are skipped.
+
+    Args:
+        source_path [Path]: The source file.
+        destination_path [Path]: The destination file.
+        options [Namespace]: The parsed command line options.
+        stats [CopyStats]: The statistics to update.
+    """
+    temporary_path = destination_path.with_name(f".{destination_path.name}.{threading.get_ident()}.tmp")
+    try:
+        source_stat = os.stat(source_path)
+        if options.max_size is not None and source_stat.st_size > options.max_size:
+            return
+        if is_up_to_date(source_stat, destination_path, options.update):
+            return
+        if options.link_dest is not None:
+            linked_path = Path(options.link_dest) / os.path.relpath(destination_path, options.destination)
+            if is_up_to_date(source_stat, linked_path, update=False):
+                os.link(linked_path, temporary_path)
+                replace_with(temporary_path, destination_path)
+                return
+        with open(source_path, "rb") as source_file, open(temporary_path, "wb") as destination_file:
+            size = copy_file_content(source_file.fileno(), destination_file.fileno())
+        copy_ownership(temporary_path, source_stat)
+        os.chmod(temporary_path, stat.S_IMODE(source_stat.st_mode))
+        os.utime(temporary_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        replace_with(temporary_path, destination_path)
+        stats.add_file(size)
+    except OSError as error:
+        logging.error("Cannot copy file: %s %s", str(source_path), error)
+        temporary_path.unlink(missing_ok=True)
+        stats.add_error()
+
+
+def sync_symlink(source_path: Path, destination_path: Path, stats: CopyStats) -> None:
+    """Recreate a symbolic link of the source at the destination.
+
+    Args:
+        source_path [Path]: The source link.
+        destination_path [Path]: The destination link.
+        stats [CopyStats]: The statistics to update.
+    """
+    try:
+        target = os.readlink(source_path)
+        if destination_path.is_symlink() and os.readlink(destination_path) == target:
+            return
+        temporary_path = destination_path.with_name(f".{destination_path.name}.tmp")
+        temporary_path.unlink(missing_ok=True)
+        temporary_path.symlink_to(target)
+        copy_ownership(temporary_path, os.lstat(source_path))
+        replace_with(temporary_path, destination_path)
+    except OSError as error:
+        logging.error("Cannot copy link: %s %s", str(source_path), error)
+        stats.add_error()
+
+
+def delete_extraneous_entries(destination_directory: Path, kept_names: Set[str], stats: CopyStats) -> None:
+    """Delete the entries of a destination directory that no longer exist in the source.
+
+    Args:
+        destination_directory [Path]: The destination directory.
+        kept_names [Set[str]]: Names of the entries of the source directory, excluded ones included.
+        stats [CopyStats]: The statistics to update.
+    """
+    try:
+        entries = [entry for entry in os.scandir(destination_directory) if entry.name not in kept_names]
+        for entry in entries:
+            logging.info("deleting %s", entry.path)
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+    except OSError as error:
+        logging.error("Cannot delete in directory: %s %s", str(destination_directory), error)
+        stats.add_error()
+
+
+def copy_tree(options: argparse.Namespace, pool: ThreadPoolExecutor) -> CopyStats:
+    """Walk the source tree, creating directories and handing files to the thread pool.
+
+    Args:
+        options [Namespace]: The parsed command line options.
+        pool [ThreadPoolExecutor]: The pool comparing and copying the files.
+    Returns:
+        CopyStats: The statistics, complete once the pool is shut down.
+    """
+    stats = CopyStats()
+    exclusion_filter = compile_exclusion_filter(
+        Path(options.source), options.exclude, read_rules_file(options.exclude_from) if options.exclude_from else []
+    )
+    directories: List[Tuple[Path, Path]] = [(Path(options.source), Path(options.destination_root))]
+    copied_directories: List[Tuple[Path, os.stat_result]] = []
+    while directories:
+        source_directory, destination_directory = directories.pop()
+        try:
+            source_stat = os.stat(source_directory)
+            entries = list(os.scandir(source_directory))
+            if destination_directory.is_symlink() or destination_directory.is_file():
+                destination_directory.unlink()
+            destination_directory.mkdir(parents=True, exist_ok=True)
+        except OSError as error:
+            logging.error("Cannot copy directory: %s %s", str(source_directory), error)
+            stats.add_error()
+            continue
+        copied_directories.append((destination_directory, source_stat))
+        if options.delete:
+            delete_extraneous_entries(destination_directory, {entry.name for entry in entries}, stats)
+        for entry in entries:
+            if exclusion_filter.is_excluded(os.path.abspath(entry.path), entry.is_dir(follow_symlinks=False)):
+                continue
+            destination_path = destination_directory / entry.name
+            if entry.is_symlink():
+                sync_symlink(Path(entry.path), destination_path, stats)
+            elif entry.is_dir():
+                directories.append((Path(entry.path), destination_path))
+            elif entry.is_file():
+                pool.submit(sync_file, Path(entry.path), destination_path, options, stats)
+    pool.shutdown(wait=True)
+    for destination_directory, source_stat in reversed(copied_directories):
+        try:
+            copy_ownership(destination_directory, source_stat)
+            os.chmod(destination_directory, stat.S_IMODE(source_stat.st_mode))
+            os.utime(destination_directory, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        except OSError as error:
+            logging.error("Cannot set the attributes of directory: %s %s", str(destination_directory), error)
+            stats.add_error()
+    return stats
+
+
+def parse_arguments(arguments: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse the command line, which follows the syntax of rsync for the supported options.
+
+    A source without trailing separator is copied into the destination, a source with a trailing separator has its
+    content copied into the destination.
+
+    Args:
+        arguments [Optional[List[str]]]: The arguments, None for the ones of the command line.
+    Returns:
+        Namespace: The options, with destination_root set to the directory receiving the content of the source.
+    """
+    parser = argparse.ArgumentParser(description="Copy a directory to a local disk, like rsync -a would")
+    parser.add_argument("--delete", help="Delete extraneous files from the destination", action="store_true")
+    parser.add_argument("--update", help="Skip files that are newer on the destination", action="store_true")
+    parser.add_argument("--max-size", help="Skip the files larger than this size, in bytes", type=int, default=None)
+    parser.add_argument("--exclude", help="Absolute path to exclude", action="append", default=[])
+    parser.add_argument("--exclude-from", help="File of exclusion rules, one per line", type=Path, default=None)
+    parser.add_argument("--link-dest", help="Hard link to files in this directory when unchanged", default=None)
+    parser.add_argument("source")
+    parser.add_argument("destination")
+    options = parser.parse_args(arguments)
+    options.destination_root = Path(options.destination)
+    if not options.source.endswith(os.sep):
+        options.destination_root = options.destination_root / Path(options.source).name
+    return options
+
+
+def main(arguments: Optional[List[str]] = None) -> int:
+    """Copy a directory and print the statistics in the format of rsync --stats.
+
+    Args:
+        arguments [Optional[List[str]]]: The arguments, None for the ones of the command line.
+    Returns:
+        int: 0 on success, 23 (partial transfer, as rsync) if an entry could not be transferred.
+    """
+    options = parse_arguments(arguments)
+    with ThreadPoolExecutor() as pool:
+        stats = copy_tree(options, pool)
+    print(f"Number of regular files transferred: {stats.files_transferred}")
+    print(f"Total transferred file size: {stats.bytes_transferred} bytes")
+    print(f"Total bytes sent: {stats.bytes_transferred}")
+    sys.stdout.flush()
+    return RETURN_CODE_PARTIAL_TRANSFER if stats.errors else 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
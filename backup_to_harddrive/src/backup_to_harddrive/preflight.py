@@ -0,0 +1,204 @@
+"""Check the harddrives before a run, so that it does not fail hours in or write where it should not.
+
+A harddrive must be a filesystem of its own: a directory on the root filesystem or on the filesystem of a source is
+what an unmounted mount point looks like. The bytes a run needs on a harddrive are the ones of the files that changed
+since the backup it holds, they are compared to its free space. A short write sample measures its throughput, so that
+the jobs of the slowest harddrives are started first. A dry run writes nothing: the jobs of the harddrives that need the
+most bytes are started first.
+"""
+
+import logging
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Optional, Set
+
+from backup_to_harddrive.config import RunConfig
+from backup_to_harddrive.manifest import Manifest
+from backup_to_harddrive.scheduler import BackupJob
+
+WRITE_SAMPLE_SIZE_IN_BYTES = 8 * 1024 * 1024
+FREE_SPACE_MARGIN_RATIO = 0.05
+
+
+@dataclass
+class DriveCheck:
+    """Result of the pre-flight check of a harddrive.
+
+    throughput is the measured write throughput in bytes per second. problem is None if the harddrive can be used.
+    """
+
+    harddrive: Path
+    needed_bytes: int = 0
+    free_bytes: int = 0
+    throughput: float = 0.0
+    problem: Optional[str] = None
+
+
+@dataclass
+class TransferPlan:
+    """Files a backup transfers to a harddrive: the ones that are new, changed or deleted since the backup it holds."""
+
+    files_to_add: int = 0
+    files_to_update: int = 0
+    files_to_delete: int = 0
+    bytes_to_write: int = 0
+
+
+def get_device_of(path: Path) -> Optional[int]:
+    """Get the device holding a path.
+
+    Args:
+        path [Path]: The path.
+    Returns:
+        Optional[int]: The device id, None if the path cannot be accessed.
+    """
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+def get_transfer_plan(live: Manifest, backed_up: Mapping[str, Any]) -> TransferPlan:
+    """Compare a source with its backup to plan the transfer of a backup.
+
+    Args:
+        live [Manifest]: Current metadata of the source.
+        backed_up [Mapping[str, Any]]: Metadata (size and mtime_ns) of the files of the backup, indexed by their path.
+    Returns:
+        TransferPlan: The files to add, update and delete, and the bytes to write.
+    """
+    transfer_plan = TransferPlan(files_to_delete=sum(1 for path in backed_up if path not in live))
+    for path, entry in live.items():
+        stored = backed_up.get(path)
+        if stored is None:
+            transfer_plan.files_to_add += 1
+        elif (entry.size, entry.mtime_ns) != (stored.size, stored.mtime_ns):
+            transfer_plan.files_to_update += 1
+        else:
+            continue
+        transfer_plan.bytes_to_write += entry.size
+    return transfer_plan
+
+
+def measure_write_throughput(harddrive: Path) -> Optional[float]:
+    """Measure the write throughput of a harddrive by writing and syncing a sample file, removed afterwards.
+
+    The sample is random so that a compressing filesystem does not make the harddrive look faster.
+
+    Args:
+        harddrive [Path]: The harddrive.
+    Returns:
+        Optional[float]: The throughput in bytes per second, None if the harddrive cannot be written.
+    """
+    sample = os.urandom(WRITE_SAMPLE_SIZE_IN_BYTES)
+    try:
+        with tempfile.NamedTemporaryFile(dir=harddrive, prefix=".preflight_") as file:
+            started = time.monotonic()
+            file.write(sample)
+            file.flush()
+            os.fsync(file.fileno())
+            elapsed = time.monotonic() - started
+    except OSError as error:
+        logging.error("Cannot write on harddrive: %s %s", str(harddrive), error)
+        return None
+    return WRITE_SAMPLE_SIZE_IN_BYTES / max(elapsed, 1e-6)
+
+
+def check_harddrive(harddrive: Path, needed_bytes: int, other_devices: Set[int], dry_run: bool = False) -> DriveCheck:
+    """Check that a harddrive is mounted, has room for the run and can be written.
+
+    Args:
+        harddrive [Path]: The harddrive.
+        needed_bytes [int]: The estimated number of bytes the run writes on it.
+        other_devices [Set[int]]: Devices of the root filesystem and of the sources.
+        dry_run [bool]: If True, the write permission is checked instead of writing a sample, and the throughput is
+            left unmeasured.
+    Returns:
+        DriveCheck: The result of the check.
+    """
+    drive_check = DriveCheck(harddrive=harddrive, needed_bytes=needed_bytes)
+    device = get_device_of(harddrive)
+    if device is None or device in other_devices:
+        drive_check.problem = "not mounted, it is on the root filesystem or on the filesystem of a source"
+        return drive_check
+    statvfs = os.statvfs(harddrive)
+    drive_check.free_bytes = statvfs.f_bavail * statvfs.f_frsize
+    if drive_check.free_bytes < needed_bytes * (1 + FREE_SPACE_MARGIN_RATIO):
+        drive_check.problem = f"not enough free space, {needed_bytes} bytes needed, {drive_check.free_bytes} free"
+        return drive_check
+    if dry_run:
+        if not os.access(harddrive, os.W_OK):
+            drive_check.problem = "not writable"
+        return drive_check
+    throughput = measure_write_throughput(harddrive)
+    if throughput is None:
+        drive_check.problem = "not writable"
+        return drive_check
+    drive_check.throughput = throughput
+    logging.info(
+        "Harddrive %s: %s bytes needed, %s free, %.1f MB/s",
+        str(harddrive),
+        needed_bytes,
+        drive_check.free_bytes,
+        throughput / 1e6,
+    )
+    return drive_check
+
+
+def skip_failed_harddrives_of(run_config: RunConfig, drive_checks: Dict[Path, DriveCheck]) -> bool:
+    """Remove the harddrives that failed their check from the run configuration.
+
+    A backup configuration left without harddrive is removed. With fan out, the next harddrive becomes the seed.
+
+    Args:
+        run_config [RunConfig]: The run configuration, updated in place.
+        drive_checks [Dict[Path, DriveCheck]]: The check of each harddrive.
+    Returns:
+        bool: True if no harddrive was skipped.
+    """
+    failed = {harddrive for harddrive, drive_check in drive_checks.items() if drive_check.problem is not None}
+    for harddrive in failed:
+        logging.error("Harddrive: %s skipped, %s", str(harddrive), drive_checks[harddrive].problem)
+    for backup_config in run_config.backup_configs:
+        backup_config.list_of_harddrive = [
+            harddrive for harddrive in backup_config.list_of_harddrive if harddrive not in failed
+        ]
+    run_config.backup_configs = [
+        backup_config for backup_config in run_config.backup_configs if backup_config.list_of_harddrive
+    ]
+    return not failed
+
+
+def get_jobs_in_plan_order(jobs: List[BackupJob], drive_checks: Dict[Path, DriveCheck]) -> List[BackupJob]:
+    """Order the jobs by the estimated duration of the writes on their harddrive, longest first.
+
+    Without measured throughput, as in a dry run, the jobs are ordered by the bytes needed on their harddrive. The jobs
+    of a harddrive that was not checked keep their place after the other ones. Dependencies are renumbered.
+
+    Args:
+        jobs [List[BackupJob]]: The jobs of the run.
+        drive_checks [Dict[Path, DriveCheck]]: The check of each harddrive.
+    Returns:
+        List[BackupJob]: The same jobs, in the order to start them.
+    """
+
+    def get_estimated_seconds_of(index: int) -> float:
+        drive_check = drive_checks.get(jobs[index].harddrive)
+        if drive_check is None or not drive_check.throughput:
+            return 0.0
+        return drive_check.needed_bytes / drive_check.throughput
+
+    def get_needed_bytes_of(index: int) -> int:
+        drive_check = drive_checks.get(jobs[index].harddrive)
+        return 0 if drive_check is None else drive_check.needed_bytes
+
+    order = sorted(range(len(jobs)), key=lambda index: (-get_estimated_seconds_of(index), -get_needed_bytes_of(index)))
+    new_indexes = {index: new_index for new_index, index in enumerate(order)}
+    ordered_jobs = [jobs[index] for index in order]
+    for job in ordered_jobs:
+        if job.depends_on is not None:
+            job.depends_on = new_indexes[job.depends_on]
+    return ordered_jobs
@@ -0,0 +1,205 @@
+"""Restore the sources of the configuration file from their backup on a harddrive, with parallel workers.
+
+The quick restore paths of all the sources are restored first, so that one can get back to work before the rest of the
+sources is restored. Directory and snapshot backups are copied by the native copy engine, with a pool of threads and
+large in-kernel copies. Backups in the deduplicating store are restored from the manifest of their latest run, the files
+by a pool of threads as well. A file that is newer at the destination than in the backup is left as is, so that the
+changes made to the quick restore paths while the rest is restored are kept.
+"""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+from backup_to_harddrive.backup_from_config import path_to_backup_within_harddrive
+from backup_to_harddrive.config import (
+    BackupConfig,
+    extract_valid_configuration_from_config_file,
+)
+from backup_to_harddrive.dedup_store import (
+    RESTORE_THREADS,
+    get_latest_run_manifest_of,
+    get_path_to_store,
+    restore_from_store,
+)
+from backup_to_harddrive.native_copy import (
+    CopyStats,
+    copy_tree,
+    parse_arguments,
+    sync_file,
+    sync_symlink,
+)
+from backup_to_harddrive.verify import get_backup_directory_of
+
+
+@dataclass
+class RestoreTask:
+    """A path of a source to restore from its backup on a harddrive.
+
+    An empty relative_path stands for the whole source. harddrive is None if no harddrive holds a backup of the source.
+    """
+
+    backup_config: BackupConfig
+    harddrive: Optional[Path]
+    relative_path: str
+    destination: Path
+
+
+def get_harddrive_to_restore_from(backup_config: BackupConfig, harddrive: Optional[Path]) -> Optional[Path]:
+    """Get the harddrive to restore a source from: the given one, or the first one holding a backup of the host.
+
+    Args:
+        backup_config [BackupConfig]: The backup configuration of the source.
+        harddrive [Optional[Path]]: The harddrive to restore from, None for the first one of the source holding a
+            backup.
+    Returns:
+        Optional[Path]: The harddrive, None if no harddrive of the source holds a backup.
+    """
+    if harddrive is not None:
+        return harddrive
+    for candidate in backup_config.list_of_harddrive:
+        if path_to_backup_within_harddrive(candidate).is_dir():
+            return candidate
+    return None
+
+
+def get_restore_tasks_of(
+    backup_configs: List[BackupConfig], harddrive: Optional[Path], destination: Optional[Path]
+) -> List[RestoreTask]:
+    """List the restore tasks of the sources: the quick restore paths of all of them, then the sources themselves.
+
+    Args:
+        backup_configs [List[BackupConfig]]: The backup configurations.
+        harddrive [Optional[Path]]: The harddrive to restore from, None for the first one of each source holding a
+            backup.
+        destination [Optional[Path]]: The directory to restore the sources into, None to restore them in place.
+    Returns:
+        List[RestoreTask]: The tasks, in the order to run them.
+    """
+    quick_tasks: List[RestoreTask] = []
+    tasks: List[RestoreTask] = []
+    for backup_config in backup_configs:
+        source_harddrive = get_harddrive_to_restore_from(backup_config, harddrive)
+        source_destination = (
+            backup_config.source.absolute()
+            if destination is None
+            else destination / backup_config.source.absolute().name
+        )
+        quick_tasks.extend(
+            RestoreTask(
+                backup_config,
+                source_harddrive,
+                str(quick_restore_path.absolute().relative_to(backup_config.source.absolute())),
+                source_destination,
+            )
+            for quick_restore_path in backup_config.quick_restore_path
+            if source_harddrive is not None
+        )
+        tasks.append(RestoreTask(backup_config, source_harddrive, "", source_destination))
+    return quick_tasks + tasks
+
+
+def restore_single_entry(backup_path: Path, destination_path: Path) -> int:
+    """Restore a file or a symbolic link of a backup, unless the file is newer at the destination.
+
+    Args:
+        backup_path [Path]: The file or link in the backup.
+        destination_path [Path]: Where to restore it.
+    Returns:
+        int: Number of entries that could not be restored.
+    """
+    stats = CopyStats()
+    try:
+        destination_path.parent.mkdir(parents=True, exist_ok=True)
+    except OSError as error:
+        logging.error("Cannot restore: %s %s", str(destination_path), error)
+        return 1
+    if backup_path.is_symlink():
+        sync_symlink(backup_path, destination_path, stats)
+    else:
+        sync_file(
+            backup_path,
+            destination_path,
+            parse_arguments(["--update", str(backup_path), str(destination_path.parent)]),
+            stats,
+        )
+    return stats.errors
+
+
+def run_restore_task(restore_task: RestoreTask) -> int:
+    """Restore a path of a source from its backup.
+
+    Args:
+        restore_task [RestoreTask]: The task.
+    Returns:
+        int: Number of entries that could not be restored.
+    """
+    backup_config = restore_task.backup_config
+    if restore_task.harddrive is None:
+        logging.error("No harddrive holds a backup of %s", str(backup_config.source))
+        return 1
+    logging.info(
+        "Restoring %s from %s",
+        str(restore_task.destination / restore_task.relative_path),
+        str(restore_task.harddrive),
+    )
+    if backup_config.target_format == "dedup":
+        manifest_path = get_latest_run_manifest_of(
+            path_to_backup_within_harddrive(restore_task.harddrive), backup_config.source.absolute().name
+        )
+        if manifest_path is None:
+            logging.error("No backup of %s on %s", str(backup_config.source), str(restore_task.harddrive))
+            return 1
+        return restore_from_store(
+            manifest_path,
+            get_path_to_store(restore_task.harddrive),
+            restore_task.destination,
+            restore_task.relative_path,
+            update=True,
+        )
+    backup_directory = get_backup_directory_of(backup_config, restore_task.harddrive)
+    if backup_directory is not None and restore_task.relative_path:
+        backup_path = backup_directory / restore_task.relative_path
+        if backup_path.is_symlink() or backup_path.is_file():
+            return restore_single_entry(backup_path, restore_task.destination / restore_task.relative_path)
+    if backup_directory is None or not (backup_directory / restore_task.relative_path).is_dir():
+        logging.error(
+            "No backup of %s on %s",
+            str(backup_config.source / restore_task.relative_path),
+            str(restore_task.harddrive),
+        )
+        return 1
+    options = parse_arguments(
+        [
+            "--update",
+            os.path.join(backup_directory / restore_task.relative_path, ""),
+            str(restore_task.destination / restore_task.relative_path),
+        ]
+    )
+    with ThreadPoolExecutor(max_workers=RESTORE_THREADS) as pool:
+        return copy_tree(options, pool).errors
+
+
+def restore_from_config_file(harddrive: Optional[Path] = None, destination: Optional[Path] = None) -> int:
+    """Restore each source of the configuration file, its quick restore paths first.
+
+    Args:
+        harddrive [Optional[Path]]: The harddrive to restore from, None for the first one of each source holding a
+            backup.
+        destination [Optional[Path]]: The directory to restore the sources into, None to restore them in place.
+    Returns:
+        int: 0 if everything was restored, 1 otherwise.
+    """
+    run_config = extract_valid_configuration_from_config_file()
+    errors = sum(
+        run_restore_task(restore_task)
+        for restore_task in get_restore_tasks_of(run_config.backup_configs, harddrive, destination)
+    )
+    if errors:
+        logging.error("Restore incomplete: %s entries could not be restored", errors)
+        return 1
+    logging.info("Restore complete")
+    return 0
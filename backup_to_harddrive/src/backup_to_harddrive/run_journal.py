@@ -0,0 +1,167 @@
+"""Journal of the jobs finished by a run, so that an interrupted run can be resumed.
+
+The journal is a JSON lines file: a header with the snapshot name of the run, then one line per finished job. Each line
+is synced to disk when written, a torn last line left by a crash is ignored.
+A job is identified by a hash of its command, so a resumed run only skips the jobs whose very same command succeeded.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set
+
+from platformdirs import user_config_dir
+
+from backup_to_harddrive.scheduler import BackupJob
+
+RUN_JOURNAL_FILE_NAME = "run_journal.jsonl"
+
+
+@dataclass
+class RunJournal:
+    """Content of the journal of an unfinished run."""
+
+    snapshot_name: str
+    started_at: str
+    finished: Set[str] = field(default_factory=set)
+
+
+def get_path_to_run_journal() -> Path:
+    """Get the path of the run journal.
+
+    Returns:
+        Path: The path to the JSON lines file of the journal.
+    """
+    return Path(user_config_dir("backup_to_harddrive")) / RUN_JOURNAL_FILE_NAME
+
+
+def get_job_key(job: BackupJob) -> str:
+    """Get the key identifying a job in the journal.
+
+    Args:
+        job (BackupJob): The job.
+    Returns:
+        str: The hexadecimal hash of its command.
+    """
+    return hashlib.blake2b("\0".join(job.command).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def append_to_run_journal(journal_path: Path, record: dict, mode: str = "a") -> None:
+    """Write a record to the journal and sync it to disk.
+
+    Args:
+        journal_path (Path): The path to the journal.
+        record (dict): The record to write.
+        mode (str): "w" to start a new journal, "a" to append to it.
+    """
+    journal_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(journal_path, mode, encoding="utf-8") as file:
+        file.write(json.dumps(record) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def start_run_journal(journal_path: Path, snapshot_name: str, started_at: str) -> None:
+    """Start the journal of a new run, discarding the one of the previous run.
+
+    Args:
+        journal_path (Path): The path to the journal.
+        snapshot_name (str): Name of the snapshot directory of the run.
+        started_at (str): The moment the run started, in ISO format.
+    """
+    append_to_run_journal(journal_path, {"snapshot_name": snapshot_name, "started_at": started_at}, "w")
+
+
+def read_run_journal(journal_path: Path) -> Optional[RunJournal]:
+    """Read the journal of the last run.
+
+    Args:
+        journal_path (Path): The path to the journal.
+    Returns:
+        Optional[RunJournal]: The journal, None if there is none or if its header cannot be read.
+    """
+    try:
+        with open(journal_path, "r", encoding="utf-8") as file:
+            lines = file.read().splitlines()
+        header = json.loads(lines[0])
+        run_journal = RunJournal(snapshot_name=header["snapshot_name"], started_at=header["started_at"])
+    except FileNotFoundError:
+        return None
+    except (OSError, IndexError, KeyError, TypeError, ValueError) as error:
+        logging.error("Cannot read the run journal: %s %s", str(journal_path), error)
+        return None
+    for line in lines[1:]:
+        try:
+            run_journal.finished.add(json.loads(line)["finished"])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return run_journal
+
+
+def remove_run_journal(journal_path: Path) -> None:
+    """Remove the journal once its run is complete.
+
+    Args:
+        journal_path (Path): The path to the journal.
+    """
+    journal_path.unlink(missing_ok=True)
+
+
+def get_journal_recorder_for(job: BackupJob, journal_path: Path) -> Callable[[], None]:
+    """Get the on_success callback of a job that also records it as finished in the journal.
+
+    The job is only recorded once its own on_success callback succeeded.
+
+    Args:
+        job (BackupJob): The job.
+        journal_path (Path): The path to the journal.
+    Returns:
+        Callable[[], None]: The callback.
+    """
+    on_success = job.on_success
+    job_key = get_job_key(job)
+
+    def record_finished_job() -> None:
+        if on_success is not None:
+            on_success()
+        append_to_run_journal(journal_path, {"finished": job_key})
+
+    return record_finished_job
+
+
+def add_journal_recording_to(jobs: List[BackupJob], journal_path: Path) -> None:
+    """Record each job of a run in the journal once it succeeded.
+
+    Args:
+        jobs (List[BackupJob]): The jobs of the run, updated in place.
+        journal_path (Path): The path to the journal.
+    """
+    for job in jobs:
+        job.on_success = get_journal_recorder_for(job, journal_path)
+
+
+def get_unfinished_jobs(jobs: List[BackupJob], finished: Set[str]) -> List[BackupJob]:
+    """Get the jobs that are not finished yet.
+
+    A dependency on a finished job is met already and dropped, the other ones are renumbered.
+
+    Args:
+        jobs (List[BackupJob]): The jobs of the run.
+        finished (Set[str]): Keys of the finished jobs.
+    Returns:
+        List[BackupJob]: The unfinished jobs, in the same order.
+    """
+    new_indexes: Dict[int, int] = {}
+    unfinished_jobs: List[BackupJob] = []
+    for index, job in enumerate(jobs):
+        if get_job_key(job) in finished:
+            continue
+        new_indexes[index] = len(unfinished_jobs)
+        unfinished_jobs.append(job)
+    for job in unfinished_jobs:
+        if job.depends_on is not None:
+            job.depends_on = new_indexes.get(job.depends_on)
+    return unfinished_jobs
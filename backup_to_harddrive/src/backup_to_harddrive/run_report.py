@@ -0,0 +1,180 @@
+"""Machine readable reports of the backup runs, written on each harddrive."""
+
+import datetime
+import json
+import os
+import socket
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from backup_to_harddrive.scheduler import BackupJob
+
+RUN_REPORTS_FILE_NAME = "run_reports.jsonl"
+HISTORY_READ_BLOCK_SIZE = 64 * 1024
+
+
+@dataclass
+class SourceReport:  # pylint: disable=(too-many-instance-attributes)
+    """Report of the backup of a single source to a harddrive."""
+
+    source: str
+    started_at: Optional[str] = None
+    ended_at: Optional[str] = None
+    duration_seconds: float = 0.0
+    bytes_transferred: int = 0
+    files_transferred: int = 0
+    return_code: Optional[int] = None
+    stop_reason: Optional[str] = None
+
+
+@dataclass
+class RunReport:
+    """Report of a backup run on a harddrive."""
+
+    hostname: str
+    harddrive: str
+    started_at: str
+    ended_at: str
+    complete: bool
+    sources: List[SourceReport] = field(default_factory=list)
+
+
+def get_source_report_of(job: BackupJob, return_code: Optional[int]) -> SourceReport:
+    """Get the report of a backup job.
+
+    Args:
+        job [BackupJob]: The job, once the scheduler is done with it.
+        return_code [Optional[int]]: The return code of the job, None if it was skipped.
+    """
+    if job.metrics is None:
+        return SourceReport(source=str(job.source), return_code=return_code)
+    return SourceReport(
+        source=job.metrics.source,
+        started_at=job.metrics.started_at,
+        ended_at=job.metrics.ended_at,
+        duration_seconds=job.metrics.elapsed_seconds,
+        bytes_transferred=job.metrics.bytes_transferred,
+        files_transferred=job.metrics.files_transferred,
+        return_code=return_code,
+        stop_reason=job.metrics.stop_reason,
+    )
+
+
+def get_run_reports_of(
+    jobs: List[BackupJob], return_codes: List[Optional[int]], started_at: datetime.datetime
+) -> Dict[Path, RunReport]:
+    """Get the report of the run for each harddrive it backed up to.
+
+    The run is complete on a harddrive if every job targeting it succeeded. A skipped job makes it incomplete.
+
+    Args:
+        jobs [List[BackupJob]]: The jobs of the run.
+        return_codes [List[Optional[int]]]: The return code of each job, None if it was skipped.
+        started_at [datetime]: The moment the run started.
+    """
+    ended_at = datetime.datetime.now().isoformat()
+    reports: Dict[Path, RunReport] = {}
+    for job, return_code in zip(jobs, return_codes):
+        report = reports.setdefault(
+            job.harddrive,
+            RunReport(
+                hostname=socket.gethostname(),
+                harddrive=str(job.harddrive),
+                started_at=started_at.isoformat(),
+                ended_at=ended_at,
+                complete=True,
+            ),
+        )
+        report.sources.append(get_source_report_of(job, return_code))
+        report.complete = report.complete and return_code == 0
+    return reports
+
+
+def get_path_to_run_reports(backup_path: Path) -> Path:
+    """Get the path of the file holding the run reports of a harddrive.
+
+    Args:
+        backup_path (Path): The backup directory within the harddrive (Backup/<hostname>).
+    Returns:
+        Path: The path to the JSON lines file of the reports.
+    """
+    return backup_path / RUN_REPORTS_FILE_NAME
+
+
+def append_run_report(reports_path: Path, report: RunReport) -> None:
+    """Append a run report to the reports of a harddrive.
+
+    Args:
+        reports_path (Path): The path to the JSON lines file of the reports.
+        report (RunReport): The report to append.
+    """
+    reports_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(reports_path, "a", encoding="utf-8") as file:
+        file.write(json.dumps(asdict(report)) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def read_last_run_reports(reports_path: Path, number_of_runs: int) -> List[dict]:
+    """Read the last run reports of a harddrive.
+
+    Only the end of the file is read, so the cost does not grow with the number of runs recorded.
+
+    Args:
+        reports_path (Path): The path to the JSON lines file of the reports.
+        number_of_runs (int): Maximum number of reports to read.
+    Returns:
+        List[dict]: The reports, oldest first. Empty if the file does not exist or number_of_runs is not positive.
+    """
+    if number_of_runs < 1:
+        return []
+    try:
+        with open(reports_path, "rb") as file:
+            end = file.seek(0, os.SEEK_END)
+            position = end
+            content = b""
+            while position > 0 and content.count(b"\n") <= number_of_runs:
+                position = max(0, position - HISTORY_READ_BLOCK_SIZE)
+                file.seek(position)
+                content = file.read(end - position)
+    except FileNotFoundError:
+        return []
+    reports = []
+    for line in content.splitlines()[-number_of_runs:]:
+        try:
+            reports.append(json.loads(line))
+        except ValueError:
+            continue
+    return reports
+
+
+def format_run_report(report: dict) -> str:
+    """Format a run report as a single line for the history.
+
+    Args:
+        report (dict): The run report.
+    Returns:
+        str: The formatted report.
+    """
+    sources = report.get("sources", [])
+    duration = sum(source.get("duration_seconds", 0) for source in sources)
+    transferred = sum(source.get("bytes_transferred", 0) for source in sources)
+    files = sum(source.get("files_transferred", 0) for source in sources)
+    status = "complete" if report.get("complete") else "INCOMPLETE"
+    return (
+        f"{report.get('started_at')}  {status:<10}  {len(sources)} source(s)  {duration:.1f}s  "
+        f"{transferred} bytes  {files} files"
+    )
+
+
+def get_run_history(reports_path: Path, number_of_runs: int) -> List[str]:
+    """Get the formatted history of the last runs on a harddrive.
+
+    Args:
+        reports_path (Path): The path to the JSON lines file of the reports.
+        number_of_runs (int): Maximum number of runs in the history.
+    Returns:
+        List[str]: One line per run, oldest first.
+    """
+    return [format_run_report(report) for report in read_last_run_reports(reports_path, number_of_runs)]
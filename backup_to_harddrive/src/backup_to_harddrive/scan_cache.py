@@ -0,0 +1,101 @@
+"""Cache of the scans of the sources and of the backups, so that a run can be planned without walking them again.
+
+The scans are kept as manifests in the user cache directory. A scan of a source is reused for
+SOURCE_SCAN_MAX_AGE_IN_SECONDS, a dry run followed by a run share it. A scan of a backup directory is reused until a run
+writes to its harddrive: it is keyed with the timestamp of the harddrive, so that another harddrive mounted at the same
+place is scanned again, and the scans of the harddrives of a run are removed when the run starts.
+"""
+
+import hashlib
+import time
+from pathlib import Path
+from typing import Iterable
+
+from platformdirs import user_cache_dir
+
+from backup_to_harddrive.filters import Exclusions, as_exclusion_filter
+from backup_to_harddrive.manifest import (
+    Manifest,
+    read_manifest,
+    scan_source,
+    write_manifest,
+)
+
+SOURCE_SCAN_MAX_AGE_IN_SECONDS = 15 * 60
+
+
+def get_path_to_scan_cache() -> Path:
+    """Get the directory holding the cached scans.
+
+    Returns:
+        Path: The scan cache directory, in the user cache directory.
+    """
+    return Path(user_cache_dir("backup_to_harddrive")) / "scan_cache"
+
+
+def get_key_of(*parts: str) -> str:
+    """Get the key of a cached scan.
+
+    Args:
+        parts [str]: What identifies the scan.
+    Returns:
+        str: The hexadecimal hash of the parts.
+    """
+    return hashlib.blake2b("\0".join(parts).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def get_cached_scan_of_source(source_path: Path, excluded_path_list: Exclusions) -> Manifest:
+    """Get the metadata of the files of a source, from a scan of less than SOURCE_SCAN_MAX_AGE_IN_SECONDS if any.
+
+    Args:
+        source_path [Path]: The source directory.
+        excluded_path_list [Exclusions]: The exclusion rules, or the absolute paths of the excluded folders.
+    Returns:
+        Manifest: The metadata of each file, indexed by its path relative to the source.
+    """
+    exclusion_filter = as_exclusion_filter(source_path, excluded_path_list)
+    key = get_key_of(str(source_path.absolute()), *sorted(exclusion_filter.excluded_paths), *exclusion_filter.rules)
+    scan_path = get_path_to_scan_cache() / f"source_{key}.json.gz"
+    try:
+        is_recent = time.time() - scan_path.stat().st_mtime < SOURCE_SCAN_MAX_AGE_IN_SECONDS
+    except FileNotFoundError:
+        is_recent = False
+    manifest = read_manifest(scan_path) if is_recent else None
+    if manifest is None:
+        manifest = scan_source(source_path, exclusion_filter)
+        write_manifest(scan_path, manifest)
+    return manifest
+
+
+def get_cached_scan_of_backup(harddrive: Path, backup_directory: Path) -> Manifest:
+    """Get the metadata of the files of a backup directory, from its scan since the last run on its harddrive if any.
+
+    Args:
+        harddrive [Path]: The harddrive holding the backup directory.
+        backup_directory [Path]: The backup directory.
+    Returns:
+        Manifest: The metadata of each file, indexed by its path relative to the backup directory.
+    """
+    try:
+        timestamp = str((harddrive / "Backup" / "timestamp.txt").stat().st_mtime_ns)
+    except OSError:
+        timestamp = ""
+    scan_path = get_path_to_scan_cache() / (
+        f"{get_key_of(str(harddrive.absolute()))}_{get_key_of(str(backup_directory), timestamp)}.json.gz"
+    )
+    manifest = read_manifest(scan_path)
+    if manifest is None:
+        manifest = scan_source(backup_directory, [])
+        write_manifest(scan_path, manifest)
+    return manifest
+
+
+def remove_cached_scans_of(harddrives: Iterable[Path]) -> None:
+    """Remove the cached scans of the backup directories of harddrives, before a run writes to them.
+
+    Args:
+        harddrives [Iterable[Path]]: The harddrives.
+    """
+    for harddrive in harddrives:
+        for scan_path in get_path_to_scan_cache().glob(f"{get_key_of(str(harddrive.absolute()))}_*"):
+            scan_path.unlink(missing_ok=True)
@@ -0,0 +1,110 @@
+"""Parallel walk of a source tree, for the manifests, the dry run plan, the verification and the sharding.
+
+Each directory is listed with os.scandir by a pool of threads, which release the GIL while they wait for the
+filesystem: the directories found by a thread are queued and taken by whichever thread is idle, so that a slow disk, a
+network mount or a single huge directory do not leave the other threads waiting. Excluded folders are pruned before they
+are listed. The files are yielded as they are found, one compact record each, in no particular order.
+"""
+
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from backup_to_harddrive.filters import ExclusionFilter, Exclusions, as_exclusion_filter
+
+SCANNER_THREADS = min(32, 2 * (os.cpu_count() or 1))
+SCAN_BATCH_SIZE = 4096
+
+
+class ScannedFile(NamedTuple):
+    """Metadata of a file found by the scanner. path is relative to the scanned directory."""
+
+    path: str
+    size: int
+    mtime_ns: int
+    inode: int
+    mode: int
+
+
+def scan_directories(
+    directories: List[str], prefix_length: int, exclusion_filter: ExclusionFilter
+) -> Tuple[List[ScannedFile], List[str]]:
+    """List directories and their subdirectories, depth first, until SCAN_BATCH_SIZE entries are listed.
+
+    The files and symbolic links that vanish while they are listed are left out. The entries that cannot be read are
+    logged and left out, the rest of their directory is still listed.
+
+    Args:
+        directories [List[str]]: Absolute paths of the directories to list.
+        prefix_length [int]: Length of the absolute path of the scanned directory, separator included.
+        exclusion_filter [ExclusionFilter]: The exclusion rules of the scanned directory.
+    Returns:
+        Tuple[List[ScannedFile], List[str]]: The files, and the absolute paths of the directories left to list.
+    """
+    files = []
+    number_of_entries = 0
+    while directories and number_of_entries < SCAN_BATCH_SIZE:
+        directory = directories.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    number_of_entries += 1
+                    try:
+                        is_directory = entry.is_dir(follow_symlinks=False)
+                        if exclusion_filter.is_excluded(entry.path, is_directory):
+                            continue
+                        if is_directory:
+                            directories.append(entry.path)
+                            continue
+                        stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    except OSError as error:
+                        logging.warning("Cannot scan entry: %s %s", entry.path, error)
+                        continue
+                    files.append(
+                        ScannedFile(
+                            entry.path[prefix_length:], stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_mode
+                        )
+                    )
+        except OSError as error:
+            logging.warning("Cannot scan directory: %s %s", directory, error)
+    return files, directories
+
+
+def scan_files(
+    source_path: Path, excluded_path_list: Exclusions, threads: Optional[int] = None
+) -> Iterator[ScannedFile]:
+    """Walk a source directory with a pool of threads and yield its files as they are found.
+
+    Excluded directories are not descended into. Directories are not yielded, symbolic links are not followed. The
+    directories a thread leaves to list are split between the idle threads.
+
+    Args:
+        source_path [Path]: The source directory.
+        excluded_path_list [Exclusions]: The exclusion rules, or the absolute paths of the excluded folders.
+        threads [Optional[int]]: Number of threads listing the directories, SCANNER_THREADS by default.
+    Yields:
+        ScannedFile: The metadata of each file, its path relative to the source.
+    """
+    exclusion_filter = as_exclusion_filter(source_path, excluded_path_list)
+    root = str(source_path.absolute())
+    prefix_length = len(os.path.join(root, ""))
+    threads = threads or SCANNER_THREADS
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="scanner") as pool:
+        pending: Set[Future] = {pool.submit(scan_directories, [root], prefix_length, exclusion_filter)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, directories = future.result()
+                if directories:
+                    number_of_splits = max(1, min(len(directories), threads - len(pending)))
+                    pending.update(
+                        pool.submit(
+                            scan_directories, directories[index::number_of_splits], prefix_length, exclusion_filter
+                        )
+                        for index in range(number_of_splits)
+                    )
+                yield from files
@@ -0,0 +1,493 @@
+"""Scheduler that runs backup jobs with per-device and global concurrency limits.
+
+Jobs run as asyncio subprocesses, each in its own process group, so that a job can be stopped with the processes it
+started when it times out, stalls or when the run is cancelled.
+"""
+
+import asyncio
+import datetime
+import logging
+import os
+import signal
+import time
+from asyncio.subprocess import Process
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+
+from backup_to_harddrive.telemetry import (
+    JobMetrics,
+    TelemetrySink,
+    collect_metrics_from,
+    emit_summary,
+)
+from backup_to_harddrive.throttle import (
+    Governor,
+    add_process_group_to,
+    get_disk_name_of,
+    run_governor,
+)
+
+ACTIVITY_CHECK_INTERVAL_IN_SECONDS = 1.0
+TERMINATION_GRACE_PERIOD_IN_SECONDS = 10.0
+RETURN_CODE_NOT_STARTED = 127
+
+
+@dataclass
+class BackupJob:  # pylint: disable=(too-many-instance-attributes)
+    """A single command to run, with the source and the harddrive it reads from and writes to.
+
+    depends_on is the index, in the list of jobs, of a job that must succeed before this one can start.
+    on_success is called once the command succeeded.
+    Jobs of the same stream_group are parallel streams of one transfer and may share their devices.
+    Jobs with adaptive_throttle are paused while the system is busy.
+    metrics is filled by the scheduler once the job started.
+    """
+
+    command: List[str]
+    source: Path
+    harddrive: Path
+    depends_on: Optional[int] = None
+    on_success: Optional[Callable[[], None]] = None
+    stream_group: Optional[str] = None
+    metrics: Optional[JobMetrics] = None
+    adaptive_throttle: bool = False
+
+
+@dataclass
+class JobLimits:
+    """Limits of the jobs. 0 means no limit.
+
+    job_timeout limits the duration of a job, stall_timeout the time without output nor data read or written, in
+    seconds. The jobs with adaptive throttling are paused while the load average is above max_load (0 for the number of
+    CPUs) or the latency of their source disks above max_disk_latency_ms.
+    """
+
+    job_timeout: float = 0
+    stall_timeout: float = 0
+    max_load: float = 0
+    max_disk_latency_ms: float = 0
+
+
+@dataclass
+class RunContext:
+    """What the jobs of a run share: where their metrics go, their limits, the cancellation event and the governor."""
+
+    telemetry: Optional[TelemetrySink]
+    limits: JobLimits
+    shutdown: asyncio.Event = field(default_factory=asyncio.Event)
+    governor: Optional[Governor] = None
+
+
+@dataclass
+class JobActivity:
+    """Last activity of a running job, as time.monotonic() values."""
+
+    pid: int
+    started: float = field(default_factory=time.monotonic)
+    last_activity: float = field(default_factory=time.monotonic)
+    io_counter: Optional[int] = None
+
+
+def get_device_id(path: Path) -> str:
+    """Get an identifier of the device (filesystem) a path lives on.
+
+    Args:
+        path [Path]: The path to look at.
+    Returns:
+        str: The st_dev of the path, or the absolute path itself if it cannot be stat'ed.
+    """
+    try:
+        return str(os.stat(path).st_dev)
+    except OSError:
+        return str(path.absolute())
+
+
+def get_devices_used_by(job: BackupJob) -> FrozenSet[str]:
+    """Get the devices a job reads from or writes to.
+
+    Args:
+        job [BackupJob]: The job.
+    Returns:
+        FrozenSet[str]: The device identifiers of the source and of the harddrive.
+    """
+    return frozenset([get_device_id(job.source), get_device_id(job.harddrive)])
+
+
+def are_devices_available_for(
+    job: BackupJob, devices: FrozenSet[str], busy_devices: Dict[str, Tuple[Optional[str], int]]
+) -> bool:
+    """Check if the devices of a job are free, or only used by jobs of its stream group.
+
+    Args:
+        job [BackupJob]: The job.
+        devices [FrozenSet[str]]: The devices used by the job.
+        busy_devices [Dict[str, Tuple[Optional[str], int]]]: Stream group and number of running jobs of each busy
+            device.
+    Returns:
+        bool: True if the job can start without competing for a device with another transfer.
+    """
+    return all(
+        device not in busy_devices or (job.stream_group is not None and busy_devices[device][0] == job.stream_group)
+        for device in devices
+    )
+
+
+def acquire_devices(
+    job: BackupJob, devices: FrozenSet[str], busy_devices: Dict[str, Tuple[Optional[str], int]]
+) -> None:
+    """Mark the devices of a starting job as busy.
+
+    Args:
+        job [BackupJob]: The starting job.
+        devices [FrozenSet[str]]: The devices used by the job.
+        busy_devices [Dict[str, Tuple[Optional[str], int]]]: Stream group and number of running jobs of each busy
+            device, updated in place.
+    """
+    for device in devices:
+        busy_devices[device] = (job.stream_group, busy_devices.get(device, (None, 0))[1] + 1)
+
+
+def release_devices(devices: FrozenSet[str], busy_devices: Dict[str, Tuple[Optional[str], int]]) -> None:
+    """Release the devices of a terminated job.
+
+    Args:
+        devices [FrozenSet[str]]: The devices used by the job.
+        busy_devices [Dict[str, Tuple[Optional[str], int]]]: Stream group and number of running jobs of each busy
+            device, updated in place.
+    """
+    for device in devices:
+        stream_group, count = busy_devices.pop(device)
+        if count > 1:
+            busy_devices[device] = (stream_group, count - 1)
+
+
+def is_dependency_failed(job: BackupJob, return_codes: List[Optional[int]], unfinished: Set[int]) -> bool:
+    """Check if the job a job depends on has failed or was skipped.
+
+    Args:
+        job [BackupJob]: The job.
+        return_codes [List[Optional[int]]]: The return codes of the jobs known so far.
+        unfinished [Set[int]]: Indexes of the jobs not started yet or still running.
+    Returns:
+        bool: True if the job can never start.
+    """
+    if job.depends_on is None or job.depends_on in unfinished:
+        return False
+    return return_codes[job.depends_on] != 0
+
+
+def is_dependency_met(job: BackupJob, return_codes: List[Optional[int]]) -> bool:
+    """Check if the job a job depends on has succeeded.
+
+    Args:
+        job [BackupJob]: The job.
+        return_codes [List[Optional[int]]]: The return codes of the jobs known so far.
+    Returns:
+        bool: True if the job has no dependency or if its dependency succeeded.
+    """
+    return job.depends_on is None or return_codes[job.depends_on] == 0
+
+
+def call_on_success_of(job: BackupJob) -> None:
+    """Call the on_success callback of a job that succeeded, logging any I/O error.
+
+    Args:
+        job [BackupJob]: The job that succeeded.
+    """
+    if job.on_success is None:
+        return
+    try:
+        job.on_success()
+    except OSError as error:
+        logging.error("Post processing failed for: %s %s", " ".join(job.command), error)
+
+
+def read_io_counter_of(pid: int) -> Optional[int]:
+    """Read the number of bytes a process read and wrote so far, pipes included.
+
+    Args:
+        pid [int]: The process id.
+    Returns:
+        Optional[int]: The sum of rchar and wchar of /proc/<pid>/io, None if it cannot be read.
+    """
+    try:
+        with open(f"/proc/{pid}/io", "r", encoding="utf-8") as file:
+            counters = dict(line.split(":", 1) for line in file if ":" in line)
+        return int(counters["rchar"]) + int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def get_stop_reason(activity: JobActivity, limits: JobLimits, shutdown: asyncio.Event) -> Optional[str]:
+    """Check if a running job has to be stopped.
+
+    Args:
+        activity [JobActivity]: The activity of the job.
+        limits [JobLimits]: The time limits of the jobs.
+        shutdown [Event]: Set when the run is cancelled.
+    Returns:
+        Optional[str]: "cancelled", "timeout" or "stalled", None if the job can go on.
+    """
+    now = time.monotonic()
+    if shutdown.is_set():
+        return "cancelled"
+    if limits.job_timeout and now - activity.started >= limits.job_timeout:
+        return "timeout"
+    io_counter = read_io_counter_of(activity.pid)
+    if io_counter is not None and io_counter != activity.io_counter:
+        activity.io_counter = io_counter
+        activity.last_activity = now
+    if limits.stall_timeout and now - activity.last_activity >= limits.stall_timeout:
+        return "stalled"
+    return None
+
+
+def signal_process_group(process: Process, signal_number: int) -> None:
+    """Send a signal to a process and to the processes it started.
+
+    Args:
+        process [Process]: The process, leader of its own process group.
+        signal_number [int]: The signal to send.
+    """
+    try:
+        os.killpg(process.pid, signal_number)
+    except ProcessLookupError:
+        pass
+
+
+async def stop_process(process: Process, waiter: asyncio.Task) -> int:
+    """Stop a process gracefully: SIGTERM first, so that rsync saves its partial files, then SIGKILL.
+
+    SIGCONT follows SIGTERM so that a process paused by the governor handles it. A process that survives SIGKILL,
+    blocked in the kernel by a hung drive, is abandoned.
+
+    Args:
+        process [Process]: The process to stop.
+        waiter [Task]: The task waiting for the process.
+    Returns:
+        int: The return code of the process, -SIGKILL if it was abandoned.
+    """
+    for signal_number in (signal.SIGTERM, signal.SIGKILL):
+        signal_process_group(process, signal_number)
+        signal_process_group(process, signal.SIGCONT)
+        await asyncio.wait([waiter], timeout=TERMINATION_GRACE_PERIOD_IN_SECONDS)
+        if process.returncode is not None:
+            return process.returncode
+    logging.error("Process %s did not terminate, abandoned", process.pid)
+    return -signal.SIGKILL
+
+
+async def run_job(job: BackupJob, context: RunContext) -> int:
+    """Run the command of a job until it terminates or has to be stopped.
+
+    The command runs in its own process group. Its output is parsed into the metrics of the job, for the run reports and
+    the telemetry. The job is active while it writes output or reads and writes data, or while the governor pauses it.
+
+    Args:
+        job [BackupJob]: The job to run.
+        context [RunContext]: What the jobs of the run share.
+    Returns:
+        int: The return code of the command, 127 (as a shell) if it cannot be started.
+    """
+    logging.info("Starting: %s", " ".join(job.command))
+    metrics = JobMetrics(source=str(job.source), harddrive=str(job.harddrive))
+    job.metrics = metrics
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *job.command, stdout=asyncio.subprocess.PIPE, start_new_session=True
+        )
+    except OSError as error:
+        logging.error("Cannot start: %s %s", " ".join(job.command), error)
+        return RETURN_CODE_NOT_STARTED
+    activity = JobActivity(pid=process.pid)
+    governor = context.governor if job.adaptive_throttle else None
+    if governor is not None:
+        add_process_group_to(governor, process.pid)
+
+    def on_output() -> None:
+        activity.last_activity = time.monotonic()
+
+    assert process.stdout is not None
+    collector = asyncio.create_task(collect_metrics_from(process.stdout, metrics, context.telemetry, on_output))
+    waiter = asyncio.create_task(process.wait())
+    return_code = None
+    while return_code is None:
+        await asyncio.wait([waiter], timeout=ACTIVITY_CHECK_INTERVAL_IN_SECONDS)
+        return_code = process.returncode
+        if governor is not None and governor.paused:
+            on_output()
+        if return_code is None:
+            metrics.stop_reason = get_stop_reason(activity, context.limits, context.shutdown)
+        if return_code is None and metrics.stop_reason is not None:
+            logging.error("Stopping (%s): %s", metrics.stop_reason, " ".join(job.command))
+            return_code = await stop_process(process, waiter)
+    if process.returncode is not None and not waiter.done():
+        logging.warning("Stopping the processes left running by: %s", " ".join(job.command))
+        signal_process_group(process, signal.SIGKILL)
+        await asyncio.wait([waiter], timeout=TERMINATION_GRACE_PERIOD_IN_SECONDS)
+    await asyncio.wait([collector], timeout=TERMINATION_GRACE_PERIOD_IN_SECONDS)
+    collector.cancel()
+    waiter.cancel()
+    if governor is not None:
+        governor.process_groups.discard(process.pid)
+    return return_code
+
+
+def finish_job(job: BackupJob, return_code: int, telemetry: Optional[TelemetrySink]) -> None:
+    """Complete the metrics of a terminated job, log and write its summary and call on_success if it succeeded.
+
+    Args:
+        job [BackupJob]: The terminated job.
+        return_code [int]: The return code of its command.
+        telemetry [Optional[TelemetrySink]]: Where to write the summary, None to only log it.
+    """
+    metrics = job.metrics
+    assert metrics is not None
+    ended_at = datetime.datetime.now()
+    metrics.ended_at = ended_at.isoformat()
+    metrics.elapsed_seconds = round((ended_at - datetime.datetime.fromisoformat(metrics.started_at)).total_seconds(), 3)
+    metrics.return_code = return_code
+    emit_summary(telemetry, metrics, return_code)
+    if return_code == 0:
+        call_on_success_of(job)
+
+
+def install_shutdown_handlers(shutdown: asyncio.Event) -> List[int]:
+    """Cancel the run on SIGTERM (system shutdown) and SIGINT (Ctrl-C) instead of dying with running jobs.
+
+    Args:
+        shutdown [Event]: Set when one of the signals is received.
+    Returns:
+        List[int]: The signals handled, none when not running in the main thread.
+    """
+    loop = asyncio.get_running_loop()
+
+    def on_signal(signal_number: int) -> None:
+        logging.warning("Received %s, stopping the running jobs", signal.Signals(signal_number).name)
+        shutdown.set()
+
+    handled: List[int] = []
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(signal_number, on_signal, signal_number)
+        except (RuntimeError, ValueError):
+            continue
+        handled.append(signal_number)
+    return handled
+
+
+async def run_jobs(jobs: List[BackupJob], max_parallel_jobs: int, context: RunContext) -> List[Optional[int]]:
+    """Run jobs in parallel, with at most one job per device at a time, until all are done or the run is cancelled.
+
+    Args:
+        jobs [List[BackupJob]]: The jobs to run, in order of priority.
+        max_parallel_jobs [int]: Maximum number of jobs running at the same time. 0 means no limit.
+        context [RunContext]: What the jobs of the run share.
+    Returns:
+        List[Optional[int]]: The return code of each job, in the same order as the jobs. None for skipped jobs.
+    """
+    devices = [get_devices_used_by(job) for job in jobs]
+    return_codes: List[Optional[int]] = [None] * len(jobs)
+    pending = list(range(len(jobs)))
+    running: Dict[asyncio.Task, int] = {}
+    busy_devices: Dict[str, Tuple[Optional[str], int]] = {}
+    while pending or running:
+        if context.shutdown.is_set() and pending:
+            logging.error("Run cancelled, %s job(s) skipped", len(pending))
+            pending.clear()
+        for index in list(pending):
+            if is_dependency_failed(jobs[index], return_codes, set(pending) | set(running.values())):
+                logging.error("Skipped because the job it depends on failed: %s", " ".join(jobs[index].command))
+                pending.remove(index)
+                continue
+            if max_parallel_jobs and len(running) >= max_parallel_jobs:
+                break
+            if not are_devices_available_for(jobs[index], devices[index], busy_devices) or not is_dependency_met(
+                jobs[index], return_codes
+            ):
+                continue
+            running[asyncio.create_task(run_job(jobs[index], context))] = index
+            acquire_devices(jobs[index], devices[index], busy_devices)
+            pending.remove(index)
+        if not running:
+            continue
+        done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            index = running.pop(task)
+            return_codes[index] = task.result()
+            release_devices(devices[index], busy_devices)
+            finish_job(jobs[index], task.result(), context.telemetry)
+    return return_codes
+
+
+def get_governor_for(jobs: List[BackupJob], limits: JobLimits) -> Optional[Governor]:
+    """Get the governor of the jobs with adaptive throttling.
+
+    Args:
+        jobs [List[BackupJob]]: The jobs of the run.
+        limits [JobLimits]: The thresholds of the governor.
+    Returns:
+        Optional[Governor]: The governor watching the source disks of those jobs, None if there is none.
+    """
+    throttled_jobs = [job for job in jobs if job.adaptive_throttle]
+    if not throttled_jobs:
+        return None
+    disks = {get_disk_name_of(job.source) for job in throttled_jobs}
+    return Governor(
+        max_load=limits.max_load or float(os.cpu_count() or 1),
+        max_disk_latency_ms=limits.max_disk_latency_ms,
+        disks={disk for disk in disks if disk is not None},
+    )
+
+
+async def run_jobs_until_done_or_cancelled(
+    jobs: List[BackupJob], max_parallel_jobs: int, context: RunContext
+) -> List[Optional[int]]:
+    """Run jobs with the shutdown handlers installed and the governor running.
+
+    Args:
+        jobs [List[BackupJob]]: The jobs to run, in order of priority.
+        max_parallel_jobs [int]: Maximum number of jobs running at the same time. 0 means no limit.
+        context [RunContext]: What the jobs of the run share.
+    Returns:
+        List[Optional[int]]: The return code of each job, in the same order as the jobs. None for skipped jobs.
+    """
+    handled_signals = install_shutdown_handlers(context.shutdown)
+    governor_task = None if context.governor is None else asyncio.create_task(run_governor(context.governor))
+    try:
+        return await run_jobs(jobs, max_parallel_jobs, context)
+    finally:
+        if governor_task is not None:
+            governor_task.cancel()
+        for signal_number in handled_signals:
+            asyncio.get_running_loop().remove_signal_handler(signal_number)
+
+
+def run_jobs_with_device_limits(
+    jobs: List[BackupJob],
+    max_parallel_jobs: int = 0,
+    telemetry: Optional[TelemetrySink] = None,
+    limits: Optional[JobLimits] = None,
+) -> List[Optional[int]]:
+    """Run jobs in parallel, with at most one job per device at a time.
+
+    Jobs that touch different devices (source filesystem or harddrive) run in parallel, jobs that share a device
+    are run one after the other so that each physical disk streams a single job at a time. Jobs of the same stream
+    group are the exception, they run in parallel.
+    A job only starts once the job it depends on succeeded. It is skipped if that job failed.
+    A job running longer than its timeout, or without any activity for the stall timeout, is stopped so that the other
+    jobs can go on. On SIGTERM or SIGINT the running jobs are stopped and the pending ones skipped.
+    Jobs with adaptive throttling are paused while the system is busy.
+
+    Args:
+        jobs [List[BackupJob]]: The jobs to run, in order of priority.
+        max_parallel_jobs [int]: Maximum number of jobs running at the same time. 0 means no limit.
+        telemetry [Optional[TelemetrySink]]: Where to write the metrics of the jobs, None to disable telemetry.
+        limits [Optional[JobLimits]]: The limits of the jobs, None for no limit.
+    Returns:
+        List[Optional[int]]: The return code of each job, in the same order as the jobs. None for skipped jobs.
+    """
+    limits = limits or JobLimits()
+    context = RunContext(telemetry=telemetry, limits=limits, governor=get_governor_for(jobs, limits))
+    return asyncio.run(run_jobs_until_done_or_cancelled(jobs, max_parallel_jobs, context))
@@ -0,0 +1,157 @@
+"""Split a source into balanced shards of top-level directories, so that several rsync streams can run in parallel.
+
+The weight of a top-level directory is its size plus a fixed cost per file, as a tree of small files is bound by the
+per-file overhead of rsync rather than by its size. Weights are cached between runs so that only new directories are
+measured. A weight is measured again when the modification time of its directory changes, as it does when an entry is
+added to or removed from it, and once it is older than SHARD_WEIGHT_MAX_AGE_IN_SECONDS, for the changes deeper down.
+"""
+
+import hashlib
+import heapq
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from platformdirs import user_cache_dir
+
+from backup_to_harddrive.filters import Exclusions, as_exclusion_filter
+from backup_to_harddrive.manifest import scan_source
+
+PER_FILE_WEIGHT_IN_BYTES = 64 * 1024
+SHARD_WEIGHT_MAX_AGE_IN_SECONDS = 7 * 24 * 60 * 60
+
+
+def get_path_to_shard_weights(source_path: Path) -> Path:
+    """Get the path of the cached weights of the top-level directories of a source.
+
+    Args:
+        source_path [Path]: The source directory.
+    Returns:
+        Path: The path to the JSON file of the weights.
+    """
+    key = hashlib.blake2b(str(source_path.absolute()).encode("utf-8"), digest_size=8)
+    return Path(user_cache_dir("backup_to_harddrive")) / "shard_weights" / f"{key.hexdigest()}.json"
+
+
+def get_top_level_directories_of(source_path: Path, excluded_path_list: Exclusions) -> List[str]:
+    """List the directories directly below a source, symbolic links and excluded folders apart.
+
+    Args:
+        source_path [Path]: The source directory.
+        excluded_path_list [Exclusions]: The exclusion rules, or the absolute paths of the excluded folders.
+    Returns:
+        List[str]: The names of the directories, sorted.
+    """
+    exclusion_filter = as_exclusion_filter(source_path, excluded_path_list)
+    try:
+        entries = list(os.scandir(source_path.absolute()))
+    except OSError as error:
+        logging.warning("Cannot scan directory: %s %s", str(source_path), error)
+        return []
+    return sorted(
+        entry.name
+        for entry in entries
+        if entry.is_dir(follow_symlinks=False) and not exclusion_filter.is_excluded(entry.path, True)
+    )
+
+
+def measure_weight_of(directory_path: Path, excluded_path_list: Exclusions) -> int:
+    """Measure the weight of a directory: its size plus PER_FILE_WEIGHT_IN_BYTES per file.
+
+    Args:
+        directory_path [Path]: The directory to measure.
+        excluded_path_list [Exclusions]: The exclusion rules, or the absolute paths of the excluded folders.
+    Returns:
+        int: The weight of the directory.
+    """
+    files = scan_source(directory_path, excluded_path_list)
+    return sum(entry.size for entry in files.values()) + PER_FILE_WEIGHT_IN_BYTES * len(files)
+
+
+def get_cached_weight_of(cached_weight: Any, mtime_ns: int) -> Optional[int]:
+    """Get the cached weight of a directory, if it is still up to date.
+
+    Args:
+        cached_weight [Any]: The cache entry of the directory: its weight, the modification time of the directory and
+            the time of the measure.
+        mtime_ns [int]: The current modification time of the directory.
+    Returns:
+        Optional[int]: The weight, None if it is missing, invalid, measured before the last change of the directory or
+            older than SHARD_WEIGHT_MAX_AGE_IN_SECONDS.
+    """
+    if (
+        not isinstance(cached_weight, dict)
+        or not isinstance(cached_weight.get("weight"), int)
+        or cached_weight.get("mtime_ns") != mtime_ns
+        or not isinstance(cached_weight.get("measured_at"), (int, float))
+        or time.time() - cached_weight["measured_at"] >= SHARD_WEIGHT_MAX_AGE_IN_SECONDS
+    ):
+        return None
+    return cached_weight["weight"]
+
+
+def get_weights_of(source_path: Path, excluded_path_list: Exclusions, dry_run: bool = False) -> Dict[str, int]:
+    """Get the weight of each top-level directory of a source, measuring only the ones not up to date in the cache.
+
+    A dry run neither measures the directories nor writes the cache: it uses the cached weights, up to date or not, and
+    the directories missing from it are given the weight of a single file.
+
+    Args:
+        source_path [Path]: The source directory.
+        excluded_path_list [Exclusions]: The exclusion rules, or the absolute paths of the excluded folders.
+        dry_run [bool]: If True, only the cached weights are used.
+    Returns:
+        Dict[str, int]: The weight of each top-level directory, indexed by its name.
+    """
+    exclusion_filter = as_exclusion_filter(source_path, excluded_path_list)
+    weights_path = get_path_to_shard_weights(source_path)
+    try:
+        cached_weights = json.loads(weights_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        cached_weights = {}
+    if not isinstance(cached_weights, dict):
+        cached_weights = {}
+    weights: Dict[str, int] = {}
+    updated_weights: Dict[str, Any] = {}
+    for name in get_top_level_directories_of(source_path, exclusion_filter):
+        cached_weight = cached_weights.get(name)
+        if dry_run:
+            weight = cached_weight.get("weight") if isinstance(cached_weight, dict) else None
+            weights[name] = weight if isinstance(weight, int) else PER_FILE_WEIGHT_IN_BYTES
+            continue
+        try:
+            mtime_ns = os.stat(source_path / name, follow_symlinks=False).st_mtime_ns
+        except OSError as error:
+            logging.warning("Cannot stat directory: %s %s", str(source_path / name), error)
+            continue
+        weight = get_cached_weight_of(cached_weight, mtime_ns)
+        if weight is None:
+            weight = measure_weight_of(source_path / name, exclusion_filter)
+            cached_weight = {"weight": weight, "mtime_ns": mtime_ns, "measured_at": time.time()}
+        weights[name] = weight
+        updated_weights[name] = cached_weight
+    if updated_weights != cached_weights and not dry_run:
+        weights_path.parent.mkdir(parents=True, exist_ok=True)
+        weights_path.write_text(json.dumps(updated_weights), encoding="utf-8")
+    return weights
+
+
+def split_into_shards(weights: Dict[str, int], number_of_shards: int) -> List[List[str]]:
+    """Split directories into shards of balanced weight.
+
+    The heaviest directories are placed first, each in the lightest shard so far.
+
+    Args:
+        weights [Dict[str, int]]: The weight of each directory, indexed by its name.
+        number_of_shards [int]: Maximum number of shards.
+    Returns:
+        List[List[str]]: The sorted names of the directories of each shard. Empty shards are left out.
+    """
+    shards: List[Tuple[int, int, List[str]]] = [(0, index, []) for index in range(number_of_shards)]
+    for name in sorted(weights, key=lambda name: (-weights[name], name)):
+        weight, index, names = heapq.heappop(shards)
+        heapq.heappush(shards, (weight + weights[name], index, names + [name]))
+    return [sorted(names) for _, _, names in sorted(shards, key=lambda shard: shard[1]) if names]
@@ -0,0 +1,170 @@
+"""Functions to handle versioned snapshots of a source within the backup directory of a harddrive.
+
+Each snapshot of a source lives in Backup/<hostname>/<timestamp>/<source name>. Unchanged files are hard linked to
+the previous snapshot by rsync --link-dest, so that a snapshot only costs the space of what changed.
+"""
+
+import datetime
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Callable, Hashable, Iterable, List, Optional, Set, Tuple
+
+SNAPSHOT_NAME_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+
+def get_snapshot_name(moment: datetime.datetime) -> str:
+    """Get the name of the snapshot directory taken at a given moment.
+
+    Args:
+        moment [datetime]: The moment the run started.
+    Returns:
+        str: The name of the snapshot directory.
+    """
+    return moment.strftime(SNAPSHOT_NAME_FORMAT)
+
+
+def get_latest_snapshot_link_of(backup_path: Path, source_name: str) -> Path:
+    """Get the path of the symbolic link pointing to the latest complete snapshot of a source.
+
+    Args:
+        backup_path [Path]: The backup directory within the harddrive (Backup/<hostname>).
+        source_name [str]: The name of the source directory.
+    Returns:
+        Path: The path of the link.
+    """
+    return backup_path / f"latest_{source_name}"
+
+
+def get_completion_marker_of(snapshot_path: Path, source_name: str) -> Path:
+    """Get the path of the file that marks the snapshot of a source as complete.
+
+    Args:
+        snapshot_path [Path]: The snapshot directory (Backup/<hostname>/<timestamp>).
+        source_name [str]: The name of the source directory.
+    Returns:
+        Path: The path of the marker.
+    """
+    return snapshot_path / f".complete_{source_name}"
+
+
+def list_snapshots_of(backup_path: Path, source_name: str) -> List[Tuple[datetime.datetime, Path]]:
+    """List the snapshots holding a given source, oldest first.
+
+    Args:
+        backup_path [Path]: The backup directory within the harddrive (Backup/<hostname>).
+        source_name [str]: The name of the source directory.
+    Returns:
+        List[Tuple[datetime, Path]]: The moment and the path of each snapshot directory.
+    """
+    snapshots = []
+    try:
+        entries = list(backup_path.iterdir())
+    except FileNotFoundError:
+        return []
+    for entry in entries:
+        try:
+            moment = datetime.datetime.strptime(entry.name, SNAPSHOT_NAME_FORMAT)
+        except ValueError:
+            continue
+        if (entry / source_name).is_dir():
+            snapshots.append((moment, entry))
+    return sorted(snapshots)
+
+
+def get_latest_complete_snapshot_of(backup_path: Path, source_name: str) -> Optional[Path]:
+    """Get the most recent snapshot of a source that was completed successfully.
+
+    Args:
+        backup_path [Path]: The backup directory within the harddrive (Backup/<hostname>).
+        source_name [str]: The name of the source directory.
+    Returns:
+        Optional[Path]: The snapshot directory, None if there is no complete snapshot.
+    """
+    for _, snapshot_path in reversed(list_snapshots_of(backup_path, source_name)):
+        if get_completion_marker_of(snapshot_path, source_name).exists():
+            return snapshot_path
+    return None
+
+
+def select_snapshots_to_keep(
+    moments: Iterable[datetime.datetime], keep_daily: int, keep_weekly: int, keep_monthly: int
+) -> Set[datetime.datetime]:
+    """Select the snapshots to keep according to a retention policy.
+
+    The most recent snapshot is always kept. Then the most recent snapshot of each of the last keep_daily days,
+    keep_weekly weeks and keep_monthly months holding a snapshot are kept.
+
+    Args:
+        moments [Iterable[datetime]]: The moments of the snapshots.
+        keep_daily [int]: Number of days to keep one snapshot of.
+        keep_weekly [int]: Number of weeks to keep one snapshot of.
+        keep_monthly [int]: Number of months to keep one snapshot of.
+    Returns:
+        Set[datetime]: The moments of the snapshots to keep.
+    """
+    newest_first = sorted(moments, reverse=True)
+    kept = set(newest_first[:1])
+    periods: List[Tuple[int, Callable[[datetime.datetime], Hashable]]] = [
+        (keep_daily, lambda moment: moment.date()),
+        (keep_weekly, lambda moment: tuple(moment.isocalendar())[:2]),
+        (keep_monthly, lambda moment: (moment.year, moment.month)),
+    ]
+    for number_to_keep, period_of in periods:
+        seen_periods: Set[Hashable] = set()
+        for moment in newest_first:
+            if period_of(moment) in seen_periods:
+                continue
+            if len(seen_periods) >= number_to_keep:
+                break
+            seen_periods.add(period_of(moment))
+            kept.add(moment)
+    return kept
+
+
+def prune_snapshots_of(
+    backup_path: Path, source_name: str, keep_daily: int, keep_weekly: int, keep_monthly: int
+) -> None:
+    """Delete the snapshots of a source that are not selected by the retention policy.
+
+    Incomplete snapshots older than the latest complete one are deleted as well. Snapshot directories left empty are
+    removed.
+
+    Args:
+        backup_path [Path]: The backup directory within the harddrive (Backup/<hostname>).
+        source_name [str]: The name of the source directory.
+        keep_daily [int]: Number of days to keep one snapshot of.
+        keep_weekly [int]: Number of weeks to keep one snapshot of.
+        keep_monthly [int]: Number of months to keep one snapshot of.
+    """
+    snapshots = list_snapshots_of(backup_path, source_name)
+    complete = [(moment, path) for moment, path in snapshots if get_completion_marker_of(path, source_name).exists()]
+    if not complete:
+        return
+    kept = select_snapshots_to_keep([moment for moment, _ in complete], keep_daily, keep_weekly, keep_monthly)
+    latest_complete_moment = complete[-1][0]
+    for moment, snapshot_path in snapshots:
+        if moment in kept or moment > latest_complete_moment:
+            continue
+        logging.info("Removing snapshot: %s", str(snapshot_path / source_name))
+        shutil.rmtree(snapshot_path / source_name)
+        get_completion_marker_of(snapshot_path, source_name).unlink(missing_ok=True)
+        if not any(snapshot_path.iterdir()):
+            snapshot_path.rmdir()
+
+
+def mark_snapshot_as_complete(backup_path: Path, snapshot_name: str, source_name: str) -> None:
+    """Mark the snapshot of a source as complete and point the latest link of the source to it.
+
+    Args:
+        backup_path [Path]: The backup directory within the harddrive (Backup/<hostname>).
+        snapshot_name [str]: The name of the snapshot directory.
+        source_name [str]: The name of the source directory.
+    """
+    get_completion_marker_of(backup_path / snapshot_name, source_name).touch()
+    latest_link = get_latest_snapshot_link_of(backup_path, source_name)
+    temporary_link = latest_link.with_name(f".{latest_link.name}.tmp")
+    temporary_link.unlink(missing_ok=True)
+    temporary_link.symlink_to(Path(snapshot_name) / source_name)
+    os.replace(temporary_link, latest_link)
@@ -0,0 +1,191 @@
+"""Collect progress and throughput metrics from the output of rsync and write them as JSON lines."""
+
+import asyncio
+import datetime
+import json
+import logging
+import re
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Callable, Optional
+
+READ_SIZE = 64 * 1024
+PROGRESS_RECORD_INTERVAL_IN_SECONDS = 5.0
+SIZE_SUFFIXES = {"": 1, "K": 10**3, "M": 10**6, "G": 10**9, "T": 10**12, "P": 10**15}
+SIZE_PATTERN = r"[\d.,]+[KMGTP]?"
+PROGRESS2_PATTERN = re.compile(
+    rf"^\s*(?P<bytes>{SIZE_PATTERN})\s+(?P<percent>\d+)%\s+(?P<rate>{SIZE_PATTERN})B/s\s+"
+    r"\d+:\d\d:\d\d(?:\s+\(xfr#(?P<files>\d+))?",
+    re.IGNORECASE,
+)
+STATS_PATTERNS = {
+    "files_transferred": re.compile(rf"^Number of regular files transferred: (?P<value>{SIZE_PATTERN})$"),
+    "bytes_transferred": re.compile(rf"^Total transferred file size: (?P<value>{SIZE_PATTERN}) bytes$"),
+    "bytes_sent": re.compile(rf"^Total bytes sent: (?P<value>{SIZE_PATTERN})$"),
+}
+
+
+@dataclass
+class JobMetrics:  # pylint: disable=(too-many-instance-attributes)
+    """Metrics of a single backup job."""
+
+    source: str
+    harddrive: str
+    started_at: str = field(default_factory=lambda: datetime.datetime.now().isoformat())
+    ended_at: Optional[str] = None
+    bytes_transferred: int = 0
+    bytes_sent: int = 0
+    files_transferred: int = 0
+    percent: int = 0
+    rate_bytes_per_second: int = 0
+    elapsed_seconds: float = 0.0
+    return_code: Optional[int] = None
+    stop_reason: Optional[str] = None
+
+
+@dataclass
+class TelemetrySink:
+    """Destination of the telemetry records: a JSON lines file, or the standard output if path is None."""
+
+    path: Optional[Path]
+    lock: threading.Lock = field(default_factory=threading.Lock, compare=False, repr=False)
+
+
+def get_telemetry_sink_for(telemetry_file: Optional[Path]) -> Optional[TelemetrySink]:
+    """Get the sink of the telemetry records.
+
+    Args:
+        telemetry_file (Optional[Path]): The JSON lines file, "-" for the standard output, None to disable telemetry.
+    Returns:
+        Optional[TelemetrySink]: The sink, None if telemetry is disabled.
+    """
+    if telemetry_file is None:
+        return None
+    if str(telemetry_file) == "-":
+        return TelemetrySink(None)
+    return TelemetrySink(telemetry_file)
+
+
+def parse_size(text: str) -> int:
+    """Parse a size or a count printed by rsync, with thousands separators or a unit suffix.
+
+    Args:
+        text (str): The size, for instance "1,234,567" or "1.23G".
+    Returns:
+        int: The size in bytes.
+    """
+    suffix = text[-1].upper() if text[-1].isalpha() else ""
+    number = text[:-1] if suffix else text
+    return int(float(number.replace(",", "")) * SIZE_SUFFIXES[suffix])
+
+
+def update_metrics_from_line(metrics: JobMetrics, line: str) -> bool:
+    """Update the metrics of a job from a line of rsync output (--info=progress2 and --stats).
+
+    Args:
+        metrics (JobMetrics): The metrics to update.
+        line (str): A line of the output of rsync.
+    Returns:
+        bool: True if the line was a progress line.
+    """
+    progress = PROGRESS2_PATTERN.match(line)
+    if progress is not None:
+        metrics.bytes_transferred = parse_size(progress["bytes"])
+        metrics.percent = int(progress["percent"])
+        metrics.rate_bytes_per_second = parse_size(progress["rate"])
+        if progress["files"] is not None:
+            metrics.files_transferred = int(progress["files"])
+        return True
+    for name, pattern in STATS_PATTERNS.items():
+        stat = pattern.match(line.strip())
+        if stat is not None:
+            setattr(metrics, name, parse_size(stat["value"]))
+    return False
+
+
+def emit_record(sink: TelemetrySink, kind: str, metrics: JobMetrics) -> None:
+    """Write a telemetry record.
+
+    Args:
+        sink (TelemetrySink): Where to write the record.
+        kind (str): Kind of record, "progress" or "summary".
+        metrics (JobMetrics): The metrics of the job.
+    """
+    line = json.dumps({"kind": kind, "time": datetime.datetime.now().isoformat(), **asdict(metrics)}) + "\n"
+    with sink.lock:
+        if sink.path is None:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+            return
+        sink.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(sink.path, "a", encoding="utf-8") as file:
+            file.write(line)
+
+
+def emit_summary(sink: Optional[TelemetrySink], metrics: JobMetrics, return_code: Optional[int]) -> None:
+    """Log the summary of a terminated job, with its average throughput, and write it as a record.
+
+    Args:
+        sink (Optional[TelemetrySink]): Where to write the record, None to only log it.
+        metrics (JobMetrics): The metrics of the job.
+        return_code (Optional[int]): The return code of the job.
+    """
+    metrics.return_code = return_code
+    if metrics.elapsed_seconds > 0:
+        metrics.rate_bytes_per_second = int(metrics.bytes_transferred / metrics.elapsed_seconds)
+    logging.info(
+        "%s -> %s: %s files, %s bytes in %ss (%s bytes/s), return code %s",
+        metrics.source,
+        metrics.harddrive,
+        metrics.files_transferred,
+        metrics.bytes_transferred,
+        metrics.elapsed_seconds,
+        metrics.rate_bytes_per_second,
+        return_code,
+    )
+    if sink is not None:
+        emit_record(sink, "summary", metrics)
+
+
+async def collect_metrics_from(
+    stream: asyncio.StreamReader,
+    metrics: JobMetrics,
+    sink: Optional[TelemetrySink],
+    on_output: Callable[[], None] = lambda: None,
+) -> None:
+    """Read the output of rsync until its end, updating the metrics and emitting progress records.
+
+    Progress records are emitted at most every PROGRESS_RECORD_INTERVAL_IN_SECONDS.
+
+    Args:
+        stream (StreamReader): The standard output of rsync.
+        metrics (JobMetrics): The metrics to update.
+        sink (Optional[TelemetrySink]): Where to write the progress records, None to only update the metrics.
+        on_output (Callable[[], None]): Called each time output is read, to track the activity of the job.
+    """
+    start = time.monotonic()
+    last_record = start
+    pending = ""
+    while True:
+        chunk = await stream.read(READ_SIZE)
+        if not chunk:
+            break
+        on_output()
+        lines = re.split(r"[\r\n]", pending + chunk.decode("utf-8", errors="replace"))
+        pending = lines.pop()
+        has_progressed = False
+        for line in lines:
+            has_progressed |= update_metrics_from_line(metrics, line)
+        metrics.elapsed_seconds = round(time.monotonic() - start, 3)
+        if (
+            sink is not None
+            and has_progressed
+            and time.monotonic() - last_record >= PROGRESS_RECORD_INTERVAL_IN_SECONDS
+        ):
+            last_record = time.monotonic()
+            emit_record(sink, "progress", metrics)
+    update_metrics_from_line(metrics, pending)
+    metrics.elapsed_seconds = round(time.monotonic() - start, 3)
@@ -0,0 +1,210 @@
+"""Keep backups from starving the interactive workloads.
+
+Jobs get a CPU and I/O scheduling class (nice, ionice), an rsync bandwidth limit and, where systemd can apply it, a
+cgroup io.max limit on the disks they read from and write to.
+With the adaptive mode, a governor pauses the jobs (SIGSTOP) while the system load or the latency of the source disks
+(from /proc/diskstats) is above its threshold, and resumes them (SIGCONT) once it dropped.
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import signal
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from backup_to_harddrive.config import BackupConfig
+
+IONICE_OPTIONS = {"normal": [], "best-effort": ["-c", "2", "-n", "7"], "idle": ["-c", "3"]}
+DISKSTATS_PATH = Path("/proc/diskstats")
+SYS_BLOCK_PATH = Path("/sys/dev/block")
+GOVERNOR_CHECK_INTERVAL_IN_SECONDS = 2.0
+RESUME_RATIO = 0.8
+
+
+@dataclass
+class Governor:
+    """State of the governor of the adaptive jobs.
+
+    max_load is compared to the 1 minute load average, max_disk_latency_ms (0 to ignore it) to the average time the
+    requests completed since the previous check spent on each watched disk. The jobs are paused while one of them is
+    exceeded and resumed once both are under RESUME_RATIO of their threshold.
+    """
+
+    max_load: float
+    max_disk_latency_ms: float
+    disks: Set[str]
+    process_groups: Set[int] = field(default_factory=set)
+    paused: bool = False
+    counters: Dict[str, Tuple[int, int]] = field(default_factory=dict)
+
+
+def get_io_max_options_for(source: Path, harddrive: Path, io_max: int) -> List[str]:
+    """Get the command prefix that runs a command in a systemd scope limiting its bandwidth with cgroup io.max.
+
+    Args:
+        source [Path]: The path read by the command, its disk is limited in reading.
+        harddrive [Path]: The path written by the command, its disk is limited in writing.
+        io_max [int]: The limit, in bytes per second.
+    Returns:
+        List[str]: The prefix, empty if systemd-run is not available.
+    """
+    if shutil.which("systemd-run") is None:
+        logging.warning("systemd-run not found, 'io_max' is not applied")
+        return []
+    return [
+        "systemd-run",
+        "--user",
+        "--scope",
+        "--quiet",
+        "-p",
+        f"IOReadBandwidthMax={str(source.absolute())} {io_max}",
+        "-p",
+        f"IOWriteBandwidthMax={str(harddrive.absolute())} {io_max}",
+    ]
+
+
+def get_prioritized_command(
+    command: List[str], backup_config: BackupConfig, source: Path, harddrive: Path
+) -> List[str]:
+    """Get a command running with the priority and the bandwidth limits of a backup configuration.
+
+    Args:
+        command [List[str]]: The command of a job of the backup configuration.
+        backup_config [BackupConfig]: The backup configuration.
+        source [Path]: The path read by the job.
+        harddrive [Path]: The path written by the job.
+    Returns:
+        List[str]: The command prefixed with systemd-run, nice and ionice as needed. rsync gets --bwlimit.
+    """
+    if backup_config.bwlimit and command[0] == "rsync":
+        command = command[:1] + [f"--bwlimit={backup_config.bwlimit}"] + command[1:]
+    if backup_config.io_priority != "normal":
+        command = ["ionice"] + IONICE_OPTIONS[backup_config.io_priority] + command
+    if backup_config.nice:
+        command = ["nice", "-n", str(backup_config.nice)] + command
+    if backup_config.io_max:
+        command = get_io_max_options_for(source, harddrive, backup_config.io_max) + command
+    return command
+
+
+def get_disk_name_of(path: Path) -> Optional[str]:
+    """Get the name of the disk holding a path, as listed in /proc/diskstats.
+
+    Args:
+        path [Path]: The path.
+    Returns:
+        Optional[str]: The name of the whole disk (sda for a file on sda1), None if it cannot be found.
+    """
+    try:
+        device = os.stat(path).st_dev
+        block_path = (SYS_BLOCK_PATH / f"{os.major(device)}:{os.minor(device)}").resolve(strict=True)
+    except OSError:
+        return None
+    if (block_path / "partition").exists():
+        block_path = block_path.parent
+    return block_path.name
+
+
+def read_disk_counters(disks: Set[str]) -> Dict[str, Tuple[int, int]]:
+    """Read the number of completed requests and the time they took, per disk.
+
+    Args:
+        disks [Set[str]]: Names of the disks to read.
+    Returns:
+        Dict[str, Tuple[int, int]]: The number of reads and writes completed and the milliseconds they took, per disk.
+    """
+    counters = {}
+    try:
+        with open(DISKSTATS_PATH, "r", encoding="utf-8") as file:
+            for line in file:
+                fields = line.split()
+                if len(fields) >= 11 and fields[2] in disks:
+                    counters[fields[2]] = (int(fields[3]) + int(fields[7]), int(fields[6]) + int(fields[10]))
+    except OSError:
+        return {}
+    return counters
+
+
+def get_disk_latency_ms(previous: Dict[str, Tuple[int, int]], current: Dict[str, Tuple[int, int]]) -> float:
+    """Get the highest average latency of the requests completed between two readings of the disk counters.
+
+    Args:
+        previous [Dict[str, Tuple[int, int]]]: The previous reading.
+        current [Dict[str, Tuple[int, int]]]: The current reading.
+    Returns:
+        float: The latency in milliseconds, 0 if no request completed.
+    """
+    latencies = [0.0]
+    for disk, (requests, milliseconds) in current.items():
+        previous_requests, previous_milliseconds = previous.get(disk, (requests, milliseconds))
+        if requests > previous_requests:
+            latencies.append((milliseconds - previous_milliseconds) / (requests - previous_requests))
+    return max(latencies)
+
+
+def signal_process_groups(process_groups: Set[int], signal_number: int) -> None:
+    """Send a signal to process groups, ignoring the ones that are gone.
+
+    Args:
+        process_groups [Set[int]]: The process group ids.
+        signal_number [int]: The signal to send.
+    """
+    for process_group in process_groups:
+        try:
+            os.killpg(process_group, signal_number)
+        except ProcessLookupError:
+            continue
+
+
+def add_process_group_to(governor: Governor, process_group: int) -> None:
+    """Put a process group under the control of the governor, pausing it if the jobs are paused.
+
+    Args:
+        governor [Governor]: The governor.
+        process_group [int]: The process group id of a starting job.
+    """
+    governor.process_groups.add(process_group)
+    if governor.paused:
+        signal_process_groups({process_group}, signal.SIGSTOP)
+
+
+def update_governor(governor: Governor) -> None:
+    """Pause or resume the jobs according to the current system load and disk latency.
+
+    Args:
+        governor [Governor]: The governor, updated in place.
+    """
+    counters = read_disk_counters(governor.disks)
+    latency = get_disk_latency_ms(governor.counters, counters)
+    governor.counters = counters
+    load = os.getloadavg()[0]
+    latency_ratio = latency / governor.max_disk_latency_ms if governor.max_disk_latency_ms else 0
+    ratio = max(load / governor.max_load, latency_ratio)
+    if not governor.paused and ratio > 1:
+        logging.info("Pausing the backup jobs: load %.2f, disk latency %.1f ms", load, latency)
+        signal_process_groups(governor.process_groups, signal.SIGSTOP)
+        governor.paused = True
+    elif governor.paused and ratio < RESUME_RATIO:
+        logging.info("Resuming the backup jobs: load %.2f, disk latency %.1f ms", load, latency)
+        signal_process_groups(governor.process_groups, signal.SIGCONT)
+        governor.paused = False
+
+
+async def run_governor(governor: Governor) -> None:
+    """Update the governor periodically until cancelled, resuming the jobs when it is.
+
+    Args:
+        governor [Governor]: The governor.
+    """
+    governor.counters = read_disk_counters(governor.disks)
+    try:
+        while True:
+            await asyncio.sleep(GOVERNOR_CHECK_INTERVAL_IN_SECONDS)
+            update_governor(governor)
+    finally:
+        if governor.paused:
+            signal_process_groups(governor.process_groups, signal.SIGCONT)
+            governor.paused = False
@@ -0,0 +1,464 @@
+"""Verify that the backups on the harddrives match their sources, byte for byte.
+
+Source and backup files are hashed with BLAKE2b by a process pool, with large sequential reads. Hashes are cached in
+an SQLite database keyed by (volume, device, inode) and valid while the size and modification time are unchanged, so
+that a new verification only hashes the files that changed. The volume is the UUID of the filesystem, or the path of
+the harddrive when it has none, as removable drives mounted in turn can get the same device number and inodes. Hashes
+of backup files expire after BACKUP_HASH_MAX_AGE_IN_SECONDS: silent corruption changes neither the size nor the
+modification time, so the backups have to be read again from time to time.
+
+A backup in the deduplicating store is verified from the manifest of its latest run: each chunk its files reference is
+read back and hashed, a file is corrupt if one of its chunks does not match its hash.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import stat
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from platformdirs import user_cache_dir
+
+from backup_to_harddrive.backup_from_config import path_to_backup_within_harddrive
+from backup_to_harddrive.config import (
+    BackupConfig,
+    extract_valid_configuration_from_config_file,
+)
+from backup_to_harddrive.dedup_store import (
+    PackedChunk,
+    StoreEntry,
+    StoreManifest,
+    get_latest_run_manifest_of,
+    get_path_to_store,
+    load_store_manifest,
+    read_chunk,
+    read_pack_index,
+)
+from backup_to_harddrive.filters import get_exclusion_filter_of
+from backup_to_harddrive.manifest import scan_source
+from backup_to_harddrive.scanner import ScannedFile, scan_files
+from backup_to_harddrive.snapshot import get_latest_complete_snapshot_of
+
+HASH_READ_SIZE = 8 * 1024 * 1024
+FILESYSTEM_UUIDS_DIRECTORY = Path("/dev/disk/by-uuid")
+BACKUP_HASH_MAX_AGE_IN_SECONDS = 30 * 24 * 3600
+FAILING_STATUSES = {"missing", "corrupt", "unreadable"}
+
+
+@dataclass
+class Mismatch:
+    """A file of a source whose backup does not match.
+
+    The status is "missing" (no backup), "corrupt" (same size and modification time but another content), "modified"
+    (changed since the backup) or "unreadable".
+    """
+
+    status: str
+    source: Path
+    harddrive: Path
+    path: str
+
+
+def get_path_to_hash_cache() -> Path:
+    """Get the path of the hash cache database.
+
+    Returns:
+        Path: The path to the SQLite database.
+    """
+    return Path(user_cache_dir("backup_to_harddrive")) / "hash_cache.sqlite"
+
+
+def get_volume_of(path: Path) -> str:
+    """Get the volume holding a directory, the key of its files in the hash cache along with their device and inode.
+
+    Args:
+        path [Path]: The directory, a source or a harddrive.
+    Returns:
+        str: The UUID of its filesystem, from the block devices listed in FILESYSTEM_UUIDS_DIRECTORY, or its absolute
+            path if none holds it.
+    """
+    try:
+        device = os.stat(path).st_dev
+        for entry in os.scandir(FILESYSTEM_UUIDS_DIRECTORY):
+            if os.stat(entry.path).st_rdev == device:
+                return entry.name
+    except OSError:
+        pass
+    return str(path.absolute())
+
+
+def open_hash_cache(cache_path: Path) -> sqlite3.Connection:
+    """Open the hash cache database, creating it if needed.
+
+    A cache whose hashes are not keyed by volume is emptied.
+
+    Args:
+        cache_path [Path]: The path to the SQLite database.
+    Returns:
+        Connection: The connection to the database.
+    """
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(cache_path)
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(hashes)")]
+    if columns and "volume" not in columns:
+        connection.execute("DROP TABLE hashes")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS hashes (volume TEXT, device INTEGER, inode INTEGER, size INTEGER, "
+        "mtime_ns INTEGER, digest TEXT, hashed_at REAL, PRIMARY KEY (volume, device, inode))"
+    )
+    return connection
+
+
+def get_cached_digest(
+    connection: sqlite3.Connection, volume: str, file_stat: os.stat_result, max_age: Optional[float]
+) -> Optional[str]:
+    """Get the cached hash of a file.
+
+    Args:
+        connection [Connection]: The hash cache database.
+        volume [str]: The volume holding the file.
+        file_stat [stat_result]: Current metadata of the file.
+        max_age [Optional[float]]: Maximum age of the hash in seconds, None for no limit.
+    Returns:
+        Optional[str]: The hash, None if it is not cached, outdated or too old.
+    """
+    row = connection.execute(
+        "SELECT digest FROM hashes "
+        "WHERE volume = ? AND device = ? AND inode = ? AND size = ? AND mtime_ns = ? AND hashed_at >= ?",
+        (
+            volume,
+            file_stat.st_dev,
+            file_stat.st_ino,
+            file_stat.st_size,
+            file_stat.st_mtime_ns,
+            0 if max_age is None else time.time() - max_age,
+        ),
+    ).fetchone()
+    return None if row is None else row[0]
+
+
+def store_digests(connection: sqlite3.Connection, volume: str, hashed: List[Tuple[os.stat_result, str]]) -> None:
+    """Store hashes in the cache.
+
+    Args:
+        connection [Connection]: The hash cache database.
+        volume [str]: The volume holding the files.
+        hashed [List[Tuple[stat_result, str]]]: The metadata and the hash of each file.
+    """
+    now = time.time()
+    with connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (volume, file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns, digest, now)
+                for file_stat, digest in hashed
+            ],
+        )
+
+
+def hash_file(file_path: str) -> Optional[str]:
+    """Hash the content of a file with large sequential reads.
+
+    Args:
+        file_path [str]: The file to hash.
+    Returns:
+        Optional[str]: The hexadecimal BLAKE2b digest of the file, None if it cannot be read.
+    """
+    digest = hashlib.blake2b()
+    buffer = bytearray(HASH_READ_SIZE)
+    view = memoryview(buffer)
+    try:
+        with open(file_path, "rb", buffering=0) as file:
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while count := file.readinto(buffer):
+                digest.update(view[:count])
+    except OSError as error:
+        logging.error("Cannot hash file: %s %s", file_path, error)
+        return None
+    return digest.hexdigest()
+
+
+def get_digests_of(
+    files: List[Tuple[str, os.stat_result]],
+    volume: str,
+    connection: sqlite3.Connection,
+    pool: Executor,
+    max_age: Optional[float],
+) -> Dict[str, Optional[str]]:
+    """Get the hash of files, from the cache or hashed by the pool.
+
+    Args:
+        files [List[Tuple[str, stat_result]]]: The path and the metadata of each file.
+        volume [str]: The volume holding the files.
+        connection [Connection]: The hash cache database.
+        pool [Executor]: The pool hashing the files.
+        max_age [Optional[float]]: Maximum age of the cached hashes in seconds, None for no limit.
+    Returns:
+        Dict[str, Optional[str]]: The hash of each file, None if it cannot be read, indexed by its path.
+    """
+    digests: Dict[str, Optional[str]] = {}
+    to_hash = []
+    for file_path, file_stat in files:
+        digests[file_path] = get_cached_digest(connection, volume, file_stat, max_age)
+        if digests[file_path] is None:
+            to_hash.append((file_path, file_stat))
+    chunk_size = max(1, len(to_hash) // ((os.cpu_count() or 1) * 4))
+    hashed = list(zip(to_hash, pool.map(hash_file, [file_path for file_path, _ in to_hash], chunksize=chunk_size)))
+    store_digests(connection, volume, [(file_stat, digest) for (_, file_stat), digest in hashed if digest is not None])
+    digests.update({file_path: digest for (file_path, _), digest in hashed})
+    return digests
+
+
+def get_backup_directory_of(backup_config: BackupConfig, harddrive: Path) -> Optional[Path]:
+    """Get the directory holding the backup of a source on a harddrive.
+
+    Args:
+        backup_config [BackupConfig]: The backup configuration.
+        harddrive [Path]: The harddrive.
+    Returns:
+        Optional[Path]: The directory, the one of the latest complete snapshot in snapshot mode. None if there is no
+            snapshot yet or if the backup is in a deduplicating store.
+    """
+    backup_path = path_to_backup_within_harddrive(harddrive)
+    source_name = backup_config.source.absolute().name
+    if backup_config.target_format == "dedup":
+        return None
+    if backup_config.snapshot:
+        snapshot_path = get_latest_complete_snapshot_of(backup_path, source_name)
+        return None if snapshot_path is None else snapshot_path / source_name
+    return backup_path / source_name
+
+
+def compare_file(
+    source_stat: os.stat_result, backup_stat: os.stat_result, digests: Tuple[Optional[str], ...]
+) -> Optional[str]:
+    """Compare a source file with its backup.
+
+    Args:
+        source_stat [stat_result]: Metadata of the source file.
+        backup_stat [stat_result]: Metadata of the backup file.
+        digests [Tuple[Optional[str], ...]]: Hashes of the source and of the backup files, None if unreadable.
+    Returns:
+        Optional[str]: The status of the mismatch, None if the files match.
+    """
+    if None in digests:
+        return "unreadable"
+    if digests[0] == digests[1]:
+        return None
+    if (source_stat.st_size, source_stat.st_mtime_ns) != (backup_stat.st_size, backup_stat.st_mtime_ns):
+        return "modified"
+    return "corrupt"
+
+
+def get_files_to_hash(
+    source_directory: Path, backup_directory: Path, relative_paths: List[str]
+) -> Tuple[List[Tuple[str, os.stat_result, os.stat_result]], Dict[str, str]]:
+    """Get the files whose content has to be compared, the other ones being settled from their metadata.
+
+    Symbolic links are compared by their target.
+
+    Args:
+        source_directory [Path]: The source directory.
+        backup_directory [Path]: The directory holding the backup of the source.
+        relative_paths [List[str]]: Paths of the files relative to the source.
+    Returns:
+        Tuple[List[Tuple[str, stat_result, stat_result]], Dict[str, str]]: The path, source and backup metadata of
+            each file to hash, and the status of each mismatch found without hashing, indexed by path.
+    """
+    to_hash = []
+    statuses = {}
+    for relative_path in relative_paths:
+        try:
+            source_stat = os.lstat(source_directory / relative_path)
+            backup_stat = os.lstat(backup_directory / relative_path)
+            if not stat.S_ISLNK(source_stat.st_mode):
+                to_hash.append((relative_path, source_stat, backup_stat))
+            elif os.readlink(source_directory / relative_path) != os.readlink(backup_directory / relative_path):
+                statuses[relative_path] = "modified"
+        except FileNotFoundError:
+            statuses[relative_path] = "missing"
+        except OSError as error:
+            logging.error("Cannot verify file: %s %s", relative_path, error)
+            statuses[relative_path] = "unreadable"
+    return to_hash, statuses
+
+
+def check_chunk(store_path: Path, chunk: Tuple[str, Optional[PackedChunk]]) -> Optional[str]:
+    """Read a chunk of the store back and check that its content matches its hash.
+
+    Args:
+        store_path [Path]: The store directory.
+        chunk [Tuple[str, Optional[PackedChunk]]]: The hash of the chunk, and its location if it is packed.
+    Returns:
+        Optional[str]: The status of the files holding the chunk, None if it matches.
+    """
+    chunk_hash, packed_chunk = chunk
+    try:
+        content = read_chunk(store_path, chunk_hash, None if packed_chunk is None else {chunk_hash: packed_chunk})
+    except FileNotFoundError:
+        return "missing"
+    except OSError as error:
+        logging.error("Cannot verify chunk: %s %s", chunk_hash, error)
+        return "unreadable"
+    return None if hashlib.blake2b(content, digest_size=32).hexdigest() == chunk_hash else "corrupt"
+
+
+def check_chunks_of(store_manifest: StoreManifest, store_path: Path, pool: Executor) -> Dict[str, Optional[str]]:
+    """Check the chunks referenced by a run manifest, each one once.
+
+    Args:
+        store_manifest [StoreManifest]: The run manifest.
+        store_path [Path]: The store directory.
+        pool [Executor]: The pool reading the chunks.
+    Returns:
+        Dict[str, Optional[str]]: The status of each chunk, None if it matches its hash, indexed by its hash.
+    """
+    packed_chunks = read_pack_index(store_path)
+    chunk_hashes = sorted({chunk_hash for entry in store_manifest.values() for chunk_hash in entry.chunks})
+    chunk_size = max(1, len(chunk_hashes) // ((os.cpu_count() or 1) * 4))
+    chunks = [(chunk_hash, packed_chunks.get(chunk_hash)) for chunk_hash in chunk_hashes]
+    return dict(zip(chunk_hashes, pool.map(partial(check_chunk, store_path), chunks, chunksize=chunk_size)))
+
+
+def compare_store_entry(
+    source_directory: Path,
+    scanned_file: ScannedFile,
+    entry: Optional[StoreEntry],
+    chunk_statuses: Dict[str, Optional[str]],
+) -> Optional[str]:
+    """Compare a source file or link with its entry in a run manifest.
+
+    Args:
+        source_directory [Path]: The source directory.
+        scanned_file [ScannedFile]: Metadata of the source file or link.
+        entry [Optional[StoreEntry]]: Its entry in the run manifest, None if it has none.
+        chunk_statuses [Dict[str, Optional[str]]]: The status of each chunk of the run, None if it matches its hash.
+    Returns:
+        Optional[str]: The status of the mismatch, None if the entry matches.
+    """
+    if entry is None or entry.kind not in ("f", "l"):
+        return "missing"
+    if entry.kind == "l":
+        try:
+            return None if os.readlink(source_directory / scanned_file.path) == entry.target else "modified"
+        except OSError as error:
+            logging.error("Cannot verify file: %s %s", scanned_file.path, error)
+            return "unreadable"
+    status = next((chunk_statuses[chunk_hash] for chunk_hash in entry.chunks if chunk_statuses[chunk_hash]), None)
+    if status is None and (entry.size, entry.mtime_ns) != (scanned_file.size, scanned_file.mtime_ns):
+        return "modified"
+    return status
+
+
+def verify_store_backup_of(backup_config: BackupConfig, harddrive: Path, pool: Executor) -> Tuple[int, List[Mismatch]]:
+    """Verify the backup of a source in the deduplicating store of a harddrive, from the manifest of its latest run.
+
+    The chunks are read once, whatever the number of files holding them. A file changed since the run is modified.
+
+    Args:
+        backup_config [BackupConfig]: The backup configuration.
+        harddrive [Path]: The harddrive.
+        pool [Executor]: The pool reading the chunks.
+    Returns:
+        Tuple[int, List[Mismatch]]: The number of files verified and the mismatches, sorted by path.
+    """
+    source_directory = backup_config.source.absolute()
+    manifest_path = get_latest_run_manifest_of(path_to_backup_within_harddrive(harddrive), source_directory.name)
+    if manifest_path is None:
+        logging.warning("No backup to verify for %s on %s", str(backup_config.source), str(harddrive))
+        return 0, []
+    try:
+        store_manifest = load_store_manifest(manifest_path)
+    except (OSError, EOFError, ValueError, TypeError) as error:
+        logging.error("Cannot verify run manifest: %s %s", str(manifest_path), error)
+        return 0, [Mismatch("unreadable", backup_config.source, harddrive, str(manifest_path))]
+    chunk_statuses = check_chunks_of(store_manifest, get_path_to_store(harddrive), pool)
+    statuses = {}
+    verified = 0
+    for scanned_file in scan_files(source_directory, get_exclusion_filter_of(backup_config)):
+        if stat.S_ISREG(scanned_file.mode) or stat.S_ISLNK(scanned_file.mode):
+            entry = store_manifest.get(scanned_file.path)
+            if entry is not None and entry.kind == "f":
+                verified += 1
+            status = compare_store_entry(source_directory, scanned_file, entry, chunk_statuses)
+            if status is not None:
+                statuses[scanned_file.path] = status
+    return verified, [Mismatch(statuses[path], backup_config.source, harddrive, path) for path in sorted(statuses)]
+
+
+def verify_backup_of(
+    backup_config: BackupConfig, harddrive: Path, connection: sqlite3.Connection, pool: Executor
+) -> Tuple[int, List[Mismatch]]:
+    """Verify the backup of a source on a harddrive.
+
+    Args:
+        backup_config [BackupConfig]: The backup configuration.
+        harddrive [Path]: The harddrive.
+        connection [Connection]: The hash cache database.
+        pool [Executor]: The pool hashing the files.
+    Returns:
+        Tuple[int, List[Mismatch]]: The number of files hashed and the mismatches, sorted by path.
+    """
+    if backup_config.target_format == "dedup":
+        return verify_store_backup_of(backup_config, harddrive, pool)
+    backup_directory = get_backup_directory_of(backup_config, harddrive)
+    if backup_directory is None:
+        logging.warning("No backup to verify for %s on %s", str(backup_config.source), str(harddrive))
+        return 0, []
+    source_directory = backup_config.source.absolute()
+    to_hash, statuses = get_files_to_hash(
+        source_directory, backup_directory, list(scan_source(source_directory, get_exclusion_filter_of(backup_config)))
+    )
+    source_digests = get_digests_of(
+        [(str(source_directory / path), source_stat) for path, source_stat, _ in to_hash],
+        get_volume_of(source_directory),
+        connection,
+        pool,
+        None,
+    )
+    backup_digests = get_digests_of(
+        [(str(backup_directory / path), backup_stat) for path, _, backup_stat in to_hash],
+        get_volume_of(harddrive),
+        connection,
+        pool,
+        BACKUP_HASH_MAX_AGE_IN_SECONDS,
+    )
+    for relative_path, source_stat, backup_stat in to_hash:
+        digests = (
+            source_digests[str(source_directory / relative_path)],
+            backup_digests[str(backup_directory / relative_path)],
+        )
+        status = compare_file(source_stat, backup_stat, digests)
+        if status is not None:
+            statuses[relative_path] = status
+    return len(to_hash), [Mismatch(statuses[path], backup_config.source, harddrive, path) for path in sorted(statuses)]
+
+
+def verify_backups_from_config_file() -> int:
+    """Verify the backup of each source of the configuration file on each harddrive and print the mismatches.
+
+    Returns:
+        int: 0 if all backups match, 1 if a file is missing, corrupt or unreadable.
+    """
+    run_config = extract_valid_configuration_from_config_file()
+    connection = open_hash_cache(get_path_to_hash_cache())
+    return_value = 0
+    try:
+        with ProcessPoolExecutor() as pool:
+            for backup_config in run_config.backup_configs:
+                for harddrive in backup_config.list_of_harddrive:
+                    verified, mismatches = verify_backup_of(backup_config, harddrive, connection, pool)
+                    print(f"{backup_config.source} on {harddrive}: {verified} files, {len(mismatches)} mismatches")
+                    for mismatch in mismatches:
+                        print(f"  {mismatch.status:<10}  {mismatch.path}")
+                    if any(mismatch.status in FAILING_STATUSES for mismatch in mismatches):
+                        return_value = 1
+    finally:
+        connection.close()
+    return return_value
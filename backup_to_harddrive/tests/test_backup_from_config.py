@@ -1,20 +1,74 @@
 """Unit test for backup from config functionality."""
 
+import asyncio
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
 import unittest
 from pathlib import Path
-from unittest.mock import MagicMock, call, patch
+from unittest.mock import ANY, AsyncMock, MagicMock, call, patch
+
+from parameterized import parameterized
 
 from backup_to_harddrive.backup_from_config import (
     create_restore_script_for,
     create_restore_scripts_from_config,
+    get_backed_up_manifest_of,
+    get_files_backed_up_by_run,
+    get_list_of_backup_jobs_for,
+    get_list_of_backup_jobs_for_this_run_configuration,
     get_list_of_rsync_command_for_this_run_configuration,
+    get_path_to_files_from_list,
+    is_rsync_required_by_config_file,
+    print_run_history,
     run_backup_from_config_file,
     write_timetsamp_on_harddrive,
 )
+from backup_to_harddrive.change_journal import get_journal_paths_of
 from backup_to_harddrive.config import BackupConfig, RunConfig
+from backup_to_harddrive.dedup_store import (
+    StoreEntry,
+    get_path_to_run_manifest,
+    write_store_manifest,
+)
+from backup_to_harddrive.filters import compile_exclusion_filter
+from backup_to_harddrive.manifest import (
+    ManifestEntry,
+    get_path_to_manifest,
+    read_manifest,
+    write_manifest,
+)
+from backup_to_harddrive.run_journal import add_journal_recording_to, start_run_journal
+from backup_to_harddrive.run_report import (
+    RunReport,
+    append_run_report,
+    get_path_to_run_reports,
+)
+from backup_to_harddrive.scheduler import BackupJob, JobLimits
+
+
+def read_filter_file_of(option: str) -> str:
+    """Read the filter file passed by a --filter=merge or --exclude-from option."""
+    return Path(option.split("=", 1)[1].split(" ", 1)[-1]).read_text(encoding="utf-8")
 
 
-class TestGetListOfRsyncCommandForThisRunConfiguration(unittest.TestCase):
+class FilterFilesTestCase(unittest.TestCase):
+    """Write the filter files of the commands in a temporary directory."""
+
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.patcher = patch("backup_to_harddrive.filters.user_cache_dir", return_value=self.temporary_directory.name)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.temporary_directory.cleanup()
+
+
+class TestGetListOfRsyncCommandForThisRunConfiguration(FilterFilesTestCase):
     def test_get_list_of_rsync_command_for_this_run_configuration_empty_config(self):
         empty_config = RunConfig(backup_configs=[])
         self.assertEqual(len(get_list_of_rsync_command_for_this_run_configuration(empty_config)), 0)
@@ -39,15 +93,620 @@ class TestGetListOfRsyncCommandForThisRunConfiguration(unittest.TestCase):
         list_of_cmd = get_list_of_rsync_command_for_this_run_configuration(dummy_config)
         self.assertEqual(len(list_of_cmd), 3, msg=[" ".join(cmd) for cmd in list_of_cmd])
 
+    def test_get_list_of_backup_jobs_keeps_source_and_harddrive(self):
+        dummy_config = RunConfig(
+            backup_configs=[
+                BackupConfig(
+                    source=Path("/home/src1"),
+                    list_of_harddrive=[Path("/media/HD1"), Path("/media/HD2")],
+                    list_of_excluded_folders=[],
+                    quick_restore_path=[],
+                ),
+            ]
+        )
+        jobs = get_list_of_backup_jobs_for_this_run_configuration(dummy_config)
+        self.assertEqual([job.source for job in jobs], [Path("/home/src1"), Path("/home/src1")])
+        self.assertEqual([job.harddrive for job in jobs], [Path("/media/HD1"), Path("/media/HD2")])
+        self.assertEqual(jobs[1].command[-1], str(Path("/media/HD2").absolute() / "Backup" / socket.gethostname()))
+
+    def test_get_list_of_backup_jobs_with_fan_out(self):
+        dummy_config = RunConfig(
+            backup_configs=[
+                BackupConfig(
+                    source=Path("/opt/src0"),
+                    list_of_harddrive=[Path("/mnt/HD0")],
+                    list_of_excluded_folders=[],
+                    quick_restore_path=[],
+                ),
+                BackupConfig(
+                    source=Path("/home/src1"),
+                    list_of_harddrive=[Path("/media/HD1"), Path("/media/HD2"), Path("/media/HD3")],
+                    list_of_excluded_folders=[Path("/home/src1/.cache")],
+                    quick_restore_path=[],
+                    fan_out=True,
+                ),
+            ]
+        )
+        jobs = get_list_of_backup_jobs_for_this_run_configuration(dummy_config)
+        backup_within_hd1 = Path("/media/HD1/Backup") / socket.gethostname()
+        self.assertEqual(len(jobs), 4)
+        self.assertEqual([job.depends_on for job in jobs], [None, None, 1, 1])
+        self.assertEqual(jobs[1].source, Path("/home/src1"))
+        self.assertTrue(jobs[1].command[-3].startswith("--filter=merge "))
+        self.assertEqual(read_filter_file_of(jobs[1].command[-3]), "- /src1/.cache\n")
+        for seed_job, harddrive in zip(jobs[2:], [Path("/media/HD2"), Path("/media/HD3")]):
+            self.assertEqual(seed_job.source, Path("/media/HD1"))
+            self.assertEqual(seed_job.harddrive, harddrive)
+            self.assertEqual(seed_job.command[-2], str(backup_within_hd1 / "src1"))
+            self.assertEqual(seed_job.command[-1], str(harddrive / "Backup" / socket.gethostname()))
+
+    @patch("shutil.which", return_value="/usr/bin/systemd-run")
+    def test_jobs_get_the_priority_of_their_backup_configuration(self, _):
+        dummy_config = RunConfig(
+            backup_configs=[
+                BackupConfig(
+                    source=Path("/home/src1"),
+                    list_of_harddrive=[Path("/media/HD1")],
+                    list_of_excluded_folders=[],
+                    quick_restore_path=[],
+                    io_priority="idle",
+                    nice=19,
+                    bwlimit=1000,
+                    io_max=2000000,
+                    adaptive_throttle=True,
+                ),
+            ]
+        )
+        job = get_list_of_backup_jobs_for_this_run_configuration(dummy_config)[0]
+        self.assertEqual(
+            job.command[:13],
+            ["systemd-run", "--user", "--scope", "--quiet", "-p", "IOReadBandwidthMax=/home/src1 2000000", "-p"]
+            + ["IOWriteBandwidthMax=/media/HD1 2000000", "nice", "-n", "19", "ionice", "-c"],
+        )
+        self.assertEqual(job.command[13:16], ["3", "rsync", "--bwlimit=1000"])
+        self.assertTrue(job.adaptive_throttle)
+
+
+class TestNativeBackend(FilterFilesTestCase):
+    def test_native_backend_replaces_full_copies(self):
+        backup_config = BackupConfig(
+            source=Path("/home/src1"),
+            list_of_harddrive=[Path("/media/HD1"), Path("/media/HD2")],
+            list_of_excluded_folders=[Path("/home/src1/.cache")],
+            quick_restore_path=[],
+            fan_out=True,
+            backend="native",
+        )
+        backup_within_hd1 = str(Path("/media/HD1/Backup") / socket.gethostname())
+        backup_within_hd2 = str(Path("/media/HD2/Backup") / socket.gethostname())
+        native_copy = [sys.executable, "-m", "backup_to_harddrive.native_copy", "--delete", "--update"]
+        jobs = get_list_of_backup_jobs_for(backup_config, 0)
+        self.assertEqual(jobs[0].command[:5], native_copy)
+        self.assertEqual(jobs[0].command[6:], ["/home/src1", backup_within_hd1])
+        self.assertEqual(read_filter_file_of(jobs[0].command[5]), "/.cache\n")
+        self.assertEqual(jobs[1].command, native_copy + [backup_within_hd1 + "/src1", backup_within_hd2])
+
+    def test_native_backend_leaves_large_files_to_the_block_level_transfer(self):
+        backup_config = BackupConfig(
+            source=Path("/home/src1"),
+            list_of_harddrive=[Path("/media/HD1")],
+            list_of_excluded_folders=[Path("/home/src1/.cache")],
+            quick_restore_path=[],
+            backend="native",
+            large_file_size=1 << 30,
+        )
+        jobs = get_list_of_backup_jobs_for(backup_config, 0)
+        self.assertEqual(jobs[0].command[5], f"--max-size={(1 << 30) - 1}")
+        self.assertEqual(jobs[1].command[2:4], ["backup_to_harddrive.block_sync", f"--min-size={1 << 30}"])
+        self.assertEqual(read_filter_file_of(jobs[1].command[4]), "/.cache\n")
+        self.assertEqual(jobs[1].depends_on, 0)
+
+    @parameterized.expand(
+        [
+            ["rsync backend", {}, True],
+            ["native backend", {"backend": "native"}, False],
+            ["native incremental", {"backend": "native", "incremental_manifest": True}, True],
+            ["native shards", {"backend": "native", "shards": 2}, True],
+        ]
+    )
+    @patch("backup_to_harddrive.backup_from_config.extract_valid_configuration_from_config_file")
+    def test_is_rsync_required_by_config_file(self, _, settings, expected, mock_extract):
+        backup_config = BackupConfig(
+            source=Path("/home/src1"),
+            list_of_harddrive=[Path("/media/HD1")],
+            list_of_excluded_folders=[],
+            quick_restore_path=[],
+            **settings,
+        )
+        mock_extract.return_value = RunConfig(backup_configs=[backup_config])
+        self.assertEqual(is_rsync_required_by_config_file(), expected)
+
+
+class TestDedupStoreBackupJobs(FilterFilesTestCase):
+    def test_dedup_store_job_uses_the_previous_run(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            harddrive = Path(temporary_directory)
+            backup_path = harddrive / "Backup" / socket.gethostname()
+            backup_config = BackupConfig(
+                source=Path("/home/foo"),
+                list_of_harddrive=[harddrive],
+                list_of_excluded_folders=[Path("/home/foo/.cache")],
+                quick_restore_path=[],
+                target_format="dedup",
+            )
+            dedup_store = [sys.executable, "-m", "backup_to_harddrive.dedup_store", "backup"]
+            expected_tail = [
+                "/home/foo",
+                str(harddrive / "Backup" / ".store"),
+                str(backup_path / "runs" / "2024-01-02_03-04-05" / "foo.json.gz"),
+            ]
+            jobs = get_list_of_backup_jobs_for(backup_config, 0, "2024-01-02_03-04-05")
+            self.assertEqual(jobs[0].command[:4] + jobs[0].command[5:], dedup_store + expected_tail)
+            self.assertTrue(jobs[0].command[4].startswith("--exclude-from="))
+            self.assertEqual(read_filter_file_of(jobs[0].command[4]), "/.cache\n")
+            previous_manifest = backup_path / "runs" / "2024-01-01_03-04-05" / "foo.json.gz"
+            previous_manifest.parent.mkdir(parents=True)
+            previous_manifest.touch()
+            jobs = get_list_of_backup_jobs_for(backup_config, 0, "2024-01-02_03-04-05")
+            self.assertEqual(jobs[0].command[-4], f"--previous={previous_manifest}")
+            backup_config.compression = "zstd"
+            jobs = get_list_of_backup_jobs_for(backup_config, 0, "2024-01-02_03-04-05")
+            self.assertEqual(jobs[0].command[-4], "--compression=zstd")
+
+    def test_packed_store_is_compacted_after_the_backup(self):
+        backup_config = BackupConfig(
+            source=Path("/home/foo"),
+            list_of_harddrive=[Path("/media/hd1"), Path("/media/hd2")],
+            list_of_excluded_folders=[],
+            quick_restore_path=[],
+            target_format="dedup",
+            pack_small_files=True,
+        )
+        jobs = get_list_of_backup_jobs_for(backup_config, 3, "2024-01-02_03-04-05")
+        self.assertEqual([job.command[3] for job in jobs], ["backup", "backup", "compact", "compact"])
+        self.assertIn("--pack", jobs[0].command)
+        self.assertEqual([job.depends_on for job in jobs], [None, None, 3, 4])
+        self.assertEqual(jobs[3].command[-1], "/media/hd2/Backup/.store")
+
+    @patch("backup_to_harddrive.backup_from_config.extract_valid_configuration_from_config_file")
+    def test_dedup_store_does_not_require_rsync(self, mock_extract):
+        backup_config = BackupConfig(
+            source=Path("/home/foo"),
+            list_of_harddrive=[Path("/media/hd1")],
+            list_of_excluded_folders=[],
+            quick_restore_path=[],
+            target_format="dedup",
+        )
+        mock_extract.return_value = RunConfig(backup_configs=[backup_config])
+        self.assertFalse(is_rsync_required_by_config_file())
+
+
+class TestGetFilesBackedUpByRun(unittest.TestCase):
+    def test_files_are_taken_from_the_manifests_of_the_run(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            harddrive = Path(temporary_directory)
+            dedup_config = BackupConfig(
+                Path("/home/foo"), [harddrive], [], quick_restore_path=[], target_format="dedup"
+            )
+            incremental_config = BackupConfig(Path("/home/bar"), [harddrive], [], [], incremental_manifest=True)
+            plain_config = BackupConfig(Path("/home/baz"), [harddrive, Path("/media/hd2")], [], [])
+            write_store_manifest(
+                get_path_to_run_manifest(harddrive / "Backup" / socket.gethostname(), "2024-01-01_00-00-00", "foo"),
+                {"docs": StoreEntry("d"), "docs/a.txt": StoreEntry("f", 1, 2), "link": StoreEntry("l", 4, 3)},
+            )
+            live_manifest = {"b.txt": ManifestEntry(1, 2, 3)}
+            with self.assertLogs(level="INFO") as logs:
+                backed_up_files = get_files_backed_up_by_run(
+                    RunConfig(backup_configs=[dedup_config, incremental_config, plain_config]),
+                    [harddrive],
+                    {Path("/home/bar"): live_manifest},
+                )
+        self.assertEqual(list(backed_up_files), [(Path("/home/foo"), harddrive), (Path("/home/bar"), harddrive)])
+        self.assertEqual(sorted(backed_up_files[(Path("/home/foo"), harddrive)]), ["docs/a.txt", "link"])
+        self.assertEqual(backed_up_files[(Path("/home/bar"), harddrive)], live_manifest)
+        self.assertIn("/home/baz has no manifest", logs.output[-1])
+
+
+class TestShardedBackupJobs(FilterFilesTestCase):
+    @patch("backup_to_harddrive.backup_from_config.get_weights_of")
+    def test_source_is_split_into_parallel_shards(self, mock_get_weights_of):
+        mock_get_weights_of.return_value = {"Music": 100, "Pictures": 60, "Documents": 50}
+        backup_config = BackupConfig(
+            source=Path("/home/foo"),
+            list_of_harddrive=[Path("/media/hd1"), Path("/media/hd2")],
+            list_of_excluded_folders=[Path("/home/foo/.cache")],
+            quick_restore_path=[],
+            shards=2,
+        )
+        jobs = get_list_of_backup_jobs_for(backup_config, 0)
+        mock_get_weights_of.assert_called_once_with(
+            Path("/home/foo"), compile_exclusion_filter(Path("/home/foo"), [Path("/home/foo/.cache")]), False
+        )
+        self.assertEqual(len(jobs), 6)
+        self.assertEqual({job.stream_group for job in jobs[:3]}, {"/home/foo:/media/hd1"})
+        self.assertEqual({job.stream_group for job in jobs[3:]}, {"/home/foo:/media/hd2"})
+        backup_within_hd1 = str(Path("/media/hd1/Backup") / socket.gethostname())
+        top_level, first_shard, second_shard = (job.command for job in jobs[:3])
+        self.assertEqual(top_level[:2], ["rsync", "-dlptgoDv"])
+        self.assertNotIn("-av", top_level)
+        self.assertIn("--delete", top_level)
+        self.assertEqual(top_level[-2:], ["/home/foo/", backup_within_hd1 + "/foo"])
+        self.assertEqual(read_filter_file_of(top_level[-3]), "- /.cache\n")
+        self.assertEqual(read_filter_file_of(first_shard[-5]), "- /foo/.cache\n")
+        self.assertEqual(
+            first_shard[-4:],
+            [
+                "--include=/foo/Music/***",
+                "--exclude=/foo/*",
+                "/home/foo",
+                backup_within_hd1,
+            ],
+        )
+        self.assertEqual(
+            second_shard[-5:],
+            [
+                "--include=/foo/Documents/***",
+                "--include=/foo/Pictures/***",
+                "--exclude=/foo/*",
+                "/home/foo",
+                backup_within_hd1,
+            ],
+        )
+        self.assertIn("--delete", second_shard)
+
+    @patch("backup_to_harddrive.backup_from_config.get_weights_of")
+    def test_shard_rules_escape_the_wildcards_of_the_names(self, mock_get_weights_of):
+        mock_get_weights_of.return_value = {"[2020] Photos": 100, "a\\b": 10}
+        backup_config = BackupConfig(
+            source=Path("/home/foo*"),
+            list_of_harddrive=[Path("/media/hd1")],
+            list_of_excluded_folders=[],
+            quick_restore_path=[],
+            shards=2,
+        )
+        jobs = get_list_of_backup_jobs_for(backup_config, 0)
+        self.assertEqual(
+            [job.command[-4:-2] for job in jobs[1:]],
+            [
+                ["--include=/foo\\*/\\[2020] Photos/***", "--exclude=/foo\\*/*"],
+                ["--include=/foo\\*/a\\\\b/***", "--exclude=/foo\\*/*"],
+            ],
+        )
+
+
+class TestIncrementalBackupJobs(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        root = Path(self.temporary_directory.name)
+        self.source = root / "foo"
+        (self.source / "Documents").mkdir(parents=True)
+        (self.source / "Documents" / "doc.txt").write_text("document", encoding="utf-8")
+        (self.source / "old.txt").write_text("old", encoding="utf-8")
+        self.harddrives = [root / "hd1", root / "hd2"]
+        for harddrive in self.harddrives:
+            harddrive.mkdir()
+        self.files_from_path = root / "cache" / "files_from.lst"
+        self.backup_config = BackupConfig(
+            source=self.source,
+            list_of_harddrive=self.harddrives,
+            list_of_excluded_folders=[],
+            quick_restore_path=[],
+            incremental_manifest=True,
+        )
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def manifest_path_of(self, harddrive):
+        """Get the path of the manifest of the source on a harddrive."""
+        return get_path_to_manifest(harddrive / "Backup" / socket.gethostname(), self.source)
+
+    def run_jobs(self, jobs):
+        """Simulate a successful run of the jobs."""
+        for job in jobs:
+            if job.on_success is not None:
+                job.on_success()
+
+    @patch("builtins.print")
+    def test_dry_run_writes_nothing_and_leaves_the_journal_unconsumed(self, mock_print):
+        self.run_jobs(get_list_of_backup_jobs_for(self.backup_config, 0))
+        (self.source / "new.txt").write_text("new", encoding="utf-8")
+        root = Path(self.temporary_directory.name)
+        with patch("backup_to_harddrive.change_journal.user_config_dir", return_value=str(root / "config")):
+            journal_paths = get_journal_paths_of(self.source)
+            journal_paths.journal.parent.mkdir(parents=True)
+            journal_paths.state.write_text(json.dumps({"pid": os.getpid(), "session": "1"}), encoding="utf-8")
+            journal_paths.journal.write_bytes(b"new.txt\0")
+            files_on_harddrives = sorted(path for harddrive in self.harddrives for path in harddrive.rglob("*"))
+            with (
+                patch(
+                    "backup_to_harddrive.backup_from_config.extract_valid_configuration_from_config_file",
+                    return_value=RunConfig(backup_configs=[self.backup_config]),
+                ),
+                patch(
+                    "backup_to_harddrive.backup_from_config.get_path_to_files_from_list",
+                    return_value=self.files_from_path,
+                ),
+                patch("backup_to_harddrive.scan_cache.user_cache_dir", return_value=str(root / "scans")),
+            ):
+                self.assertTrue(run_backup_from_config_file(dry_run=True))
+        self.assertEqual(
+            sorted(path for harddrive in self.harddrives for path in harddrive.rglob("*")), files_on_harddrives
+        )
+        self.assertTrue(journal_paths.journal.exists())
+        self.assertFalse(journal_paths.consuming.exists())
+        self.assertFalse(journal_paths.live_manifest.exists())
+        self.assertFalse(self.files_from_path.exists())
+        self.assertIn(f"--files-from={self.files_from_path}", mock_print.call_args.args[0])
+
+    def test_dry_run_of_a_first_backup_is_a_full_rsync(self):
+        jobs = get_list_of_backup_jobs_for(self.backup_config, 0, dry_run=True)
+        self.assertEqual(len(jobs), 2)
+        self.assertIn("--delete", jobs[0].command)
+
+    def test_live_manifest_is_kept_for_the_catalog(self):
+        live_manifests = {}
+        get_list_of_backup_jobs_for(self.backup_config, 0, live_manifests=live_manifests)
+        self.assertEqual(sorted(live_manifests[self.source]), ["Documents/doc.txt", "old.txt"])
+
+    def test_first_run_is_a_full_rsync_that_writes_the_manifest(self):
+        self.backup_config.manifest_with_digest = True
+        jobs = get_list_of_backup_jobs_for(self.backup_config, 0)
+        self.assertEqual(len(jobs), 2)
+        self.assertIn("--delete", jobs[0].command)
+        self.assertEqual(jobs[0].command[-2], str(self.source))
+        self.run_jobs(jobs)
+        for harddrive in self.harddrives:
+            manifest = read_manifest(self.manifest_path_of(harddrive))
+            self.assertEqual(sorted(manifest), ["Documents/doc.txt", "old.txt"])
+            self.assertNotEqual(manifest["old.txt"].digest, "")
+
+    @patch("logging.info")
+    def test_nothing_changed(self, mock_info):
+        self.run_jobs(get_list_of_backup_jobs_for(self.backup_config, 0))
+        self.assertEqual(get_list_of_backup_jobs_for(self.backup_config, 0), [])
+        self.assertEqual(mock_info.call_count, 2)
+
+    @patch("logging.info")
+    def test_nothing_changed_with_fan_out(self, _):
+        self.backup_config.fan_out = True
+        self.run_jobs(get_list_of_backup_jobs_for(self.backup_config, 0))
+        jobs = get_list_of_backup_jobs_for(self.backup_config, 5)
+        self.assertEqual(len(jobs), 1)
+        self.assertIsNone(jobs[0].depends_on)
+        self.assertEqual(jobs[0].source, self.harddrives[0])
+
+    def test_only_changed_and_deleted_files_are_transferred(self):
+        self.run_jobs(get_list_of_backup_jobs_for(self.backup_config, 0))
+        (self.source / "old.txt").unlink()
+        (self.source / "new.txt").write_text("new", encoding="utf-8")
+        with patch(
+            "backup_to_harddrive.backup_from_config.get_path_to_files_from_list", return_value=self.files_from_path
+        ):
+            jobs = get_list_of_backup_jobs_for(self.backup_config, 0)
+        self.assertEqual(len(jobs), 2)
+        self.assertNotIn("--delete", jobs[0].command)
+        self.assertIn(f"--files-from={self.files_from_path}", jobs[0].command)
+        self.assertIn("--delete-missing-args", jobs[0].command)
+        self.assertEqual(jobs[0].command[-2], str(self.source.parent))
+        self.assertEqual(self.files_from_path.read_text(encoding="utf-8"), "foo/new.txt\0foo/old.txt\0")
+        self.run_jobs(jobs)
+        self.assertEqual(
+            sorted(read_manifest(self.manifest_path_of(self.harddrives[1]))), ["Documents/doc.txt", "new.txt"]
+        )
+
+    @patch("logging.info")
+    def test_large_files_are_transferred_by_blocks(self, _):
+        self.backup_config.large_file_size = 1024
+        jobs = get_list_of_backup_jobs_for(self.backup_config, 3)
+        self.assertEqual(len(jobs), 4)
+        self.assertIn("--max-size=1023", jobs[0].command)
+        self.assertEqual([job.depends_on for job in jobs], [None, None, 3, 4])
+        backup_path = self.harddrives[1] / "Backup" / socket.gethostname()
+        self.assertEqual(
+            jobs[3].command,
+            [sys.executable, "-m", "backup_to_harddrive.block_sync", "--min-size=1024"]
+            + [str(self.source), str(backup_path / "foo"), str(backup_path / ".block_maps_foo")],
+        )
+        self.run_jobs(jobs)
+        jobs = get_list_of_backup_jobs_for(self.backup_config, 0)
+        self.assertEqual(
+            [(job.command[2], job.depends_on) for job in jobs], [("backup_to_harddrive.block_sync", None)] * 2
+        )
+        (self.source / "new.txt").write_text("new", encoding="utf-8")
+        with patch(
+            "backup_to_harddrive.backup_from_config.get_path_to_files_from_list", return_value=self.files_from_path
+        ):
+            jobs = get_list_of_backup_jobs_for(self.backup_config, 0)
+        self.assertIn("--max-size=1023", jobs[0].command)
+        self.assertEqual([job.depends_on for job in jobs], [None, None, 0, 1])
+
+    def test_get_path_to_files_from_list(self):
+        path = get_path_to_files_from_list(Path("/home/foo"), Path("/media/hd1"))
+        self.assertEqual(path.parent.name, "files_from")
+        self.assertNotEqual(path, get_path_to_files_from_list(Path("/home/foo"), Path("/media/hd2")))
+
+
+class TestSnapshotBackupJobs(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        root = Path(self.temporary_directory.name)
+        self.harddrives = [root / "hd1", root / "hd2"]
+        self.backup_paths = [harddrive / "Backup" / socket.gethostname() for harddrive in self.harddrives]
+        self.backup_config = BackupConfig(
+            source=Path("/home/foo"),
+            list_of_harddrive=self.harddrives,
+            list_of_excluded_folders=[],
+            quick_restore_path=[],
+            snapshot=True,
+            keep_daily=1,
+            keep_weekly=0,
+            keep_monthly=0,
+        )
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def test_first_snapshot_has_no_link_dest(self):
+        jobs = get_list_of_backup_jobs_for(self.backup_config, 0, "2024-01-02_03-04-05")
+        self.assertEqual(len(jobs), 2)
+        self.assertFalse(any(option.startswith("--link-dest") for option in jobs[0].command))
+        self.assertEqual(jobs[0].command[-1], str(self.backup_paths[0] / "2024-01-02_03-04-05"))
+
+    def test_snapshot_is_linked_to_previous_complete_snapshot_and_pruned(self):
+        for backup_path in self.backup_paths:
+            for snapshot_name in ["2024-01-01_00-00-00", "2024-01-02_00-00-00"]:
+                (backup_path / snapshot_name / "foo").mkdir(parents=True)
+                (backup_path / snapshot_name / ".complete_foo").touch()
+        jobs = get_list_of_backup_jobs_for(self.backup_config, 0, "2024-01-02_03-04-05")
+        self.assertIn(f"--link-dest={self.backup_paths[0] / '2024-01-02_00-00-00'}", jobs[0].command)
+        (self.backup_paths[0] / "2024-01-02_03-04-05" / "foo").mkdir(parents=True)
+        jobs[0].on_success()
+        self.assertEqual(
+            sorted(path.name for path in self.backup_paths[0].iterdir()), ["2024-01-02_03-04-05", "latest_foo"]
+        )
+        self.assertEqual(
+            (self.backup_paths[0] / "latest_foo").resolve(), self.backup_paths[0] / "2024-01-02_03-04-05" / "foo"
+        )
+
+    def test_fan_out_seeds_the_snapshot(self):
+        self.backup_config.fan_out = True
+        (self.backup_paths[1] / "2024-01-01_00-00-00" / "foo").mkdir(parents=True)
+        (self.backup_paths[1] / "2024-01-01_00-00-00" / ".complete_foo").touch()
+        jobs = get_list_of_backup_jobs_for(self.backup_config, 0, "2024-01-02_03-04-05")
+        self.assertEqual(jobs[1].depends_on, 0)
+        self.assertEqual(
+            jobs[1].command[-3:],
+            [
+                f"--link-dest={self.backup_paths[1] / '2024-01-01_00-00-00'}",
+                str(self.backup_paths[0] / "2024-01-02_03-04-05" / "foo"),
+                str(self.backup_paths[1] / "2024-01-02_03-04-05"),
+            ],
+        )
+        (self.backup_paths[1] / "2024-01-02_03-04-05" / "foo").mkdir(parents=True)
+        jobs[1].on_success()
+        self.assertTrue((self.backup_paths[1] / "2024-01-02_03-04-05" / ".complete_foo").exists())
+
+
+class TestPreflight(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.addCleanup(self.temporary_directory.cleanup)
+        root = Path(self.temporary_directory.name)
+        self.harddrives = [root / "hd1", root / "hd2"]
+        self.backup_path = self.harddrives[0] / "Backup" / socket.gethostname()
+        self.backup_config = BackupConfig(
+            source=root / "foo", list_of_harddrive=self.harddrives, list_of_excluded_folders=[], quick_restore_path=[]
+        )
+        self.backup_config.source.mkdir()
+        (self.backup_config.source / "a.txt").write_bytes(b"a" * 100)
+        (self.backup_config.source / "b.txt").write_bytes(b"b" * 200)
+        (self.backup_path / "foo").mkdir(parents=True)
+        shutil.copy2(self.backup_config.source / "a.txt", self.backup_path / "foo" / "a.txt")
+        self.harddrives[1].mkdir()
+        patcher = patch("backup_to_harddrive.backup_from_config.extract_valid_configuration_from_config_file")
+        patcher.start().return_value = RunConfig(backup_configs=[self.backup_config], preflight=True)
+        self.addCleanup(patcher.stop)
+        patcher = patch("backup_to_harddrive.scan_cache.user_cache_dir", return_value=str(root / "cache"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_backed_up_manifest_of(self):
+        self.assertEqual(list(get_backed_up_manifest_of(self.backup_config, self.harddrives[0])), ["a.txt"])
+        self.assertEqual(get_backed_up_manifest_of(self.backup_config, self.harddrives[1]), {})
+        self.backup_config.snapshot = True
+        self.assertEqual(get_backed_up_manifest_of(self.backup_config, self.harddrives[0]), {})
+        (self.backup_path / "2024-01-01_00-00-00" / "foo").mkdir(parents=True)
+        (self.backup_path / "2024-01-01_00-00-00" / ".complete_foo").touch()
+        self.assertEqual(get_backed_up_manifest_of(self.backup_config, self.harddrives[0]), {})
+        manifest = {"b.txt": ManifestEntry(size=200, mtime_ns=1, inode=1)}
+        write_manifest(get_path_to_manifest(self.backup_path, self.backup_config.source), manifest)
+        self.assertEqual(get_backed_up_manifest_of(self.backup_config, self.harddrives[0]), manifest)
+        self.backup_config.target_format = "dedup"
+        self.assertEqual(get_backed_up_manifest_of(self.backup_config, self.harddrives[0]), {})
+
+    @patch("builtins.print")
+    def test_unmounted_harddrives_are_skipped(self, mock_print):
+        with self.assertLogs(level="ERROR") as logs:
+            self.assertFalse(run_backup_from_config_file(dry_run=True))
+        self.assertEqual(len(logs.records), 2)
+        mock_print.assert_not_called()
+
+    @patch("builtins.print")
+    @patch("backup_to_harddrive.preflight.measure_write_throughput")
+    @patch("backup_to_harddrive.backup_from_config.get_device_of", return_value=None)
+    def test_dry_run_starts_the_jobs_needing_the_most_bytes_first(self, _, mock_measure, mock_print):
+        with self.assertLogs(level="INFO"):
+            self.assertTrue(run_backup_from_config_file(dry_run=True, preflight=True))
+        mock_measure.assert_not_called()
+        self.assertEqual([path.name for path in self.harddrives[1].iterdir()], [])
+        printed = [printed.args[0] for printed in mock_print.call_args_list]
+        self.assertEqual(
+            printed[:2],
+            [
+                f"{self.backup_config.source} -> {self.harddrives[0]}: 1 to add, 0 to update, 0 to delete, 200 bytes",
+                f"{self.backup_config.source} -> {self.harddrives[1]}: 2 to add, 0 to update, 0 to delete, 300 bytes",
+            ],
+        )
+        self.assertEqual(
+            [line.split()[-1] for line in printed[2:]],
+            [str(harddrive / "Backup" / socket.gethostname()) for harddrive in reversed(self.harddrives)],
+        )
+
+
+async def create_finished_process_mock(*_, **__):
+    """Create a mock of an asyncio subprocess that terminated successfully without output.
+
+    Returns:
+        MagicMock: The mocked process.
+    """
+    process = MagicMock(pid=0, returncode=0, wait=AsyncMock(return_value=0))
+    process.stdout = asyncio.StreamReader()
+    process.stdout.feed_eof()
+    return process
+
+
+async def create_process_mock_printing_stats(*_, **__):
+    """Create a mock of an asyncio subprocess that terminated successfully after printing the rsync --stats lines.
+
+    Returns:
+        MagicMock: The mocked process.
+    """
+    process = await create_finished_process_mock()
+    process.stdout = asyncio.StreamReader()
+    process.stdout.feed_data(b"Number of regular files transferred: 3\nTotal transferred file size: 1,234 bytes\n")
+    process.stdout.feed_eof()
+    return process
+
 
 class TestRunBackupFromConfig(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.addCleanup(self.temporary_directory.cleanup)
+        self.journal_path = Path(self.temporary_directory.name) / "run_journal.jsonl"
+        patcher = patch(
+            "backup_to_harddrive.backup_from_config.get_path_to_run_journal", return_value=self.journal_path
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("backup_to_harddrive.backup_from_config.add_run_to_catalog_of")
+        self.mock_add_run_to_catalog_of = patcher.start()
+        self.addCleanup(patcher.stop)
 
+    @patch("backup_to_harddrive.backup_from_config.append_run_report")
+    @patch("backup_to_harddrive.scheduler.emit_summary")
     @patch("backup_to_harddrive.backup_from_config.write_timetsamp_on_harddrive")
-    @patch("subprocess.Popen")
+    @patch("backup_to_harddrive.scheduler.asyncio.create_subprocess_exec", new_callable=AsyncMock)
     @patch("backup_to_harddrive.backup_from_config.extract_valid_configuration_from_config_file")
-    @patch("backup_to_harddrive.backup_from_config.get_list_of_rsync_command_for_this_run_configuration")
-    def test_run_backup_from_config(self, mock_get_commands, mock_extract, mock_popen, mock_write_timestamp):
-        mock_get_commands.return_value = [["rsync", "foo", "bar"], ["rsync", "foo2", "bar2"]]
+    @patch("backup_to_harddrive.backup_from_config.get_list_of_backup_jobs_for_this_run_configuration")
+    # pylint: disable=too-many-positional-arguments
+    def test_run_backup_from_config(
+        self, mock_get_jobs, mock_extract, mock_create_process, mock_write_timestamp, mock_summary, mock_append
+    ):
+        mock_get_jobs.return_value = [
+            BackupJob(command=["rsync", "foo", "bar"], source=Path("foo"), harddrive=Path("/media/foo")),
+            BackupJob(command=["rsync", "foo2", "bar2"], source=Path("foo2"), harddrive=Path("/media/foo")),
+        ]
         mock_extract.return_value = RunConfig(
             backup_configs=[
                 BackupConfig(
@@ -58,40 +717,176 @@ class TestRunBackupFromConfig(unittest.TestCase):
                 ),
             ]
         )
-        mock_process_1 = MagicMock()
-        mock_process_2 = MagicMock()
-        mock_process_1.wait.return_value = 0
-        mock_process_2.wait.return_value = 0
-        mock_popen.side_effect = [mock_process_1, mock_process_2]
-        run_backup_from_config_file(dry_run=False)
-        mock_popen.assert_has_calls([call(["rsync", "foo", "bar"]), call(["rsync", "foo2", "bar2"])])
-        mock_process_1.wait.assert_called_once()
-        mock_process_2.wait.assert_called_once()
+        mock_create_process.side_effect = create_finished_process_mock
+        with patch("backup_to_harddrive.backup_from_config.remove_cached_scans_of") as mock_remove_cached_scans:
+            self.assertTrue(run_backup_from_config_file(dry_run=False))
+        mock_remove_cached_scans.assert_called_once_with({Path("/media/foo")})
+        self.assertFalse(self.journal_path.exists())
+        mock_create_process.assert_has_calls(
+            [
+                call("rsync", "foo", "bar", stdout=asyncio.subprocess.PIPE, start_new_session=True),
+                call("rsync", "foo2", "bar2", stdout=asyncio.subprocess.PIPE, start_new_session=True),
+            ],
+            any_order=True,
+        )
         mock_write_timestamp.assert_called_once()
+        self.mock_add_run_to_catalog_of.assert_called_once_with({}, ANY)
+        self.assertEqual(mock_summary.call_count, 2)
+        reports_path, report = mock_append.call_args.args
+        self.assertEqual(reports_path, Path("/media/foo/Backup") / socket.gethostname() / "run_reports.jsonl")
+        self.assertTrue(report.complete)
+        self.assertEqual([source.source for source in report.sources], ["foo", "foo2"])
+        self.assertEqual([source.return_code for source in report.sources], [0, 0])
+
+    @patch("backup_to_harddrive.backup_from_config.append_run_report")
+    @patch("backup_to_harddrive.telemetry.emit_record")
+    @patch("backup_to_harddrive.backup_from_config.write_timetsamp_on_harddrive")
+    @patch("backup_to_harddrive.scheduler.asyncio.create_subprocess_exec", new_callable=AsyncMock)
+    @patch("backup_to_harddrive.backup_from_config.extract_valid_configuration_from_config_file")
+    @patch("backup_to_harddrive.backup_from_config.get_list_of_backup_jobs_for_this_run_configuration")
+    # pylint: disable=too-many-positional-arguments
+    def test_run_without_telemetry_reports_the_transfers(
+        self, mock_get_jobs, mock_extract, mock_create_process, _, mock_emit_record, mock_append
+    ):
+        mock_get_jobs.return_value = [BackupJob(command=["rsync"], source=Path("foo"), harddrive=Path("/media/foo"))]
+        mock_extract.return_value = RunConfig(
+            backup_configs=[BackupConfig(Path(), [Path("/media/foo")], [], quick_restore_path=[])]
+        )
+        mock_create_process.side_effect = create_process_mock_printing_stats
+        with patch("backup_to_harddrive.backup_from_config.remove_cached_scans_of"):
+            self.assertTrue(run_backup_from_config_file(dry_run=False))
+        mock_emit_record.assert_not_called()
+        report = mock_append.call_args.args[1]
+        self.assertEqual((report.sources[0].bytes_transferred, report.sources[0].files_transferred), (1234, 3))
+
+    @patch("logging.error")
+    @patch("backup_to_harddrive.backup_from_config.run_jobs_with_device_limits")
+    @patch("backup_to_harddrive.backup_from_config.write_timetsamp_on_harddrive")
+    @patch("backup_to_harddrive.backup_from_config.extract_valid_configuration_from_config_file")
+    @patch("backup_to_harddrive.backup_from_config.get_list_of_backup_jobs_for_this_run_configuration")
+    # pylint: disable=too-many-positional-arguments
+    def test_timestamp_is_only_written_on_harddrives_the_run_completed_on(
+        self, mock_get_jobs, mock_extract, mock_write_timestamp, mock_run_jobs, mock_log_error
+    ):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            harddrives = [Path(temporary_directory) / "hd1", Path(temporary_directory) / "hd2"]
+            mock_get_jobs.return_value = [
+                BackupJob(command=["rsync"], source=Path("foo"), harddrive=harddrives[0]),
+                BackupJob(command=["rsync"], source=Path("foo"), harddrive=harddrives[1]),
+                BackupJob(command=["rsync"], source=Path("bar"), harddrive=harddrives[1]),
+            ]
+            mock_extract.return_value = RunConfig(
+                backup_configs=[
+                    BackupConfig(
+                        source=Path(temporary_directory),
+                        list_of_harddrive=harddrives + [Path(temporary_directory) / "unchanged"],
+                        list_of_excluded_folders=[],
+                        quick_restore_path=[],
+                    ),
+                ]
+            )
+            mock_run_jobs.return_value = [0, 0, None]
+            with patch("backup_to_harddrive.backup_from_config.get_files_backed_up_by_run") as mock_get_files:
+                self.assertFalse(run_backup_from_config_file(dry_run=False))
+            self.assertEqual(
+                mock_write_timestamp.call_args_list,
+                [call(harddrives[0]), call(Path(temporary_directory) / "unchanged")],
+            )
+            self.assertEqual(mock_get_files.call_args.args[1], [harddrives[0], Path(temporary_directory) / "unchanged"])
+            mock_log_error.assert_called_once()
+            reports_path = get_path_to_run_reports(harddrives[1] / "Backup" / socket.gethostname())
+            self.assertIn('"complete": false', reports_path.read_text(encoding="utf-8"))
+        self.assertTrue(self.journal_path.exists())
+
+    @patch("backup_to_harddrive.backup_from_config.run_jobs_with_device_limits", return_value=[0])
+    @patch("backup_to_harddrive.backup_from_config.extract_valid_configuration_from_config_file")
+    @patch("backup_to_harddrive.backup_from_config.get_list_of_backup_jobs_for_this_run_configuration")
+    def test_resume_runs_the_unfinished_jobs(self, mock_get_jobs, mock_extract, mock_run_jobs):
+        jobs = [
+            BackupJob(command=["rsync", "foo", "hd1"], source=Path("foo"), harddrive=Path("/media/hd1")),
+            BackupJob(command=["rsync", "hd1", "hd2"], source=Path("/media/hd1"), harddrive=Path("/media/hd2")),
+        ]
+        jobs[1].depends_on = 0
+        mock_get_jobs.return_value = jobs
+        mock_extract.return_value = RunConfig(backup_configs=[])
+        start_run_journal(self.journal_path, "2024-01-02_03-04-05", "2024-01-02T03:04:05")
+        add_journal_recording_to(jobs[:1], self.journal_path)
+        jobs[0].on_success()
+        self.assertTrue(run_backup_from_config_file(dry_run=False, resume=True))
+        mock_get_jobs.assert_called_once_with(mock_extract.return_value, "2024-01-02_03-04-05", {}, False)
+        self.assertEqual([job.command for job in mock_run_jobs.call_args.args[0]], [["rsync", "hd1", "hd2"]])
+        self.assertIsNone(jobs[1].depends_on)
+        self.assertFalse(self.journal_path.exists())
+
+    @patch("backup_to_harddrive.backup_from_config.run_jobs_with_device_limits")
+    @patch("backup_to_harddrive.backup_from_config.extract_valid_configuration_from_config_file")
+    def test_resume_without_interrupted_run(self, _, mock_run_jobs):
+        with self.assertLogs(level="INFO"):
+            self.assertTrue(run_backup_from_config_file(dry_run=False, resume=True))
+        mock_run_jobs.assert_not_called()
+
+    @patch("backup_to_harddrive.backup_from_config.run_jobs_with_device_limits")
+    @patch("backup_to_harddrive.backup_from_config.write_timetsamp_on_harddrive")
+    @patch("backup_to_harddrive.backup_from_config.extract_valid_configuration_from_config_file")
+    @patch("backup_to_harddrive.backup_from_config.get_list_of_backup_jobs_for_this_run_configuration")
+    def test_run_backup_from_config_max_parallel_jobs_override(self, mock_get_jobs, mock_extract, _, mock_run_jobs):
+        mock_get_jobs.return_value = []
+        mock_extract.return_value = RunConfig(backup_configs=[], max_parallel_jobs=4, stall_timeout=300)
+        mock_run_jobs.return_value = []
+        run_backup_from_config_file(dry_run=False)
+        mock_run_jobs.assert_called_with([], 4, None, JobLimits(stall_timeout=300))
+        run_backup_from_config_file(dry_run=False, max_parallel_jobs=1, telemetry_file=Path("/tmp/metrics.jsonl"))
+        self.assertEqual(mock_run_jobs.call_args.args[1], 1)
+        self.assertEqual(mock_run_jobs.call_args.args[2].path, Path("/tmp/metrics.jsonl"))
 
     @patch("backup_to_harddrive.backup_from_config.write_timetsamp_on_harddrive")
     @patch("logging.info")
-    @patch("subprocess.Popen")
+    @patch("backup_to_harddrive.scheduler.asyncio.create_subprocess_exec", new_callable=AsyncMock)
     @patch("backup_to_harddrive.backup_from_config.extract_valid_configuration_from_config_file")
-    @patch("backup_to_harddrive.backup_from_config.get_list_of_rsync_command_for_this_run_configuration")
+    @patch("backup_to_harddrive.backup_from_config.get_list_of_backup_jobs_for_this_run_configuration")
     def test_run_backup_from_config_dry_run(
-        self, mock_get_commands, _, mock_popen, mock_log_info, mock_write_timestamp
+        self, mock_get_jobs, _, mock_create_process, mock_log_info, mock_write_timestamp
     ):
-        mock_get_commands.return_value = [["rsync", "foo", "bar"], ["rsync", "foo2", "bar2"]]
-
-        mock_process_1 = MagicMock()
-        mock_process_2 = MagicMock()
-        mock_process_1.wait.return_value = 0
-        mock_process_2.wait.return_value = 0
-        mock_popen.side_effect = [mock_process_1, mock_process_2]
-        run_backup_from_config_file(dry_run=True)
-        mock_popen.assert_not_called()
-        mock_process_1.wait.assert_not_called()
-        mock_process_2.wait.assert_not_called()
+        mock_get_jobs.return_value = [
+            BackupJob(command=["rsync", "foo", "bar"], source=Path("foo"), harddrive=Path("/media/foo")),
+            BackupJob(command=["rsync", "foo2", "bar2"], source=Path("foo2"), harddrive=Path("/media/foo")),
+        ]
+        self.assertTrue(run_backup_from_config_file(dry_run=True))
+        mock_create_process.assert_not_called()
         mock_log_info.assert_called_once()
         mock_write_timestamp.assert_not_called()
 
 
+class TestPrintRunHistory(unittest.TestCase):
+    @patch("builtins.print")
+    @patch("backup_to_harddrive.backup_from_config.extract_valid_configuration_from_config_file")
+    def test_print_run_history(self, mock_extract, mock_print):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            harddrive = Path(temporary_directory)
+            backup_config = BackupConfig(
+                source=Path("foo"), list_of_harddrive=[harddrive], list_of_excluded_folders=[], quick_restore_path=[]
+            )
+            mock_extract.return_value = RunConfig(backup_configs=[backup_config, backup_config])
+            reports_path = get_path_to_run_reports(harddrive / "Backup" / socket.gethostname())
+            for day in range(1, 4):
+                append_run_report(
+                    reports_path,
+                    RunReport(
+                        hostname="host",
+                        harddrive=str(harddrive),
+                        started_at=f"2024-01-0{day}T00:00:00",
+                        ended_at=f"2024-01-0{day}T00:01:00",
+                        complete=True,
+                    ),
+                )
+            print_run_history(2)
+            printed = [printed_call.args[0] for printed_call in mock_print.call_args_list]
+            self.assertEqual(len(printed), 3)
+            self.assertEqual(printed[0], f"{temporary_directory}:")
+            self.assertTrue(printed[1].strip().startswith("2024-01-02"))
+            self.assertTrue(printed[2].strip().startswith("2024-01-03"))
+
+
 class TestWriteTimetsampOnHarddrive(unittest.TestCase):
     @patch("builtins.open", new_callable=MagicMock)
     def test_write_timetsamp_on_harddrive(self, mock_open):
@@ -123,6 +918,27 @@ class TestCreateRestoreScriptFor(unittest.TestCase):
             ]
         )
 
+    @patch("builtins.open", new_callable=MagicMock)
+    @patch("backup_to_harddrive.backup_from_config.path_to_backup_within_harddrive")
+    def test_create_restore_script_for_snapshot(self, _, mock_file):
+        create_restore_script_for(Path("/home/foo/Documents"), Path("/media/hd1"), Path("/home/foo"), snapshot=True)
+        mock_file.return_value.__enter__.return_value.write.assert_called_once_with(
+            "#!/bin/bash\nset -euxo pipefail\nrsync -av --delete latest_foo/Documents /home/foo\n"
+        )
+
+    @patch("sys.executable", "/home/foo/.local/pipx/venvs/backup to harddrive/bin/python")
+    @patch("builtins.open", new_callable=MagicMock)
+    @patch("backup_to_harddrive.backup_from_config.path_to_backup_within_harddrive")
+    def test_create_restore_script_for_dedup_store(self, _, mock_file):
+        create_restore_script_for(
+            Path("/home/foo/Documents"), Path("/media/hd1"), Path("/home/foo"), target_format="dedup"
+        )
+        mock_file.return_value.__enter__.return_value.write.assert_called_once_with(
+            "#!/bin/bash\nset -euxo pipefail\n'/home/foo/.local/pipx/venvs/backup to harddrive/bin/python' "
+            "-m backup_to_harddrive.dedup_store restore --path=Documents "
+            "$(ls -d runs/*/foo.json.gz | tail -n 1) ../.store /home/foo\n"
+        )
+
 
 class TestCreateRestoreScriptsFromConfig(unittest.TestCase):
     @patch("backup_to_harddrive.backup_from_config.create_restore_script_for")
@@ -137,7 +953,7 @@ class TestCreateRestoreScriptsFromConfig(unittest.TestCase):
         )
         mock_create_restore_script_for.assert_has_calls(
             [
-                call(Path("/home/foo/Documents"), Path("/media/hd1"), Path("/home/foo")),
-                call(Path("/home/foo/Pictures"), Path("/media/hd1"), Path("/home/foo")),
+                call(Path("/home/foo/Documents"), Path("/media/hd1"), Path("/home/foo"), False, "directory"),
+                call(Path("/home/foo/Pictures"), Path("/media/hd1"), Path("/home/foo"), False, "directory"),
             ]
         )
@@ -0,0 +1,126 @@
+"""Unit tests for the block-level transfer of the large files."""
+
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from parameterized import parameterized
+
+from backup_to_harddrive.block_sync import (
+    BLOCK_SIZE,
+    get_path_to_block_map,
+    get_path_to_block_maps,
+    main,
+    read_block_map,
+)
+
+
+def random_block(seed: int) -> bytes:
+    """Get a block of pseudo random bytes."""
+    return bytes((index * 7 + seed) % 251 for index in range(256)) * (BLOCK_SIZE // 256)
+
+
+class TestBlockSync(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.addCleanup(self.temporary_directory.cleanup)
+        root = Path(self.temporary_directory.name)
+        self.source = root / "foo"
+        self.destination = root / "hd1" / "Backup" / "host" / "foo"
+        self.block_maps = get_path_to_block_maps(root / "hd1" / "Backup" / "host", self.source)
+        (self.source / "vm").mkdir(parents=True)
+        (self.source / ".cache").mkdir()
+        self.image = self.source / "vm" / "disk.img"
+        self.image.write_bytes(random_block(1) + bytes(2 * BLOCK_SIZE) + random_block(2) + b"tail")
+        (self.source / ".cache" / "cached.img").write_bytes(random_block(3))
+        (self.source / "small.txt").write_text("small", encoding="utf-8")
+        patcher = patch("backup_to_harddrive.block_sync.SEGMENT_BLOCKS", 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sync(self):
+        """Run the block-level transfer of the source and get the number of bytes written."""
+        with patch("builtins.print") as mock_print:
+            return_code = main(
+                [
+                    f"--min-size={BLOCK_SIZE}",
+                    f"--exclude={self.source / '.cache'}",
+                    str(self.source),
+                    str(self.destination),
+                    str(self.block_maps),
+                ]
+            )
+        self.assertEqual(mock_print.call_args_list[-1].args[0].split(": ")[0], "Total bytes sent")
+        return return_code, int(mock_print.call_args_list[-1].args[0].split(": ")[1])
+
+    def assert_backup_matches_the_source(self):
+        """Check that the backup of the image has the content, the time and the block map of the source."""
+        backup = self.destination / "vm" / "disk.img"
+        self.assertEqual(backup.read_bytes(), self.image.read_bytes())
+        self.assertEqual(backup.stat().st_mtime_ns, self.image.stat().st_mtime_ns)
+        block_map = read_block_map(get_path_to_block_map(self.block_maps, "vm/disk.img"))
+        self.assertEqual((block_map.size, len(block_map.digests)), (self.image.stat().st_size, 5))
+
+    def test_new_backup_is_sparse_and_unchanged_files_are_skipped(self):
+        self.assertEqual(self.sync(), (0, 2 * BLOCK_SIZE + 4))
+        self.assert_backup_matches_the_source()
+        self.assertFalse((self.destination / "small.txt").exists())
+        self.assertFalse((self.destination / ".cache").exists())
+        self.assertEqual(self.sync(), (0, 0))
+
+    def test_only_changed_blocks_are_written(self):
+        self.sync()
+        with open(self.image, "r+b") as file:
+            file.seek(BLOCK_SIZE + 10)
+            file.write(b"changed")
+        self.assertEqual(self.sync(), (0, BLOCK_SIZE))
+        self.assert_backup_matches_the_source()
+        self.image.write_bytes(self.image.read_bytes()[: 4 * BLOCK_SIZE] + random_block(4))
+        self.assertEqual(self.sync(), (0, BLOCK_SIZE))
+        self.assert_backup_matches_the_source()
+
+    @parameterized.expand([["truncated map", b"corrupt"], ["map of another format", b"corrupt" * 8]])
+    def test_backup_without_map_is_hashed(self, _, map_content):
+        backup = self.destination / "vm" / "disk.img"
+        backup.parent.mkdir(parents=True)
+        backup.write_bytes(self.image.read_bytes()[:-4] + b"old!")
+        get_path_to_block_map(self.block_maps, "vm/disk.img").parent.mkdir(parents=True)
+        get_path_to_block_map(self.block_maps, "vm/disk.img").write_bytes(map_content)
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(self.sync(), (0, 4))
+        self.assert_backup_matches_the_source()
+
+    def test_directories_and_links_are_replaced(self):
+        (self.destination / "vm" / "disk.img").mkdir(parents=True)
+        self.sync()
+        self.assert_backup_matches_the_source()
+        (self.destination / "vm" / "disk.img").unlink()
+        (self.destination / "vm" / "disk.img").symlink_to("elsewhere")
+        self.sync()
+        self.assert_backup_matches_the_source()
+
+    def test_deleted_backup_is_written_again(self):
+        self.sync()
+        (self.destination / "vm" / "disk.img").unlink()
+        self.assertEqual(self.sync(), (0, 2 * BLOCK_SIZE + 4))
+        self.assert_backup_matches_the_source()
+
+    def test_maps_of_deleted_files_are_removed(self):
+        self.sync()
+        self.image.unlink()
+        self.sync()
+        self.assertEqual(list(self.block_maps.iterdir()), [])
+
+    def test_file_changed_during_the_transfer_is_compared_again(self):
+        with patch("backup_to_harddrive.block_sync.os.fsync", side_effect=lambda _: self.image.touch()):
+            with self.assertLogs(level="ERROR"):
+                self.assertEqual(self.sync()[0], 23)
+        self.assertIsNone(read_block_map(get_path_to_block_map(self.block_maps, "vm/disk.img")))
+        self.assertEqual(self.sync(), (0, 0))
+        self.assert_backup_matches_the_source()
+
+    @patch("backup_to_harddrive.block_sync.open_destination", side_effect=OSError("denied"))
+    def test_errors_make_a_partial_transfer(self, _):
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(self.sync()[0], 23)
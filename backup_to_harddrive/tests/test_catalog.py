@@ -0,0 +1,131 @@
+"""Unit tests for the catalog of the backed up files."""
+
+import datetime
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from backup_to_harddrive.catalog import (
+    add_run_to_catalog,
+    add_run_to_catalog_of,
+    find_in_catalog,
+    open_catalog,
+    print_files_found_in_catalog,
+)
+from backup_to_harddrive.manifest import ManifestEntry
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.addCleanup(self.temporary_directory.cleanup)
+        self.catalog_path = Path(self.temporary_directory.name) / "config" / "catalog.sqlite"
+        self.connection = open_catalog(self.catalog_path)
+        self.addCleanup(self.connection.close)
+
+    def test_versions_of_a_file_and_their_runs(self):
+        report = {
+            "docs/report.odt": ManifestEntry(size=3, mtime_ns=1, inode=1),
+            "notes.txt": ManifestEntry(size=1, mtime_ns=1, inode=1),
+        }
+        add_run_to_catalog(self.connection, Path("/media/hd1"), Path("/home/me"), report, "2024-01-01T00:00:00")
+        add_run_to_catalog(self.connection, Path("/media/hd1"), Path("/home/me"), report, "2024-01-02T00:00:00")
+        report["docs/report.odt"] = ManifestEntry(size=4, mtime_ns=2, inode=1)
+        add_run_to_catalog(self.connection, Path("/media/hd1"), Path("/home/me"), report, "2024-01-03T00:00:00")
+        catalog_entries = find_in_catalog(self.connection, "*.odt")
+        self.assertEqual([catalog_entry.size for catalog_entry in catalog_entries], [3, 4])
+        self.assertEqual(
+            [(catalog_entry.first_backed_up, catalog_entry.last_backed_up) for catalog_entry in catalog_entries],
+            [("2024-01-01T00:00:00", "2024-01-02T00:00:00"), ("2024-01-03T00:00:00", "2024-01-03T00:00:00")],
+        )
+        self.assertEqual(catalog_entries[0].last_run_on_harddrive, "2024-01-03T00:00:00")
+        self.assertEqual(catalog_entries[0].harddrive, "/media/hd1")
+
+    def test_pattern_with_a_separator_matches_the_paths(self):
+        manifest = {
+            "docs/report.odt": ManifestEntry(size=3, mtime_ns=1, inode=1),
+            "report.odt": ManifestEntry(size=1, mtime_ns=1, inode=1),
+        }
+        add_run_to_catalog(self.connection, Path("/media/hd1"), Path("/home/me"), manifest, "2024-01-01T00:00:00")
+        self.assertEqual(len(find_in_catalog(self.connection, "report.odt")), 2)
+        self.assertEqual([entry.path for entry in find_in_catalog(self.connection, "docs/*")], ["docs/report.odt"])
+        self.assertEqual(find_in_catalog(self.connection, "Report.odt"), [])
+
+    def test_suffix_is_searched_with_an_index(self):
+        manifest = {"docs/report.odt": ManifestEntry(3, 1, 1), "docs/report.txt": ManifestEntry(1, 1, 1)}
+        add_run_to_catalog(self.connection, Path("/media/hd1"), Path("/home/me"), manifest, "2024-01-01T00:00:00")
+        self.assertEqual([entry.path for entry in find_in_catalog(self.connection, "*.odt")], ["docs/report.odt"])
+        self.assertEqual(len(find_in_catalog(self.connection, "?eport.*")), 2)
+        self.assertEqual(len(find_in_catalog(self.connection, "*.[ot][dx][t]")), 2)
+        plan = self.connection.execute("EXPLAIN QUERY PLAN SELECT * FROM files WHERE reversed_name GLOB 'tdo.*'")
+        self.assertIn("files_by_reversed_name", str(plan.fetchall()))
+
+    def test_catalog_without_reversed_names_is_migrated(self):
+        connection = sqlite3.connect(self.catalog_path.with_name("old.sqlite"))
+        with connection:
+            connection.execute(
+                "CREATE TABLE files (backup_id INTEGER, path TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, "
+                "first_run TEXT, last_run TEXT, PRIMARY KEY (backup_id, path, size, mtime_ns))"
+            )
+            connection.execute("INSERT INTO files VALUES (1, 'docs/a.odt', 'a.odt', 1, 1, 'run', 'run')")
+        connection.close()
+        connection = open_catalog(self.catalog_path.with_name("old.sqlite"))
+        self.addCleanup(connection.close)
+        self.assertEqual(connection.execute("SELECT reversed_name FROM files").fetchall(), [("tdo.a",)])
+
+    def test_catalog_is_reopened(self):
+        add_run_to_catalog(
+            self.connection, Path("/media/hd1"), Path("/home/me"), {"a": ManifestEntry(1, 1, 1)}, "2024-01-01T00:00:00"
+        )
+        connection = open_catalog(self.catalog_path)
+        self.addCleanup(connection.close)
+        self.assertEqual(len(find_in_catalog(connection, "a")), 1)
+
+
+class TestCatalogOfRuns(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.addCleanup(self.temporary_directory.cleanup)
+        self.root = Path(self.temporary_directory.name)
+        (self.root / "foo").mkdir()
+        (self.root / "foo" / "a.txt").write_text("a", encoding="utf-8")
+        patcher = patch("backup_to_harddrive.catalog.user_config_dir", return_value=str(self.root / "config"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch("builtins.print")
+    def test_run_is_added_for_the_harddrives_it_completed_on(self, mock_print):
+        backed_up_files = {(self.root / "foo", Path("/media/hd2")): {"a.txt": ManifestEntry(1, 1, 1)}}
+        add_run_to_catalog_of(backed_up_files, datetime.datetime(2024, 1, 1))
+        self.assertEqual(print_files_found_in_catalog("a.txt"), 0)
+        self.assertEqual(mock_print.call_count, 2)
+        self.assertIn(str(self.root / "foo" / "a.txt"), mock_print.call_args_list[0].args[0])
+        self.assertEqual(
+            mock_print.call_args_list[1].args[0],
+            "  on /media/hd2, backed up from 2024-01-01T00:00:00 to 2024-01-01T00:00:00",
+        )
+
+    @patch("builtins.print")
+    def test_replaced_version(self, mock_print):
+        connection = open_catalog(self.root / "config" / "catalog.sqlite")
+        self.addCleanup(connection.close)
+        for day, size in ((1, 1), (2, 2)):
+            add_run_to_catalog(
+                connection, Path("/media/hd1"), Path("/home/me"), {"a": ManifestEntry(size, size, 1)}, f"2024-01-0{day}"
+            )
+        self.assertEqual(print_files_found_in_catalog("a"), 0)
+        self.assertTrue(mock_print.call_args_list[1].args[0].endswith(", replaced since"))
+        self.assertFalse(mock_print.call_args_list[3].args[0].endswith(", replaced since"))
+
+    @patch("logging.error")
+    def test_nothing_found(self, mock_log_error):
+        self.assertEqual(print_files_found_in_catalog("b.txt"), 1)
+        mock_log_error.assert_called_once()
+
+    @patch("logging.error")
+    def test_catalog_error_does_not_fail_the_run(self, mock_log_error):
+        with patch("backup_to_harddrive.catalog.open_catalog", side_effect=sqlite3.OperationalError("locked")):
+            add_run_to_catalog_of({}, datetime.datetime(2024, 1, 1))
+        mock_log_error.assert_called_once()
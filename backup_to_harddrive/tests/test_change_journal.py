@@ -0,0 +1,289 @@
+"""Unit tests for the change journal recorded by the watcher."""
+
+import errno
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from backup_to_harddrive.change_journal import (
+    EVENT_HEADER,
+    IN_ATTRIB,
+    IN_CREATE,
+    IN_IGNORED,
+    IN_ISDIR,
+    IN_MODIFY,
+    IN_Q_OVERFLOW,
+    WatchedSource,
+    Watcher,
+    add_watches_below,
+    apply_journal_to,
+    get_journal_paths_of,
+    get_live_manifest_of,
+    get_watched_sources_of,
+    handle_event,
+    inotify_add_watch,
+    inotify_init,
+    is_watcher_alive,
+    parse_events,
+    read_journal,
+    read_journal_state,
+    start_session_of,
+    watch_sources,
+    watch_sources_of_config_file,
+    write_pending_paths_of,
+)
+from backup_to_harddrive.config import BackupConfig
+from backup_to_harddrive.filters import compile_exclusion_filter
+from backup_to_harddrive.manifest import ManifestEntry, scan_source
+
+
+class JournalTestCase(unittest.TestCase):
+    """Provide a source and a journal directory in a temporary directory."""
+
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        root = Path(self.temporary_directory.name)
+        self.source = root / "foo"
+        (self.source / "Documents").mkdir(parents=True)
+        (self.source / ".cache").mkdir()
+        (self.source / "Documents" / "doc.txt").write_text("document", encoding="utf-8")
+        (self.source / "top.txt").write_text("top", encoding="utf-8")
+        self.patcher = patch("backup_to_harddrive.change_journal.user_config_dir", return_value=str(root / "config"))
+        self.patcher.start()
+        self.paths = get_journal_paths_of(self.source)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.temporary_directory.cleanup()
+
+    def get_backup_config(self, incremental_manifest: bool = True) -> BackupConfig:
+        """Get a backup configuration of the source, excluding its .cache folder."""
+        return BackupConfig(
+            source=self.source,
+            list_of_harddrive=[Path("/media/hd1")],
+            list_of_excluded_folders=[self.source / ".cache"],
+            quick_restore_path=[],
+            incremental_manifest=incremental_manifest,
+        )
+
+    def get_watched_source(self) -> WatchedSource:
+        """Get the watched source of the backup configuration."""
+        return get_watched_sources_of([self.get_backup_config()])[0]
+
+
+class TestInotify(unittest.TestCase):
+    def test_parse_events(self):
+        buffer = EVENT_HEADER.pack(1, IN_CREATE, 0, 8) + b"new\0\0\0\0\0" + EVENT_HEADER.pack(2, IN_ATTRIB, 0, 0)
+        self.assertEqual(parse_events(buffer), [(1, IN_CREATE, "new"), (2, IN_ATTRIB, "")])
+
+    @patch("backup_to_harddrive.change_journal.ctypes.get_errno", return_value=errno.EMFILE)
+    @patch("backup_to_harddrive.change_journal.get_libc")
+    def test_errors_are_raised(self, mock_get_libc, _):
+        mock_get_libc.return_value.inotify_init1.return_value = -1
+        mock_get_libc.return_value.inotify_add_watch.return_value = -1
+        with self.assertRaises(OSError):
+            inotify_init()
+        with self.assertRaises(OSError):
+            inotify_add_watch(3, "/home/foo")
+
+
+class TestWatcher(JournalTestCase):
+    def test_changes_are_recorded(self):
+        actions = [
+            lambda: (self.source / "top.txt").write_text("changed", encoding="utf-8"),
+            (self.source / "Documents" / "doc.txt").unlink,
+            lambda: (self.source / "Music" / "Album").mkdir(parents=True),
+            lambda: (self.source / "Music" / "Album" / "song.flac").write_bytes(b"song"),
+            lambda: (self.source / ".cache" / "cached").write_text("cached", encoding="utf-8"),
+            lambda: (self.source / ".cache").rename(self.source / ".cache.old"),
+            lambda: None,
+            lambda: None,
+        ]
+
+        def should_stop() -> bool:
+            if not actions:
+                return True
+            actions.pop(0)()
+            return False
+
+        self.assertEqual(watch_sources([self.get_backup_config()], should_stop, poll_interval=0.05), 0)
+        self.assertEqual(
+            read_journal(self.paths.journal),
+            [".cache.old", "Documents/doc.txt", "Music", "Music/Album/song.flac", "top.txt"],
+        )
+        self.assertEqual(read_journal(self.paths.consuming), [])
+        state = read_journal_state(self.paths.state)
+        self.assertEqual(state["pid"], os.getpid())
+        self.assertTrue(state["complete"])
+
+    def test_nothing_to_watch(self):
+        self.assertEqual(watch_sources([self.get_backup_config(incremental_manifest=False)]), 1)
+
+    @patch("backup_to_harddrive.change_journal.select.select", side_effect=KeyboardInterrupt)
+    def test_interrupted(self, _):
+        self.assertEqual(watch_sources([self.get_backup_config()]), 0)
+
+    @patch("backup_to_harddrive.change_journal.watch_sources", return_value=0)
+    @patch("backup_to_harddrive.change_journal.extract_valid_configuration_from_config_file")
+    def test_watch_sources_of_config_file(self, mock_extract, mock_watch_sources):
+        self.assertEqual(watch_sources_of_config_file(), 0)
+        mock_watch_sources.assert_called_once_with(mock_extract.return_value.backup_configs)
+
+    def test_shared_source_excludes_common_folders_only(self):
+        other_config = self.get_backup_config()
+        other_config.list_of_excluded_folders = []
+        other_config.exclude = ["*.tmp"]
+        backup_config = self.get_backup_config()
+        backup_config.exclude = ["*.tmp", "build/"]
+        watched_sources = get_watched_sources_of([backup_config, other_config])
+        self.assertEqual(len(watched_sources), 1)
+        self.assertEqual(watched_sources[0].excluded.rules, ("*.tmp",))
+        self.assertFalse(watched_sources[0].excluded.is_excluded(str(self.source / ".cache"), True))
+
+    def test_overflow_starts_a_new_session(self):
+        watched_source = self.get_watched_source()
+        watcher = Watcher(fd=-1, directories={1: (watched_source, str(self.source))})
+        start_session_of(watched_source)
+        session = read_journal_state(self.paths.state)["session"]
+        self.paths.journal.write_bytes(b"top.txt\0")
+        watched_source.pending.add("Documents/doc.txt")
+        handle_event(watcher, -1, IN_Q_OVERFLOW, "")
+        self.assertNotEqual(read_journal_state(self.paths.state)["session"], session)
+        self.assertFalse(self.paths.journal.exists())
+        self.assertEqual(watched_source.pending, set())
+
+    def test_ignored_and_unknown_events(self):
+        watched_source = self.get_watched_source()
+        watcher = Watcher(fd=-1, directories={1: (watched_source, str(self.source))})
+        handle_event(watcher, 2, IN_MODIFY, "top.txt")
+        handle_event(watcher, 1, IN_ATTRIB, "")
+        handle_event(watcher, 1, IN_ATTRIB | IN_ISDIR, "Documents")
+        handle_event(watcher, 1, IN_IGNORED, "")
+        self.assertEqual(watcher.directories, {})
+        self.assertEqual(watched_source.pending, set())
+
+    @patch("backup_to_harddrive.change_journal.inotify_add_watch")
+    def test_watch_limit_makes_the_source_incomplete(self, mock_add_watch):
+        mock_add_watch.side_effect = [1, OSError(errno.ENOSPC, "No space left on device")]
+        watched_source = self.get_watched_source()
+        watcher = Watcher(fd=-1)
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(add_watches_below(watcher, watched_source, str(self.source)))
+        self.assertFalse(watched_source.complete)
+        (self.source / "Music").mkdir()
+        mock_add_watch.side_effect = OSError(errno.ENOSPC, "No space left on device")
+        with self.assertLogs(level="ERROR"):
+            handle_event(watcher, 1, IN_CREATE | IN_ISDIR, "Music")
+        self.assertFalse(read_journal_state(self.paths.state)["complete"])
+
+    @patch("backup_to_harddrive.change_journal.inotify_add_watch")
+    def test_unreadable_directory_is_skipped(self, mock_add_watch):
+        mock_add_watch.side_effect = [OSError(errno.EACCES, "Permission denied"), 2]
+        watcher = Watcher(fd=-1)
+        with self.assertLogs(level="WARNING"):
+            self.assertTrue(add_watches_below(watcher, self.get_watched_source(), str(self.source)))
+        self.assertEqual(list(watcher.directories), [2])
+
+    @patch("backup_to_harddrive.change_journal.MAX_JOURNAL_SIZE", 4)
+    def test_journal_too_large_starts_a_new_session(self):
+        watched_source = self.get_watched_source()
+        start_session_of(watched_source)
+        write_pending_paths_of(watched_source)
+        self.assertFalse(self.paths.journal.exists())
+        watched_source.pending.add("top.txt")
+        with self.assertLogs(level="WARNING"):
+            write_pending_paths_of(watched_source)
+        self.assertFalse(self.paths.journal.exists())
+
+
+class TestApplyJournalTo(JournalTestCase):
+    def test_apply_journal_to(self):
+        manifest = scan_source(self.source, [self.source / ".cache"])
+        (self.source / "top.txt").write_text("changed", encoding="utf-8")
+        (self.source / "Documents" / "doc.txt").unlink()
+        (self.source / "Documents").rmdir()
+        (self.source / "Music" / "Album").mkdir(parents=True)
+        (self.source / "Music" / "Album" / "song.flac").write_bytes(b"song")
+        (self.source / ".cache" / "cached").write_text("cached", encoding="utf-8")
+        journal = ["Documents", "Music", "Music/Album", "top.txt", ".cache/cached", "gone.txt"]
+        self.assertEqual(
+            apply_journal_to(manifest, self.source, [self.source / ".cache"], journal),
+            scan_source(self.source, [self.source / ".cache"]),
+        )
+
+    def test_apply_journal_to_with_patterns(self):
+        exclusion_filter = compile_exclusion_filter(self.source, [], ["*.tmp", "build/"])
+        manifest = scan_source(self.source, exclusion_filter)
+        (self.source / "Documents" / "draft.tmp").write_text("draft", encoding="utf-8")
+        (self.source / "build").mkdir()
+        (self.source / "build" / "out.o").write_bytes(b"out")
+        (self.source / "Documents" / "new.txt").write_text("new", encoding="utf-8")
+        journal = ["Documents/draft.tmp", "build", "build/out.o", "Documents/new.txt", "build/gone.o"]
+        self.assertEqual(
+            apply_journal_to(manifest, self.source, exclusion_filter, journal),
+            scan_source(self.source, exclusion_filter),
+        )
+        self.assertIn("Documents/new.txt", manifest)
+
+
+class TestGetLiveManifestOf(JournalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.watched_source = self.get_watched_source()
+
+    def test_without_watcher_the_source_is_walked(self):
+        self.assertEqual(get_live_manifest_of(self.source, []), scan_source(self.source, []))
+        self.assertFalse(self.paths.live_manifest.exists())
+
+    @patch("backup_to_harddrive.change_journal.scan_source", wraps=scan_source)
+    def test_journal_of_the_consumed_session_is_used(self, mock_scan_source):
+        start_session_of(self.watched_source)
+        get_live_manifest_of(self.source, [])
+        mock_scan_source.assert_called_once_with(self.source, [])
+        (self.source / "top.txt").write_text("changed", encoding="utf-8")
+        self.paths.journal.write_bytes(b"top.txt\0")
+        live_manifest = get_live_manifest_of(self.source, [])
+        mock_scan_source.assert_called_once()
+        self.assertEqual(live_manifest, scan_source(self.source, []))
+        self.assertFalse(self.paths.journal.exists())
+        self.assertFalse(self.paths.consuming.exists())
+
+    @patch("backup_to_harddrive.change_journal.scan_source", return_value={})
+    def test_journal_is_not_used_after_an_interrupted_run(self, mock_scan_source):
+        start_session_of(self.watched_source)
+        get_live_manifest_of(self.source, [])
+        self.paths.consuming.write_bytes(b"top.txt\0")
+        get_live_manifest_of(self.source, [])
+        self.assertEqual(mock_scan_source.call_count, 2)
+
+    @patch("backup_to_harddrive.change_journal.is_watcher_alive", return_value=False)
+    @patch("backup_to_harddrive.change_journal.scan_source", return_value={"top.txt": ManifestEntry(3, 1, 2)})
+    def test_journal_is_not_used_when_the_watcher_is_down(self, mock_scan_source, _):
+        start_session_of(self.watched_source)
+        get_live_manifest_of(self.source, [])
+        self.assertEqual(get_live_manifest_of(self.source, []), {"top.txt": ManifestEntry(3, 1, 2)})
+        self.assertEqual(mock_scan_source.call_count, 2)
+
+    def test_corrupt_state_is_ignored(self):
+        self.paths.state.parent.mkdir(parents=True)
+        self.paths.state.write_text("{corrupt", encoding="utf-8")
+        self.assertIsNone(read_journal_state(self.paths.state))
+        self.paths.state.write_text(json.dumps(["session"]), encoding="utf-8")
+        self.assertIsNone(read_journal_state(self.paths.state))
+
+    def test_state_with_an_invalid_pid_is_ignored(self):
+        self.paths.state.parent.mkdir(parents=True)
+        for pid in [None, "1234", True, 12.0]:
+            self.paths.state.write_text(json.dumps({"session": "1-2", "pid": pid, "complete": True}), encoding="utf-8")
+            self.assertIsNone(read_journal_state(self.paths.state))
+
+
+class TestIsWatcherAlive(unittest.TestCase):
+    def test_is_watcher_alive(self):
+        self.assertTrue(is_watcher_alive(os.getpid()))
+        self.assertFalse(is_watcher_alive(2**70))
+        with patch("backup_to_harddrive.change_journal.os.kill", MagicMock(side_effect=PermissionError)):
+            self.assertTrue(is_watcher_alive(1))
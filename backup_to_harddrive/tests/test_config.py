@@ -1,5 +1,7 @@
 """Unit tests for config module."""
 
+import os
+import tempfile
 import unittest
 from pathlib import Path
 from unittest.mock import patch
@@ -9,7 +11,9 @@ from parameterized import parameterized
 from backup_to_harddrive.config import (
     extract_valid_configuration_from_config_file,
     extract_valid_configuration_from_configuration_dict,
+    get_path_to_config_cache,
     get_path_to_config_file_and_initialize_if_none,
+    read_config_file,
 )
 
 DUMMY_YAML_FILE = """
@@ -313,3 +317,280 @@ class TestExtractValidConfigurationFromConfigurationDict(unittest.TestCase):
     def test_extract_valid_configuration_from_configuration_dict(self, mock_error):
         extract_valid_configuration_from_configuration_dict({"backup_configurations": None})
         mock_error.assert_called_once()
+
+    def test_extract_max_parallel_jobs(self):
+        run_config = extract_valid_configuration_from_configuration_dict(
+            {"backup_configurations": None, "max_parallel_jobs": 3}
+        )
+        self.assertEqual(run_config.max_parallel_jobs, 3)
+
+    @parameterized.expand([["negative", -1], ["not an integer", "two"], ["boolean", True]])
+    @patch("logging.warning")
+    def test_extract_invalid_max_parallel_jobs(self, _, max_parallel_jobs, mock_warning):
+        run_config = extract_valid_configuration_from_configuration_dict(
+            {"backup_configurations": None, "max_parallel_jobs": max_parallel_jobs}
+        )
+        self.assertEqual(run_config.max_parallel_jobs, 0)
+        mock_warning.assert_called_once()
+
+    @patch("logging.warning")
+    def test_extract_timeouts(self, mock_warning):
+        run_config = extract_valid_configuration_from_configuration_dict(
+            {"backup_configurations": None, "job_timeout": 7200, "stall_timeout": -5, "max_disk_latency_ms": 50}
+        )
+        self.assertEqual(
+            (run_config.job_timeout, run_config.stall_timeout, run_config.max_disk_latency_ms), (7200, 0, 50)
+        )
+        mock_warning.assert_called_once()
+
+    @patch("logging.warning")
+    def test_extract_preflight(self, mock_warning):
+        run_config = extract_valid_configuration_from_configuration_dict(
+            {"backup_configurations": None, "preflight": True}
+        )
+        self.assertTrue(run_config.preflight)
+        run_config = extract_valid_configuration_from_configuration_dict(
+            {"backup_configurations": None, "preflight": "yes"}
+        )
+        self.assertFalse(run_config.preflight)
+        mock_warning.assert_called_once()
+
+    def test_extract_fan_out(self):
+        config_dict = {
+            "backup_configurations": {
+                "foo": {"source": "/home/foo", "list_of_harddrive": ["/media/foo", "/media/bar"], "fan_out": True},
+                "bar": {"source": "/home/bar", "list_of_harddrive": ["/media/foo"]},
+            }
+        }
+        with patch.object(Path, "exists", exists_mock_generator()):
+            run_config = extract_valid_configuration_from_configuration_dict(config_dict)
+        self.assertEqual([backup.fan_out for backup in run_config.backup_configs], [True, False])
+
+    @patch("logging.warning")
+    def test_extract_invalid_optional_setting(self, mock_warning):
+        config_dict = {
+            "backup_configurations": {
+                "foo": {"source": "/home/foo", "list_of_harddrive": ["/media/foo"], "fan_out": "yes"},
+            }
+        }
+        with patch.object(Path, "exists", exists_mock_generator()):
+            run_config = extract_valid_configuration_from_configuration_dict(config_dict)
+        self.assertFalse(run_config.backup_configs[0].fan_out)
+        mock_warning.assert_called_once()
+
+    @patch("logging.warning")
+    def test_extract_snapshot_disables_incremental_manifest(self, mock_warning):
+        config_dict = {
+            "backup_configurations": {
+                "foo": {
+                    "source": "/home/foo",
+                    "list_of_harddrive": ["/media/foo"],
+                    "snapshot": True,
+                    "keep_daily": 3,
+                    "incremental_manifest": True,
+                },
+            }
+        }
+        with patch.object(Path, "exists", exists_mock_generator()):
+            backup_config = extract_valid_configuration_from_configuration_dict(config_dict).backup_configs[0]
+        self.assertTrue(backup_config.snapshot)
+        self.assertFalse(backup_config.incremental_manifest)
+        self.assertEqual((backup_config.keep_daily, backup_config.keep_weekly, backup_config.keep_monthly), (3, 4, 6))
+        mock_warning.assert_called_once()
+
+    @parameterized.expand(
+        [
+            ({"shards": 4}, 4, 0),
+            ({"shards": 0}, 1, 1),
+            ({"shards": 4, "fan_out": True}, 1, 1),
+            ({"shards": 4, "snapshot": True}, 1, 1),
+        ]
+    )
+    @patch("logging.warning")
+    def test_extract_shards(self, settings, expected_shards, expected_warnings, mock_warning):
+        config_dict = {
+            "backup_configurations": {"foo": {"source": "/home/foo", "list_of_harddrive": ["/media/foo"], **settings}}
+        }
+        with patch.object(Path, "exists", exists_mock_generator()):
+            backup_config = extract_valid_configuration_from_configuration_dict(config_dict).backup_configs[0]
+        self.assertEqual(backup_config.shards, expected_shards)
+        self.assertEqual(mock_warning.call_count, expected_warnings)
+
+    @parameterized.expand(
+        [
+            ({"target_format": "dedup", "compression": "zstd", "pack_small_files": True}, "zstd", True, 0),
+            ({"target_format": "dedup", "compression": "lzma"}, "none", False, 1),
+            ({"compression": "zlib"}, "none", False, 1),
+            ({"pack_small_files": True}, "none", False, 1),
+        ]
+    )
+    @patch("logging.warning")
+    def test_extract_store_settings(  # pylint: disable=(too-many-positional-arguments)
+        self, settings, expected_compression, expected_pack_small_files, expected_warnings, mock_warning
+    ):
+        config_dict = {
+            "backup_configurations": {"foo": {"source": "/home/foo", "list_of_harddrive": ["/media/foo"], **settings}}
+        }
+        with patch.object(Path, "exists", exists_mock_generator()):
+            backup_config = extract_valid_configuration_from_configuration_dict(config_dict).backup_configs[0]
+        self.assertEqual(backup_config.compression, expected_compression)
+        self.assertEqual(backup_config.pack_small_files, expected_pack_small_files)
+        self.assertEqual(mock_warning.call_count, expected_warnings)
+
+    @parameterized.expand([["native", "native", 0], ["rsync", "rsync", 0], ["cp", "rsync", 1]])
+    @patch("logging.warning")
+    def test_extract_backend(self, backend, expected_backend, expected_warnings, mock_warning):
+        config_dict = {
+            "backup_configurations": {
+                "foo": {"source": "/home/foo", "list_of_harddrive": ["/media/foo"], "backend": backend}
+            }
+        }
+        with patch.object(Path, "exists", exists_mock_generator()):
+            backup_config = extract_valid_configuration_from_configuration_dict(config_dict).backup_configs[0]
+        self.assertEqual(backup_config.backend, expected_backend)
+        self.assertEqual(mock_warning.call_count, expected_warnings)
+
+    @parameterized.expand(
+        [
+            ({"target_format": "dedup"}, "dedup", 0),
+            ({"target_format": "tar"}, "directory", 1),
+            ({"target_format": "dedup", "snapshot": True, "shards": 2, "backend": "native"}, "dedup", 3),
+        ]
+    )
+    @patch("logging.warning")
+    def test_extract_target_format(self, settings, expected_target_format, expected_warnings, mock_warning):
+        config_dict = {
+            "backup_configurations": {"foo": {"source": "/home/foo", "list_of_harddrive": ["/media/foo"], **settings}}
+        }
+        with patch.object(Path, "exists", exists_mock_generator()):
+            backup_config = extract_valid_configuration_from_configuration_dict(config_dict).backup_configs[0]
+        self.assertEqual(backup_config.target_format, expected_target_format)
+        self.assertEqual((backup_config.snapshot, backup_config.shards, backup_config.backend), (False, 1, "rsync"))
+        self.assertEqual(mock_warning.call_count, expected_warnings)
+
+    @parameterized.expand(
+        [
+            ({}, ("normal", 0, 0, 0, False), 0),
+            (
+                {"io_priority": "idle", "nice": 10, "bwlimit": 20000, "io_max": 50000000, "adaptive_throttle": True},
+                ("idle", 10, 20000, 50000000, True),
+                0,
+            ),
+            ({"io_priority": "realtime", "nice": 20, "bwlimit": -1, "io_max": -1}, ("normal", 0, 0, 0, False), 4),
+        ]
+    )
+    @patch("logging.warning")
+    def test_extract_priority(self, settings, expected_priority, expected_warnings, mock_warning):
+        config_dict = {
+            "backup_configurations": {"foo": {"source": "/home/foo", "list_of_harddrive": ["/media/foo"], **settings}}
+        }
+        with patch.object(Path, "exists", exists_mock_generator()):
+            backup_config = extract_valid_configuration_from_configuration_dict(config_dict).backup_configs[0]
+        self.assertEqual(
+            (
+                backup_config.io_priority,
+                backup_config.nice,
+                backup_config.bwlimit,
+                backup_config.io_max,
+                backup_config.adaptive_throttle,
+            ),
+            expected_priority,
+        )
+        self.assertEqual(mock_warning.call_count, expected_warnings)
+
+    @parameterized.expand(
+        [
+            ({"exclude": ["*.tmp", "/build/", "node_modules/"]}, ["*.tmp", "/build/", "node_modules/"], 0),
+            ({"exclude": ["re:.*\\.o", "*.tmp"]}, ["*.tmp"], 1),
+            ({"exclude": ["re:.*\\.o"], "target_format": "dedup"}, ["re:.*\\.o"], 0),
+            ({"exclude": ["re:.*\\.o"], "backend": "native"}, ["re:.*\\.o"], 0),
+            ({"exclude": ["re:(", "/", 3, "a\nb"], "backend": "native"}, [], 4),
+            ({"exclude": "*.tmp"}, [], 1),
+        ]
+    )
+    @patch("logging.warning")
+    def test_extract_exclude_rules(self, settings, expected_rules, expected_warnings, mock_warning):
+        config_dict = {
+            "backup_configurations": {"foo": {"source": "/home/foo", "list_of_harddrive": ["/media/foo"], **settings}}
+        }
+        with patch.object(Path, "exists", exists_mock_generator()):
+            backup_config = extract_valid_configuration_from_configuration_dict(config_dict).backup_configs[0]
+        self.assertEqual(backup_config.exclude, expected_rules)
+        self.assertEqual(mock_warning.call_count, expected_warnings)
+
+    @parameterized.expand(
+        [
+            ({"large_file_size": 1073741824}, 1073741824, 0),
+            ({"large_file_size": 1073741824, "incremental_manifest": True}, 1073741824, 0),
+            ({"large_file_size": -1}, 0, 1),
+            ({"large_file_size": 1073741824, "snapshot": True, "fan_out": True}, 0, 1),
+            ({"large_file_size": 1073741824, "shards": 2}, 0, 1),
+            ({"large_file_size": 1073741824, "target_format": "dedup"}, 0, 1),
+        ]
+    )
+    @patch("logging.warning")
+    def test_extract_large_file_size(self, settings, expected_large_file_size, expected_warnings, mock_warning):
+        config_dict = {
+            "backup_configurations": {"foo": {"source": "/home/foo", "list_of_harddrive": ["/media/foo"], **settings}}
+        }
+        with patch.object(Path, "exists", exists_mock_generator()):
+            backup_config = extract_valid_configuration_from_configuration_dict(config_dict).backup_configs[0]
+        self.assertEqual(backup_config.large_file_size, expected_large_file_size)
+        self.assertEqual(mock_warning.call_count, expected_warnings)
+
+    @patch("logging.warning")
+    def test_extract_telemetry_file(self, mock_warning):
+        run_config = extract_valid_configuration_from_configuration_dict(
+            {"backup_configurations": None, "telemetry_file": "/var/log/backup.jsonl"}
+        )
+        self.assertEqual(run_config.telemetry_file, Path("/var/log/backup.jsonl"))
+        run_config = extract_valid_configuration_from_configuration_dict(
+            {"backup_configurations": None, "telemetry_file": 12}
+        )
+        self.assertIsNone(run_config.telemetry_file)
+        mock_warning.assert_called_once()
+
+
+class TestConfigCache(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.addCleanup(self.temporary_directory.cleanup)
+        root = Path(self.temporary_directory.name)
+        self.config_file_path = root / "config.yaml"
+        self.config_file_path.write_text(DUMMY_YAML_FILE, encoding="utf-8")
+        patcher = patch("backup_to_harddrive.config.user_cache_dir", return_value=str(root / "cache"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_config_file_is_parsed_again_once_changed(self):
+        config_dict = read_config_file(self.config_file_path)
+        self.assertTrue(get_path_to_config_cache().exists())
+        with patch("yaml.safe_load", side_effect=AssertionError("parsed")):
+            self.assertEqual(read_config_file(self.config_file_path), config_dict)
+        self.config_file_path.write_text(ONE_ENTRY_YAML_FILE, encoding="utf-8")
+        os.utime(self.config_file_path, ns=(1, 1))
+        self.assertEqual(list(read_config_file(self.config_file_path)["backup_configurations"]), ["backup_of_foo"])
+
+    def test_corrupt_cache_is_ignored(self):
+        get_path_to_config_cache().parent.mkdir(parents=True)
+        get_path_to_config_cache().write_bytes(b"corrupt")
+        self.assertEqual(len(read_config_file(self.config_file_path)["backup_configurations"]), 2)
+
+    def test_dates_are_not_cached(self):
+        self.config_file_path.write_text("backup_configurations:\nsince: 2024-01-01\n", encoding="utf-8")
+        self.assertIn("since", read_config_file(self.config_file_path))
+        self.assertFalse(get_path_to_config_cache().exists())
+
+    @patch("logging.warning")
+    def test_cache_that_cannot_be_written_is_logged(self, mock_warning):
+        with patch("backup_to_harddrive.config.os.replace", side_effect=PermissionError("read only")):
+            self.assertIsNotNone(read_config_file(self.config_file_path))
+        mock_warning.assert_called_once()
+
+    @parameterized.expand([["invalid yaml", "backup_configurations:\n  - source: @foo\n"], ["empty file", ""]])
+    @patch("logging.error")
+    def test_unusable_config_file(self, _, content, mock_error):
+        self.config_file_path.write_text(content, encoding="utf-8")
+        self.assertIsNone(read_config_file(self.config_file_path))
+        mock_error.assert_called_once()
+        self.assertFalse(get_path_to_config_cache().exists())
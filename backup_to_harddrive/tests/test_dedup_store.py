@@ -0,0 +1,338 @@
+"""Unit tests for the deduplicating store."""
+
+import gzip
+import io
+import os
+import random
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from backup_to_harddrive.dedup_store import (
+    MAX_CHUNK_SIZE,
+    MIN_CHUNK_SIZE,
+    PackedChunk,
+    backup_to_store,
+    get_compressor_for,
+    get_latest_run_manifest_of,
+    get_path_to_run_manifest,
+    iter_chunks_of,
+    main,
+    read_chunk,
+    read_pack_index,
+    read_packed_chunk,
+    read_store_manifest,
+    restore_from_store,
+)
+
+
+def random_bytes(size: int, seed: int) -> bytes:
+    """Generate reproducible random bytes."""
+    return random.Random(seed).randbytes(size)
+
+
+class TestChunking(unittest.TestCase):
+    def test_chunks_are_bounded_and_cover_the_file(self):
+        data = random_bytes(12 * 1024 * 1024, 1) + bytes(9 * 1024 * 1024)
+        with patch("backup_to_harddrive.dedup_store.READ_SIZE", 3 * 1024 * 1024):
+            chunks = list(iter_chunks_of(io.BytesIO(data)))
+        self.assertEqual(b"".join(chunks), data)
+        self.assertTrue(all(MIN_CHUNK_SIZE <= len(chunk) <= MAX_CHUNK_SIZE for chunk in chunks[:-1]))
+        self.assertEqual(list(iter_chunks_of(io.BytesIO(b""))), [])
+
+    def test_boundaries_follow_the_content(self):
+        data = random_bytes(8 * 1024 * 1024, 2)
+        chunks = list(iter_chunks_of(io.BytesIO(data)))
+        shifted_chunks = list(iter_chunks_of(io.BytesIO(b"inserted" + data)))
+        self.assertGreater(len(set(chunks) & set(shifted_chunks)), len(chunks) // 2)
+
+    def test_boundaries_follow_the_content_of_text(self):
+        generator = random.Random(4)
+        words = [
+            bytes(generator.choices(b"abcdefghijklmnopqrstuvwxyz", k=generator.randint(1, 9))) for _ in range(2000)
+        ]
+        data = b" ".join(generator.choices(words, k=2 * 1024 * 1024))[: 8 * 1024 * 1024]
+        chunks = list(iter_chunks_of(io.BytesIO(data)))
+        shifted_chunks = list(iter_chunks_of(io.BytesIO(data[:1000] + b"inserted" + data[1000:])))
+        self.assertGreater(len(chunks), 2)
+        self.assertGreater(len(set(chunks) & set(shifted_chunks)), len(chunks) // 2)
+
+
+class TestDedupStore(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        root = Path(self.temporary_directory.name)
+        self.source = root / "foo"
+        self.store = root / "hd1" / "Backup" / ".store"
+        self.backup_path = root / "hd1" / "Backup" / "host"
+        (self.source / "Pictures" / "2024").mkdir(parents=True)
+        (self.source / ".cache").mkdir()
+        self.photo = random_bytes(2 * 1024 * 1024, 3)
+        (self.source / "Pictures" / "2024" / "photo.jpg").write_bytes(self.photo)
+        (self.source / "Pictures" / "copy.jpg").write_bytes(self.photo)
+        (self.source / ".cache" / "cached").write_text("cached", encoding="utf-8")
+        (self.source / "empty.txt").touch()
+        (self.source / "secret.txt").write_text("secret", encoding="utf-8")
+        (self.source / "link").symlink_to("empty.txt")
+        os.mkfifo(self.source / "fifo")
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def backup(self, run_name):
+        """Backup the source to the store for a run, reusing the latest run."""
+        previous = get_latest_run_manifest_of(self.backup_path, "foo")
+        manifest = get_path_to_run_manifest(self.backup_path, run_name, "foo")
+        return main(
+            ["backup", f"--exclude={self.source / '.cache'}", f"--exclude={self.source / 'secret.txt'}"]
+            + ([] if previous is None else [f"--previous={previous}"])
+            + [str(self.source), str(self.store), str(manifest)]
+        )
+
+    def stored_size(self):
+        """Get the size of the chunks of the store."""
+        return sum(path.stat().st_size for path in (self.store / "chunks").rglob("*") if path.is_file())
+
+    @patch("builtins.print")
+    def test_duplicates_are_stored_once_and_restored(self, mock_print):
+        self.assertIsNone(get_latest_run_manifest_of(self.backup_path, "foo"))
+        get_path_to_run_manifest(self.backup_path, "2024-01-01_00-00-00", "bar").parent.mkdir(parents=True)
+        self.assertIsNone(get_latest_run_manifest_of(self.backup_path, "foo"))
+        self.assertEqual(self.backup("2024-01-01_00-00-00"), 0)
+        self.assertEqual(self.stored_size(), len(self.photo))
+        printed = [printed.args[0] for printed in mock_print.call_args_list]
+        self.assertEqual(printed[0], "Number of regular files transferred: 3")
+        self.assertEqual(printed[2], f"Total bytes sent: {len(self.photo)}")
+        manifest = read_store_manifest(get_path_to_run_manifest(self.backup_path, "2024-01-01_00-00-00", "foo"))
+        self.assertEqual(
+            sorted(manifest),
+            ["Pictures", "Pictures/2024", "Pictures/2024/photo.jpg", "Pictures/copy.jpg", "empty.txt", "link"],
+        )
+
+        destination = Path(self.temporary_directory.name) / "restored"
+        manifest_path = get_latest_run_manifest_of(self.backup_path, "foo")
+        self.assertEqual(main(["restore", str(manifest_path), str(self.store), str(destination)]), 0)
+        self.assertEqual((destination / "Pictures" / "2024" / "photo.jpg").read_bytes(), self.photo)
+        self.assertEqual(os.readlink(destination / "link"), "empty.txt")
+        self.assertEqual(
+            (destination / "Pictures" / "copy.jpg").stat().st_mtime_ns,
+            (self.source / "Pictures" / "copy.jpg").stat().st_mtime_ns,
+        )
+
+    @patch("builtins.print")
+    def test_chunks_are_synced_before_the_manifest(self, _):
+        synced = []
+        manifest = get_path_to_run_manifest(self.backup_path, "2024-01-01_00-00-00", "foo")
+        with patch(
+            "os.fsync", side_effect=lambda fd: synced.append((os.readlink(f"/proc/self/fd/{fd}"), manifest.exists()))
+        ):
+            self.assertEqual(self.backup("2024-01-01_00-00-00"), 0)
+        chunk_paths = [path for path in (self.store / "chunks").rglob("*") if path.is_file()]
+        self.assertEqual(
+            {path for path, _ in synced if not path.endswith(".tmp")},
+            {str(path.parent) for path in chunk_paths},
+        )
+        self.assertEqual(len([path for path, _ in synced if path.endswith(".tmp")]), len(chunk_paths))
+        self.assertFalse(any(manifest_exists for _, manifest_exists in synced))
+
+    @patch("builtins.print")
+    def test_unchanged_files_are_not_read_again(self, mock_print):
+        self.backup("2024-01-01_00-00-00")
+        (self.source / "new.txt").write_text("new", encoding="utf-8")
+        (self.source / "new.jpg").write_bytes(self.photo)
+        with patch("backup_to_harddrive.dedup_store.iter_chunks_of", wraps=iter_chunks_of) as mock_iter_chunks_of:
+            self.assertEqual(self.backup("2024-01-02_00-00-00"), 0)
+        self.assertEqual(mock_iter_chunks_of.call_count, 2)
+        self.assertEqual(mock_print.call_args_list[-1].args[0], "Total bytes sent: 3")
+        self.assertEqual(get_latest_run_manifest_of(self.backup_path, "foo").parent.name, "2024-01-02_00-00-00")
+
+    @patch("builtins.print")
+    def test_rules_file_excludes_patterns(self, _):
+        rules_path = Path(self.temporary_directory.name) / "rules"
+        rules_path.write_text("*.jpg\n/.cache/\n", encoding="utf-8")
+        manifest_path = get_path_to_run_manifest(self.backup_path, "2024-01-01_00-00-00", "foo")
+        self.assertEqual(
+            main(["backup", f"--exclude-from={rules_path}", str(self.source), str(self.store), str(manifest_path)]), 0
+        )
+        self.assertEqual(
+            sorted(read_store_manifest(manifest_path)), ["Pictures", "Pictures/2024", "empty.txt", "link", "secret.txt"]
+        )
+
+    @patch("builtins.print")
+    def test_partial_restore(self, _):
+        self.backup("2024-01-01_00-00-00")
+        destination = Path(self.temporary_directory.name) / "restored"
+        manifest_path = get_latest_run_manifest_of(self.backup_path, "foo")
+        main(["restore", "--path=Pictures/2024", str(manifest_path), str(self.store), str(destination)])
+        self.assertEqual(sorted(path.name for path in destination.rglob("*")), ["2024", "Pictures", "photo.jpg"])
+
+    @patch("builtins.print")
+    @patch("logging.error")
+    def test_errors_make_a_partial_transfer(self, mock_error, _):
+        with patch("os.readlink", side_effect=PermissionError):
+            self.assertEqual(self.backup("2024-01-01_00-00-00"), 23)
+        destination = Path(self.temporary_directory.name) / "restored"
+        manifest_path = get_latest_run_manifest_of(self.backup_path, "foo")
+        for chunk in (self.store / "chunks").rglob("*"):
+            if chunk.is_file():
+                chunk.unlink()
+        self.assertEqual(main(["restore", str(manifest_path), str(self.store), str(destination)]), 23)
+        self.assertEqual(mock_error.call_count, 3)
+
+    @patch("logging.warning")
+    def test_corrupt_manifest(self, mock_warning):
+        manifest_path = get_path_to_run_manifest(self.backup_path, "2024-01-01_00-00-00", "foo")
+        manifest_path.parent.mkdir(parents=True)
+        with gzip.open(manifest_path, "wt", encoding="utf-8") as file:
+            file.write("{corrupt\n")
+        self.assertEqual(read_store_manifest(manifest_path), {})
+        mock_warning.assert_called_once()
+
+
+class TestCompressedStore(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.addCleanup(self.temporary_directory.cleanup)
+        self.root = Path(self.temporary_directory.name)
+        (self.root / "source").mkdir()
+        self.log = b"".join(f"2024-01-01 00:00:{index % 60:02} INFO line {index}\n".encode() for index in range(50000))
+        self.photo = random_bytes(1024 * 1024, 5)
+        (self.root / "source" / "app.log").write_bytes(self.log)
+        (self.root / "source" / "photo.jpg").write_bytes(self.photo)
+        self.store = self.root / "store"
+
+    def test_compressed_chunks_are_restored(self):
+        manifest_path = self.root / "runs" / "1" / "source.json.gz"
+        stats = backup_to_store(self.root / "source", self.store, manifest_path, None, [], "zlib")
+        suffixes = sorted(path.suffix for path in (self.store / "chunks").rglob("*") if path.is_file())
+        self.assertEqual(set(suffixes), {"", ".zz"})
+        self.assertLess(stats.bytes_written, len(self.photo) + len(self.log) // 3)
+        stats = backup_to_store(self.root / "source", self.store, self.root / "runs" / "2" / "source.json.gz", None, [])
+        self.assertEqual(stats.bytes_written, 0)
+        self.assertEqual(restore_from_store(manifest_path, self.store, self.root / "restored"), 0)
+        self.assertEqual((self.root / "restored" / "app.log").read_bytes(), self.log)
+        self.assertEqual((self.root / "restored" / "photo.jpg").read_bytes(), self.photo)
+
+    def test_zstd_compression(self):
+        mock_zstandard = MagicMock()
+        mock_zstandard.ZstdCompressor.return_value.compress.return_value = b"compressed"
+        mock_zstandard.ZstdDecompressor.return_value.decompress.return_value = b"plain"
+        with patch("backup_to_harddrive.dedup_store.zstandard", mock_zstandard):
+            suffix, compress = get_compressor_for("zstd")
+            self.assertEqual((suffix, compress(b"plain")), (".zst", b"compressed"))
+            (self.store / "chunks" / "ab").mkdir(parents=True)
+            (self.store / "chunks" / "ab" / "abcd.zst").write_bytes(b"compressed")
+            self.assertEqual(read_chunk(self.store, "abcd"), b"plain")
+        mock_zstandard.ZstdCompressor.assert_called_once_with(level=3, threads=-1)
+        with patch("backup_to_harddrive.dedup_store.zstandard", None):
+            with self.assertRaises(OSError):
+                read_chunk(self.store, "abcd")
+            with self.assertLogs(level="WARNING"):
+                self.assertEqual(get_compressor_for("zstd")[0], ".zz")
+        self.assertEqual(get_compressor_for("none"), ("", None))
+
+    def test_corrupt_compressed_chunk(self):
+        (self.store / "chunks" / "ab").mkdir(parents=True)
+        (self.store / "chunks" / "ab" / "abcd.zz").write_bytes(b"corrupt")
+        with self.assertRaises(OSError):
+            read_chunk(self.store, "abcd")
+        with self.assertRaises(FileNotFoundError):
+            read_chunk(self.store, "ef01")
+
+
+class TestPackedStore(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.addCleanup(self.temporary_directory.cleanup)
+        self.root = Path(self.temporary_directory.name)
+        self.source = self.root / "node_modules"
+        self.store = self.root / "hd1" / "Backup" / ".store"
+        self.backup_path = self.root / "hd1" / "Backup" / "host"
+        self.source.mkdir()
+        for index in range(20):
+            (self.source / f"module_{index}.js").write_text(f"module.exports = {index};", encoding="utf-8")
+        (self.source / "large.bin").write_bytes(random_bytes(MAX_CHUNK_SIZE, 7))
+
+    def backup(self, run_name):
+        """Backup the source to the store with packing, reusing the latest run."""
+        previous = get_latest_run_manifest_of(self.backup_path, "node_modules")
+        with patch("builtins.print"):
+            return main(
+                ["backup", "--pack"]
+                + ([] if previous is None else [f"--previous={previous}"])
+                + [
+                    str(self.source),
+                    str(self.store),
+                    str(get_path_to_run_manifest(self.backup_path, run_name, "node_modules")),
+                ]
+            )
+
+    def restore(self, run_name):
+        """Restore a run of the source, return the restored directory."""
+        destination = self.root / "restored" / run_name
+        manifest_path = get_path_to_run_manifest(self.backup_path, run_name, "node_modules")
+        self.assertEqual(restore_from_store(manifest_path, self.store, destination), 0)
+        return destination
+
+    def test_small_files_are_packed_and_restored(self):
+        self.assertEqual(self.backup("1"), 0)
+        chunk_paths = [path for path in (self.store / "chunks").rglob("*") if path.is_file()]
+        self.assertEqual(sum(path.stat().st_size for path in chunk_paths), MAX_CHUNK_SIZE)
+        self.assertEqual(sorted(path.suffix for path in (self.store / "packs").iterdir()), [".idx", ".pack"])
+        self.assertEqual(len(read_pack_index(self.store)), 20)
+        (self.source / "module_3.js").write_text("module.exports = 'changed';", encoding="utf-8")
+        self.assertEqual(self.backup("2"), 0)
+        self.assertEqual(len(read_pack_index(self.store)), 21)
+        self.assertEqual((self.restore("1") / "module_3.js").read_text(encoding="utf-8"), "module.exports = 3;")
+        restored = self.restore("2")
+        self.assertEqual((restored / "module_3.js").read_text(encoding="utf-8"), "module.exports = 'changed';")
+        self.assertEqual((restored / "large.bin").read_bytes(), (self.source / "large.bin").read_bytes())
+
+    def test_full_segments_are_closed(self):
+        with patch("backup_to_harddrive.dedup_store.SEGMENT_MAX_SIZE", 100):
+            self.assertEqual(self.backup("1"), 0)
+        self.assertEqual(len(list((self.store / "packs").glob("*.pack"))), 4)
+        self.assertEqual((self.restore("1") / "module_19.js").read_text(encoding="utf-8"), "module.exports = 19;")
+
+    @patch("backup_to_harddrive.dedup_store.SMALL_SEGMENTS_BEFORE_COMPACTION", 3)
+    def test_small_segments_are_compacted(self):
+        for run_name in ["1", "2", "3"]:
+            (self.source / "module_0.js").write_text(f"module.exports = 'run {run_name}';", encoding="utf-8")
+            self.backup(run_name)
+            with patch("builtins.print") as mock_print:
+                self.assertEqual(main(["compact", str(self.store)]), 0)
+            mock_print.assert_called_once_with(f"Segments compacted: {3 if run_name == '3' else 0}")
+        self.assertEqual(len(list((self.store / "packs").glob("*.pack"))), 1)
+        self.assertEqual(len(read_pack_index(self.store)), 22)
+        get_path_to_run_manifest(self.backup_path, "1", "node_modules").unlink()
+        get_path_to_run_manifest(self.backup_path, "2", "node_modules").unlink()
+        with patch("backup_to_harddrive.dedup_store.SMALL_SEGMENTS_BEFORE_COMPACTION", 1), patch("builtins.print"):
+            main(["compact", str(self.store)])
+        self.assertEqual(len(read_pack_index(self.store)), 20)
+        restored = self.restore("3")
+        self.assertEqual((restored / "module_0.js").read_text(encoding="utf-8"), "module.exports = 'run 3';")
+
+    @patch("backup_to_harddrive.dedup_store.SMALL_SEGMENTS_BEFORE_COMPACTION", 1)
+    def test_compaction_errors(self):
+        self.backup("1")
+        with patch("backup_to_harddrive.dedup_store.compact_store", side_effect=PermissionError("denied")):
+            with self.assertLogs(level="ERROR"):
+                self.assertEqual(main(["compact", str(self.store)]), 23)
+        get_path_to_run_manifest(self.backup_path, "1", "node_modules").write_bytes(b"corrupt")
+        with self.assertLogs(level="ERROR"), patch("builtins.print") as mock_print:
+            self.assertEqual(main(["compact", str(self.store)]), 0)
+        mock_print.assert_called_once_with("Segments compacted: 0")
+        self.assertEqual(len(read_pack_index(self.store)), 20)
+
+    def test_interrupted_segments_are_ignored(self):
+        self.backup("1")
+        index_path = next((self.store / "packs").glob("*.idx"))
+        with open(index_path, "a", encoding="utf-8") as file:
+            file.write('["beyond", 1000000, 10, ""]\n["torn", 0,')
+        (self.store / "packs" / "unreadable.idx").mkdir()
+        with self.assertLogs(level="WARNING"):
+            packed_chunks = read_pack_index(self.store)
+        self.assertEqual(len(packed_chunks), 20)
+        with self.assertRaises(OSError):
+            read_packed_chunk(self.store, PackedChunk(index_path.stem, 0, 1000000))
@@ -0,0 +1,145 @@
+"""Unit tests for the exclusion rules of the sources."""
+
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from parameterized import parameterized
+
+from backup_to_harddrive.config import BackupConfig
+from backup_to_harddrive.filters import (
+    as_exclusion_filter,
+    compile_exclusion_filter,
+    escape_glob,
+    get_exclusion_filter_of,
+    get_filter_options_of,
+    read_rules_file,
+)
+
+ROOT = Path("/home/foo")
+
+
+class TestExclusionFilter(unittest.TestCase):
+    @parameterized.expand(
+        [
+            ["name", ".cache", ".cache", True, True],
+            ["name of a file", ".cache", "a/.cache", False, True],
+            ["other name", ".cache", "cache", True, False],
+            ["directory name", "node_modules/", "a/node_modules", True, True],
+            ["directory name on a file", "node_modules/", "a/node_modules", False, False],
+            ["anchored", "/build", "build", True, True],
+            ["anchored below", "/build", "a/build", True, False],
+            ["anchored directory", "/build/", "build", True, True],
+            ["anchored directory on a file", "/build/", "build", False, False],
+            ["anchored path", "/a/build", "a/build", False, True],
+            ["unanchored path", "docs/*.md", "a/docs/readme.md", False, True],
+            ["unanchored path below", "docs/*.md", "docs/a/readme.md", False, False],
+            ["star", "*.tmp", "a/b/file.tmp", False, True],
+            ["star within a name", "*.tmp", "a/file.tmp.txt", False, False],
+            ["question mark", "file?.txt", "file1.txt", False, True],
+            ["character set", "file[0-9].txt", "file1.txt", False, True],
+            ["negated character set", "file[!0-9].txt", "file1.txt", False, False],
+            ["double star", "/a/**/c", "a/b/d/c", True, True],
+            ["single star does not cross directories", "/a/*/c", "a/b/d/c", True, False],
+            ["triple star", "/a/***", "a", True, True],
+            ["escaped wildcard", "file\\*.txt", "file*.txt", False, True],
+            ["escaped wildcard is literal", "file\\*.txt", "file1.txt", False, False],
+            ["regular expression", "re:.*\\.o", "a/b.o", False, True],
+            ["regular expression of directories", "re:(.*/)?target/", "a/target", True, True],
+            ["regular expression of directories on a file", "re:(.*/)?target/", "a/target", False, False],
+        ]
+    )
+    def test_is_excluded(  # pylint: disable=(too-many-positional-arguments)
+        self, _, rule, relative_path, is_directory, expected
+    ):
+        exclusion_filter = compile_exclusion_filter(ROOT, [], [rule])
+        self.assertEqual(exclusion_filter.is_excluded(str(ROOT / relative_path), is_directory), expected)
+
+    def test_excluded_folders_are_anchored_rules(self):
+        exclusion_filter = compile_exclusion_filter(
+            ROOT, [ROOT / ".cache", ROOT / "[draft]", "/other/excluded"], ["*.tmp"]
+        )
+        self.assertEqual(exclusion_filter.rules, ("/.cache", "/\\[draft]", "*.tmp"))
+        self.assertTrue(exclusion_filter.is_excluded("/other/excluded", True))
+        self.assertTrue(exclusion_filter.is_excluded(str(ROOT / "[draft]"), True))
+        self.assertFalse(exclusion_filter.is_excluded(str(ROOT / "d"), True))
+
+    @parameterized.expand(
+        [
+            ["literal", "a\\b", False, "a\\b"],
+            ["wildcards", "[2020] a\\b", False, "\\[2020] a\\\\b"],
+            ["within wildcards", "a\\b", True, "a\\\\b"],
+        ]
+    )
+    def test_escape_glob(self, _, text, is_within_wildcards, expected):
+        self.assertEqual(escape_glob(text, is_within_wildcards), expected)
+
+    def test_is_below_excluded(self):
+        exclusion_filter = compile_exclusion_filter(ROOT, [ROOT / ".cache"], ["node_modules/"])
+        self.assertTrue(exclusion_filter.is_below_excluded(str(ROOT / ".cache" / "a" / "b"), False))
+        self.assertTrue(exclusion_filter.is_below_excluded(str(ROOT / "a" / "node_modules" / "b"), False))
+        self.assertFalse(exclusion_filter.is_below_excluded(str(ROOT / "a" / "node_modules"), False))
+        self.assertFalse(exclusion_filter.is_below_excluded(str(ROOT / "a" / "b"), True))
+
+    def test_get_exclusion_filter_of(self):
+        backup_config = BackupConfig(
+            source=ROOT,
+            list_of_harddrive=[Path("/media/hd1")],
+            list_of_excluded_folders=[ROOT / ".cache"],
+            quick_restore_path=[],
+            exclude=["*.tmp"],
+        )
+        exclusion_filter = get_exclusion_filter_of(backup_config)
+        self.assertEqual(exclusion_filter.rules, ("/.cache", "*.tmp"))
+        self.assertIs(as_exclusion_filter(ROOT, exclusion_filter), exclusion_filter)
+        self.assertEqual(as_exclusion_filter(ROOT, [ROOT / ".cache"]).rules, ("/.cache",))
+
+
+class TestFilterFiles(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.addCleanup(self.temporary_directory.cleanup)
+        patcher = patch("backup_to_harddrive.filters.user_cache_dir", return_value=self.temporary_directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.exclusion_filter = compile_exclusion_filter(ROOT, [ROOT / ".cache"], ["*.tmp", "re:.*\\.o"])
+
+    @parameterized.expand(
+        [
+            ["anchored to the source name", "foo", "- /foo/.cache\n- /foo/*.tmp\n- /foo/**/*.tmp\n"],
+            ["anchored to the root", "", "- /.cache\n- /*.tmp\n- /**/*.tmp\n"],
+            [
+                "anchored to a source name holding wildcards",
+                "foo[1]",
+                "- /foo\\[1]/.cache\n- /foo\\[1]/*.tmp\n- /foo\\[1]/**/*.tmp\n",
+            ],
+        ]
+    )
+    def test_rsync_merge_file(self, _, anchor, expected_content):
+        (option,) = get_filter_options_of(self.exclusion_filter, "rsync", anchor)
+        self.assertTrue(option.startswith("--filter=merge "))
+        self.assertEqual(Path(option[len("--filter=merge ") :]).read_text(encoding="utf-8"), expected_content)
+
+    def test_literal_rules_are_escaped_within_wildcards(self):
+        exclusion_filter = compile_exclusion_filter(ROOT, [], ["/a\\b", "c\\d"])
+        (option,) = get_filter_options_of(exclusion_filter, "rsync", "foo*")
+        self.assertEqual(
+            read_rules_file(Path(option[len("--filter=merge ") :])),
+            ["- /foo\\*/a\\\\b", "- /foo\\*/c\\\\d", "- /foo\\*/**/c\\\\d"],
+        )
+        (option,) = get_filter_options_of(exclusion_filter, "rsync", "foo")
+        self.assertEqual(
+            read_rules_file(Path(option[len("--filter=merge ") :])), ["- /foo/a\\b", "- /foo/c\\d", "- /foo/**/c\\\\d"]
+        )
+
+    def test_rules_file_is_written_once(self):
+        (option,) = get_filter_options_of(self.exclusion_filter, "native")
+        rules_path = Path(option[len("--exclude-from=") :])
+        self.assertEqual(read_rules_file(rules_path), ["/.cache", "*.tmp", "re:.*\\.o"])
+        with patch("backup_to_harddrive.filters.os.replace") as mock_replace:
+            self.assertEqual(get_filter_options_of(self.exclusion_filter, "dedup"), [option])
+        mock_replace.assert_not_called()
+
+    def test_nothing_excluded(self):
+        self.assertEqual(get_filter_options_of(compile_exclusion_filter(ROOT, ["/other"]), "rsync", "foo"), [])
@@ -1,21 +1,39 @@
 """Unit test of main module."""
 
 import argparse
+import os
+import subprocess
+import sys
 import unittest
+from pathlib import Path
 from unittest.mock import patch
 
-from backup_to_harddrive.main import main
+from parameterized import parameterized
+
+import backup_to_harddrive
+from backup_to_harddrive.main import get_integer_type_at_least, main
+
+MODULES_NOT_IMPORTED_AT_STARTUP = [
+    "yaml",
+    "asyncio",
+    "sqlite3",
+    "socket",
+    "subprocess",
+    "concurrent.futures",
+    "backup_to_harddrive.config",
+    "backup_to_harddrive.backup_from_config",
+]
 
 
 class TestMainFunction(unittest.TestCase):
 
     def setUp(self):
         """Set up the test case."""
-        self.patcher = patch("backup_to_harddrive.main.check_if_rsync_is_installed_and_log_if_not")
+        self.patcher = patch("backup_to_harddrive.rsync_installation_check.check_if_rsync_is_installed_and_log_if_not")
         self.mock_check_rsync = self.patcher.start()
         self.mock_check_rsync.return_value = True
 
-    @patch("backup_to_harddrive.main.run_backup_from_config_file")
+    @patch("backup_to_harddrive.backup_from_config.run_backup_from_config_file")
     @patch("backup_to_harddrive.main.set_backup_status")
     @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
     def test_main_switch_on(self, mock_parse_args, mock_set_backup_status, mock_run):
@@ -25,8 +43,9 @@ class TestMainFunction(unittest.TestCase):
 
         mock_set_backup_status.assert_called_once_with(True)
         mock_run.assert_not_called()
+        self.mock_check_rsync.assert_not_called()
 
-    @patch("backup_to_harddrive.main.run_backup_from_config_file")
+    @patch("backup_to_harddrive.backup_from_config.run_backup_from_config_file")
     @patch("backup_to_harddrive.main.set_backup_status")
     @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
     def test_main_switch_off(self, mock_parse_args, mock_set_backup_status, mock_run):
@@ -38,26 +57,103 @@ class TestMainFunction(unittest.TestCase):
         mock_run.assert_not_called()
 
     @patch("backup_to_harddrive.main.is_backup_switched_on")
-    @patch("backup_to_harddrive.main.run_backup_from_config_file")
+    @patch("backup_to_harddrive.backup_from_config.run_backup_from_config_file")
     @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
     def test_dry_run(self, mock_parse_args, mock_run, mock_get_status):
         mock_parse_args.return_value = argparse.Namespace(switch_on=None, switch_off=None, dry_run=1)
         mock_get_status.return_value = True
         self.assertEqual(main(), 0)
-        mock_run.assert_called_with(dry_run=True)
+        mock_run.assert_called_with(
+            dry_run=True, max_parallel_jobs=None, telemetry_file=None, resume=False, preflight=False
+        )
 
     @patch("backup_to_harddrive.main.is_backup_switched_on")
-    @patch("backup_to_harddrive.main.run_backup_from_config_file")
+    @patch("backup_to_harddrive.backup_from_config.run_backup_from_config_file")
     @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
     def test_wet_run_switched_on(self, mock_parse_args, mock_run, mock_is_backup_switched_on):
         mock_is_backup_switched_on.return_value = True
         mock_parse_args.return_value = argparse.Namespace(switch_on=None, switch_off=None)
         self.assertEqual(main(), 0)
-        mock_run.assert_called_with(dry_run=False)
+        mock_run.assert_called_with(
+            dry_run=False, max_parallel_jobs=None, telemetry_file=None, resume=False, preflight=False
+        )
+
+    @patch("backup_to_harddrive.main.is_backup_switched_on", return_value=True)
+    @patch("backup_to_harddrive.backup_from_config.run_backup_from_config_file")
+    @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
+    def test_resume(self, mock_parse_args, mock_run, _):
+        mock_parse_args.return_value = argparse.Namespace(switch_on=None, switch_off=None, resume=1)
+        self.assertEqual(main(), 0)
+        mock_run.assert_called_with(
+            dry_run=False, max_parallel_jobs=None, telemetry_file=None, resume=True, preflight=False
+        )
+
+    @patch("backup_to_harddrive.main.is_backup_switched_on")
+    @patch("backup_to_harddrive.backup_from_config.run_backup_from_config_file")
+    @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
+    def test_wet_run_incomplete(self, mock_parse_args, mock_run, mock_is_backup_switched_on):
+        mock_is_backup_switched_on.return_value = True
+        mock_parse_args.return_value = argparse.Namespace(switch_on=None, switch_off=None)
+        mock_run.return_value = False
+        self.assertEqual(main(), 1)
+
+    @patch("backup_to_harddrive.backup_from_config.print_run_history")
+    @patch("backup_to_harddrive.backup_from_config.run_backup_from_config_file")
+    @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
+    def test_history(self, mock_parse_args, mock_run, mock_print_run_history):
+        mock_parse_args.return_value = argparse.Namespace(switch_on=None, switch_off=None, history=5)
+        self.assertEqual(main(), 0)
+        mock_print_run_history.assert_called_once_with(5)
+        mock_run.assert_not_called()
+
+    @patch("backup_to_harddrive.verify.verify_backups_from_config_file", return_value=1)
+    @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
+    def test_verify(self, mock_parse_args, mock_verify):
+        mock_parse_args.return_value = argparse.Namespace(switch_on=None, switch_off=None, verify=1)
+        self.assertEqual(main(), 1)
+        mock_verify.assert_called_once_with()
+
+    @patch("backup_to_harddrive.restore.restore_from_config_file", return_value=0)
+    @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
+    def test_restore(self, mock_parse_args, mock_restore):
+        mock_parse_args.return_value = argparse.Namespace(
+            switch_on=None, switch_off=None, restore=1, restore_from=Path("/media/hd1"), restore_to=None
+        )
+        self.assertEqual(main(), 0)
+        mock_restore.assert_called_once_with(harddrive=Path("/media/hd1"), destination=None)
+
+    @patch("backup_to_harddrive.catalog.print_files_found_in_catalog", return_value=1)
+    @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
+    def test_find(self, mock_parse_args, mock_find):
+        mock_parse_args.return_value = argparse.Namespace(switch_on=None, switch_off=None, find="*.odt")
+        self.assertEqual(main(), 1)
+        mock_find.assert_called_once_with("*.odt")
+
+    @patch("backup_to_harddrive.change_journal.watch_sources_of_config_file", return_value=0)
+    @patch("backup_to_harddrive.backup_from_config.run_backup_from_config_file")
+    @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
+    def test_watch(self, mock_parse_args, mock_run, mock_watch):
+        mock_parse_args.return_value = argparse.Namespace(switch_on=None, switch_off=None, watch=1)
+        self.assertEqual(main(), 0)
+        mock_watch.assert_called_once_with()
+        mock_run.assert_not_called()
+
+    @patch("backup_to_harddrive.main.is_backup_switched_on")
+    @patch("backup_to_harddrive.backup_from_config.run_backup_from_config_file")
+    @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
+    def test_wet_run_max_parallel_jobs(self, mock_parse_args, mock_run, mock_is_backup_switched_on):
+        mock_is_backup_switched_on.return_value = True
+        mock_parse_args.return_value = argparse.Namespace(
+            switch_on=None, switch_off=None, max_parallel_jobs=2, telemetry_file=Path("-"), preflight=1
+        )
+        self.assertEqual(main(), 0)
+        mock_run.assert_called_with(
+            dry_run=False, max_parallel_jobs=2, telemetry_file=Path("-"), resume=False, preflight=True
+        )
 
     @patch("logging.info")
     @patch("backup_to_harddrive.main.is_backup_switched_on")
-    @patch("backup_to_harddrive.main.run_backup_from_config_file")
+    @patch("backup_to_harddrive.backup_from_config.run_backup_from_config_file")
     @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
     def test_wet_run_switched_off(self, mock_parse_args, mock_run, mock_is_backup_switched_on, mock_log_info):
         mock_is_backup_switched_on.return_value = False
@@ -68,7 +164,7 @@ class TestMainFunction(unittest.TestCase):
 
     @patch("logging.info")
     @patch("backup_to_harddrive.main.is_backup_switched_on")
-    @patch("backup_to_harddrive.main.run_backup_from_config_file")
+    @patch("backup_to_harddrive.backup_from_config.run_backup_from_config_file")
     @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
     def test_status_when_switched_off(self, mock_parse_args, mock_run, mock_is_backup_switched_on, mock_log_info):
         mock_is_backup_switched_on.return_value = False
@@ -80,7 +176,7 @@ class TestMainFunction(unittest.TestCase):
 
     @patch("logging.info")
     @patch("backup_to_harddrive.main.is_backup_switched_on")
-    @patch("backup_to_harddrive.main.run_backup_from_config_file")
+    @patch("backup_to_harddrive.backup_from_config.run_backup_from_config_file")
     @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
     def test_status_when_switched_on(self, mock_parse_args, mock_run, mock_is_backup_switched_on, mock_log_info):
         mock_is_backup_switched_on.return_value = True
@@ -90,14 +186,71 @@ class TestMainFunction(unittest.TestCase):
         mock_log_info.assert_not_called()
         mock_is_backup_switched_on.assert_called()
 
+    @patch("backup_to_harddrive.backup_from_config.is_rsync_required_by_config_file", return_value=True)
     @patch("logging.error")
     @patch("backup_to_harddrive.main.is_backup_switched_on")
-    @patch("backup_to_harddrive.main.run_backup_from_config_file")
+    @patch("backup_to_harddrive.backup_from_config.run_backup_from_config_file")
     @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
-    def test_wet_run_rsync_not_installed(self, mock_parse_args, mock_run, mock_is_backup_switched_on, mock_log_error):
+    # pylint: disable=too-many-positional-arguments
+    def test_wet_run_rsync_not_installed(
+        self, mock_parse_args, mock_run, mock_is_backup_switched_on, mock_log_error, mock_is_rsync_required
+    ):
         mock_is_backup_switched_on.return_value = True
         mock_parse_args.return_value = argparse.Namespace(switch_on=None, switch_off=None)
         self.mock_check_rsync.return_value = False
         self.assertEqual(main(), 1)
         mock_run.assert_not_called()
         mock_log_error.assert_called()
+        mock_is_rsync_required.assert_called_once()
+
+    @patch("backup_to_harddrive.backup_from_config.is_rsync_required_by_config_file", return_value=False)
+    @patch("backup_to_harddrive.main.is_backup_switched_on")
+    @patch("backup_to_harddrive.backup_from_config.run_backup_from_config_file")
+    @patch("backup_to_harddrive.main.argparse.ArgumentParser.parse_args")
+    def test_wet_run_native_backend_without_rsync(self, mock_parse_args, mock_run, mock_is_backup_switched_on, _):
+        mock_is_backup_switched_on.return_value = True
+        mock_parse_args.return_value = argparse.Namespace(switch_on=None, switch_off=None)
+        self.mock_check_rsync.return_value = False
+        self.assertEqual(main(), 0)
+        mock_run.assert_called_once()
+
+
+class TestIntegerOptions(unittest.TestCase):
+    @patch("backup_to_harddrive.backup_from_config.run_backup_from_config_file")
+    @patch("sys.stderr")
+    @patch("sys.argv", ["backup_to_harddrive", "--max-parallel-jobs", "-1"])
+    def test_negative_max_parallel_jobs_is_rejected(self, _, mock_run):
+        with self.assertRaises(SystemExit):
+            main()
+        mock_run.assert_not_called()
+
+    @patch("backup_to_harddrive.backup_from_config.print_run_history")
+    @patch("sys.stderr")
+    @patch("sys.argv", ["backup_to_harddrive", "--history", "0"])
+    def test_zero_history_is_rejected(self, _, mock_print_run_history):
+        with self.assertRaises(SystemExit):
+            main()
+        mock_print_run_history.assert_not_called()
+
+    @parameterized.expand([["below the minimum", "0"], ["not an integer", "two"]])
+    def test_invalid_values_are_rejected(self, _, value):
+        with self.assertRaises(argparse.ArgumentTypeError):
+            get_integer_type_at_least(1)(value)
+
+    def test_valid_value(self):
+        self.assertEqual(get_integer_type_at_least(0)("0"), 0)
+
+
+class TestStartupImports(unittest.TestCase):
+    def test_heavy_modules_are_not_imported_at_startup(self):
+        environment = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(backup_to_harddrive.__file__)))
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import backup_to_harddrive.main"],
+            env=environment,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        imported = {line.rsplit("|", 1)[-1].strip() for line in result.stderr.splitlines()}
+        self.assertIn("backup_to_harddrive.main", imported)
+        self.assertEqual([module for module in MODULES_NOT_IMPORTED_AT_STARTUP if module in imported], [])
@@ -0,0 +1,130 @@
+"""Unit tests for the manifest of backed up files."""
+
+import gzip
+import hashlib
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from backup_to_harddrive.manifest import (
+    ManifestEntry,
+    add_digests_to,
+    compute_digest_of,
+    get_changed_and_deleted_paths,
+    get_path_to_manifest,
+    read_manifest,
+    scan_source,
+    write_manifest,
+)
+
+
+class TestGetPathToManifest(unittest.TestCase):
+    def test_get_path_to_manifest(self):
+        self.assertEqual(
+            get_path_to_manifest(Path("/media/hd1/Backup/host"), Path("/home/foo")),
+            Path("/media/hd1/Backup/host/.manifest_foo.json.gz"),
+        )
+
+
+class TestScanSource(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.source = Path(self.temporary_directory.name) / "foo"
+        (self.source / "Documents" / "deep").mkdir(parents=True)
+        (self.source / ".cache").mkdir()
+        (self.source / "top.txt").write_text("top", encoding="utf-8")
+        (self.source / "Documents" / "deep" / "doc.txt").write_text("document", encoding="utf-8")
+        (self.source / ".cache" / "cached").write_text("cached", encoding="utf-8")
+        (self.source / "link").symlink_to("top.txt")
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def test_scan_source(self):
+        manifest = scan_source(self.source, [self.source / ".cache"])
+        self.assertEqual(sorted(manifest), [os.path.join("Documents", "deep", "doc.txt"), "link", "top.txt"])
+        self.assertEqual(manifest["top.txt"].size, 3)
+        self.assertEqual(manifest["top.txt"].inode, (self.source / "top.txt").stat().st_ino)
+        self.assertEqual(manifest["top.txt"].mtime_ns, (self.source / "top.txt").stat().st_mtime_ns)
+
+    @patch("logging.warning")
+    def test_scan_source_unreadable_directory(self, mock_warning):
+        with patch("os.scandir", side_effect=PermissionError):
+            self.assertEqual(scan_source(self.source, []), {})
+        mock_warning.assert_called_once()
+
+    def test_digests(self):
+        expected = hashlib.blake2b(b"top").hexdigest()
+        self.assertEqual(compute_digest_of(self.source / "top.txt"), expected)
+
+        live = scan_source(self.source, [self.source / ".cache"])
+        stored = {"link": ManifestEntry(**vars(live["link"]))}
+        stored["link"].digest = "recorded"
+        live["top.txt"].digest = "already computed"
+        add_digests_to(live, stored, self.source)
+        self.assertEqual(live["link"].digest, "recorded")
+        self.assertEqual(live["top.txt"].digest, "already computed")
+        self.assertEqual(
+            live[os.path.join("Documents", "deep", "doc.txt")].digest, hashlib.blake2b(b"document").hexdigest()
+        )
+
+    @patch("logging.warning")
+    def test_digest_of_vanished_file(self, mock_warning):
+        live = {"vanished": ManifestEntry(size=1, mtime_ns=1, inode=1)}
+        add_digests_to(live, {}, self.source)
+        self.assertEqual(live["vanished"].digest, "")
+        mock_warning.assert_called_once()
+
+
+class TestGetChangedAndDeletedPaths(unittest.TestCase):
+    def test_get_changed_and_deleted_paths(self):
+        stored = {
+            "same": ManifestEntry(size=1, mtime_ns=10, inode=100),
+            "touched": ManifestEntry(size=1, mtime_ns=10, inode=101),
+            "resized": ManifestEntry(size=1, mtime_ns=10, inode=102),
+            "replaced": ManifestEntry(size=1, mtime_ns=10, inode=103),
+            "deleted": ManifestEntry(size=1, mtime_ns=10, inode=104),
+        }
+        live = {
+            "same": ManifestEntry(size=1, mtime_ns=10, inode=100),
+            "touched": ManifestEntry(size=1, mtime_ns=11, inode=101),
+            "resized": ManifestEntry(size=2, mtime_ns=10, inode=102),
+            "replaced": ManifestEntry(size=1, mtime_ns=10, inode=203),
+            "new": ManifestEntry(size=1, mtime_ns=10, inode=105),
+        }
+        changed, deleted = get_changed_and_deleted_paths(live, stored)
+        self.assertEqual(changed, ["new", "replaced", "resized", "touched"])
+        self.assertEqual(deleted, ["deleted"])
+
+
+class TestReadWriteManifest(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.manifest_path = Path(self.temporary_directory.name) / "Backup" / "host" / ".manifest_foo.json.gz"
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def test_round_trip(self):
+        manifest = {
+            "a\tb\nc": ManifestEntry(size=1, mtime_ns=2, inode=3, digest="abc"),
+            "d": ManifestEntry(size=4, mtime_ns=5, inode=6),
+        }
+        write_manifest(self.manifest_path, manifest)
+        self.assertEqual(read_manifest(self.manifest_path), manifest)
+        self.assertEqual(list(self.manifest_path.parent.iterdir()), [self.manifest_path])
+
+    def test_missing_manifest(self):
+        self.assertIsNone(read_manifest(self.manifest_path))
+
+    @patch("logging.warning")
+    def test_corrupted_manifest(self, mock_warning):
+        self.manifest_path.parent.mkdir(parents=True)
+        self.manifest_path.write_bytes(b"not gzip")
+        self.assertIsNone(read_manifest(self.manifest_path))
+        with gzip.open(self.manifest_path, "wt", encoding="utf-8") as file:
+            file.write("[1, 2]\n")
+        self.assertIsNone(read_manifest(self.manifest_path))
+        self.assertEqual(mock_warning.call_count, 2)
@@ -0,0 +1,261 @@
+"""Unit tests for the native copy engine."""
+
+import errno
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from backup_to_harddrive.native_copy import copy_file_content, main
+
+
+class TestCopyFileContent(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.source = Path(self.temporary_directory.name) / "source.bin"
+        self.destination = Path(self.temporary_directory.name) / "destination.bin"
+        self.source.write_bytes(os.urandom(3000))
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def copy(self):
+        """Copy the source file to the destination file."""
+        with open(self.source, "rb") as source_file, open(self.destination, "wb") as destination_file:
+            return copy_file_content(source_file.fileno(), destination_file.fileno())
+
+    def test_copy_file_range(self):
+        self.assertEqual(self.copy(), 3000)
+        self.assertEqual(self.destination.read_bytes(), self.source.read_bytes())
+
+    @patch("backup_to_harddrive.native_copy.COPY_CHUNK_SIZE", 1000)
+    def test_fallback_to_sendfile_and_read_write_keeps_the_offset(self):
+        offsets = []
+
+        def copy_chunk_then_fail(error_number):
+            """Generate a mock of a kernel copy that copies one chunk, then fails."""
+
+            def copy_chunk(source_fd, destination_fd, offset):
+                if offsets and offsets[-1][0] == error_number:
+                    raise OSError(error_number, os.strerror(error_number))
+                offsets.append((error_number, offset))
+                return os.pwrite(destination_fd, os.pread(source_fd, 1000, offset), offset)
+
+            return copy_chunk
+
+        copy_file_range_mock = copy_chunk_then_fail(errno.EXDEV)
+        sendfile_mock = copy_chunk_then_fail(errno.EINVAL)
+        with (
+            patch(
+                "os.copy_file_range",
+                side_effect=lambda source_fd, destination_fd, _, offset, __: copy_file_range_mock(
+                    source_fd, destination_fd, offset
+                ),
+            ),
+            patch(
+                "os.sendfile",
+                side_effect=lambda destination_fd, source_fd, offset, _: sendfile_mock(
+                    source_fd, destination_fd, offset
+                ),
+            ),
+        ):
+            self.assertEqual(self.copy(), 3000)
+        self.assertEqual(self.destination.read_bytes(), self.source.read_bytes())
+        self.assertEqual(offsets, [(errno.EXDEV, 0), (errno.EINVAL, 1000)])
+
+    @patch("os.copy_file_range", side_effect=OSError(errno.EIO, "input/output error"))
+    def test_other_errors_are_raised(self, _):
+        with self.assertRaises(OSError):
+            self.copy()
+
+    @patch("os.pread", side_effect=OSError(errno.EINVAL, "invalid"))
+    @patch("os.sendfile", side_effect=OSError(errno.EINVAL, "invalid"))
+    @patch("os.copy_file_range", side_effect=OSError(errno.EXDEV, "cross device"))
+    def test_error_of_the_last_method_is_raised(self, *_):
+        with self.assertRaises(OSError):
+            self.copy()
+
+
+class TestNativeCopy(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        root = Path(self.temporary_directory.name)
+        self.source = root / "foo"
+        self.backup = root / "hd1" / "Backup"
+        (self.source / "Documents" / "deep").mkdir(parents=True)
+        (self.source / "Documents" / "deep" / "doc.txt").write_text("document", encoding="utf-8")
+        (self.source / ".cache").mkdir()
+        (self.source / ".cache" / "cached").write_text("cached", encoding="utf-8")
+        (self.source / "top.txt").write_text("top", encoding="utf-8")
+        (self.source / "link").symlink_to("top.txt")
+        os.mkfifo(self.source / "fifo")
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def run_copy(self, *options, source=None):
+        """Run the native copy of the source into the backup directory."""
+        return main(list(options) + [str(source or self.source), str(self.backup)])
+
+    @patch("builtins.print")
+    def test_copy_mirrors_the_source(self, mock_print):
+        self.assertEqual(self.run_copy("--delete", f"--exclude={self.source / '.cache'}"), 0)
+        destination = self.backup / "foo"
+        self.assertEqual((destination / "Documents" / "deep" / "doc.txt").read_text(encoding="utf-8"), "document")
+        self.assertEqual(os.readlink(destination / "link"), "top.txt")
+        self.assertFalse((destination / ".cache").exists())
+        self.assertFalse((destination / "fifo").exists())
+        self.assertEqual((destination / "top.txt").stat().st_mtime_ns, (self.source / "top.txt").stat().st_mtime_ns)
+        self.assertEqual(
+            [printed.args[0] for printed in mock_print.call_args_list],
+            [
+                "Number of regular files transferred: 2",
+                "Total transferred file size: 11 bytes",
+                "Total bytes sent: 11",
+            ],
+        )
+
+    @patch("builtins.print")
+    def test_files_larger_than_max_size_are_skipped(self, _):
+        self.run_copy("--delete")
+        (self.source / "top.txt").write_text("changed top", encoding="utf-8")
+        self.assertEqual(self.run_copy("--delete", "--max-size=8"), 0)
+        self.assertEqual((self.backup / "foo" / "top.txt").read_text(encoding="utf-8"), "top")
+
+    @patch("builtins.print")
+    def test_rules_file_excludes_patterns(self, _):
+        rules_path = Path(self.temporary_directory.name) / "rules"
+        rules_path.write_text("deep/\n/top.txt\nre:.*/doc\\.txt\n", encoding="utf-8")
+        (self.source / "Documents" / "doc.txt").write_text("document", encoding="utf-8")
+        (self.source / "Documents" / "notes.txt").write_text("notes", encoding="utf-8")
+        self.assertEqual(self.run_copy(f"--exclude-from={rules_path}"), 0)
+        destination = self.backup / "foo"
+        self.assertEqual(sorted(path.name for path in (destination / "Documents").iterdir()), ["notes.txt"])
+        self.assertFalse((destination / "top.txt").exists())
+        self.assertTrue((destination / ".cache" / "cached").exists())
+
+    @patch("builtins.print")
+    def test_second_copy_only_transfers_changes_and_deletes_extraneous_entries(self, mock_print):
+        self.run_copy("--delete")
+        destination = self.backup / "foo"
+        (destination / "extraneous").mkdir()
+        (destination / "extraneous.txt").write_text("extraneous", encoding="utf-8")
+        (self.source / "Documents" / "deep" / "doc.txt").write_text("changed document", encoding="utf-8")
+        self.assertEqual(self.run_copy("--delete"), 0)
+        self.assertEqual(mock_print.call_args_list[-3].args[0], "Number of regular files transferred: 1")
+        self.assertFalse((destination / "extraneous").exists())
+        self.assertFalse((destination / "extraneous.txt").exists())
+        self.assertEqual(
+            (destination / "Documents" / "deep" / "doc.txt").read_text(encoding="utf-8"), "changed document"
+        )
+
+    @patch("builtins.print")
+    def test_update_keeps_newer_files_and_type_changes_are_replaced(self, _):
+        self.run_copy()
+        destination = self.backup / "foo"
+        (destination / "top.txt").write_text("newer", encoding="utf-8")
+        os.utime(destination / "top.txt", ns=(0, (self.source / "top.txt").stat().st_mtime_ns + 10**9))
+        (destination / "link").unlink()
+        (destination / "link").mkdir()
+        (destination / "Documents" / "deep" / "doc.txt").unlink()
+        (destination / "Documents" / "deep" / "doc.txt").mkdir()
+        (self.source / "Music").mkdir()
+        (destination / "Music").write_text("file instead of directory", encoding="utf-8")
+        self.assertEqual(self.run_copy("--update"), 0)
+        self.assertEqual((destination / "top.txt").read_text(encoding="utf-8"), "newer")
+        self.assertEqual(os.readlink(destination / "link"), "top.txt")
+        self.assertEqual((destination / "Documents" / "deep" / "doc.txt").read_text(encoding="utf-8"), "document")
+        self.assertTrue((destination / "Music").is_dir())
+        self.run_copy()
+        self.assertEqual((destination / "top.txt").read_text(encoding="utf-8"), "top")
+
+    @patch("builtins.print")
+    def test_link_dest_hard_links_unchanged_files(self, _):
+        self.run_copy(source=f"{self.source}{os.sep}")
+        self.assertTrue((self.backup / "top.txt").exists())
+        previous = self.backup
+        self.backup = Path(self.temporary_directory.name) / "hd1" / "snapshot"
+        (self.source / "top.txt").write_text("changed", encoding="utf-8")
+        self.assertEqual(self.run_copy(f"--link-dest={previous}", source=f"{self.source}{os.sep}"), 0)
+        self.assertEqual(
+            (self.backup / "Documents" / "deep" / "doc.txt").stat().st_ino,
+            (previous / "Documents" / "deep" / "doc.txt").stat().st_ino,
+        )
+        self.assertNotEqual((self.backup / "top.txt").stat().st_ino, (previous / "top.txt").stat().st_ino)
+        self.assertEqual((self.backup / "top.txt").read_text(encoding="utf-8"), "changed")
+
+    @patch("builtins.print")
+    @patch("logging.error")
+    def test_errors_make_a_partial_transfer(self, mock_error, _):
+        with patch("os.scandir", side_effect=PermissionError):
+            self.assertEqual(self.run_copy("--delete"), 23)
+        self.assertEqual(mock_error.call_count, 1)
+
+    @patch("builtins.print")
+    @patch("logging.error")
+    def test_file_and_link_errors_are_counted(self, mock_error, _):
+        chmod = os.chmod
+
+        def chmod_mock(path, mode):
+            if str(path).endswith("doc.txt.tmp") or ".doc.txt." in str(path):
+                raise PermissionError
+            chmod(path, mode)
+
+        with patch("os.readlink", side_effect=PermissionError), patch("os.chmod", side_effect=chmod_mock):
+            self.assertEqual(self.run_copy(), 23)
+        self.assertEqual(mock_error.call_count, 2)
+        self.assertEqual(list((self.backup / "foo").glob(".*.tmp")), [])
+
+    @patch("builtins.print")
+    @patch("logging.error")
+    def test_delete_errors_are_counted(self, mock_error, _):
+        self.run_copy()
+        (self.backup / "foo" / "extraneous.txt").write_text("extraneous", encoding="utf-8")
+        with patch("os.unlink", side_effect=PermissionError):
+            self.assertEqual(self.run_copy("--delete"), 23)
+        mock_error.assert_called_once()
+
+    @patch("builtins.print")
+    @patch("logging.error")
+    def test_entries_deleted_during_the_copy_are_counted(self, mock_error, _):
+        stat = os.stat
+
+        def stat_mock(path, *args, **kwargs):
+            if Path(path) == self.source / "Documents":
+                raise FileNotFoundError(path)
+            return stat(path, *args, **kwargs)
+
+        with patch("os.stat", side_effect=stat_mock):
+            self.assertEqual(self.run_copy(), 23)
+        mock_error.assert_called_once()
+        self.assertEqual((self.backup / "foo" / "top.txt").read_text(encoding="utf-8"), "top")
+
+    @patch("builtins.print")
+    @patch("logging.error")
+    def test_directory_attribute_errors_are_counted(self, mock_error, _):
+        with patch("os.utime", side_effect=PermissionError):
+            self.assertEqual(self.run_copy(), 23)
+        self.assertGreaterEqual(mock_error.call_count, 4)
+
+    @patch("builtins.print")
+    @patch("os.chown")
+    def test_ownership_is_copied_when_run_as_root(self, mock_chown, _):
+        with patch("os.geteuid", return_value=0):
+            self.run_copy()
+        owner = (self.source.stat().st_uid, self.source.stat().st_gid)
+        self.assertEqual(
+            {(chown.args[1:], chown.kwargs["follow_symlinks"]) for chown in mock_chown.call_args_list}, {(owner, False)}
+        )
+        chowned = sorted(chown.args[0].name for chown in mock_chown.call_args_list)
+        self.assertEqual(
+            [name for name in chowned if not name.endswith(".tmp")], [".cache", "Documents", "deep", "foo"]
+        )
+        self.assertEqual(
+            sorted(name.split(".")[1] for name in chowned if name.endswith(".tmp")), ["cached", "doc", "link", "top"]
+        )
+        mock_chown.reset_mock()
+        os.utime(self.source / "top.txt", ns=(0, 0))
+        with patch("os.geteuid", return_value=1000):
+            self.run_copy()
+        mock_chown.assert_not_called()
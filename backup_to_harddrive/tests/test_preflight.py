@@ -0,0 +1,123 @@
+"""Unit tests for the pre-flight check of the harddrives."""
+
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from backup_to_harddrive.config import BackupConfig, RunConfig
+from backup_to_harddrive.manifest import ManifestEntry
+from backup_to_harddrive.preflight import (
+    DriveCheck,
+    TransferPlan,
+    check_harddrive,
+    get_jobs_in_plan_order,
+    get_transfer_plan,
+    measure_write_throughput,
+    skip_failed_harddrives_of,
+)
+from backup_to_harddrive.scheduler import BackupJob
+
+
+class TestCheckHarddrive(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.addCleanup(self.temporary_directory.cleanup)
+        self.harddrive = Path(self.temporary_directory.name)
+
+    def test_usable_harddrive(self):
+        with self.assertLogs(level="INFO"):
+            drive_check = check_harddrive(self.harddrive, 1000, set())
+        self.assertIsNone(drive_check.problem)
+        self.assertGreater(drive_check.free_bytes, 1000)
+        self.assertGreater(drive_check.throughput, 0)
+        self.assertEqual(os.listdir(self.harddrive), [])
+
+    @patch("backup_to_harddrive.preflight.measure_write_throughput")
+    def test_dry_run_writes_no_sample(self, mock_measure):
+        drive_check = check_harddrive(self.harddrive, 1000, set(), dry_run=True)
+        self.assertIsNone(drive_check.problem)
+        self.assertEqual(drive_check.throughput, 0)
+        mock_measure.assert_not_called()
+        with patch("backup_to_harddrive.preflight.os.access", return_value=False):
+            self.assertEqual(check_harddrive(self.harddrive, 0, set(), dry_run=True).problem, "not writable")
+
+    def test_unmounted_harddrive(self):
+        drive_check = check_harddrive(self.harddrive, 0, {os.stat(self.harddrive).st_dev})
+        self.assertTrue(drive_check.problem.startswith("not mounted"))
+        self.assertTrue(check_harddrive(self.harddrive / "missing", 0, set()).problem.startswith("not mounted"))
+
+    def test_full_harddrive(self):
+        drive_check = check_harddrive(self.harddrive, 2**62, set())
+        self.assertTrue(drive_check.problem.startswith("not enough free space"))
+        self.assertEqual(drive_check.throughput, 0)
+
+    def test_read_only_harddrive(self):
+        with patch("backup_to_harddrive.preflight.tempfile.NamedTemporaryFile", side_effect=PermissionError("denied")):
+            with self.assertLogs(level="ERROR"):
+                self.assertIsNone(measure_write_throughput(self.harddrive))
+            with self.assertLogs(level="ERROR"):
+                self.assertEqual(check_harddrive(self.harddrive, 0, set()).problem, "not writable")
+
+
+class TestPlan(unittest.TestCase):
+    def test_get_transfer_plan(self):
+        live = {
+            "same": ManifestEntry(size=10, mtime_ns=1, inode=1),
+            "changed": ManifestEntry(size=20, mtime_ns=2, inode=2),
+            "new": ManifestEntry(size=30, mtime_ns=3, inode=3),
+        }
+        backed_up = {
+            "same": ManifestEntry(size=10, mtime_ns=1, inode=9),
+            "changed": ManifestEntry(size=20, mtime_ns=1, inode=2),
+            "deleted": ManifestEntry(size=40, mtime_ns=4, inode=4),
+        }
+        self.assertEqual(get_transfer_plan(live, backed_up), TransferPlan(1, 1, 1, 50))
+
+    def test_skip_failed_harddrives_of(self):
+        run_config = RunConfig(
+            backup_configs=[
+                BackupConfig(Path("/home/foo"), [Path("/media/hd1"), Path("/media/hd2")], [], []),
+                BackupConfig(Path("/home/bar"), [Path("/media/hd2")], [], []),
+            ]
+        )
+        drive_checks = {
+            Path("/media/hd1"): DriveCheck(Path("/media/hd1")),
+            Path("/media/hd2"): DriveCheck(Path("/media/hd2"), problem="not writable"),
+        }
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(skip_failed_harddrives_of(run_config, drive_checks))
+        self.assertEqual(
+            [backup_config.list_of_harddrive for backup_config in run_config.backup_configs], [[Path("/media/hd1")]]
+        )
+        self.assertTrue(skip_failed_harddrives_of(run_config, {}))
+
+    def test_jobs_of_the_slowest_harddrives_start_first(self):
+        jobs = [
+            BackupJob(command=["rsync", "foo", "hd1"], source=Path("foo"), harddrive=Path("/media/hd1")),
+            BackupJob(command=["rsync", "hd1", "hd2"], source=Path("/media/hd1"), harddrive=Path("/media/hd2")),
+            BackupJob(command=["rsync", "bar", "hd3"], source=Path("bar"), harddrive=Path("/media/hd3")),
+            BackupJob(command=["rsync", "baz", "hd4"], source=Path("baz"), harddrive=Path("/media/hd4")),
+        ]
+        jobs[1].depends_on = 0
+        drive_checks = {
+            Path("/media/hd1"): DriveCheck(Path("/media/hd1"), needed_bytes=100, throughput=100.0),
+            Path("/media/hd2"): DriveCheck(Path("/media/hd2"), needed_bytes=100, throughput=10.0),
+            Path("/media/hd3"): DriveCheck(Path("/media/hd3"), needed_bytes=100, throughput=50.0),
+        }
+        ordered_jobs = get_jobs_in_plan_order(jobs, drive_checks)
+        self.assertEqual([job.harddrive.name for job in ordered_jobs], ["hd2", "hd3", "hd1", "hd4"])
+        self.assertEqual(ordered_jobs[0].depends_on, 2)
+
+    def test_without_throughput_the_jobs_needing_the_most_bytes_start_first(self):
+        jobs = [
+            BackupJob(command=["rsync", "foo", "hd1"], source=Path("foo"), harddrive=Path("/media/hd1")),
+            BackupJob(command=["rsync", "foo", "hd2"], source=Path("foo"), harddrive=Path("/media/hd2")),
+        ]
+        drive_checks = {
+            Path("/media/hd1"): DriveCheck(Path("/media/hd1"), needed_bytes=100),
+            Path("/media/hd2"): DriveCheck(Path("/media/hd2"), needed_bytes=300),
+        }
+        ordered_jobs = get_jobs_in_plan_order(jobs, drive_checks)
+        self.assertEqual([job.harddrive.name for job in ordered_jobs], ["hd2", "hd1"])
@@ -0,0 +1,146 @@
+"""Unit tests for the restore of the sources from their backups."""
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from backup_to_harddrive.config import BackupConfig, RunConfig
+from backup_to_harddrive.dedup_store import backup_to_store, get_path_to_run_manifest
+from backup_to_harddrive.restore import (
+    get_restore_tasks_of,
+    restore_from_config_file,
+    restore_single_entry,
+)
+
+
+class TestRestore(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.addCleanup(self.temporary_directory.cleanup)
+        root = Path(self.temporary_directory.name)
+        self.source = root / "foo"
+        self.harddrives = [root / "hd1", root / "hd2"]
+        self.backup_path = self.harddrives[1] / "Backup" / socket.gethostname()
+        (self.source / "Documents").mkdir(parents=True)
+        (self.source / "Music").mkdir()
+        (self.source / "Documents" / "doc.txt").write_text("document", encoding="utf-8")
+        (self.source / "Music" / "song.flac").write_bytes(b"song" * 1000)
+        (self.source / "link").symlink_to("Music")
+        self.backup_config = BackupConfig(
+            source=self.source,
+            list_of_harddrive=self.harddrives,
+            list_of_excluded_folders=[],
+            quick_restore_path=[self.source / "Documents"],
+        )
+        patcher = patch("backup_to_harddrive.restore.extract_valid_configuration_from_config_file")
+        patcher.start().return_value = RunConfig(backup_configs=[self.backup_config])
+        self.addCleanup(patcher.stop)
+        self.destination = root / "restored"
+        self.restored = self.destination / "foo"
+
+    def assert_restored(self):
+        """Check that the source was restored."""
+        self.assertEqual((self.restored / "Documents" / "doc.txt").read_text(encoding="utf-8"), "document")
+        self.assertEqual((self.restored / "Music" / "song.flac").read_bytes(), b"song" * 1000)
+        self.assertEqual(os.readlink(self.restored / "link"), "Music")
+
+    def test_quick_restore_paths_come_first(self):
+        self.backup_path.mkdir(parents=True)
+        tasks = get_restore_tasks_of([self.backup_config, self.backup_config], None, None)
+        self.assertEqual([task.relative_path for task in tasks], ["Documents", "Documents", "", ""])
+        self.assertEqual(tasks[0].harddrive, self.harddrives[1])
+        self.assertEqual(tasks[0].destination, self.source)
+
+    def test_restore_from_directory(self):
+        shutil.copytree(self.source, self.backup_path / "foo", symlinks=True)
+        (self.restored / "Music").mkdir(parents=True)
+        (self.restored / "Music" / "song.flac").write_bytes(b"changed since")
+        with self.assertLogs(level="INFO") as logs:
+            self.assertEqual(restore_from_config_file(destination=self.destination), 0)
+        self.assertEqual(
+            [record.getMessage() for record in logs.records[:2]],
+            [
+                f"Restoring {self.restored / 'Documents'} from {self.harddrives[1]}",
+                f"Restoring {self.restored} from {self.harddrives[1]}",
+            ],
+        )
+        self.assertEqual((self.restored / "Music" / "song.flac").read_bytes(), b"changed since")
+        (self.restored / "Music" / "song.flac").unlink()
+        with self.assertLogs(level="INFO"):
+            self.assertEqual(restore_from_config_file(destination=self.destination), 0)
+        self.assert_restored()
+
+    def test_quick_restore_paths_of_files_and_links(self):
+        shutil.copytree(self.source, self.backup_path / "foo", symlinks=True)
+        self.backup_config.quick_restore_path = [self.source / "Documents" / "doc.txt", self.source / "link"]
+        with self.assertLogs(level="INFO") as logs:
+            self.assertEqual(restore_from_config_file(destination=self.destination), 0)
+        self.assertEqual(
+            [record.getMessage() for record in logs.records[:3]],
+            [
+                f"Restoring {self.restored / 'Documents' / 'doc.txt'} from {self.harddrives[1]}",
+                f"Restoring {self.restored / 'link'} from {self.harddrives[1]}",
+                f"Restoring {self.restored} from {self.harddrives[1]}",
+            ],
+        )
+        self.assert_restored()
+        (self.restored / "Documents" / "doc.txt").write_text("changed since", encoding="utf-8")
+        restore_single_entry(
+            self.backup_path / "foo" / "Documents" / "doc.txt", self.restored / "Documents" / "doc.txt"
+        )
+        self.assertEqual((self.restored / "Documents" / "doc.txt").read_text(encoding="utf-8"), "changed since")
+
+    def test_quick_restore_path_of_a_file_that_cannot_be_restored(self):
+        self.destination.write_text("not a directory", encoding="utf-8")
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(restore_single_entry(self.source / "link", self.restored / "link"), 1)
+
+    def test_restore_from_snapshot(self):
+        self.backup_config.snapshot = True
+        shutil.copytree(self.source, self.backup_path / "2024-01-01_00-00-00" / "foo", symlinks=True)
+        (self.backup_path / "2024-01-01_00-00-00" / ".complete_foo").touch()
+        with self.assertLogs(level="INFO"):
+            self.assertEqual(restore_from_config_file(harddrive=self.harddrives[1], destination=self.destination), 0)
+        self.assert_restored()
+
+    def test_restore_from_store(self):
+        self.backup_config.target_format = "dedup"
+        manifest_path = get_path_to_run_manifest(self.backup_path, "2024-01-01_00-00-00", "foo")
+        backup_to_store(self.source, self.harddrives[1] / "Backup" / ".store", manifest_path, None, [])
+        with self.assertLogs(level="INFO"):
+            self.assertEqual(restore_from_config_file(destination=self.destination), 0)
+        self.assert_restored()
+        (self.restored / "Documents" / "doc.txt").write_text("changed since", encoding="utf-8")
+        with (
+            self.assertLogs(level="INFO"),
+            patch("backup_to_harddrive.dedup_store.restore_entry") as mock_restore_entry,
+        ):
+            self.assertEqual(restore_from_config_file(destination=self.destination), 0)
+        self.assertEqual(
+            sorted(call.args[2] for call in mock_restore_entry.call_args_list),
+            [self.restored / "Documents", self.restored / "Documents", self.restored / "Music"],
+        )
+        shutil.rmtree(self.restored / "Music")
+        (self.restored / "Music").write_text("not a directory", encoding="utf-8")
+        with self.assertLogs(level="ERROR") as logs:
+            self.assertEqual(restore_from_config_file(destination=self.destination), 1)
+        self.assertEqual(logs.records[-1].getMessage(), "Restore incomplete: 2 entries could not be restored")
+
+    def test_nothing_to_restore(self):
+        with self.assertLogs(level="ERROR") as logs:
+            self.assertEqual(restore_from_config_file(), 1)
+        self.assertEqual(logs.records[0].getMessage(), f"No harddrive holds a backup of {self.source}")
+        (self.backup_path / "foo").mkdir(parents=True)
+        self.backup_config.target_format = "dedup"
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(restore_from_config_file(), 1)
+        self.backup_config.target_format = "directory"
+        with self.assertLogs(level="ERROR") as logs:
+            self.assertEqual(restore_from_config_file(destination=self.destination), 1)
+        self.assertEqual(
+            logs.records[0].getMessage(), f"No backup of {self.source / 'Documents'} on {self.harddrives[1]}"
+        )
@@ -0,0 +1,74 @@
+"""Unit tests for the journal of the jobs finished by a run."""
+
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from backup_to_harddrive.run_journal import (
+    RunJournal,
+    add_journal_recording_to,
+    get_job_key,
+    get_path_to_run_journal,
+    get_unfinished_jobs,
+    read_run_journal,
+    remove_run_journal,
+    start_run_journal,
+)
+from backup_to_harddrive.scheduler import BackupJob
+
+
+class TestRunJournal(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.journal_path = Path(self.temporary_directory.name) / "config" / "run_journal.jsonl"
+        self.jobs = [
+            BackupJob(command=["rsync", "foo", "hd1"], source=Path("foo"), harddrive=Path("/media/hd1")),
+            BackupJob(command=["rsync", "bar", "hd1"], source=Path("bar"), harddrive=Path("/media/hd1")),
+        ]
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    @patch("backup_to_harddrive.run_journal.user_config_dir", return_value="/home/foo/.config/backup_to_harddrive")
+    def test_get_path_to_run_journal(self, _):
+        self.assertEqual(get_path_to_run_journal(), Path("/home/foo/.config/backup_to_harddrive/run_journal.jsonl"))
+
+    def test_finished_jobs_are_recorded(self):
+        on_success = MagicMock()
+        self.jobs[0].on_success = on_success
+        start_run_journal(self.journal_path, "2024-01-02_03-04-05", "2024-01-02T03:04:05")
+        add_journal_recording_to(self.jobs, self.journal_path)
+        self.jobs[0].on_success()
+        on_success.assert_called_once()
+        with open(self.journal_path, "a", encoding="utf-8") as file:
+            file.write('{"finished": "torn')
+        self.assertEqual(
+            read_run_journal(self.journal_path),
+            RunJournal("2024-01-02_03-04-05", "2024-01-02T03:04:05", {get_job_key(self.jobs[0])}),
+        )
+        remove_run_journal(self.journal_path)
+        self.assertIsNone(read_run_journal(self.journal_path))
+
+    def test_job_is_not_recorded_if_its_on_success_fails(self):
+        self.jobs[0].on_success = MagicMock(side_effect=OSError)
+        start_run_journal(self.journal_path, "2024-01-02_03-04-05", "2024-01-02T03:04:05")
+        add_journal_recording_to(self.jobs, self.journal_path)
+        with self.assertRaises(OSError):
+            self.jobs[0].on_success()
+        self.assertEqual(read_run_journal(self.journal_path).finished, set())
+
+    def test_journal_without_header(self):
+        self.journal_path.parent.mkdir()
+        self.journal_path.write_text("", encoding="utf-8")
+        with self.assertLogs(level="ERROR"):
+            self.assertIsNone(read_run_journal(self.journal_path))
+
+    def test_get_unfinished_jobs(self):
+        self.jobs.append(
+            BackupJob(command=["rsync", "hd1", "hd2"], source=Path("/media/hd1"), harddrive=Path("/media/hd2"))
+        )
+        self.jobs[2].depends_on = 1
+        unfinished_jobs = get_unfinished_jobs(self.jobs, {get_job_key(self.jobs[0])})
+        self.assertEqual(unfinished_jobs, self.jobs[1:])
+        self.assertEqual(unfinished_jobs[1].depends_on, 0)
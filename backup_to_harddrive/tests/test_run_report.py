@@ -0,0 +1,67 @@
+"""Unit test of run report module."""
+
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from backup_to_harddrive.run_report import (
+    RunReport,
+    SourceReport,
+    append_run_report,
+    format_run_report,
+    get_path_to_run_reports,
+    read_last_run_reports,
+)
+
+
+def report_started_at(started_at: str, complete: bool = True) -> RunReport:
+    """Build a run report with a single source."""
+    return RunReport(
+        hostname="host",
+        harddrive="/media/hd1",
+        started_at=started_at,
+        ended_at=started_at,
+        complete=complete,
+        sources=[SourceReport(source="/home/foo", duration_seconds=1.5, bytes_transferred=10, files_transferred=2)],
+    )
+
+
+class TestRunReports(unittest.TestCase):
+    def setUp(self):
+        """Set up the test case."""
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.reports_path = get_path_to_run_reports(Path(self.temporary_directory.name) / "Backup" / "host")
+
+    def tearDown(self):
+        """Tear down the test case."""
+        self.temporary_directory.cleanup()
+
+    def test_get_path_to_run_reports(self):
+        self.assertEqual(get_path_to_run_reports(Path("/media/hd1/Backup/host")).name, "run_reports.jsonl")
+
+    def test_missing_reports(self):
+        self.assertEqual(read_last_run_reports(self.reports_path, 10), [])
+
+    def test_last_reports_are_read_oldest_first(self):
+        for index in range(5):
+            append_run_report(self.reports_path, report_started_at(f"2024-01-0{index + 1}"))
+        reports = read_last_run_reports(self.reports_path, 2)
+        self.assertEqual([report["started_at"] for report in reports], ["2024-01-04", "2024-01-05"])
+        self.assertEqual(reports[0]["sources"][0]["bytes_transferred"], 10)
+        self.assertEqual(read_last_run_reports(self.reports_path, 0), [])
+
+    @patch("backup_to_harddrive.run_report.HISTORY_READ_BLOCK_SIZE", 16)
+    def test_reports_spanning_several_blocks_and_corrupt_lines(self):
+        append_run_report(self.reports_path, report_started_at("2024-01-01"))
+        with open(self.reports_path, "a", encoding="utf-8") as file:
+            file.write("{truncated\n")
+        append_run_report(self.reports_path, report_started_at("2024-01-02"))
+        reports = read_last_run_reports(self.reports_path, 3)
+        self.assertEqual([report["started_at"] for report in reports], ["2024-01-01", "2024-01-02"])
+
+    def test_format_run_report(self):
+        append_run_report(self.reports_path, report_started_at("2024-01-01", complete=False))
+        line = format_run_report(read_last_run_reports(self.reports_path, 1)[0])
+        self.assertEqual(line, "2024-01-01  INCOMPLETE  1 source(s)  1.5s  10 bytes  2 files")
+        self.assertIn("complete", format_run_report({"started_at": "2024-01-02", "complete": True}))
@@ -0,0 +1,56 @@
+"""Unit tests for the cache of the scans of the sources and backups."""
+
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from backup_to_harddrive.scan_cache import (
+    SOURCE_SCAN_MAX_AGE_IN_SECONDS,
+    get_cached_scan_of_backup,
+    get_cached_scan_of_source,
+    remove_cached_scans_of,
+)
+
+
+class TestScanCache(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.addCleanup(self.temporary_directory.cleanup)
+        root = Path(self.temporary_directory.name)
+        self.source = root / "foo"
+        self.harddrive = root / "hd1"
+        self.backup_directory = self.harddrive / "Backup" / "host" / "foo"
+        self.source.mkdir()
+        self.backup_directory.mkdir(parents=True)
+        (self.source / "a.txt").write_text("a", encoding="utf-8")
+        (self.backup_directory / "a.txt").write_text("a", encoding="utf-8")
+        patcher = patch("backup_to_harddrive.scan_cache.user_cache_dir", return_value=str(root / "cache"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_recent_source_scan_is_reused(self):
+        self.assertEqual(list(get_cached_scan_of_source(self.source, [])), ["a.txt"])
+        (self.source / "b.txt").write_text("b", encoding="utf-8")
+        self.assertEqual(list(get_cached_scan_of_source(self.source, [])), ["a.txt"])
+        self.assertEqual(sorted(get_cached_scan_of_source(self.source, [self.source / "c"])), ["a.txt", "b.txt"])
+        with patch(
+            "backup_to_harddrive.scan_cache.time.time", return_value=time.time() + SOURCE_SCAN_MAX_AGE_IN_SECONDS
+        ):
+            self.assertEqual(sorted(get_cached_scan_of_source(self.source, [])), ["a.txt", "b.txt"])
+
+    def test_backup_scan_is_reused_until_a_run(self):
+        self.assertEqual(list(get_cached_scan_of_backup(self.harddrive, self.backup_directory)), ["a.txt"])
+        (self.backup_directory / "b.txt").write_text("b", encoding="utf-8")
+        self.assertEqual(list(get_cached_scan_of_backup(self.harddrive, self.backup_directory)), ["a.txt"])
+        remove_cached_scans_of([self.harddrive])
+        self.assertEqual(sorted(get_cached_scan_of_backup(self.harddrive, self.backup_directory)), ["a.txt", "b.txt"])
+
+    def test_backup_scan_depends_on_the_harddrive_timestamp(self):
+        get_cached_scan_of_backup(self.harddrive, self.backup_directory)
+        (self.backup_directory / "b.txt").write_text("b", encoding="utf-8")
+        (self.harddrive / "Backup" / "timestamp.txt").write_text("2024-01-01", encoding="utf-8")
+        os.utime(self.harddrive / "Backup" / "timestamp.txt", ns=(1, 1))
+        self.assertEqual(sorted(get_cached_scan_of_backup(self.harddrive, self.backup_directory)), ["a.txt", "b.txt"])
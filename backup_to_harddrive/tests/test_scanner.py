@@ -0,0 +1,67 @@
+"""Unit tests for the parallel scanner of the source trees."""
+
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from parameterized import parameterized
+
+from backup_to_harddrive.filters import compile_exclusion_filter
+from backup_to_harddrive.scanner import ScannedFile, scan_files
+
+
+class TestScanFiles(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.addCleanup(self.temporary_directory.cleanup)
+        self.source = Path(self.temporary_directory.name) / "foo"
+        for directory in ["a/b/c", "a/d", ".cache/e", "empty"]:
+            (self.source / directory).mkdir(parents=True)
+        for index, file_path in enumerate(["top.txt", "a/one.txt", "a/b/c/deep.txt", "a/d/two.txt", ".cache/e/x"]):
+            (self.source / file_path).write_bytes(b"0" * index)
+        (self.source / "link").symlink_to("a")
+
+    @parameterized.expand([[1, 4096], [4, 4096], [None, 4096], [1, 1], [4, 1]])
+    def test_scan_files(self, threads, batch_size):
+        with patch("backup_to_harddrive.scanner.SCAN_BATCH_SIZE", batch_size):
+            scanned_files = sorted(scan_files(self.source, [self.source / ".cache"], threads))
+        self.assertEqual(
+            [scanned_file.path for scanned_file in scanned_files],
+            ["a/b/c/deep.txt", "a/d/two.txt", "a/one.txt", "link", "top.txt"],
+        )
+        deep_stat = os.lstat(self.source / "a" / "b" / "c" / "deep.txt")
+        self.assertEqual(
+            scanned_files[0],
+            ScannedFile("a/b/c/deep.txt", 2, deep_stat.st_mtime_ns, deep_stat.st_ino, deep_stat.st_mode),
+        )
+
+    def test_scan_files_with_patterns(self):
+        exclusion_filter = compile_exclusion_filter(self.source, [], ["b/", "/top.txt", "one.*", "re:\\.cache/.*"])
+        self.assertEqual(
+            sorted(scanned_file.path for scanned_file in scan_files(self.source, exclusion_filter)),
+            ["a/d/two.txt", "link"],
+        )
+
+    def test_unreadable_directory(self):
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(list(scan_files(self.source / "top.txt", [])), [])
+
+    def test_vanished_file(self):
+        entry = MagicMock(path=str(self.source / "vanished"))
+        entry.is_dir.return_value = False
+        entry.stat.side_effect = FileNotFoundError("vanished")
+        with patch("backup_to_harddrive.scanner.os.scandir") as mock_scandir:
+            mock_scandir.return_value.__enter__.return_value = [entry]
+            self.assertEqual(list(scan_files(self.source, [])), [])
+
+    def test_unreadable_entry(self):
+        unreadable_entry = MagicMock(path=str(self.source / "unreadable"))
+        unreadable_entry.is_dir.side_effect = PermissionError("denied")
+        readable_entry = MagicMock(path=str(self.source / "readable"))
+        readable_entry.is_dir.return_value = False
+        readable_entry.stat.return_value = os.stat_result((0o100644, 7, 0, 1, 0, 0, 3, 0, 0, 0))
+        with patch("backup_to_harddrive.scanner.os.scandir") as mock_scandir, self.assertLogs(level="WARNING"):
+            mock_scandir.return_value.__enter__.return_value = [unreadable_entry, readable_entry]
+            self.assertEqual([scanned_file.path for scanned_file in scan_files(self.source, [])], ["readable"])
@@ -0,0 +1,342 @@
+"""Unit tests for the scheduler of backup jobs."""
+
+import asyncio
+import os
+import signal
+import sys
+import threading
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from backup_to_harddrive.scheduler import (
+    BackupJob,
+    JobLimits,
+    RunContext,
+    get_device_id,
+    get_devices_used_by,
+    get_governor_for,
+    install_shutdown_handlers,
+    read_io_counter_of,
+    run_job,
+    run_jobs_with_device_limits,
+    stop_process,
+)
+from backup_to_harddrive.telemetry import JobMetrics, TelemetrySink
+from backup_to_harddrive.throttle import Governor, signal_process_groups
+
+
+def stat_mock_generator(devices: dict):
+    """Generate a function that mocks os.stat returning a given st_dev per path.
+
+    Args:
+        devices (dict): Mapping from path string to st_dev.
+    Returns:
+        function: Function that mocks os.stat
+    """
+
+    def stat_mock(path):
+        return MagicMock(st_dev=devices[str(path)])
+
+    return stat_mock
+
+
+def python_command(code: str) -> list:
+    """Get the command running a Python snippet.
+
+    Args:
+        code (str): The Python code to run.
+    Returns:
+        list: The command.
+    """
+    return [sys.executable, "-c", code]
+
+
+class TestGetDeviceId(unittest.TestCase):
+    @patch("os.stat", side_effect=stat_mock_generator({"/home/foo": 42}))
+    def test_get_device_id(self, _):
+        self.assertEqual(get_device_id(Path("/home/foo")), "42")
+
+    @patch("os.stat", side_effect=FileNotFoundError)
+    def test_get_device_id_of_missing_path(self, _):
+        self.assertEqual(get_device_id(Path("/media/missing")), "/media/missing")
+
+    @patch("os.stat", side_effect=stat_mock_generator({"/home/foo": 1, "/media/hd1": 2}))
+    def test_get_devices_used_by(self, _):
+        job = BackupJob(command=[], source=Path("/home/foo"), harddrive=Path("/media/hd1"))
+        self.assertEqual(get_devices_used_by(job), frozenset(["1", "2"]))
+
+
+class TestRunJobsWithDeviceLimits(unittest.TestCase):
+    def setUp(self):
+        self.devices = {"/home/foo": 1, "/home/bar": 1, "/opt/baz": 2, "/media/hd1": 10, "/media/hd2": 20}
+        self.return_codes = {}
+        self.running = set()
+        self.running_when_started = {}
+        patcher = patch("backup_to_harddrive.scheduler.run_job", side_effect=self.run_job_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def run_job_mock(self, job, *_):
+        """Record the jobs running when a job starts and terminate it once every other job had a chance to start."""
+        name = job.command[0]
+        job.metrics = JobMetrics(source=str(job.source), harddrive=str(job.harddrive))
+        self.running.add(name)
+        self.running_when_started[name] = sorted(self.running)
+        for _ in range(len(self.running_when_started) + 1):
+            await asyncio.sleep(0)
+        self.running.remove(name)
+        return self.return_codes.get(name, 0)
+
+    def run_jobs(self, jobs, **kwargs):
+        """Run the jobs with the mocked devices."""
+        with patch("os.stat", side_effect=stat_mock_generator(self.devices | {"/opt/baz": 2})):
+            return run_jobs_with_device_limits(jobs, **kwargs)
+
+    def test_jobs_sharing_a_device_are_serialized(self):
+        jobs = [
+            BackupJob(command=["a"], source=Path("/home/foo"), harddrive=Path("/media/hd1")),
+            BackupJob(command=["b"], source=Path("/home/bar"), harddrive=Path("/media/hd2")),
+            BackupJob(command=["c"], source=Path("/opt/baz"), harddrive=Path("/media/hd2")),
+        ]
+        self.assertEqual(self.run_jobs(jobs), [0, 0, 0])
+        # a and c do not share any device: they start together, b waits for both
+        self.assertEqual(self.running_when_started, {"a": ["a"], "c": ["a", "c"], "b": ["b"]})
+        self.assertEqual(list(self.running_when_started), ["a", "c", "b"])
+
+    def test_jobs_of_a_stream_group_share_their_devices(self):
+        jobs = [
+            BackupJob(command=["a"], source=Path("/home/foo"), harddrive=Path("/media/hd1"), stream_group="foo"),
+            BackupJob(command=["b"], source=Path("/home/foo"), harddrive=Path("/media/hd1"), stream_group="foo"),
+            BackupJob(command=["c"], source=Path("/home/bar"), harddrive=Path("/media/hd2"), stream_group="bar"),
+            BackupJob(command=["d"], source=Path("/home/foo"), harddrive=Path("/media/hd1"), stream_group="foo"),
+        ]
+        self.assertEqual(self.run_jobs(jobs), [0, 0, 0, 0])
+        # the streams of foo run together, bar shares the source device and waits for all of them
+        self.assertEqual(self.running_when_started["d"], ["a", "b", "d"])
+        self.assertEqual(self.running_when_started["c"], ["c"])
+
+    def test_global_limit_is_respected(self):
+        jobs = [
+            BackupJob(command=["a"], source=Path("/home/foo"), harddrive=Path("/media/hd1")),
+            BackupJob(command=["c"], source=Path("/opt/baz"), harddrive=Path("/media/hd2")),
+        ]
+        self.run_jobs(jobs, max_parallel_jobs=1)
+        self.assertEqual(self.running_when_started, {"a": ["a"], "c": ["c"]})
+
+    def test_return_codes_are_reported_in_job_order(self):
+        jobs = [
+            BackupJob(command=["a"], source=Path("/home/foo"), harddrive=Path("/media/hd1")),
+            BackupJob(command=["c"], source=Path("/opt/baz"), harddrive=Path("/media/hd2")),
+        ]
+        self.return_codes = {"a": 23}
+        self.assertEqual(self.run_jobs(jobs), [23, 0])
+        self.assertEqual([job.metrics.return_code for job in jobs], [23, 0])
+        self.assertTrue(all(job.metrics.ended_at is not None for job in jobs))
+
+    @patch("logging.error")
+    def test_on_success_is_only_called_for_successful_jobs(self, mock_log_error):
+        on_success = [MagicMock(), MagicMock(side_effect=OSError), MagicMock()]
+        jobs = [
+            BackupJob(command=["a"], source=Path("/home/foo"), harddrive=Path("/media/hd1"), on_success=on_success[0]),
+            BackupJob(command=["b"], source=Path("/home/foo"), harddrive=Path("/media/hd1"), on_success=on_success[1]),
+            BackupJob(command=["c"], source=Path("/home/foo"), harddrive=Path("/media/hd1"), on_success=on_success[2]),
+        ]
+        self.return_codes = {"c": 1}
+        self.assertEqual(self.run_jobs(jobs), [0, 0, 1])
+        on_success[0].assert_called_once()
+        on_success[1].assert_called_once()
+        on_success[2].assert_not_called()
+        mock_log_error.assert_called_once()
+
+    @patch("backup_to_harddrive.scheduler.get_disk_name_of", return_value="sda")
+    def test_governor_runs_with_adaptive_jobs(self, _):
+        jobs = [
+            BackupJob(command=["a"], source=Path("/home/foo"), harddrive=Path("/media/hd1"), adaptive_throttle=True)
+        ]
+        with patch("backup_to_harddrive.scheduler.run_governor") as mock_run_governor:
+            self.assertEqual(self.run_jobs(jobs), [0])
+        self.assertEqual(mock_run_governor.call_args.args[0].disks, {"sda"})
+
+    def test_no_job(self):
+        self.assertEqual(self.run_jobs([]), [])
+
+    def test_job_waits_for_its_dependency(self):
+        jobs = [
+            BackupJob(command=["a"], source=Path("/home/foo"), harddrive=Path("/media/hd1")),
+            BackupJob(command=["c"], source=Path("/opt/baz"), harddrive=Path("/media/hd2"), depends_on=0),
+        ]
+        self.assertEqual(self.run_jobs(jobs), [0, 0])
+        self.assertEqual(self.running_when_started, {"a": ["a"], "c": ["c"]})
+
+    @patch("logging.error")
+    def test_jobs_depending_on_a_failed_job_are_skipped(self, mock_log_error):
+        jobs = [
+            BackupJob(command=["a"], source=Path("/home/foo"), harddrive=Path("/media/hd1")),
+            BackupJob(command=["b"], source=Path("/media/hd1"), harddrive=Path("/media/hd2"), depends_on=0),
+            BackupJob(command=["c"], source=Path("/media/hd2"), harddrive=Path("/opt/baz"), depends_on=1),
+        ]
+        self.return_codes = {"a": 23}
+        self.assertEqual(self.run_jobs(jobs), [23, None, None])
+        self.assertEqual(list(self.running_when_started), ["a"])
+        self.assertEqual(mock_log_error.call_count, 2)
+
+
+@patch("backup_to_harddrive.scheduler.TERMINATION_GRACE_PERIOD_IN_SECONDS", 1.0)
+@patch("backup_to_harddrive.scheduler.ACTIVITY_CHECK_INTERVAL_IN_SECONDS", 0.05)
+class TestRunJob(unittest.TestCase):
+    def setUp(self):
+        self.job = BackupJob(command=[], source=Path("/home/foo"), harddrive=Path("/media/hd1"))
+        self.governor = None
+
+    def resume_governed_jobs(self):
+        """Resume the jobs paused by the governor."""
+        self.governor.paused = False
+        signal_process_groups(self.governor.process_groups, signal.SIGCONT)
+
+    def run_job(self, code, limits=JobLimits(), telemetry=None, cancel_after=None):
+        """Run a Python snippet as the command of the job.
+
+        Args:
+            code (str): The Python code to run.
+            limits (JobLimits): The time limits of the job.
+            telemetry (Optional[TelemetrySink]): Where to write the metrics.
+            cancel_after (Optional[float]): Delay after which the run is cancelled, None to never cancel it.
+        Returns:
+            int: The return code of the job.
+        """
+        self.job.command = python_command(code)
+
+        async def run():
+            context = RunContext(telemetry=telemetry, limits=limits, governor=self.governor)
+            if cancel_after is not None:
+                asyncio.get_running_loop().call_later(cancel_after, context.shutdown.set)
+            if self.governor is not None:
+                asyncio.get_running_loop().call_later(0.5, self.resume_governed_jobs)
+            return await run_job(self.job, context)
+
+        return asyncio.run(run())
+
+    def test_output_is_captured_with_telemetry(self):
+        code = "print('Number of regular files transferred: 3')"
+        self.assertEqual(self.run_job(code, telemetry=TelemetrySink(None)), 0)
+        self.assertEqual(self.job.metrics.files_transferred, 3)
+        self.assertIsNone(self.job.metrics.stop_reason)
+
+    def test_output_is_parsed_without_telemetry(self):
+        self.assertEqual(self.run_job("print('Total transferred file size: 12 bytes')"), 0)
+        self.assertEqual(self.job.metrics.bytes_transferred, 12)
+
+    def test_job_running_too_long_is_stopped(self):
+        with self.assertLogs(level="ERROR"):
+            return_code = self.run_job("import time; time.sleep(30)", JobLimits(job_timeout=0.2))
+        self.assertEqual((return_code, self.job.metrics.stop_reason), (-signal.SIGTERM, "timeout"))
+
+    def test_stalled_job_is_stopped(self):
+        code = "import time\nfor _ in range(10):\n    print('.', flush=True)\n    time.sleep(0.05)\ntime.sleep(30)"
+        with self.assertLogs(level="ERROR"):
+            return_code = self.run_job(code, JobLimits(stall_timeout=0.3), TelemetrySink(None))
+        self.assertEqual((return_code, self.job.metrics.stop_reason), (-signal.SIGTERM, "stalled"))
+        self.assertGreaterEqual(self.job.metrics.elapsed_seconds, 0.5)
+
+    def test_job_ignoring_sigterm_is_killed_when_cancelled(self):
+        code = "import signal, time\nsignal.signal(signal.SIGTERM, signal.SIG_IGN)\nprint(flush=True)\ntime.sleep(30)"
+        with self.assertLogs(level="ERROR"):
+            return_code = self.run_job(code, telemetry=TelemetrySink(None), cancel_after=0.5)
+        self.assertEqual((return_code, self.job.metrics.stop_reason), (-signal.SIGKILL, "cancelled"))
+
+    def test_paused_job_is_not_stalled(self):
+        self.job.adaptive_throttle = True
+        self.governor = Governor(max_load=1, max_disk_latency_ms=0, disks=set(), paused=True)
+        self.assertEqual(self.run_job("print(flush=True)", JobLimits(stall_timeout=0.2), TelemetrySink(None)), 0)
+        self.assertIsNone(self.job.metrics.stop_reason)
+        self.assertGreaterEqual(self.job.metrics.elapsed_seconds, 0.4)
+        self.assertEqual(self.governor.process_groups, set())
+
+    def test_processes_left_running_are_stopped(self):
+        code = "import subprocess, sys\nsubprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])"
+        with self.assertLogs(level="WARNING") as logs:
+            self.assertEqual(self.run_job(code, telemetry=TelemetrySink(None)), 0)
+        self.assertIn("left running", logs.output[-1])
+
+
+class TestJobThatCannotStart(unittest.TestCase):
+    def test_jobs_depending_on_a_job_that_cannot_start_are_skipped(self):
+        jobs = [
+            BackupJob(command=["/nonexistent/rsync"], source=Path("/"), harddrive=Path("/")),
+            BackupJob(command=python_command("pass"), source=Path("/"), harddrive=Path("/"), depends_on=0),
+        ]
+        with self.assertLogs(level="ERROR") as logs:
+            self.assertEqual(run_jobs_with_device_limits(jobs), [127, None])
+        self.assertIn("Cannot start: /nonexistent/rsync", logs.output[0])
+        self.assertEqual(jobs[0].metrics.return_code, 127)
+
+
+class TestStopProcess(unittest.TestCase):
+    @patch("backup_to_harddrive.scheduler.TERMINATION_GRACE_PERIOD_IN_SECONDS", 0.01)
+    @patch("os.killpg", side_effect=ProcessLookupError)
+    def test_process_that_cannot_be_killed_is_abandoned(self, mock_killpg):
+        async def stop():
+            waiter = asyncio.create_task(asyncio.sleep(1))
+            return_code = await stop_process(MagicMock(pid=42, returncode=None), waiter)
+            waiter.cancel()
+            return return_code
+
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(asyncio.run(stop()), -signal.SIGKILL)
+        self.assertEqual(
+            [call.args[1] for call in mock_killpg.call_args_list],
+            [signal.SIGTERM, signal.SIGCONT, signal.SIGKILL, signal.SIGCONT],
+        )
+
+
+class TestShutdown(unittest.TestCase):
+    def test_running_jobs_are_stopped_and_pending_ones_skipped_on_sigterm(self):
+        code = "import os, signal, time\nos.kill(os.getppid(), signal.SIGTERM)\ntime.sleep(30)"
+        jobs = [
+            BackupJob(command=python_command(code), source=Path("/"), harddrive=Path("/")),
+            BackupJob(command=python_command(""), source=Path("/"), harddrive=Path("/")),
+        ]
+        with self.assertLogs(level="WARNING") as logs:
+            self.assertEqual(run_jobs_with_device_limits(jobs), [-signal.SIGTERM, None])
+        self.assertEqual(jobs[0].metrics.stop_reason, "cancelled")
+        self.assertIsNone(jobs[1].metrics)
+        self.assertIn("Received SIGTERM", logs.output[0])
+        self.assertIs(signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+
+    def test_no_handler_outside_of_the_main_thread(self):
+        handled = []
+        thread = threading.Thread(target=lambda: handled.append(asyncio.run(self.install_handlers())))
+        thread.start()
+        thread.join()
+        self.assertEqual(handled, [[]])
+
+    @staticmethod
+    async def install_handlers():
+        """Install the shutdown handlers in the running loop."""
+        return install_shutdown_handlers(asyncio.Event())
+
+
+class TestReadIoCounterOf(unittest.TestCase):
+    def test_read_io_counter_of(self):
+        self.assertIsInstance(read_io_counter_of(os.getpid()), int)
+        with patch("builtins.open", side_effect=PermissionError):
+            self.assertIsNone(read_io_counter_of(os.getpid()))
+
+
+class TestGetGovernorFor(unittest.TestCase):
+    @patch(
+        "backup_to_harddrive.scheduler.get_disk_name_of", side_effect=lambda path: {"/home/foo": "sda"}.get(str(path))
+    )
+    def test_get_governor_for(self, _):
+        jobs = [
+            BackupJob(command=["a"], source=Path("/home/foo"), harddrive=Path("/media/hd1"), adaptive_throttle=True),
+            BackupJob(command=["b"], source=Path("/tmpfs"), harddrive=Path("/media/hd1"), adaptive_throttle=True),
+            BackupJob(command=["c"], source=Path("/opt/baz"), harddrive=Path("/media/hd2")),
+        ]
+        self.assertIsNone(get_governor_for(jobs[2:], JobLimits()))
+        with patch("os.cpu_count", return_value=8):
+            self.assertEqual(get_governor_for(jobs, JobLimits()), Governor(8.0, 0, {"sda"}))
+        self.assertEqual(
+            get_governor_for(jobs, JobLimits(max_load=2, max_disk_latency_ms=50)), Governor(2, 50, {"sda"})
+        )
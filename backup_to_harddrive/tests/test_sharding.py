@@ -0,0 +1,103 @@
+"""Unit tests for the sharding of a source into parallel rsync streams."""
+
+import json
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from parameterized import parameterized
+
+from backup_to_harddrive.filters import compile_exclusion_filter
+from backup_to_harddrive.sharding import (
+    PER_FILE_WEIGHT_IN_BYTES,
+    SHARD_WEIGHT_MAX_AGE_IN_SECONDS,
+    get_path_to_shard_weights,
+    get_weights_of,
+    split_into_shards,
+)
+
+
+class TestSplitIntoShards(unittest.TestCase):
+    def test_heaviest_directories_go_to_the_lightest_shard(self):
+        self.assertEqual(split_into_shards({"a": 10, "b": 6, "c": 5, "d": 1}, 2), [["a", "d"], ["b", "c"]])
+
+    def test_empty_shards_are_left_out(self):
+        self.assertEqual(split_into_shards({"a": 10}, 3), [["a"]])
+        self.assertEqual(split_into_shards({}, 3), [])
+
+
+class TestGetWeightsOf(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        root = Path(self.temporary_directory.name)
+        self.source = root / "foo"
+        (self.source / "Music" / "Album").mkdir(parents=True)
+        (self.source / "Documents").mkdir()
+        (self.source / ".cache").mkdir()
+        (self.source / "Music" / "Album" / "song.flac").write_bytes(b"0" * 1000)
+        (self.source / "Documents" / "doc.txt").write_text("document", encoding="utf-8")
+        (self.source / "top.txt").write_text("top", encoding="utf-8")
+        (self.source / "link").symlink_to("Music")
+        self.patcher = patch("backup_to_harddrive.sharding.user_cache_dir", return_value=str(root / "cache"))
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.temporary_directory.cleanup()
+
+    def test_weights_of_top_level_directories(self):
+        weights = get_weights_of(self.source, [self.source / ".cache"])
+        self.assertEqual(weights, {"Documents": 8 + PER_FILE_WEIGHT_IN_BYTES, "Music": 1000 + PER_FILE_WEIGHT_IN_BYTES})
+        self.assertTrue(get_path_to_shard_weights(self.source).exists())
+
+    def test_cached_weights_are_reused(self):
+        get_weights_of(self.source, [])
+        (self.source / "Pictures").mkdir()
+        with patch("backup_to_harddrive.sharding.measure_weight_of", return_value=7) as mock_measure:
+            weights = get_weights_of(self.source, [])
+        mock_measure.assert_called_once_with(self.source / "Pictures", compile_exclusion_filter(self.source, []))
+        self.assertEqual(weights["Pictures"], 7)
+        self.assertEqual(weights["Music"], 1000 + PER_FILE_WEIGHT_IN_BYTES)
+
+    def test_changed_directory_is_measured_again(self):
+        get_weights_of(self.source, [])
+        (self.source / "Documents" / "new.txt").write_bytes(b"0" * 100)
+        weights = get_weights_of(self.source, [])
+        self.assertEqual(weights["Documents"], 108 + 2 * PER_FILE_WEIGHT_IN_BYTES)
+        self.assertEqual(weights["Music"], 1000 + PER_FILE_WEIGHT_IN_BYTES)
+
+    def test_expired_weights_are_measured_again(self):
+        get_weights_of(self.source, [])
+        with (
+            patch("backup_to_harddrive.sharding.time.time", return_value=time.time() + SHARD_WEIGHT_MAX_AGE_IN_SECONDS),
+            patch("backup_to_harddrive.sharding.measure_weight_of", return_value=7) as mock_measure,
+        ):
+            self.assertEqual(get_weights_of(self.source, []), {".cache": 7, "Documents": 7, "Music": 7})
+        self.assertEqual(mock_measure.call_count, 3)
+
+    @patch("backup_to_harddrive.sharding.get_top_level_directories_of", return_value=["Documents", "Removed"])
+    def test_removed_directory_is_left_out(self, _):
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(list(get_weights_of(self.source, [])), ["Documents"])
+
+    def test_dry_run_only_uses_the_cached_weights(self):
+        get_weights_of(self.source, [])
+        (self.source / "Pictures").mkdir()
+        with patch("backup_to_harddrive.sharding.measure_weight_of") as mock_measure:
+            weights = get_weights_of(self.source, [], dry_run=True)
+        mock_measure.assert_not_called()
+        self.assertEqual(weights["Pictures"], PER_FILE_WEIGHT_IN_BYTES)
+        self.assertNotIn("Pictures", json.loads(get_path_to_shard_weights(self.source).read_text(encoding="utf-8")))
+
+    @parameterized.expand(["{corrupt", "[]", '{"Documents": 1}'])
+    def test_corrupt_cache_is_ignored(self, content):
+        get_path_to_shard_weights(self.source).parent.mkdir(parents=True)
+        get_path_to_shard_weights(self.source).write_text(content, encoding="utf-8")
+        self.assertEqual(get_weights_of(self.source, [])["Documents"], 8 + PER_FILE_WEIGHT_IN_BYTES)
+
+    @patch("logging.warning")
+    def test_missing_source(self, mock_warning):
+        self.assertEqual(get_weights_of(self.source / "missing", []), {})
+        mock_warning.assert_called_once()
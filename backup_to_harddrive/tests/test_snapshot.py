@@ -0,0 +1,98 @@
+"""Unit tests for snapshots and their retention."""
+
+import datetime
+import tempfile
+import unittest
+from pathlib import Path
+
+from backup_to_harddrive.snapshot import (
+    get_latest_complete_snapshot_of,
+    get_snapshot_name,
+    list_snapshots_of,
+    mark_snapshot_as_complete,
+    prune_snapshots_of,
+    select_snapshots_to_keep,
+)
+
+
+class TestSelectSnapshotsToKeep(unittest.TestCase):
+    def test_no_snapshot(self):
+        self.assertEqual(select_snapshots_to_keep([], 7, 4, 6), set())
+
+    def test_latest_is_always_kept(self):
+        moments = [datetime.datetime(2024, 1, 1), datetime.datetime(2024, 1, 2)]
+        self.assertEqual(select_snapshots_to_keep(moments, 0, 0, 0), {datetime.datetime(2024, 1, 2)})
+
+    def test_daily_weekly_monthly(self):
+        # one snapshot at 8:00 and one at 20:00 every day of January to March 2024
+        moments = [
+            datetime.datetime(2024, 1, 1, hour) + datetime.timedelta(days=day) for day in range(91) for hour in (8, 20)
+        ]
+        kept = select_snapshots_to_keep(moments, keep_daily=3, keep_weekly=2, keep_monthly=3)
+        self.assertEqual(
+            sorted(kept),
+            [
+                datetime.datetime(2024, 1, 31, 20),  # end of January
+                datetime.datetime(2024, 2, 29, 20),  # end of February
+                datetime.datetime(2024, 3, 24, 20),  # end of the previous week (Sunday)
+                datetime.datetime(2024, 3, 29, 20),
+                datetime.datetime(2024, 3, 30, 20),
+                datetime.datetime(2024, 3, 31, 20),  # latest, last day, current week and current month
+            ],
+        )
+
+
+class TestSnapshotsOnHarddrive(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.backup_path = Path(self.temporary_directory.name) / "Backup" / "host"
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def create_snapshot(self, moment, source_name="foo", complete=True):
+        """Create a snapshot directory of a source."""
+        snapshot_path = self.backup_path / get_snapshot_name(moment)
+        (snapshot_path / source_name).mkdir(parents=True)
+        (snapshot_path / source_name / "file").write_text(source_name, encoding="utf-8")
+        if complete:
+            mark_snapshot_as_complete(self.backup_path, snapshot_path.name, source_name)
+        return snapshot_path
+
+    def test_no_backup_directory(self):
+        self.assertEqual(list_snapshots_of(self.backup_path, "foo"), [])
+        self.assertIsNone(get_latest_complete_snapshot_of(self.backup_path, "foo"))
+
+    def test_list_and_latest(self):
+        first = self.create_snapshot(datetime.datetime(2024, 1, 1))
+        self.create_snapshot(datetime.datetime(2024, 1, 2), source_name="bar")
+        self.create_snapshot(datetime.datetime(2024, 1, 3), complete=False)
+        (self.backup_path / "not_a_snapshot").mkdir()
+        self.assertEqual(
+            [moment for moment, _ in list_snapshots_of(self.backup_path, "foo")],
+            [datetime.datetime(2024, 1, 1), datetime.datetime(2024, 1, 3)],
+        )
+        self.assertEqual(get_latest_complete_snapshot_of(self.backup_path, "foo"), first)
+        self.assertEqual((self.backup_path / "latest_foo").resolve(), first / "foo")
+        self.assertEqual((self.backup_path / "latest_bar").resolve(), self.backup_path / "2024-01-02_00-00-00" / "bar")
+
+    def test_prune_without_complete_snapshot(self):
+        incomplete = self.create_snapshot(datetime.datetime(2024, 1, 1), complete=False)
+        prune_snapshots_of(self.backup_path, "foo", 0, 0, 0)
+        self.assertTrue(incomplete.exists())
+
+    def test_prune(self):
+        shared = self.create_snapshot(datetime.datetime(2024, 1, 1))
+        self.create_snapshot(datetime.datetime(2024, 1, 1), source_name="bar")
+        old = self.create_snapshot(datetime.datetime(2024, 1, 2))
+        interrupted = self.create_snapshot(datetime.datetime(2024, 1, 3), complete=False)
+        latest = self.create_snapshot(datetime.datetime(2024, 1, 4))
+        running = self.create_snapshot(datetime.datetime(2024, 1, 5), complete=False)
+        prune_snapshots_of(self.backup_path, "foo", 1, 0, 0)
+        self.assertFalse((shared / "foo").exists())
+        self.assertFalse((shared / ".complete_foo").exists())
+        self.assertTrue((shared / "bar").exists())
+        self.assertFalse(old.exists())
+        self.assertFalse(interrupted.exists())
+        self.assertTrue(latest.exists())
+        self.assertTrue(running.exists())
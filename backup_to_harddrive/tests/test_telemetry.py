@@ -0,0 +1,164 @@
+"""Unit tests for the telemetry parsed from the output of rsync."""
+
+import asyncio
+import io
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from parameterized import parameterized
+
+from backup_to_harddrive.telemetry import (
+    JobMetrics,
+    TelemetrySink,
+    collect_metrics_from,
+    emit_record,
+    emit_summary,
+    get_telemetry_sink_for,
+    parse_size,
+    update_metrics_from_line,
+)
+
+RSYNC_OUTPUT = (
+    b"sending incremental file list\n"
+    b"          1.23M  10%    1.00MB/s    0:00:01 (xfr#1, to-chk=9/10)\r"
+    b"         12.30M 100%   12.00MB/s    0:00:01 (xfr#10, to-chk=0/10)\n"
+    b"\n"
+    b"Number of files: 11 (reg: 10, dir: 1)\n"
+    b"Number of regular files transferred: 10\n"
+    b"Total file size: 12.30M bytes\n"
+    b"Total transferred file size: 12.30M bytes\n"
+    b"Total bytes sent: 12.31M\n"
+    b"Total bytes received: 210\n"
+    b"\n"
+    b"sent 12.31M bytes  received 210 bytes  8.21M bytes/sec\n"
+    b"total size is 12.30M  speedup is 1.00"
+)
+
+
+class TestParseSize(unittest.TestCase):
+    @parameterized.expand(
+        [
+            ["plain", "123", 123],
+            ["thousands separator", "1,234,567", 1234567],
+            ["kilo", "1.50K", 1500],
+            ["lower case kilo", "2.00k", 2000],
+            ["mega", "12.30M", 12300000],
+            ["giga", "1.5G", 1500000000],
+        ]
+    )
+    def test_parse_size(self, _, text, expected):
+        self.assertEqual(parse_size(text), expected)
+
+
+class TestUpdateMetricsFromLine(unittest.TestCase):
+    def test_progress_line(self):
+        metrics = JobMetrics(source="/home/foo", harddrive="/media/hd1")
+        self.assertTrue(
+            update_metrics_from_line(metrics, "      1,234,567  45%  123.45kB/s    0:00:10 (xfr#12, to-chk=1/9)")
+        )
+        self.assertEqual(
+            (metrics.bytes_transferred, metrics.percent, metrics.rate_bytes_per_second, metrics.files_transferred),
+            (1234567, 45, 123450, 12),
+        )
+
+    def test_progress_line_without_transfer(self):
+        metrics = JobMetrics(source="/home/foo", harddrive="/media/hd1")
+        self.assertTrue(update_metrics_from_line(metrics, "              0   0%    0.00kB/s    0:00:00"))
+        self.assertEqual(metrics.files_transferred, 0)
+
+    def test_other_line(self):
+        metrics = JobMetrics(source="/home/foo", harddrive="/media/hd1")
+        self.assertFalse(update_metrics_from_line(metrics, "sending incremental file list"))
+        self.assertEqual(metrics, JobMetrics(source="/home/foo", harddrive="/media/hd1", started_at=metrics.started_at))
+
+
+def collect_metrics_of_rsync_output(metrics: JobMetrics, read_size: int) -> int:
+    """Collect the metrics of RSYNC_OUTPUT, read by chunks.
+
+    Args:
+        metrics (JobMetrics): The metrics to update.
+        read_size (int): Maximum size of the chunks read.
+    Returns:
+        int: The number of chunks read.
+    """
+    chunks = []
+
+    async def collect() -> None:
+        stream = asyncio.StreamReader()
+        stream.feed_data(RSYNC_OUTPUT)
+        stream.feed_eof()
+        await collect_metrics_from(stream, metrics, TelemetrySink(None), lambda: chunks.append(1))
+
+    with patch("backup_to_harddrive.telemetry.READ_SIZE", read_size):
+        asyncio.run(collect())
+    return len(chunks)
+
+
+class TestCollectMetricsFrom(unittest.TestCase):
+    def test_collect_metrics_from_rsync_output(self):
+        metrics = JobMetrics(source="/home/foo", harddrive="/media/hd1")
+        with patch("backup_to_harddrive.telemetry.emit_record") as mock_emit:
+            with patch("backup_to_harddrive.telemetry.PROGRESS_RECORD_INTERVAL_IN_SECONDS", 0):
+                chunks = collect_metrics_of_rsync_output(metrics, 64)
+        self.assertEqual(chunks, -(-len(RSYNC_OUTPUT) // 64))
+        self.assertEqual(metrics.files_transferred, 10)
+        self.assertEqual(metrics.bytes_transferred, 12300000)
+        self.assertEqual(metrics.bytes_sent, 12310000)
+        self.assertEqual(metrics.percent, 100)
+        self.assertGreaterEqual(metrics.elapsed_seconds, 0)
+        self.assertGreaterEqual(mock_emit.call_count, 1)
+        self.assertEqual({call.args[1] for call in mock_emit.call_args_list}, {"progress"})
+
+    def test_progress_records_are_throttled(self):
+        metrics = JobMetrics(source="/home/foo", harddrive="/media/hd1")
+        with patch("backup_to_harddrive.telemetry.emit_record") as mock_emit:
+            collect_metrics_of_rsync_output(metrics, 65536)
+        mock_emit.assert_not_called()
+
+
+class TestEmitRecord(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.path = Path(self.temporary_directory.name) / "telemetry" / "metrics.jsonl"
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def test_emit_to_file(self):
+        sink = TelemetrySink(self.path)
+        emit_record(sink, "progress", JobMetrics(source="/home/foo", harddrive="/media/hd1", bytes_transferred=10))
+        emit_record(sink, "progress", JobMetrics(source="/home/foo", harddrive="/media/hd1", bytes_transferred=20))
+        records = [json.loads(line) for line in self.path.read_text(encoding="utf-8").splitlines()]
+        self.assertEqual([record["bytes_transferred"] for record in records], [10, 20])
+        self.assertEqual(records[0]["kind"], "progress")
+        self.assertEqual(records[0]["harddrive"], "/media/hd1")
+
+    def test_emit_to_standard_output(self):
+        with patch("sys.stdout", new_callable=io.StringIO) as mock_stdout:
+            emit_record(TelemetrySink(None), "summary", JobMetrics(source="/home/foo", harddrive="/media/hd1"))
+        self.assertEqual(json.loads(mock_stdout.getvalue())["kind"], "summary")
+
+    @patch("logging.info")
+    def test_emit_summary(self, mock_info):
+        sink = TelemetrySink(self.path)
+        metrics = JobMetrics(source="/home/foo", harddrive="/media/hd1", bytes_transferred=100, elapsed_seconds=4)
+        emit_summary(sink, metrics, 0)
+        record = json.loads(self.path.read_text(encoding="utf-8"))
+        self.assertEqual((record["kind"], record["return_code"], record["rate_bytes_per_second"]), ("summary", 0, 25))
+        mock_info.assert_called_once()
+
+    @patch("logging.info")
+    def test_emit_summary_of_instant_job(self, _):
+        metrics = JobMetrics(source="/home/foo", harddrive="/media/hd1", rate_bytes_per_second=5)
+        emit_summary(TelemetrySink(self.path), metrics, 23)
+        self.assertEqual((metrics.return_code, metrics.rate_bytes_per_second), (23, 5))
+
+
+class TestGetTelemetrySinkFor(unittest.TestCase):
+    def test_get_telemetry_sink_for(self):
+        self.assertIsNone(get_telemetry_sink_for(None))
+        self.assertIsNone(get_telemetry_sink_for(Path("-")).path)
+        self.assertEqual(get_telemetry_sink_for(Path("/tmp/metrics.jsonl")).path, Path("/tmp/metrics.jsonl"))
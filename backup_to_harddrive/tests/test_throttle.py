@@ -0,0 +1,161 @@
+"""Unit tests for the priority, the bandwidth limits and the adaptive throttling of the backup jobs."""
+
+import asyncio
+import os
+import signal
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from parameterized import parameterized
+
+from backup_to_harddrive.config import BackupConfig
+from backup_to_harddrive.throttle import (
+    Governor,
+    add_process_group_to,
+    get_disk_latency_ms,
+    get_disk_name_of,
+    get_prioritized_command,
+    read_disk_counters,
+    run_governor,
+    update_governor,
+)
+
+DISKSTATS = """   8       0 sda 1000 0 8000 500 2000 0 16000 1500 0 0 0 0 0 0 0 0 0
+   8       1 sda1 900 0 7200 450 1900 0 15200 1400 0 0 0 0 0 0 0 0 0
+ 259       0 nvme0n1 10 0 80 1 20 0 160 2 0 0 0 0 0 0 0 0 0
+"""
+
+
+class TestGetPrioritizedCommand(unittest.TestCase):
+    @parameterized.expand(
+        [
+            ["default", {}, ["rsync", "-av"]],
+            ["best effort", {"io_priority": "best-effort"}, ["ionice", "-c", "2", "-n", "7", "rsync", "-av"]],
+            [
+                "nice and bandwidth limit",
+                {"nice": 5, "bwlimit": 100},
+                ["nice", "-n", "5", "rsync", "--bwlimit=100", "-av"],
+            ],
+        ]
+    )
+    def test_get_prioritized_command(self, _, settings, expected_command):
+        backup_config = BackupConfig(
+            source=Path("/home/foo"),
+            list_of_harddrive=[],
+            list_of_excluded_folders=[],
+            quick_restore_path=[],
+            **settings,
+        )
+        self.assertEqual(
+            get_prioritized_command(["rsync", "-av"], backup_config, Path("/home/foo"), Path("/media/hd1")),
+            expected_command,
+        )
+
+    @patch("shutil.which", return_value=None)
+    def test_io_max_without_systemd(self, _):
+        backup_config = BackupConfig(
+            source=Path("/home/foo"), list_of_harddrive=[], list_of_excluded_folders=[], quick_restore_path=[], io_max=1
+        )
+        command = ["python", "-m", "backup_to_harddrive.native_copy"]
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(get_prioritized_command(command, backup_config, Path("/"), Path("/")), command)
+
+
+class TestDiskStatistics(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.root = Path(self.temporary_directory.name)
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def test_read_disk_counters(self):
+        (self.root / "diskstats").write_text(DISKSTATS, encoding="utf-8")
+        with patch("backup_to_harddrive.throttle.DISKSTATS_PATH", self.root / "diskstats"):
+            self.assertEqual(read_disk_counters({"sda", "sdb"}), {"sda": (3000, 2000)})
+        with patch("backup_to_harddrive.throttle.DISKSTATS_PATH", self.root / "missing"):
+            self.assertEqual(read_disk_counters({"sda"}), {})
+
+    def test_get_disk_latency_ms(self):
+        previous = {"sda": (3000, 2000), "sdb": (10, 10)}
+        self.assertEqual(get_disk_latency_ms(previous, {"sda": (3100, 4000), "sdb": (20, 20), "sdc": (1, 1)}), 20)
+        self.assertEqual(get_disk_latency_ms(previous, previous), 0)
+
+    def test_get_disk_name_of(self):
+        (self.root / "block" / "sda" / "sda1").mkdir(parents=True)
+        (self.root / "block" / "sda" / "sda1" / "partition").write_text("1", encoding="utf-8")
+        (self.root / "dev").mkdir()
+        (self.root / "dev" / "8:1").symlink_to(self.root / "block" / "sda" / "sda1")
+        (self.root / "dev" / "8:0").symlink_to(self.root / "block" / "sda")
+        devices = {"/home/foo": 0x801, "/media/hd1": 0x800, "/media/hd2": 0x802}
+        stat = os.stat
+
+        def stat_mock(path, *args, **kwargs):
+            if str(path) in devices:
+                return MagicMock(st_dev=devices[str(path)])
+            return stat(path, *args, **kwargs)
+
+        with (
+            patch("os.stat", side_effect=stat_mock),
+            patch("backup_to_harddrive.throttle.SYS_BLOCK_PATH", self.root / "dev"),
+        ):
+            self.assertEqual(
+                [get_disk_name_of(Path(path)) for path in devices],
+                ["sda", "sda", None],
+            )
+
+
+class TestGovernor(unittest.TestCase):
+    def setUp(self):
+        self.governor = Governor(max_load=4, max_disk_latency_ms=100, disks={"sda"}, process_groups={42})
+        patcher = patch("backup_to_harddrive.throttle.read_disk_counters", return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @parameterized.expand(
+        [
+            ["load above threshold", False, 4.5, 0, True],
+            ["disk latency above threshold", False, 0.5, 150, True],
+            ["between the thresholds", True, 3.5, 0, True],
+            ["load dropped", True, 3.0, 50, False],
+        ]
+    )
+    @patch("os.killpg")
+    # pylint: disable=too-many-positional-arguments
+    def test_update_governor(self, _, paused, load, latency, expected_paused, mock_killpg):
+        self.governor.paused = paused
+        with (
+            patch("os.getloadavg", return_value=(load, 0, 0)),
+            patch("backup_to_harddrive.throttle.get_disk_latency_ms", return_value=latency),
+        ):
+            update_governor(self.governor)
+        self.assertEqual(self.governor.paused, expected_paused)
+        if paused == expected_paused:
+            mock_killpg.assert_not_called()
+        else:
+            mock_killpg.assert_called_once_with(42, signal.SIGSTOP if expected_paused else signal.SIGCONT)
+
+    @patch("os.killpg", side_effect=ProcessLookupError)
+    def test_new_job_is_paused_with_the_other_ones(self, mock_killpg):
+        add_process_group_to(self.governor, 43)
+        self.governor.paused = True
+        add_process_group_to(self.governor, 44)
+        mock_killpg.assert_called_once_with(44, signal.SIGSTOP)
+        self.assertEqual(self.governor.process_groups, {42, 43, 44})
+
+    @patch("backup_to_harddrive.throttle.GOVERNOR_CHECK_INTERVAL_IN_SECONDS", 0.01)
+    @patch("os.killpg")
+    def test_jobs_are_resumed_when_the_governor_stops(self, mock_killpg):
+        async def run():
+            task = asyncio.create_task(run_governor(self.governor))
+            await asyncio.sleep(0.1)
+            task.cancel()
+
+        with patch("os.getloadavg", return_value=(8.0, 0, 0)), self.assertLogs(level="INFO"):
+            asyncio.run(run())
+        self.assertFalse(self.governor.paused)
+        self.assertEqual(
+            [call.args for call in mock_killpg.call_args_list], [(42, signal.SIGSTOP), (42, signal.SIGCONT)]
+        )
@@ -0,0 +1,302 @@
+"""Unit tests for the verification of the backups against their sources."""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from backup_to_harddrive.config import BackupConfig, RunConfig
+from backup_to_harddrive.dedup_store import get_path_to_chunk, get_path_to_run_manifest
+from backup_to_harddrive.dedup_store import main as dedup_store_main
+from backup_to_harddrive.dedup_store import read_store_manifest
+from backup_to_harddrive.verify import (
+    Mismatch,
+    get_backup_directory_of,
+    get_cached_digest,
+    get_path_to_hash_cache,
+    get_volume_of,
+    hash_file,
+    open_hash_cache,
+    store_digests,
+    verify_backup_of,
+    verify_backups_from_config_file,
+)
+
+
+class TestVerifyBackupOf(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        root = Path(self.temporary_directory.name)
+        self.source = root / "foo"
+        self.harddrive = root / "hd1"
+        self.backup = self.harddrive / "Backup" / "host" / "foo"
+        (self.source / "Documents").mkdir(parents=True)
+        (self.source / "photo.jpg").write_bytes(b"photo" * 1000)
+        (self.source / "Documents" / "doc.txt").write_text("document", encoding="utf-8")
+        (self.source / "link").symlink_to("photo.jpg")
+        shutil.copytree(self.source, self.backup, symlinks=True)
+        patcher = patch(
+            "backup_to_harddrive.verify.path_to_backup_within_harddrive",
+            return_value=self.harddrive / "Backup" / "host",
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connection = open_hash_cache(root / "cache" / "hash_cache.sqlite")
+        self.pool = ThreadPoolExecutor()
+        self.backup_config = BackupConfig(
+            source=self.source, list_of_harddrive=[self.harddrive], list_of_excluded_folders=[], quick_restore_path=[]
+        )
+
+    def tearDown(self):
+        self.pool.shutdown()
+        self.connection.close()
+        self.temporary_directory.cleanup()
+
+    def verify(self):
+        """Verify the backup of the source on the harddrive."""
+        return verify_backup_of(self.backup_config, self.harddrive, self.connection, self.pool)
+
+    def test_matching_backup(self):
+        self.assertEqual(self.verify(), (2, []))
+
+    def test_unchanged_files_are_not_hashed_again(self):
+        self.verify()
+        with patch("backup_to_harddrive.verify.hash_file") as mock_hash_file:
+            self.assertEqual(self.verify(), (2, []))
+        mock_hash_file.assert_not_called()
+
+    def test_mismatches(self):
+        stat = (self.backup / "photo.jpg").stat()
+        (self.backup / "photo.jpg").write_bytes(b"bitrot" + b"photo" * 998 + b"!" * 4)
+        os.utime(self.backup / "photo.jpg", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        (self.source / "new.txt").write_text("new", encoding="utf-8")
+        (self.source / "Documents" / "doc.txt").write_text("changed document", encoding="utf-8")
+        (self.backup / "link").unlink()
+        (self.backup / "link").symlink_to("elsewhere")
+        self.assertEqual(
+            self.verify(),
+            (
+                2,
+                [
+                    Mismatch("modified", self.source, self.harddrive, "Documents/doc.txt"),
+                    Mismatch("modified", self.source, self.harddrive, "link"),
+                    Mismatch("missing", self.source, self.harddrive, "new.txt"),
+                    Mismatch("corrupt", self.source, self.harddrive, "photo.jpg"),
+                ],
+            ),
+        )
+
+    def test_unreadable_files(self):
+        shutil.rmtree(self.backup / "Documents")
+        (self.backup / "Documents").write_text("not a directory", encoding="utf-8")
+        with patch("backup_to_harddrive.verify.hash_file", return_value=None), self.assertLogs(level="ERROR"):
+            _, mismatches = self.verify()
+        self.assertEqual([mismatch.status for mismatch in mismatches], ["unreadable", "unreadable"])
+
+    def test_no_backup_to_verify(self):
+        self.backup_config.snapshot = True
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(self.verify(), (0, []))
+
+    @patch("backup_to_harddrive.verify.extract_valid_configuration_from_config_file")
+    @patch("backup_to_harddrive.verify.ProcessPoolExecutor", ThreadPoolExecutor)
+    def test_verify_backups_from_config_file(self, mock_extract):
+        mock_extract.return_value = RunConfig(backup_configs=[self.backup_config])
+        cache_path = Path(self.temporary_directory.name) / "cache" / "other.sqlite"
+        with patch("backup_to_harddrive.verify.get_path_to_hash_cache", return_value=cache_path):
+            self.assertEqual(verify_backups_from_config_file(), 0)
+            (self.backup / "photo.jpg").unlink()
+            with patch("builtins.print") as mock_print:
+                self.assertEqual(verify_backups_from_config_file(), 1)
+        mock_print.assert_any_call("  missing     photo.jpg")
+
+
+class TestVerifyStoreBackupOf(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.addCleanup(self.temporary_directory.cleanup)
+        root = Path(self.temporary_directory.name)
+        self.harddrive = root / "hd1"
+        self.source = root / "foo"
+        self.manifest_path = get_path_to_run_manifest(self.harddrive / "Backup" / "host", "2024-01-01", "foo")
+        (self.source / "Documents").mkdir(parents=True)
+        (self.source / "photo.jpg").write_bytes(os.urandom(300 * 1024))
+        (self.source / "Documents" / "doc.txt").write_text("document", encoding="utf-8")
+        (self.source / "notes.txt").write_text("notes", encoding="utf-8")
+        (self.source / "link").symlink_to("photo.jpg")
+        os.mkfifo(self.source / "fifo")
+        patcher = patch(
+            "backup_to_harddrive.verify.path_to_backup_within_harddrive",
+            return_value=self.harddrive / "Backup" / "host",
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = ThreadPoolExecutor()
+        self.addCleanup(self.pool.shutdown)
+        self.backup_config = BackupConfig(
+            source=self.source,
+            list_of_harddrive=[self.harddrive],
+            list_of_excluded_folders=[],
+            quick_restore_path=[],
+            target_format="dedup",
+        )
+
+    def backup(self, *options):
+        """Backup the source to the store of the harddrive."""
+        with patch("builtins.print"):
+            dedup_store_main(
+                [
+                    "backup",
+                    *options,
+                    str(self.source),
+                    str(self.harddrive / "Backup" / ".store"),
+                    str(self.manifest_path),
+                ]
+            )
+
+    def chunk_path_of(self, relative_path):
+        """Get the path of the first chunk of a file of the source."""
+        chunk_hash = read_store_manifest(self.manifest_path)[relative_path].chunks[0]
+        return get_path_to_chunk(self.harddrive / "Backup" / ".store", chunk_hash)
+
+    def verify(self):
+        """Verify the backup of the source on the harddrive."""
+        return verify_backup_of(self.backup_config, self.harddrive, None, self.pool)
+
+    def test_matching_backup(self):
+        self.backup()
+        self.assertEqual(self.verify(), (3, []))
+        self.backup("--pack")
+        self.assertEqual(self.verify(), (3, []))
+
+    def test_mismatches(self):
+        self.backup()
+        self.chunk_path_of("photo.jpg").write_bytes(b"bitrot")
+        self.chunk_path_of("Documents/doc.txt").unlink()
+        (self.source / "notes.txt").write_text("changed notes", encoding="utf-8")
+        (self.source / "new.txt").write_text("new", encoding="utf-8")
+        (self.source / "link").unlink()
+        (self.source / "link").symlink_to("elsewhere")
+        self.assertEqual(
+            self.verify(),
+            (
+                3,
+                [
+                    Mismatch("missing", self.source, self.harddrive, "Documents/doc.txt"),
+                    Mismatch("modified", self.source, self.harddrive, "link"),
+                    Mismatch("missing", self.source, self.harddrive, "new.txt"),
+                    Mismatch("modified", self.source, self.harddrive, "notes.txt"),
+                    Mismatch("corrupt", self.source, self.harddrive, "photo.jpg"),
+                ],
+            ),
+        )
+
+    def test_unreadable_chunks_and_links(self):
+        self.backup()
+        with (
+            patch("backup_to_harddrive.verify.read_chunk", side_effect=OSError("corrupt chunk")),
+            patch("os.readlink", side_effect=PermissionError),
+            self.assertLogs(level="ERROR"),
+        ):
+            _, mismatches = self.verify()
+        self.assertEqual([mismatch.status for mismatch in mismatches], ["unreadable"] * 4)
+
+    def test_no_run_to_verify(self):
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(self.verify(), (0, []))
+
+    def test_unreadable_run_manifest(self):
+        self.manifest_path.parent.mkdir(parents=True)
+        self.manifest_path.write_bytes(b"corrupt")
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(
+                self.verify(), (0, [Mismatch("unreadable", self.source, self.harddrive, str(self.manifest_path))])
+            )
+
+
+class TestHashCache(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()  # pylint: disable=(consider-using-with)
+        self.file_path = Path(self.temporary_directory.name) / "file.bin"
+        self.file_path.write_bytes(b"content")
+        self.connection = open_hash_cache(Path(self.temporary_directory.name) / "hash_cache.sqlite")
+
+    def tearDown(self):
+        self.connection.close()
+        self.temporary_directory.cleanup()
+
+    def test_cached_digest_expires(self):
+        file_stat = self.file_path.stat()
+        store_digests(self.connection, "volume", [(file_stat, "digest")])
+        self.assertEqual(get_cached_digest(self.connection, "volume", file_stat, None), "digest")
+        with patch("backup_to_harddrive.verify.time.time", return_value=time.time() + 3600):
+            self.assertIsNone(get_cached_digest(self.connection, "volume", file_stat, 60))
+
+    def test_changed_file_is_not_cached(self):
+        store_digests(self.connection, "volume", [(self.file_path.stat(), "digest")])
+        self.file_path.write_bytes(b"changed content")
+        self.assertIsNone(get_cached_digest(self.connection, "volume", self.file_path.stat(), None))
+
+    def test_same_inode_on_another_volume_is_not_cached(self):
+        store_digests(self.connection, "hd1-uuid", [(self.file_path.stat(), "digest")])
+        self.assertIsNone(get_cached_digest(self.connection, "hd2-uuid", self.file_path.stat(), None))
+
+    def test_cache_without_volumes_is_emptied(self):
+        self.connection.execute("DROP TABLE hashes")
+        self.connection.execute("CREATE TABLE hashes (device INTEGER, inode INTEGER, digest TEXT)")
+        self.connection.execute("INSERT INTO hashes VALUES (1, 2, 'digest')")
+        self.connection.commit()
+        connection = open_hash_cache(Path(self.temporary_directory.name) / "hash_cache.sqlite")
+        self.addCleanup(connection.close)
+        self.assertEqual(connection.execute("SELECT COUNT(*) FROM hashes").fetchone(), (0,))
+        self.assertIn("volume", [row[1] for row in connection.execute("PRAGMA table_info(hashes)")])
+
+    def test_volume_is_the_uuid_of_the_filesystem(self):
+        uuids = Path(self.temporary_directory.name) / "by-uuid"
+        uuids.mkdir()
+        (uuids / "other-uuid").touch()
+        (uuids / "1234-abcd").touch()
+        with (
+            patch("backup_to_harddrive.verify.FILESYSTEM_UUIDS_DIRECTORY", uuids),
+            patch(
+                "backup_to_harddrive.verify.os.stat",
+                side_effect=lambda path: MagicMock(st_dev=7, st_rdev=7 if str(path).endswith("1234-abcd") else 8),
+            ),
+        ):
+            self.assertEqual(get_volume_of(self.file_path.parent), "1234-abcd")
+        with patch("backup_to_harddrive.verify.FILESYSTEM_UUIDS_DIRECTORY", uuids):
+            self.assertEqual(get_volume_of(self.file_path.parent), str(self.file_path.parent.absolute()))
+        with patch("backup_to_harddrive.verify.FILESYSTEM_UUIDS_DIRECTORY", uuids / "missing"):
+            self.assertEqual(get_volume_of(self.file_path.parent), str(self.file_path.parent.absolute()))
+
+    @patch("backup_to_harddrive.verify.user_cache_dir", return_value="/home/foo/.cache/backup_to_harddrive")
+    def test_get_path_to_hash_cache(self, _):
+        self.assertEqual(get_path_to_hash_cache(), Path("/home/foo/.cache/backup_to_harddrive/hash_cache.sqlite"))
+
+    def test_hash_file(self):
+        self.assertEqual(hash_file(str(self.file_path)), hash_file(str(self.file_path)))
+        with self.assertLogs(level="ERROR"):
+            self.assertIsNone(hash_file(str(self.file_path.with_name("missing"))))
+
+
+class TestGetBackupDirectoryOf(unittest.TestCase):
+    def setUp(self):
+        self.backup_config = BackupConfig(
+            source=Path("/home/foo"), list_of_harddrive=[], list_of_excluded_folders=[], quick_restore_path=[]
+        )
+
+    def test_get_backup_directory_of(self):
+        with patch("backup_to_harddrive.verify.path_to_backup_within_harddrive", return_value=Path("/hd/Backup/h")):
+            self.assertEqual(get_backup_directory_of(self.backup_config, Path("/hd")), Path("/hd/Backup/h/foo"))
+            self.backup_config.target_format = "dedup"
+            self.assertIsNone(get_backup_directory_of(self.backup_config, Path("/hd")))
+
+    @patch("backup_to_harddrive.verify.get_latest_complete_snapshot_of", return_value=Path("/hd/Backup/h/2024"))
+    def test_latest_snapshot_is_verified(self, _):
+        self.backup_config.snapshot = True
+        with patch("backup_to_harddrive.verify.path_to_backup_within_harddrive", return_value=Path("/hd/Backup/h")):
+            self.assertEqual(get_backup_directory_of(self.backup_config, Path("/hd")), Path("/hd/Backup/h/2024/foo"))